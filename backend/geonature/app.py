@@ -36,6 +36,7 @@ from geonature.utils.env import MAIL, DB, db, MA, migrate, BACKEND_DIR
 from geonature.utils.logs import config_loggers
 from geonature.utils.module import iter_modules_dist
 from geonature.core.admin.admin import admin
+from geonature.core.gn_permissions.cache import permissions_cache
 from geonature.middlewares import SchemeFix, RequestID
 
 from pypnusershub.db.tools import (
@@ -128,6 +129,7 @@ def create_app(with_external_mods=True):
     db.init_app(app)
     migrate.init_app(app, DB, directory=BACKEND_DIR / "geonature" / "migrations")
     MA.init_app(app)
+    permissions_cache.init_app(app)
     CORS(app, supports_credentials=True)
 
     if "CELERY" in app.config:
@@ -203,7 +205,7 @@ def create_app(with_external_mods=True):
         ("geonature.core.auth.routes:routes", "/gn_auth"),
         ("geonature.core.gn_monitoring.routes:routes", "/gn_monitoring"),
         ("geonature.core.gn_profiles.routes:routes", "/gn_profiles"),
-        ("geonature.core.sensitivity.routes:routes", None),
+        ("geonature.core.sensitivity.routes:routes", "/sensitivity"),
         ("geonature.core.notifications.routes:routes", "/notifications"),
     ]:
         module_name, blueprint_name = blueprint_path.split(":")
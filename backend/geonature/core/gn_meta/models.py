@@ -201,6 +201,30 @@ class CorDatasetActor(DB.Model):
         return "{} ({})".format(actor, self.nomenclature_actor_role.label_default)
 
 
+class CorRoleDatasetScope(DB.Model):
+    """
+    Datasets readable by each role, maintained by triggers:
+    scope 1 if the role is digitizer or actor of the dataset or of its acquisition framework,
+    scope 2 if only its organism is actor.
+    Same datasets as TDatasets.query.filter_by_scope without querying all the actors.
+    """
+
+    __tablename__ = "cor_role_dataset_scope"
+    __table_args__ = {"schema": "gn_meta"}
+    id_role = DB.Column(DB.Integer, ForeignKey(User.id_role), primary_key=True)
+    id_dataset = DB.Column(
+        DB.Integer, ForeignKey("gn_meta.t_datasets.id_dataset"), primary_key=True
+    )
+    scope = DB.Column(DB.SmallInteger, nullable=False)
+
+    @classmethod
+    def select_id_datasets(cls, id_role, scope):
+        """
+        Select the id of the datasets readable by the role with the given scope (1 or 2)
+        """
+        return select([cls.id_dataset]).where(and_(cls.id_role == id_role, cls.scope <= scope))
+
+
 @serializable
 class CorDatasetProtocol(DB.Model):
     __tablename__ = "cor_dataset_protocol"
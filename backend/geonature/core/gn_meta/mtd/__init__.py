@@ -1,14 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from urllib.parse import urljoin
+from uuid import UUID
 
 import logging
 
 import requests
-from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from datetime import *
 
-import time
-
 from geonature.utils.config import config
 from geonature.utils.env import db
 from geonature.core.gn_meta.models import (
@@ -21,8 +23,24 @@ from pypnusershub.db.models import User
 
 from pypnnomenclature.models import TNomenclatures
 
-from .xml_parser import parse_acquisition_framework, parse_jdd_xml, parse_acquisition_framwork_xml
-from .mtd_utils import sync_af, sync_ds, associate_actors
+from .xml_parser import (
+    parse_jdd_xml,
+    parse_acquisition_framwork_xml,
+    iter_acquisition_frameworks,
+    iter_jdd,
+)
+from .mtd_utils import (
+    sync_af,
+    sync_ds,
+    associate_actors,
+    bulk_sync_af,
+    bulk_sync_ds,
+    bulk_sync_organisms,
+    bulk_associate_actors,
+    get_nomenclatures_ids,
+    NOMENCLATURE_MAPPING,
+    BULK_CHUNK_SIZE,
+)
 
 # create logger
 logger = logging.getLogger("MTD_SYNC")
@@ -36,6 +54,24 @@ logger.addHandler(handler)
 logger.propagate = False
 
 
+def get_http_session():
+    """
+    HTTP session shared by all the requests of a sync: connections are pooled and
+    reused, and requests are retried on connection errors and server errors.
+    """
+    pool_size = config["MTD"]["SYNC_MAX_WORKERS"]
+    retries = Retry(
+        total=config["MTD"]["SYNC_MAX_RETRIES"],
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 class MTDInstanceApi:
     af_path = "/mtd/cadre/export/xml/GetRecordsByInstanceId?id={ID_INSTANCE}"
     ds_path = "/mtd/cadre/jdd/export/xml/GetRecordsByInstanceId?id={ID_INSTANCE}"
@@ -43,14 +79,15 @@ class MTDInstanceApi:
     single_af_path = "/mtd/cadre/export/xml/GetRecordById?id={ID_AF}"
 
     # https://inpn.mnhn.fr/mtd/cadre/jdd/export/xml/GetRecordsByUserId?id=41542"
-    def __init__(self, api_endpoint, instance_id, id_role=None):
+    def __init__(self, api_endpoint, instance_id, id_role=None, session=None):
         self.api_endpoint = api_endpoint
         self.instance_id = instance_id
         self.id_role = id_role
+        self.session = session or get_http_session()
 
     def _get_xml_by_url(self, url):
         logger.debug("MTD - REQUEST : %s" % url)
-        response = requests.get(url)
+        response = self.session.get(url, timeout=config["MTD"]["SYNC_TIMEOUT"])
         response.raise_for_status()
         return response.content
 
@@ -59,24 +96,35 @@ class MTDInstanceApi:
         url = url.format(ID_INSTANCE=self.instance_id)
         return self._get_xml_by_url(url)
 
+    def _iter_xml(self, path, parser):
+        """
+        Stream the xml at `path` into `parser`, without loading it in memory
+        """
+        url = urljoin(self.api_endpoint, path)
+        url = url.format(ID_INSTANCE=self.instance_id)
+        logger.debug("MTD - REQUEST : %s" % url)
+        with self.session.get(url, stream=True, timeout=config["MTD"]["SYNC_TIMEOUT"]) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            yield from parser(response.raw)
+
     def _get_af_xml(self):
         return self._get_xml(self.af_path)
 
+    def iter_af_list(self):
+        return self._iter_xml(self.af_path, iter_acquisition_frameworks)
+
     def get_af_list(self):
-        xml = self._get_af_xml()
-        root = etree.fromstring(xml)
-        af_iter = root.iterfind(".//{http://inpn.mnhn.fr/mtd}CadreAcquisition")
-        af_list = []
-        for af in af_iter:
-            af_list.append(parse_acquisition_framework(af))
-        return af_list
+        return list(self.iter_af_list())
 
     def _get_ds_xml(self):
         return self._get_xml(self.ds_path)
 
+    def iter_ds_list(self):
+        return self._iter_xml(self.ds_path, iter_jdd)
+
     def get_ds_list(self):
-        xml = self._get_ds_xml()
-        return parse_jdd_xml(xml)
+        return list(self.iter_ds_list())
 
     def get_ds_user_list(self):
         url = urljoin(self.api_endpoint, self.ds_user_path)
@@ -90,110 +138,230 @@ class MTDInstanceApi:
         xml = self._get_xml_by_url(url)
         return parse_acquisition_framwork_xml(xml)
 
+    def get_af_list_by_uuids(self, af_uuids):
+        """
+        Fetch concurrently the given AF, each one once, in the order of `af_uuids`
+        """
+        af_uuids = list(dict.fromkeys(af_uuids))
+        with ThreadPoolExecutor(max_workers=config["MTD"]["SYNC_MAX_WORKERS"]) as executor:
+            return list(executor.map(self.get_user_af_list, af_uuids))
+
 
 class INPNCAS:
     base_url = config["CAS"]["CAS_USER_WS"]["BASE_URL"]
     user = config["CAS"]["CAS_USER_WS"]["ID"]
     password = config["CAS"]["CAS_USER_WS"]["PASSWORD"]
     id_search_path = "rechercheParId/{user_id}"
+    _session = None
+
+    @classmethod
+    def _get_session(cls):
+        if cls._session is None:
+            cls._session = get_http_session()
+        return cls._session
 
     @classmethod
     def _get_user_json(cls, user_id):
         url = urljoin(cls.base_url, cls.id_search_path)
         url = url.format(user_id=user_id)
-        response = requests.get(url, auth=(cls.user, cls.password))
+        response = cls._get_session().get(
+            url, auth=(cls.user, cls.password), timeout=config["MTD"]["SYNC_TIMEOUT"]
+        )
         return response.json()
 
     @classmethod
     def get_user(cls, user_id):
         return cls._get_user_json(user_id)
 
+    @classmethod
+    def get_users(cls, user_ids):
+        """Fetch concurrently the given users"""
+        with ThreadPoolExecutor(max_workers=config["MTD"]["SYNC_MAX_WORKERS"]) as executor:
+            return list(executor.map(cls.get_user, user_ids))
 
-def add_unexisting_digitizer(id_digitizer):
+
+def add_unexisting_digitizers(id_digitizers):
     """
-    Method to trigger global MTD sync.
+    Create the digitizers which are not yet in the database, fetching them
+    concurrently from the INPN CAS web service.
 
-    :param id_digitizer: as id role from meta info
+    :param id_digitizers: id roles from meta info
     """
-    if not db.session.query(User.query.filter_by(id_role=id_digitizer).exists()).scalar():
-        # not fast - need perf optimization on user call
-        user = INPNCAS.get_user(id_digitizer)
+    id_digitizers = {int(id_digitizer) for id_digitizer in id_digitizers if id_digitizer}
+    if not id_digitizers:
+        return
+    known_digitizers = {
+        id_role
+        for (id_role,) in db.session.query(User.id_role).filter(User.id_role.in_(id_digitizers))
+    }
+    for user in INPNCAS.get_users(sorted(id_digitizers - known_digitizers)):
         # to avoid to create org
         if user.get("codeOrganisme"):
             user["codeOrganisme"] = None
         # insert or update user
-        insert_user_and_org(user)
+        with db.session.begin_nested():
+            insert_user_and_org(user)
+
+
+def add_unexisting_digitizer(id_digitizer):
+    """
+    Create the digitizer if it is not yet in the database.
+
+    :param id_digitizer: as id role from meta info
+    """
+    add_unexisting_digitizers([id_digitizer])
+
+
+def iter_chunks(iterable, size=BULK_CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
-def process_af_and_ds(af_list, ds_list, id_role=None):
+def process_af_and_ds(af_list, ds_list, id_role=None, bulk=False):
     """
-    Synchro AF<array>, Synchro DS<array>
+    Synchro AF<iterable>, Synchro DS<iterable>
+
+    AF and DS are processed by chunks, so that they can be generators
+    parsing the MTD exports as they are downloaded.
 
     :param af_list: list af
     :param ds_list: list ds
     :param id_role: use role id pass on user authent only
+    :param bulk: sync AF and DS with a few set-based statements by chunk,
+        see :func:`bulk_process_af_and_ds`
     """
-    cas_api = INPNCAS()
-    # read nomenclatures from DB to avoid errors if GN nomenclature is not the same
-    list_cd_nomenclature = [
-        record[0] for record in db.session.query(TNomenclatures.cd_nomenclature).distinct()
-    ]
-    user_add_total_time = 0
+    if id_role:
+        add_unexisting_digitizers([id_role])
+    if bulk:
+        nomenclatures = get_nomenclatures_ids({*NOMENCLATURE_MAPPING.values(), "ROLE_ACTEUR"})
+    else:
+        # read nomenclatures from DB to avoid errors if GN nomenclature is not the same
+        list_cd_nomenclature = [
+            record[0] for record in db.session.query(TNomenclatures.cd_nomenclature).distinct()
+        ]
+    # id_organisme by uuid of the organisms already synchronised
+    organisms = {}
     logger.debug("MTD - PROCESS AF LIST")
-    for af in af_list:
-        actors = af.pop("actors")
-        with db.session.begin_nested():
-            start_add_user_time = time.time()
-            if not id_role:
-                add_unexisting_digitizer(af["id_digitizer"])
-            else:
-                add_unexisting_digitizer(id_role)
-            user_add_total_time += time.time() - start_add_user_time
-        af = sync_af(af)
-        associate_actors(
-            actors,
-            CorAcquisitionFrameworkActor,
-            "id_acquisition_framework",
-            af.id_acquisition_framework,
-        )
-        # TODO: remove actors removed from MTD
-    db.session.commit()
+    for af_chunk in iter_chunks(af_list):
+        # CREATE DIGITIZERS
+        if not id_role:
+            add_unexisting_digitizers([af["id_digitizer"] for af in af_chunk])
+        if bulk:
+            bulk_process_af(af_chunk, nomenclatures)
+        else:
+            for af in af_chunk:
+                actors = af.pop("actors")
+                af = sync_af(af)
+                associate_actors(
+                    actors,
+                    CorAcquisitionFrameworkActor,
+                    "id_acquisition_framework",
+                    af.id_acquisition_framework,
+                    organisms=organisms,
+                )
+                # TODO: remove actors removed from MTD
+        db.session.commit()
     logger.debug("MTD - PROCESS DS LIST")
-    for ds in ds_list:
-        actors = ds.pop("actors")
-        # CREATE DIGITIZER
-        with db.session.begin_nested():
-            start_add_user_time = time.time()
-            if not id_role:
-                add_unexisting_digitizer(ds["id_digitizer"])
-            else:
-                add_unexisting_digitizer(id_role)
-            user_add_total_time += time.time() - start_add_user_time
-        ds = sync_ds(ds, list_cd_nomenclature)
-        if ds is not None:
-            associate_actors(actors, CorDatasetActor, "id_dataset", ds.id_dataset)
-
-    user_add_total_time = round(user_add_total_time, 2)
+    for ds_chunk in iter_chunks(ds_list):
+        # CREATE DIGITIZERS
+        if not id_role:
+            add_unexisting_digitizers([ds["id_digitizer"] for ds in ds_chunk])
+        if bulk:
+            bulk_process_ds(ds_chunk, nomenclatures)
+        else:
+            for ds in ds_chunk:
+                actors = ds.pop("actors")
+                ds = sync_ds(ds, list_cd_nomenclature)
+                if ds is not None:
+                    associate_actors(
+                        actors, CorDatasetActor, "id_dataset", ds.id_dataset, organisms=organisms
+                    )
+        db.session.commit()
+
+
+def bulk_process_af_and_ds(af_list, ds_list):
+    """
+    Synchro AF<array>, Synchro DS<array> with one INSERT ... ON CONFLICT DO UPDATE
+    statement by table, instead of several queries by AF or DS. Organisms actors
+    no longer in MTD are removed.
+
+    :param af_list: list af
+    :param ds_list: list ds
+    """
+    nomenclatures = get_nomenclatures_ids({*NOMENCLATURE_MAPPING.values(), "ROLE_ACTEUR"})
+    logger.debug("MTD - PROCESS AF LIST")
+    bulk_process_af(af_list, nomenclatures)
+    logger.debug("MTD - PROCESS DS LIST")
+    bulk_process_ds(ds_list, nomenclatures)
     db.session.commit()
 
 
-def sync_af_and_ds():
+def bulk_process_af(af_list, nomenclatures):
+    """
+    Synchro AF<array> with one INSERT ... ON CONFLICT DO UPDATE statement by table,
+    instead of several queries by AF. Organisms actors no longer in MTD are removed.
+
+    :param af_list: list af
+    :param nomenclatures: as returned by :func:`get_nomenclatures_ids`
+    """
+    af_actors = {af["unique_acquisition_framework_id"]: af.pop("actors") for af in af_list}
+    organisms = bulk_sync_organisms([actor for actors in af_actors.values() for actor in actors])
+    af_ids = bulk_sync_af(af_list)
+    bulk_associate_actors(
+        {af_ids[UUID(af_uuid)]: actors for af_uuid, actors in af_actors.items()},
+        CorAcquisitionFrameworkActor,
+        "id_acquisition_framework",
+        organisms,
+        nomenclatures,
+    )
+
+
+def bulk_process_ds(ds_list, nomenclatures):
+    """
+    Synchro DS<array> with one INSERT ... ON CONFLICT DO UPDATE statement by table,
+    instead of several queries by DS. Organisms actors no longer in MTD are removed.
+
+    :param ds_list: list ds
+    :param nomenclatures: as returned by :func:`get_nomenclatures_ids`
+    """
+    ds_actors = {ds["unique_dataset_id"]: ds.pop("actors") for ds in ds_list}
+    organisms = bulk_sync_organisms([actor for actors in ds_actors.values() for actor in actors])
+    ds_ids = bulk_sync_ds(ds_list, {}, nomenclatures)
+    bulk_associate_actors(
+        {
+            ds_ids[UUID(ds_uuid)]: actors
+            for ds_uuid, actors in ds_actors.items()
+            if UUID(ds_uuid) in ds_ids
+        },
+        CorDatasetActor,
+        "id_dataset",
+        organisms,
+        nomenclatures,
+    )
+
+
+def sync_af_and_ds(bulk=False):
     """
     Method to trigger global MTD sync.
     """
     logger.info("MTD - SYNC GLOBAL : START")
     mtd_api = MTDInstanceApi(config["MTD_API_ENDPOINT"], config["MTD"]["ID_INSTANCE_FILTER"])
 
-    af_list = mtd_api.get_af_list()
+    # AF and DS are parsed while downloaded and processed by chunks
+    af_list = mtd_api.iter_af_list()
 
-    ds_list = mtd_api.get_ds_list()
+    ds_list = mtd_api.iter_ds_list()
 
     # synchro a partir des listes
-    process_af_and_ds(af_list, ds_list)
+    process_af_and_ds(af_list, ds_list, bulk=bulk)
     logger.info("MTD - SYNC GLOBAL : FINISH")
 
 
-def sync_af_and_ds_by_user(id_role):
+def sync_af_and_ds_by_user(id_role, bulk=False):
     """
     Method to trigger MTD sync on user authent.
     """
@@ -213,9 +381,9 @@ def sync_af_and_ds_by_user(id_role):
     # af_list = [af for af in af_list if af["unique_acquisition_framework_id"] in user_af_uuids]
 
     # call INPN API for each AF to retrieve info
-    af_list = [mtd_api.get_user_af_list(af_uuid) for af_uuid in user_af_uuids]
+    af_list = mtd_api.get_af_list_by_uuids(user_af_uuids)
 
     # start AF and DS lists
-    process_af_and_ds(af_list, ds_list, id_role)
+    process_af_and_ds(af_list, ds_list, id_role, bulk=bulk)
 
     logger.info("MTD - SYNC USER : FINISH")
@@ -1,10 +1,13 @@
 import logging
 import json
+from collections import defaultdict
 from copy import copy
+from uuid import UUID
 from flask import current_app
 
+from sqlalchemy import inspect
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.sql import func, update
+from sqlalchemy.sql import func, update, literal_column
 
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 
@@ -15,8 +18,9 @@ from geonature.core.gn_meta.models import (
     TAcquisitionFramework,
     CorAcquisitionFrameworkActor,
 )
-from geonature.core.gn_commons.models import TModules
+from geonature.core.gn_commons.models import TModules, cor_module_dataset
 from pypnusershub.db.models import Organisme as BibOrganismes
+from pypnnomenclature.models import BibNomenclaturesTypes, TNomenclatures
 from geonature.core.users import routes as users
 from geonature.core.auth.routes import insert_user_and_org, get_user_from_id_inpn_ws
 
@@ -33,6 +37,9 @@ NOMENCLATURE_MAPPING = {
 # get the root logger
 log = logging.getLogger()
 
+# rows by INSERT ... ON CONFLICT statement of the bulk sync
+BULK_CHUNK_SIZE = 1000
+
 
 def sync_ds(ds, cd_nomenclatures):
     """
@@ -154,7 +161,7 @@ def add_or_update_organism(uuid, nom, email):
     return DB.session.execute(statement).scalar()
 
 
-def associate_actors(actors, CorActor, pk_name, pk_value):
+def associate_actors(actors, CorActor, pk_name, pk_value, organisms=None):
     """
     Associate actor and DS or AF according to CorActor value.
 
@@ -162,18 +169,23 @@ def associate_actors(actors, CorActor, pk_name, pk_value):
     :param CorActor: table model
     :param pk_name: pk attribute name
     :param pk_value: pk value
+    :param organisms: optional cache of the organisms already created or updated
+        during the sync, as a dict {uuid: id_organisme}
     """
     for actor in actors:
         if not actor["uuid_organism"]:
             continue
-        # test if actor already exists
-        with DB.session.begin_nested():
-            # create or update organisme
-            id_organism = add_or_update_organism(
-                uuid=actor["uuid_organism"],
-                nom=actor["organism"] or "",
-                email=actor["email"],
-            )
+        id_organism = organisms.get(actor["uuid_organism"]) if organisms is not None else None
+        if id_organism is None:
+            with DB.session.begin_nested():
+                # create or update organisme
+                id_organism = add_or_update_organism(
+                    uuid=actor["uuid_organism"],
+                    nom=actor["organism"] or "",
+                    email=actor["email"],
+                )
+            if organisms is not None:
+                organisms[actor["uuid_organism"]] = id_organism
         # Test if actor already exists to avoid nextVal increase
         statement = (
             pg_insert(CorActor)
@@ -202,3 +214,216 @@ def associate_dataset_modules(dataset):
         .filter(TModules.module_code.in_(current_app.config["MTD"]["JDD_MODULE_CODE_ASSOCIATION"]))
         .all()
     )
+
+
+def get_nomenclatures_ids(mnemoniques):
+    """
+    Id of the nomenclatures of the given types, as {(mnemonique, cd_nomenclature): id_nomenclature}
+    """
+    query = (
+        DB.session.query(
+            BibNomenclaturesTypes.mnemonique,
+            TNomenclatures.cd_nomenclature,
+            TNomenclatures.id_nomenclature,
+        )
+        .join(BibNomenclaturesTypes, BibNomenclaturesTypes.id_type == TNomenclatures.id_type)
+        .filter(BibNomenclaturesTypes.mnemonique.in_(mnemoniques))
+    )
+    return {(mnemonique, cd): id_nomenclature for mnemonique, cd, id_nomenclature in query}
+
+
+def bulk_upsert(Model, rows, index_element, returning):
+    """
+    Create or update the rows with INSERT ... ON CONFLICT DO UPDATE statements: one
+    by chunk of rows having the same columns, so that missing values are left untouched.
+
+    :param Model: table model
+    :param rows: list of dict, unique on `index_element`
+    :param index_element: name of the unique column
+    :param returning: columns to return
+    :returns: list of the returned columns, followed by True if the row was created
+    """
+    rows_by_columns = defaultdict(list)
+    for row in rows:
+        rows_by_columns[tuple(sorted(row))].append(row)
+    results = []
+    for columns, rows in rows_by_columns.items():
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            statement = pg_insert(Model).values(rows[start : start + BULK_CHUNK_SIZE])
+            statement = statement.on_conflict_do_update(
+                index_elements=[index_element],
+                set_={
+                    column: statement.excluded[column]
+                    for column in columns
+                    if column != index_element
+                },
+            ).returning(*returning, literal_column("xmax = 0").label("inserted"))
+            results.extend(DB.session.execute(statement))
+    return results
+
+
+def bulk_sync_af(af_list):
+    """
+    Create or update the given AF according to UUID.
+
+    :param af_list: list of AF infos, without actors
+    :returns: id_acquisition_framework by UUID
+    """
+    af_list = {UUID(af["unique_acquisition_framework_id"]): af for af in af_list}
+    return {
+        UUID(str(af_uuid)): af_id
+        for af_id, af_uuid, _ in bulk_upsert(
+            TAcquisitionFramework,
+            af_list.values(),
+            "unique_acquisition_framework_id",
+            [
+                TAcquisitionFramework.id_acquisition_framework,
+                TAcquisitionFramework.unique_acquisition_framework_id,
+            ],
+        )
+    }
+
+
+def bulk_sync_ds(ds_list, af_ids, nomenclatures):
+    """
+    Create or update the given DS according to UUID, and associate the created ones
+    to the modules. DS whose AF or data origin are unknown are ignored.
+
+    :param ds_list: list of DS infos, without actors
+    :param af_ids: id_acquisition_framework by UUID of the AF already known
+    :param nomenclatures: as returned by :func:`get_nomenclatures_ids`
+    :returns: id_dataset by UUID
+    """
+    af_uuids = {UUID(ds["uuid_acquisition_framework"]) for ds in ds_list} - set(af_ids)
+    if af_uuids:
+        af_ids = dict(af_ids)
+        af_ids.update(
+            (UUID(str(af_uuid)), af_id)
+            for af_uuid, af_id in DB.session.query(
+                TAcquisitionFramework.unique_acquisition_framework_id,
+                TAcquisitionFramework.id_acquisition_framework,
+            ).filter(TAcquisitionFramework.unique_acquisition_framework_id.in_(af_uuids))
+        )
+    rows = {}
+    for ds in ds_list:
+        data_origin = (
+            NOMENCLATURE_MAPPING["id_nomenclature_data_origin"],
+            ds["id_nomenclature_data_origin"],
+        )
+        af_id = af_ids.get(UUID(ds["uuid_acquisition_framework"]))
+        if data_origin not in nomenclatures or af_id is None:
+            continue
+        row = {
+            k: nomenclatures.get((NOMENCLATURE_MAPPING[k], v))
+            if k.startswith("id_nomenclature")
+            else v
+            for k, v in ds.items()
+            if k != "uuid_acquisition_framework"
+        }
+        row["id_acquisition_framework"] = af_id
+        rows[UUID(ds["unique_dataset_id"])] = {k: v for k, v in row.items() if v is not None}
+    results = bulk_upsert(
+        TDatasets,
+        rows.values(),
+        "unique_dataset_id",
+        [TDatasets.id_dataset, TDatasets.unique_dataset_id],
+    )
+    # Associate the new datasets to the modules
+    new_ds_ids = [ds_id for ds_id, _, inserted in results if inserted]
+    module_ids = [
+        module_id
+        for (module_id,) in DB.session.query(TModules.id_module).filter(
+            TModules.module_code.in_(current_app.config["MTD"]["JDD_MODULE_CODE_ASSOCIATION"])
+        )
+    ]
+    if new_ds_ids and module_ids:
+        DB.session.execute(
+            cor_module_dataset.insert().values(
+                [
+                    {"id_module": module_id, "id_dataset": ds_id}
+                    for ds_id in new_ds_ids
+                    for module_id in module_ids
+                ]
+            )
+        )
+    return {UUID(str(ds_uuid)): ds_id for ds_id, ds_uuid, _ in results}
+
+
+def bulk_sync_organisms(actors):
+    """
+    Create or update the organisms of the given actors according to UUID.
+
+    :param actors: list of actors
+    :returns: id_organisme by UUID
+    """
+    organisms = {
+        UUID(actor["uuid_organism"]): {
+            "uuid_organisme": actor["uuid_organism"],
+            "nom_organisme": actor["organism"] or "",
+            "email_organisme": actor["email"],
+        }
+        for actor in actors
+        if actor["uuid_organism"]
+    }
+    return {
+        UUID(str(org_uuid)): org_id
+        for org_id, org_uuid, _ in bulk_upsert(
+            BibOrganismes,
+            organisms.values(),
+            "uuid_organisme",
+            [BibOrganismes.id_organisme, BibOrganismes.uuid_organisme],
+        )
+    }
+
+
+def bulk_associate_actors(actors, CorActor, pk_name, organisms, nomenclatures):
+    """
+    Set the organisms actors of DS or AF according to CorActor value: missing
+    actors are added, actors no longer in MTD are removed. Actors which are
+    users are left untouched.
+
+    :param actors: list of actors by pk value
+    :param CorActor: table model
+    :param pk_name: pk attribute name
+    :param organisms: as returned by :func:`bulk_sync_organisms`
+    :param nomenclatures: as returned by :func:`get_nomenclatures_ids`
+    """
+    if not actors:
+        return
+    pk_column = getattr(CorActor, pk_name)
+    expected = set()
+    for pk_value, pk_actors in actors.items():
+        for actor in pk_actors:
+            id_role_nomenclature = nomenclatures.get(("ROLE_ACTEUR", actor["actor_role"]))
+            if actor["uuid_organism"] and id_role_nomenclature:
+                expected.add(
+                    (pk_value, organisms[UUID(actor["uuid_organism"])], id_role_nomenclature)
+                )
+    (id_column,) = inspect(CorActor).primary_key
+    existing = {
+        (pk_value, id_organism, id_role_nomenclature): id_actor
+        for id_actor, pk_value, id_organism, id_role_nomenclature in DB.session.query(
+            id_column, pk_column, CorActor.id_organism, CorActor.id_nomenclature_actor_role
+        ).filter(
+            pk_column.in_(actors.keys()),
+            CorActor.id_organism.isnot(None),
+            CorActor.id_role.is_(None),
+        )
+    }
+    removed = [id_actor for actor, id_actor in existing.items() if actor not in expected]
+    if removed:
+        DB.session.execute(CorActor.__table__.delete().where(id_column.in_(removed)))
+    added = expected - existing.keys()
+    if added:
+        DB.session.execute(
+            pg_insert(CorActor).values(
+                [
+                    {
+                        pk_name: pk_value,
+                        "id_organism": id_organism,
+                        "id_nomenclature_actor_role": id_role_nomenclature,
+                    }
+                    for pk_value, id_organism, id_role_nomenclature in added
+                ]
+            )
+        )
@@ -131,76 +131,127 @@ def parse_jdd_xml(xml):
     root = ET.fromstring(xml, parser=_xml_parser)
     jdd_list = []
     for jdd in root.findall(".//" + namespace + "JeuDeDonnees"):
-        # We extract all the required informations from the different tags of the XML file
-        jdd_uuid = get_tag_content(jdd, "identifiantJdd")
-        ca_uuid = get_tag_content(jdd, "identifiantCadre")
-        dataset_name = get_tag_content(jdd, "libelle")
-        dataset_shortname = get_tag_content(jdd, "libelleCourt", default_value="")
-        dataset_desc = get_tag_content(jdd, "description", default_value="")
-        terrestrial_domain = get_tag_content(jdd, "domaineTerrestre", default_value=False)
-        marine_domain = get_tag_content(jdd, "domaineMarin", default_value=False)
-        data_type = get_tag_content(jdd, "typeDonnees")
-        collect_data_type = get_tag_content(jdd, "typeDonneesCollectees")
-        create_date = get_tag_content(jdd, "dateCreation", default_value=datetime.datetime.now())
-        update_date = get_tag_content(jdd, "dateRevision")
-        attributs_additionnels_node = jdd.find(namespace + "attributsAdditionnels")
-
-        # We extract the ID of the user to assign it the JDD as an id_digitizer
-        id_digitizer = None
-        id_instance = None
-        code_statut_donnees_source = None
-        for attr in attributs_additionnels_node:
-            if get_tag_content(attr, "nomAttribut") == "ID_CREATEUR":
-                id_digitizer = get_tag_content(attr, "valeurAttribut")
-
-            if get_tag_content(attr, "nomAttribut") == "ID_INSTANCE":
-                id_instance = get_tag_content(attr, "valeurAttribut")
-
-            if get_tag_content(attr, "nomAttribut") == "CODE_STATUT_DONNEES_SOURCE":
-                code_statut_donnees_source = get_tag_content(attr, "valeurAttribut")
-
-        # We search for all the Contact nodes :
-        # - Main contact in pointContactPF node
-        # - JDD provider in pointContactJdd node
-        # - JDD builder in pointContactJdd node
-        # - Database contact in contactBaseProduction node
-        list_contact_tags = ["pointContactPF", "pointContactJdd", "contactBaseProduction"]
-        all_actors = []
-        for contact_tag in list_contact_tags:
-            if contact_tag == "contactBaseProduction":
-                contact_node = jdd.find(namespace + "BaseProduction")
-            else:
-                contact_node = jdd
-            if get_tag_content(contact_node, contact_tag) is not None:
-                for actor_node in contact_node.findall(namespace + contact_tag):
-                    actor = parse_actors_xml(actor_node)
-                    all_actors = all_actors + actor
-
-        keywords = None
-
-        # We build the JDD data from all the variables collected from the XML file
-        current_jdd = {
-            "unique_dataset_id": jdd_uuid,
-            "uuid_acquisition_framework": ca_uuid,
-            "dataset_name": dataset_name,
-            "dataset_shortname": dataset_shortname,
-            "dataset_desc": dataset_desc,
-            "keywords": keywords,
-            "terrestrial_domain": json.loads(terrestrial_domain),
-            "marine_domain": json.loads(marine_domain),
-            "id_nomenclature_data_type": data_type,
-            "id_digitizer": id_digitizer,
-            "id_nomenclature_data_origin": code_statut_donnees_source,
-            "actors": all_actors,
-            "meta_create_date": create_date,
-            "meta_update_date": update_date,
-        }
-
-        # filter with id_instance
-        if current_app.config["MTD"]["ID_INSTANCE_FILTER"]:
-            if id_instance and id_instance == str(current_app.config["MTD"]["ID_INSTANCE_FILTER"]):
-                jdd_list.append(current_jdd)
-        else:
+        current_jdd = parse_jdd(jdd)
+        if current_jdd is not None:
             jdd_list.append(current_jdd)
-
     return jdd_list
+
+
+def parse_jdd(jdd):
+    """
+    Parse a JeuDeDonnees node
+    Return:
+        dict: the JDD data, or None if the JDD is not from the instance
+            of the MTD ID_INSTANCE_FILTER parameter
+    """
+    # We extract all the required informations from the different tags of the XML file
+    jdd_uuid = get_tag_content(jdd, "identifiantJdd")
+    ca_uuid = get_tag_content(jdd, "identifiantCadre")
+    dataset_name = get_tag_content(jdd, "libelle")
+    dataset_shortname = get_tag_content(jdd, "libelleCourt", default_value="")
+    dataset_desc = get_tag_content(jdd, "description", default_value="")
+    terrestrial_domain = get_tag_content(jdd, "domaineTerrestre", default_value=False)
+    marine_domain = get_tag_content(jdd, "domaineMarin", default_value=False)
+    data_type = get_tag_content(jdd, "typeDonnees")
+    collect_data_type = get_tag_content(jdd, "typeDonneesCollectees")
+    create_date = get_tag_content(jdd, "dateCreation", default_value=datetime.datetime.now())
+    update_date = get_tag_content(jdd, "dateRevision")
+    attributs_additionnels_node = jdd.find(namespace + "attributsAdditionnels")
+
+    # We extract the ID of the user to assign it the JDD as an id_digitizer
+    id_digitizer = None
+    id_instance = None
+    code_statut_donnees_source = None
+    for attr in attributs_additionnels_node:
+        if get_tag_content(attr, "nomAttribut") == "ID_CREATEUR":
+            id_digitizer = get_tag_content(attr, "valeurAttribut")
+
+        if get_tag_content(attr, "nomAttribut") == "ID_INSTANCE":
+            id_instance = get_tag_content(attr, "valeurAttribut")
+
+        if get_tag_content(attr, "nomAttribut") == "CODE_STATUT_DONNEES_SOURCE":
+            code_statut_donnees_source = get_tag_content(attr, "valeurAttribut")
+
+    # filter with id_instance
+    if current_app.config["MTD"]["ID_INSTANCE_FILTER"]:
+        if not id_instance or id_instance != str(current_app.config["MTD"]["ID_INSTANCE_FILTER"]):
+            return None
+
+    # We search for all the Contact nodes :
+    # - Main contact in pointContactPF node
+    # - JDD provider in pointContactJdd node
+    # - JDD builder in pointContactJdd node
+    # - Database contact in contactBaseProduction node
+    list_contact_tags = ["pointContactPF", "pointContactJdd", "contactBaseProduction"]
+    all_actors = []
+    for contact_tag in list_contact_tags:
+        if contact_tag == "contactBaseProduction":
+            contact_node = jdd.find(namespace + "BaseProduction")
+        else:
+            contact_node = jdd
+        if get_tag_content(contact_node, contact_tag) is not None:
+            for actor_node in contact_node.findall(namespace + contact_tag):
+                actor = parse_actors_xml(actor_node)
+                all_actors = all_actors + actor
+
+    keywords = None
+
+    # We build the JDD data from all the variables collected from the XML file
+    return {
+        "unique_dataset_id": jdd_uuid,
+        "uuid_acquisition_framework": ca_uuid,
+        "dataset_name": dataset_name,
+        "dataset_shortname": dataset_shortname,
+        "dataset_desc": dataset_desc,
+        "keywords": keywords,
+        "terrestrial_domain": json.loads(terrestrial_domain),
+        "marine_domain": json.loads(marine_domain),
+        "id_nomenclature_data_type": data_type,
+        "id_digitizer": id_digitizer,
+        "id_nomenclature_data_origin": code_statut_donnees_source,
+        "actors": all_actors,
+        "meta_create_date": create_date,
+        "meta_update_date": update_date,
+    }
+
+
+def iter_xml_nodes(source, tag_name):
+    """
+    Iterate over the nodes of a xml file, parsed incrementally
+    Params:
+        source (file-like object): the xml file, e.g. a streamed HTTP response
+        tag_name (str): the name of the nodes
+    Yield:
+        etree Element: each node, cleared once the next one is requested
+            so that memory is bounded whatever the size of the file
+    """
+    for _, node in ET.iterparse(
+        source, events=("end",), tag=namespace + tag_name, recover=True, encoding="utf-8"
+    ):
+        yield node
+        node.clear()
+        # drop the references to the previous nodes kept by the root
+        while node.getprevious() is not None:
+            del node.getparent()[0]
+
+
+def iter_acquisition_frameworks(source):
+    """
+    Parse incrementally an xml of AF
+    Yield:
+        dict: the parsed AF
+    """
+    for ca in iter_xml_nodes(source, "CadreAcquisition"):
+        yield parse_acquisition_framework(ca)
+
+
+def iter_jdd(source):
+    """
+    Parse incrementally an xml of datasets
+    Yield:
+        dict: the parsed JDD
+    """
+    for jdd in iter_xml_nodes(source, "JeuDeDonnees"):
+        current_jdd = parse_jdd(jdd)
+        if current_jdd is not None:
+            yield current_jdd
@@ -1,3 +1,4 @@
+import json
 import logging
 
 from sqlalchemy import or_, String, Date, and_
@@ -5,7 +6,7 @@ from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import joinedload, contains_eager, aliased
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.functions import func
-from sqlalchemy.sql.expression import cast
+from sqlalchemy.sql.expression import cast, text
 
 from flask import request, current_app
 import requests
@@ -178,3 +179,140 @@ def get_metadata_list(role, scope, args, exclude_cols):
             except:
                 pass
     return query
+
+
+def refresh_stale_dataset_stats(af_ids=(), dataset_ids=()):
+    """
+    Recompute the stats of the given datasets, and of the datasets of the given AF,
+    which are stale since observations were updated or deleted.
+    If no dataset nor AF is given, all stale stats are recomputed.
+
+    :returns: the number of datasets having observations among the recomputed ones
+    """
+    return DB.session.execute(
+        text(
+            """
+            SELECT gn_meta.refresh_dataset_stats(ARRAY(
+                SELECT st.id_dataset
+                FROM gn_meta.t_dataset_stats st
+                JOIN gn_meta.t_datasets d USING (id_dataset)
+                WHERE st.stale
+                AND (
+                    :all
+                    OR d.id_dataset = ANY(:dataset_ids)
+                    OR d.id_acquisition_framework = ANY(:af_ids)
+                )
+            ))
+            """
+        ),
+        {
+            "all": not af_ids and not dataset_ids,
+            "af_ids": list(af_ids),
+            "dataset_ids": list(dataset_ids),
+        },
+    ).scalar()
+
+
+def get_metadata_stats(af_ids=(), dataset_ids=()):
+    """
+    Stats of many AF and datasets, read from the gn_meta.t_dataset_stats rollup.
+    Stale stats are recomputed by :func:`refresh_stale_dataset_stats`, run periodically:
+    they are returned as is.
+
+    :returns: {"acquisition_frameworks": {id: stats}, "datasets": {id: stats}}
+        where stats are nb_taxons, nb_observations, nb_habitats and bbox (GeoJSON),
+        and nb_dataset for AF
+    """
+    params = {"af_ids": list(af_ids), "dataset_ids": list(dataset_ids)}
+    # pr_occhab is an optional module
+    if DB.session.execute(text("SELECT to_regclass('pr_occhab.t_habitats')")).scalar():
+        habitats_query = """
+            SELECT s.id_dataset, count(*) AS nb_habitats
+            FROM pr_occhab.t_stations s
+            JOIN pr_occhab.t_habitats h ON h.id_station = s.id_station
+            JOIN datasets d ON d.id_dataset = s.id_dataset
+            GROUP BY s.id_dataset
+        """
+    else:
+        habitats_query = "SELECT NULL::integer AS id_dataset, 0 AS nb_habitats"
+    stats_query = f"""
+        WITH datasets AS (
+            SELECT d.id_dataset, d.id_acquisition_framework
+            FROM gn_meta.t_datasets d
+            WHERE d.id_dataset = ANY(:dataset_ids)
+            OR d.id_acquisition_framework = ANY(:af_ids)
+        ),
+        habitats AS ({habitats_query}),
+        stats AS (
+            SELECT
+                d.id_dataset,
+                d.id_acquisition_framework,
+                COALESCE(st.nb_observations, 0) AS nb_observations,
+                st.bbox,
+                COALESCE(h.nb_habitats, 0) AS nb_habitats
+            FROM datasets d
+            LEFT JOIN gn_meta.t_dataset_stats st ON st.id_dataset = d.id_dataset
+            LEFT JOIN habitats h ON h.id_dataset = d.id_dataset
+        )
+    """
+    datasets = DB.session.execute(
+        text(
+            stats_query
+            + """
+            SELECT
+                s.id_dataset,
+                (
+                    SELECT count(*) FROM gn_meta.t_dataset_taxa t
+                    WHERE t.id_dataset = s.id_dataset
+                ) AS nb_taxons,
+                s.nb_observations,
+                s.nb_habitats,
+                st_asgeojson(s.bbox) AS bbox
+            FROM stats s
+            WHERE s.id_dataset = ANY(:dataset_ids)
+            """
+        ),
+        params,
+    )
+    acquisition_frameworks = DB.session.execute(
+        text(
+            stats_query
+            + """
+            SELECT
+                s.id_acquisition_framework,
+                count(*) AS nb_dataset,
+                (
+                    SELECT count(DISTINCT t.cd_nom)
+                    FROM stats s2
+                    JOIN gn_meta.t_dataset_taxa t ON t.id_dataset = s2.id_dataset
+                    WHERE s2.id_acquisition_framework = s.id_acquisition_framework
+                ) AS nb_taxons,
+                sum(s.nb_observations)::bigint AS nb_observations,
+                sum(s.nb_habitats)::bigint AS nb_habitats,
+                st_asgeojson(st_extent(s.bbox)) AS bbox
+            FROM stats s
+            WHERE s.id_acquisition_framework = ANY(:af_ids)
+            GROUP BY s.id_acquisition_framework
+            """
+        ),
+        params,
+    )
+
+    def as_dict(row):
+        stats = dict(row)
+        stats["bbox"] = json.loads(stats["bbox"]) if stats["bbox"] else None
+        return stats
+
+    empty_stats = {"nb_taxons": 0, "nb_observations": 0, "nb_habitats": 0, "bbox": None}
+    stats = {
+        "acquisition_frameworks": {
+            id_af: dict(empty_stats, id_acquisition_framework=id_af, nb_dataset=0)
+            for id_af in af_ids
+        },
+        "datasets": {},
+    }
+    stats["acquisition_frameworks"].update(
+        (row.id_acquisition_framework, as_dict(row)) for row in acquisition_frameworks
+    )
+    stats["datasets"].update((row.id_dataset, as_dict(row)) for row in datasets)
+    return stats
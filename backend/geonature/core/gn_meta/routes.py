@@ -2,7 +2,6 @@
     Routes for gn_meta 
 """
 import datetime as dt
-import json
 import logging
 from lxml import etree as ET
 
@@ -10,7 +9,6 @@ from flask import (
     Blueprint,
     current_app,
     request,
-    Response,
     g,
 )
 
@@ -18,11 +16,11 @@ import click
 
 from flask.json import jsonify
 from sqlalchemy import inspect, and_, or_
-from sqlalchemy.sql import text, exists, select, update
+from sqlalchemy.sql import select, update
 from sqlalchemy.sql.functions import func
-from sqlalchemy.orm import Load, joinedload, raiseload, undefer
+from sqlalchemy.orm import Load, aliased, joinedload, raiseload, undefer
 from werkzeug.exceptions import Conflict, BadRequest, Forbidden, NotFound
-from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.datastructures import MultiDict
 from werkzeug.utils import secure_filename
 from marshmallow import ValidationError, EXCLUDE
 
@@ -35,11 +33,14 @@ from geonature.core.gn_synthese.models import (
     CorAreaSynthese,
 )
 from geonature.core.gn_permissions.decorators import login_required
+from geonature.utils.streaming import iter_results, to_csv_stream_resp
 
 from .mtd import sync_af_and_ds as mtd_sync_af_and_ds, sync_af_and_ds_by_user
+import geonature.core.gn_meta.tasks  # noqa: F401
 
 from ref_geo.models import LAreas
 from pypnnomenclature.models import TNomenclatures
+from apptax.taxonomie.models import Taxref
 from pypnusershub.db.tools import InsufficientRightsError
 from pypnusershub.db.models import User
 
@@ -56,13 +57,14 @@ from geonature.core.gn_meta.models import (
 )
 from geonature.core.gn_meta.repositories import (
     get_metadata_list,
+    get_metadata_stats,
+    refresh_stale_dataset_stats,
 )
 from geonature.core.gn_meta.schemas import (
     AcquisitionFrameworkSchema,
     DatasetSchema,
 )
-from utils_flask_sqla.response import json_resp, to_csv_resp, generate_csv_content
-from werkzeug.datastructures import Headers
+from utils_flask_sqla.response import json_resp, to_csv_resp
 from geonature.core.gn_permissions import decorators as permissions
 from geonature.core.gn_permissions.tools import get_scopes_by_action
 from geonature.core.gn_permissions.models import TObjects
@@ -79,6 +81,9 @@ routes = Blueprint("gn_meta", __name__, cli_group="metadata")
 # get the root logger
 log = logging.getLogger()
 
+# seconds during which the browser may reuse the stats without revalidating them
+STATS_CACHE_MAX_AGE = 60
+
 
 if config["CAS_PUBLIC"]["CAS_AUTHENTIFICATION"]:
 
@@ -318,46 +323,73 @@ def sensi_report():
     id_import = params.get("id_import")
     id_module = params.get("id_module")
 
+    # only the needed columns are selected, nomenclatures and taxa are joined
+    # instead of being fetched by a function call for each row
+    sensitivity = aliased(TNomenclatures)
+    bio_status = aliased(TNomenclatures)
     query = (
-        DB.session.query(
-            Synthese,
-            func.taxonomie.find_cdref(Synthese.cd_nom).label("cd_ref"),
-            func.array_agg(LAreas.area_name).label("codeDepartementCalcule"),
-            func.ref_nomenclatures.get_cd_nomenclature(Synthese.id_nomenclature_sensitivity).label(
-                "cd_sensi"
-            ),
-            func.ref_nomenclatures.get_nomenclature_label(
-                Synthese.id_nomenclature_bio_status, "fr"
-            ).label("occStatutBiologique"),
-            TNomenclatures.cd_nomenclature,
-            TNomenclatures.label_fr,
+        select(
+            [
+                Synthese.cd_nom,
+                Taxref.cd_ref,
+                func.array_agg(LAreas.area_name).label("codeDepartementCalcule"),
+                Synthese.entity_source_pk_value,
+                bio_status.label_fr.label("occStatutBiologique"),
+                Synthese.unique_id_sinp,
+                sensitivity.cd_nomenclature,
+                sensitivity.label_fr,
+            ]
         )
-        .select_from(Synthese)
-        .outerjoin(CorAreaSynthese, CorAreaSynthese.id_synthese == Synthese.id_synthese)
-        .outerjoin(LAreas, LAreas.id_area == CorAreaSynthese.id_area)
-        .outerjoin(
-            TNomenclatures, TNomenclatures.id_nomenclature == Synthese.id_nomenclature_sensitivity
+        .select_from(
+            Synthese.__table__.join(
+                CorAreaSynthese, CorAreaSynthese.id_synthese == Synthese.id_synthese
+            )
+            .join(LAreas, LAreas.id_area == CorAreaSynthese.id_area)
+            .outerjoin(Taxref, Taxref.cd_nom == Synthese.cd_nom)
+            .outerjoin(
+                sensitivity, sensitivity.id_nomenclature == Synthese.id_nomenclature_sensitivity
+            )
+            .outerjoin(
+                bio_status, bio_status.id_nomenclature == Synthese.id_nomenclature_bio_status
+            )
         )
-        .filter(LAreas.id_type == func.ref_geo.get_id_area_type("DEP"))
+        .where(LAreas.id_type == func.ref_geo.get_id_area_type("DEP"))
+        .where(Synthese.id_dataset == ds_id)
     )
 
     if id_module:
-        query = query.filter(Synthese.id_module == id_module)
-
-    query = query.filter(Synthese.id_dataset == ds_id)
+        query = query.where(Synthese.id_module == id_module)
 
     if id_import:
-        query = query.outerjoin(TSources, TSources.id_source == Synthese.id_source).filter(
-            TSources.name_source == "Import(id={})".format(id_import)
+        query = query.where(
+            Synthese.id_source.in_(
+                select([TSources.id_source]).where(
+                    TSources.name_source == "Import(id={})".format(id_import)
+                )
+            )
         )
 
-    data = query.group_by(
-        Synthese.id_synthese, TNomenclatures.cd_nomenclature, TNomenclatures.label_fr
-    ).all()
+    query = query.group_by(
+        Synthese.id_synthese,
+        Taxref.cd_ref,
+        bio_status.label_fr,
+        sensitivity.cd_nomenclature,
+        sensitivity.label_fr,
+    )
+
+    # counts of the header, computed before streaming the rows
+    report = query.alias("report")
+    nb_total, nb_sensitive = DB.session.execute(
+        select(
+            [
+                func.count(),
+                func.count().filter(report.c.cd_nomenclature.is_distinct_from("0")),
+            ]
+        ).select_from(report)
+    ).first()
 
     str_productor = ""
-    header = ""
-    if len(data) > 0:
+    if nb_total > 0:
         index_productor = -1
         if dataset.cor_dataset_actor:
             for index, actor in enumerate(dataset.cor_dataset_actor):
@@ -372,19 +404,20 @@ def sensi_report():
                     str_productor = productor.role.nom_complet
                 else:
                     str_productor = productor.organism.nom_organisme
-    data = [
-        {
-            "cdNom": row.Synthese.cd_nom,
-            "cdRef": row.cd_ref,
-            "codeDepartementCalcule": ", ".join(row.codeDepartementCalcule),
-            "identifiantOrigine": row.Synthese.entity_source_pk_value,
-            "occStatutBiologique": row.occStatutBiologique,
-            "identifiantPermanent": row.Synthese.unique_id_sinp,
-            "sensible": "Oui" if row.cd_sensi != "0" else "Non",
-            "sensiNiveau": f"{row.cd_nomenclature} = {row.label_fr}",
-        }
-        for row in data
-    ]
+
+    def data():
+        for row in iter_results(query):
+            yield {
+                "cdNom": row.cd_nom,
+                "cdRef": row.cd_ref,
+                "codeDepartementCalcule": ", ".join(row.codeDepartementCalcule),
+                "identifiantOrigine": row.entity_source_pk_value,
+                "occStatutBiologique": row.occStatutBiologique,
+                "identifiantPermanent": row.unique_id_sinp,
+                "sensible": "Oui" if row.cd_nomenclature != "0" else "Non",
+                "sensiNiveau": f"{row.cd_nomenclature} = {row.label_fr}",
+            }
+
     sensi_version = DB.session.query(
         func.gn_commons.get_default_parameter("ref_sensi_version")
     ).one_or_none()
@@ -397,14 +430,14 @@ def sensi_report():
         "Identifiant SINP";"{dataset.unique_dataset_id}"
         "Organisme/personne fournisseur";"{str_productor}"
         "Date de création du rapport";"{dt.datetime.now().strftime("%d/%m/%Y %Hh%M")}"
-        "Nombre de données sensibles";"{len(list(filter(lambda row: row["sensible"] == "Oui", data)))}"
-        "Nombre de données total dans le fichier";"{len(data)}"
+        "Nombre de données sensibles";"{nb_sensitive}"
+        "Nombre de données total dans le fichier";"{nb_total}"
         "sensiVersionReferentiel";"{sensi_version}"
         """
 
-    return my_csv_resp(
+    return to_csv_stream_resp(
         filename="filename",
-        data=data,
+        data=data(),
         columns=[
             "cdNom",
             "cdRef",
@@ -415,18 +448,10 @@ def sensi_report():
             "sensible",
             "sensiNiveau",
         ],
-        _header=header,
+        header=header,
     )
 
 
-def my_csv_resp(filename, data, columns, _header, separator=";"):
-    headers = Headers()
-    headers.add("Content-Type", "text/plain")
-    headers.add("Content-Disposition", "attachment", filename="export_%s.csv" % filename)
-    out = _header + generate_csv_content(columns, data, separator)
-    return Response(out, headers=headers)
-
-
 def datasetHandler(dataset, data):
     datasetSchema = DatasetSchema(
         only=["cor_dataset_actor", "modules", "cor_territories"], unknown=EXCLUDE
@@ -639,41 +664,12 @@ def get_export_pdf_acquisition_frameworks(id_acquisition_framework):
     # Recuperation des données
     af = DB.session.query(TAcquisitionFrameworkDetails).get(id_acquisition_framework)
     acquisition_framework = af.as_dict(True, depth=2)
-    dataset_ids = [d.id_dataset for d in af.t_datasets]
-    nb_data = len(dataset_ids)
-    nb_taxons = (
-        DB.session.query(Synthese.cd_nom)
-        .filter(Synthese.id_dataset.in_(dataset_ids))
-        .distinct()
-        .count()
-    )
-    nb_observations = (
-        DB.session.query(Synthese.cd_nom).filter(Synthese.id_dataset.in_(dataset_ids)).count()
-    )
-    nb_habitat = 0
-
-    # Check if pr_occhab exist
-    check_schema_query = exists(
-        select([text("schema_name")])
-        .select_from(text("information_schema.schemata"))
-        .where(text("schema_name = 'pr_occhab'"))
-    )
-
-    if DB.session.query(check_schema_query).scalar() and nb_data > 0:
-        query = (
-            "SELECT count(*) FROM pr_occhab.t_stations s, pr_occhab.t_habitats h WHERE s.id_station = h.id_station AND s.id_dataset in \
-        ("
-            + str(dataset_ids).strip("[]")
-            + ")"
-        )
-
-        nb_habitat = DB.engine.execute(text(query)).first()[0]
-
+    stats = get_acquisition_framework_stats_from_rollup(af.id_acquisition_framework)
     acquisition_framework["stats"] = {
-        "nb_data": nb_data,
-        "nb_taxons": nb_taxons,
-        "nb_observations": nb_observations,
-        "nb_habitats": nb_habitat,
+        "nb_data": stats["nb_dataset"],
+        "nb_taxons": stats["nb_taxons"],
+        "nb_observations": stats["nb_observations"],
+        "nb_habitats": stats["nb_habitats"],
     }
 
     if request.is_json and request.json is not None:
@@ -863,7 +859,36 @@ def updateAcquisitionFramework(id_acquisition_framework, scope):
     )
 
 
-@routes.route("/acquisition_framework/<id_acquisition_framework>/stats", methods=["GET"])
+def get_acquisition_framework_stats_from_rollup(id_acquisition_framework):
+    return get_metadata_stats(af_ids=[id_acquisition_framework])["acquisition_frameworks"][
+        id_acquisition_framework
+    ]
+
+
+@routes.route("/stats", methods=["GET"])
+@permissions.check_cruved_scope("R", module_code="METADATA")
+def get_stats():
+    """
+    Get stats of many AF and datasets in one call
+    .. :quickref: Metadata;
+    :query int id_acquisition_framework: AF, can be repeated
+    :query int id_dataset: dataset, can be repeated
+    """
+    af_ids = request.args.getlist("id_acquisition_framework", type=int)
+    dataset_ids = request.args.getlist("id_dataset", type=int)
+    if not af_ids and not dataset_ids:
+        raise BadRequest("Missing id_acquisition_framework or id_dataset")
+    stats = get_metadata_stats(af_ids=af_ids, dataset_ids=dataset_ids)
+    response = jsonify(stats)
+    # stats only change with the synthese: let the browser keep them a little while,
+    # then revalidate them with the ETag
+    response.cache_control.private = True
+    response.cache_control.max_age = STATS_CACHE_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@routes.route("/acquisition_framework/<int:id_acquisition_framework>/stats", methods=["GET"])
 @permissions.check_cruved_scope("R", module_code="METADATA")
 @json_resp
 def get_acquisition_framework_stats(id_acquisition_framework):
@@ -873,49 +898,16 @@ def get_acquisition_framework_stats(id_acquisition_framework):
     :param id_acquisition_framework: the id_acquisition_framework
     :param type: int
     """
-    datasets = TDatasets.query.filter(
-        TDatasets.id_acquisition_framework == id_acquisition_framework
-    ).all()
-    dataset_ids = [d.id_dataset for d in datasets]
-
-    nb_dataset = len(dataset_ids)
-    nb_taxons = (
-        DB.session.query(Synthese.cd_nom)
-        .filter(Synthese.id_dataset.in_(dataset_ids))
-        .distinct()
-        .count()
-    )
-    nb_observations = Synthese.query.filter(
-        Synthese.dataset.has(TDatasets.id_acquisition_framework == id_acquisition_framework)
-    ).count()
-    nb_habitat = 0
-
-    # Check if pr_occhab exist
-    check_schema_query = exists(
-        select([text("schema_name")])
-        .select_from(text("information_schema.schemata"))
-        .where(text("schema_name = 'pr_occhab'"))
-    )
-
-    if DB.session.query(check_schema_query).scalar() and nb_dataset > 0:
-        query = (
-            "SELECT count(*) FROM pr_occhab.t_stations s, pr_occhab.t_habitats h WHERE s.id_station = h.id_station AND s.id_dataset in \
-        ("
-            + str(dataset_ids).strip("[]")
-            + ")"
-        )
-
-        nb_habitat = DB.engine.execute(text(query)).first()[0]
-
+    stats = get_acquisition_framework_stats_from_rollup(id_acquisition_framework)
     return {
-        "nb_dataset": nb_dataset,
-        "nb_taxons": nb_taxons,
-        "nb_observations": nb_observations,
-        "nb_habitats": nb_habitat,
+        "nb_dataset": stats["nb_dataset"],
+        "nb_taxons": stats["nb_taxons"],
+        "nb_observations": stats["nb_observations"],
+        "nb_habitats": stats["nb_habitats"],
     }
 
 
-@routes.route("/acquisition_framework/<id_acquisition_framework>/bbox", methods=["GET"])
+@routes.route("/acquisition_framework/<int:id_acquisition_framework>/bbox", methods=["GET"])
 @permissions.check_cruved_scope("R", module_code="METADATA")
 @json_resp
 def get_acquisition_framework_bbox(id_acquisition_framework):
@@ -925,16 +917,7 @@ def get_acquisition_framework_bbox(id_acquisition_framework):
     :param id_acquisition_framework: the id_acquisition_framework
     :param type: int
     """
-    datasets = TDatasets.query.filter(
-        TDatasets.id_acquisition_framework == id_acquisition_framework
-    ).all()
-    dataset_ids = [d.id_dataset for d in datasets]
-    geojsonData = (
-        DB.session.query(func.ST_AsGeoJSON(func.ST_Extent(Synthese.the_geom_4326)))
-        .filter(Synthese.id_dataset.in_(dataset_ids))
-        .first()[0]
-    )
-    return json.loads(geojsonData) if geojsonData else None
+    return get_acquisition_framework_stats_from_rollup(id_acquisition_framework)["bbox"]
 
 
 def publish_acquisition_framework_mail(af):
@@ -1050,15 +1033,30 @@ def publish_acquisition_framework(af_id):
     return af.as_dict()
 
 
+@routes.cli.command()
+def refresh_stats():
+    """
+    Recalcule les statistiques périmées des jeux de données
+    """
+    count = refresh_stale_dataset_stats()
+    DB.session.commit()
+    click.echo(f"Statistiques de {count} jeux de données recalculées.")
+
+
 @routes.cli.command()
 @click.argument("id_role", nargs=1, required=False, default=None)
-def mtd_sync(id_role):
+@click.option(
+    "--bulk",
+    is_flag=True,
+    help="Synchronise par lots : une requête par table, suppression des acteurs retirés du MTD",
+)
+def mtd_sync(id_role, bulk):
     """
     Trigger global sync or a sync for a given user only.
 
     :param id_role: user id
     """
     if id_role:
-        return sync_af_and_ds_by_user(id_role)
+        return sync_af_and_ds_by_user(id_role, bulk=bulk)
     else:
-        return mtd_sync_af_and_ds()
+        return mtd_sync_af_and_ds(bulk=bulk)
@@ -0,0 +1,36 @@
+from celery.utils.log import get_task_logger
+from celery.schedules import crontab
+
+from geonature.utils.config import config
+from geonature.utils.celery import celery_app
+from geonature.utils.env import db
+from geonature.core.gn_meta.repositories import refresh_stale_dataset_stats
+
+
+logger = get_task_logger(__name__)
+
+
+@celery_app.on_after_finalize.connect
+def setup_periodic_tasks(sender, **kwargs):
+    ct = config["DATASET_STATS_REFRESH_CRONTAB"]
+    if ct:
+        minute, hour, day_of_month, month_of_year, day_of_week = ct.split(" ")
+        sender.add_periodic_task(
+            crontab(
+                minute=minute,
+                hour=hour,
+                day_of_week=day_of_week,
+                day_of_month=day_of_month,
+                month_of_year=month_of_year,
+            ),
+            refresh_dataset_stats.s(),
+            name="refresh dataset stats",
+        )
+
+
+@celery_app.task(bind=True)
+def refresh_dataset_stats(self):
+    logger.info("Refresh stale dataset stats...")
+    count = refresh_stale_dataset_stats()
+    db.session.commit()
+    logger.info(f"Stats of {count} datasets refreshed.")
@@ -0,0 +1,159 @@
+"""
+Cache of the permissions of each role, shared across requests
+
+The cache is disabled by default. When PERMISSIONS_CACHE.TTL is set, the ids of the
+permissions of a role are cached for TTL seconds, in Redis when
+PERMISSIONS_CACHE.REDIS_URL is set so the cache is shared by all workers, otherwise
+in the memory of the current process (only suitable for single process deployments).
+The permissions themselves are always read from the database by id, so deleted or
+modified permissions are taken into account at once; the cache only saves the
+resolution of the groups of the role.
+The whole cache is invalidated when a permission, a module or a role
+(i.e. groups membership) is modified through the ORM. Changes made elsewhere
+(UsersHub, SQL) require 'geonature permissions clear-cache' or the TTL expiration.
+"""
+import json
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+
+from pypnusershub.db.models import User
+
+from geonature.core.gn_commons.models import TModules
+from geonature.core.gn_permissions.models import Permission
+
+
+class LocalCacheBackend:
+    """Cache stored in the memory of the current process"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, id_role):
+        entry = self.entries.get(id_role)
+        if entry is None:
+            return None
+        expiration, value = entry
+        if expiration < time.monotonic():
+            self.entries.pop(id_role, None)
+            return None
+        return value
+
+    def set(self, id_role, value):
+        self.entries[id_role] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        self.entries = {}
+
+
+class RedisCacheBackend:
+    """
+    Cache stored in Redis, shared by all processes.
+
+    Invalidation increments a version number included in the keys,
+    previous keys are left to expire.
+    """
+
+    prefix = "geonature:permissions"
+
+    def __init__(self, ttl, url):
+        import redis
+
+        self.ttl = ttl
+        self.redis = redis.Redis.from_url(url)
+
+    def _key(self, id_role):
+        version = self.redis.get(f"{self.prefix}:version") or b"0"
+        return f"{self.prefix}:{version.decode()}:{id_role}"
+
+    def get(self, id_role):
+        return self.redis.get(self._key(id_role))
+
+    def set(self, id_role, value):
+        self.redis.set(self._key(id_role), value, ex=self.ttl)
+
+    def clear(self):
+        self.redis.incr(f"{self.prefix}:version")
+
+
+class PermissionsCache:
+    """
+    Store the ids of the permissions of a role as JSON.
+    They are loaded again by id when retrieved.
+    """
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        config = app.config["PERMISSIONS_CACHE"]
+        if not config["TTL"]:
+            self.backend = None
+        elif config["REDIS_URL"]:
+            self.backend = RedisCacheBackend(config["TTL"], config["REDIS_URL"])
+        else:
+            self.backend = LocalCacheBackend(config["TTL"])
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get(self, session, id_role):
+        if not self.enabled:
+            return None
+        value = self.backend.get(id_role)
+        if value is None:
+            return None
+        return (
+            session.query(Permission)
+            .options(
+                joinedload(Permission.module),
+                joinedload(Permission.object),
+                joinedload(Permission.action),
+            )
+            .filter(Permission.id_permission.in_(json.loads(value)))
+            .all()
+        )
+
+    def set(self, id_role, permissions):
+        if self.enabled:
+            self.backend.set(id_role, json.dumps([p.id_permission for p in permissions]))
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+
+permissions_cache = PermissionsCache()
+
+
+INVALIDATING_MODELS = (Permission, TModules, User)
+
+
+@event.listens_for(Session, "after_flush")
+def invalidate_on_flush(session, flush_context):
+    if any(
+        isinstance(obj, INVALIDATING_MODELS)
+        for obj in (*session.new, *session.dirty, *session.deleted)
+    ):
+        # clear now, and again at commit time, so that permissions cached
+        # by a concurrent request before the commit are not kept
+        session.info["invalidate_permissions_cache"] = True
+        permissions_cache.clear()
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_on_commit(session):
+    if session.info.pop("invalidate_permissions_cache", False):
+        permissions_cache.clear()
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def invalidate_on_rollback(session, previous_transaction):
+    # permissions read from not committed changes may have been cached
+    if session.info.get("invalidate_permissions_cache", False):
+        permissions_cache.clear()
+        if previous_transaction.parent is None:
+            del session.info["invalidate_permissions_cache"]
@@ -8,6 +8,7 @@ from pypnusershub.db.models import User
 
 from geonature.utils.env import db
 from geonature.core.gn_permissions.models import Permission, PermissionAvailable
+from geonature.core.gn_permissions.cache import permissions_cache
 
 
 @click.command(
@@ -72,3 +73,11 @@ def supergrant(skip_existing, dry_run, yes, **filters):
             db.session.add(Permission(availability=ap, role=role))
     if not dry_run:
         db.session.commit()
+
+
+@click.command(
+    help="Vider le cache des permissions partagé dans Redis (PERMISSIONS_CACHE.REDIS_URL). "
+    "Le cache propre à chaque processus expire au bout de PERMISSIONS_CACHE.TTL secondes."
+)
+def clear_cache():
+    permissions_cache.clear()
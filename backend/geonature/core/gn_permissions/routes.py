@@ -12,7 +12,7 @@ from sqlalchemy.orm import joinedload
 from utils_flask_sqla.response import json_resp
 from geonature.core.gn_commons.models import TModules
 from geonature.core.gn_permissions import decorators as permissions
-from geonature.core.gn_permissions.commands import supergrant
+from geonature.core.gn_permissions.commands import supergrant, clear_cache
 
 
 routes = Blueprint(
@@ -20,6 +20,7 @@ routes = Blueprint(
 )
 
 routes.cli.add_command(supergrant)
+routes.cli.add_command(clear_cache)
 
 
 @routes.route("/logout_cruved", methods=["GET"])
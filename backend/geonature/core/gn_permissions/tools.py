@@ -7,6 +7,7 @@ from sqlalchemy.orm import joinedload
 from flask import g
 
 from geonature.core.gn_commons.models import TModules
+from geonature.core.gn_permissions.cache import permissions_cache
 from geonature.core.gn_permissions.models import (
     PermAction,
     PermObject,
@@ -51,7 +52,11 @@ def get_user_permissions(id_role=None):
     if id_role is None:
         id_role = g.current_user.id_role
     if id_role not in g._permissions_by_user:
-        g._permissions_by_user[id_role] = _get_user_permissions(id_role)
+        permissions = permissions_cache.get(db.session, id_role)
+        if permissions is None:
+            permissions = _get_user_permissions(id_role)
+            permissions_cache.set(id_role, permissions)
+        g._permissions_by_user[id_role] = permissions
     return g._permissions_by_user[id_role]
 
 
@@ -0,0 +1,285 @@
+"""
+    Checks of observations against the profiles of their taxon
+
+    Profiles (general profile, valid distribution and phenology) are loaded by batches
+    of cd_ref and kept in an in-process LRU cache, cleared when the profiles are
+    refreshed (see gn_profiles.t_refresh_history): checking the observations of a
+    whole relevé costs a handful of queries instead of a few per observation.
+"""
+import datetime
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+
+from geoalchemy2.shape import to_shape
+from shapely.geometry import shape
+from sqlalchemy.sql import func
+from werkzeug.exceptions import BadRequest
+
+from pypnnomenclature.models import TNomenclatures
+
+from geonature.utils.env import db
+from geonature.core.gn_profiles.models import (
+    VmCorTaxonPhenology,
+    VmValidProfiles,
+    TRefreshHistory,
+)
+
+
+PROFILES_CACHE_SIZE = 1024
+
+
+Profile = namedtuple(
+    "Profile",
+    [
+        "properties",  # VmValidProfiles.as_dict()
+        "distribution",  # valid distribution as a shapely geometry in WGS84
+        "phenology",  # list of Phenology
+    ],
+)
+Phenology = namedtuple(
+    "Phenology",
+    [
+        "doy_min",
+        "doy_max",
+        "id_nomenclature_life_stage",
+        "calculated_altitude_min",
+        "calculated_altitude_max",
+    ],
+)
+
+
+def load_profiles(cd_refs):
+    """Profile of each given cd_ref, None for the taxa without profile"""
+    profiles = dict.fromkeys(cd_refs)
+    phenology = defaultdict(list)
+    query = db.session.query(
+        VmCorTaxonPhenology.cd_ref,
+        VmCorTaxonPhenology.doy_min,
+        VmCorTaxonPhenology.doy_max,
+        VmCorTaxonPhenology.id_nomenclature_life_stage,
+        VmCorTaxonPhenology.calculated_altitude_min,
+        VmCorTaxonPhenology.calculated_altitude_max,
+    ).filter(VmCorTaxonPhenology.cd_ref.in_(cd_refs))
+    for cd_ref, *row in query:
+        phenology[cd_ref].append(Phenology(*row))
+    query = db.session.query(
+        VmValidProfiles,
+        func.st_transform(VmValidProfiles.valid_distribution, 4326),
+    ).filter(VmValidProfiles.cd_ref.in_(cd_refs))
+    for profile, distribution in query:
+        profiles[profile.cd_ref] = Profile(
+            profile.as_dict(),
+            to_shape(distribution) if distribution is not None else None,
+            phenology[profile.cd_ref],
+        )
+    return profiles
+
+
+class ProfilesCache:
+    """
+    LRU cache of profiles by cd_ref, cleared when a new refresh of the profiles
+    is recorded in TRefreshHistory.
+    """
+
+    def __init__(self, maxsize=PROFILES_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.profiles = OrderedDict()
+        self.id_refresh = None
+        self.lock = threading.Lock()
+
+    def get_many(self, cd_refs):
+        """Profile of each given cd_ref, None for the taxa without profile"""
+        id_refresh = db.session.query(func.max(TRefreshHistory.id_refresh)).scalar()
+        profiles = {}
+        with self.lock:
+            if id_refresh != self.id_refresh:
+                self.profiles.clear()
+                self.id_refresh = id_refresh
+            for cd_ref in set(cd_refs):
+                if cd_ref in self.profiles:
+                    self.profiles.move_to_end(cd_ref)
+                    profiles[cd_ref] = self.profiles[cd_ref]
+        missing = set(cd_refs) - set(profiles)
+        if missing:
+            loaded = load_profiles(missing)
+            with self.lock:
+                self.profiles.update(loaded)
+                while len(self.profiles) > self.maxsize:
+                    self.profiles.popitem(last=False)
+            profiles.update(loaded)
+        return profiles
+
+    def clear(self):
+        with self.lock:
+            self.profiles.clear()
+
+
+profiles_cache = ProfilesCache()
+
+
+def get_life_stage_labels(observations):
+    """label_default of the life stages of the given observations"""
+    ids = {
+        life_stage
+        for observation in observations
+        if isinstance(observation.get("life_stages"), list)
+        for life_stage in observation["life_stages"]
+    }
+    if not ids:
+        return {}
+    return dict(
+        db.session.query(TNomenclatures.id_nomenclature, TNomenclatures.label_default).filter(
+            TNomenclatures.id_nomenclature.in_(ids)
+        )
+    )
+
+
+def check_observation(profile, data, life_stage_labels):
+    """
+    Check an observation with the profile of its taxon
+
+    :param profile: :class:`Profile` of the taxon of the observation
+    :param data: the observation, as posted to /check_observation
+    :param life_stage_labels: label of the life stages of the observation by id
+    """
+    properties = profile.properties
+    check_life_stage = properties["active_life_stage"]
+
+    result = {
+        "valid_distribution": True,
+        "valid_altitude": True,
+        "valid_phenology": True,
+        "valid_life_stage": None,
+        "life_stage_accepted": [],
+        "errors": [],
+        "profil": properties,
+        "check_life_stage": check_life_stage,
+    }
+
+    # Calcul de la période correspondant à la date
+    if data.get("date_min") and data.get("date_max"):
+        try:
+            date_min = datetime.datetime.strptime(data["date_min"], "%Y-%m-%d")
+            date_max = datetime.datetime.strptime(data["date_max"], "%Y-%m-%d")
+        except (TypeError, ValueError):
+            raise BadRequest("date_min and date_max must be formatted as YYYY-MM-DD")
+        # Calcul du numéro du jour pour les dates min et max
+        doy_min = date_min.timetuple().tm_yday
+        doy_max = date_max.timetuple().tm_yday
+    else:
+        raise BadRequest("Missing date min or date max")
+    # Récupération des altitudes
+    if data.get("altitude_min") and data.get("altitude_max"):
+        altitude_min = data["altitude_min"]
+        altitude_max = data["altitude_max"]
+    else:
+        raise BadRequest("Missing altitude_min or altitude_max")
+    if "geom" not in data:
+        return result
+
+    # Check de la répartition
+    try:
+        geom = shape(data["geom"])
+    except Exception:
+        raise BadRequest("geom must be a GeoJSON geometry")
+    if profile.distribution is not None and not profile.distribution.contains(geom):
+        result["valid_distribution"] = False
+        result["errors"].append(
+            {
+                "type": "geom",
+                "value": "Le taxon n'a jamais été observé dans cette zone géographique",
+            }
+        )
+
+    # check de la periode
+    period_result = [
+        row for row in profile.phenology if row.doy_min <= doy_min and row.doy_max >= doy_max
+    ]
+    if len(period_result) == 0:
+        result["valid_phenology"] = False
+        result["errors"].append(
+            {"type": "period", "value": "Le taxon n'a jamais été observé à cette periode"}
+        )
+
+    # check de l'altitude
+    if altitude_max > properties["altitude_max"] or altitude_min < properties["altitude_min"]:
+        result["valid_altitude"] = False
+        result["errors"].append(
+            {
+                "type": "altitude",
+                "value": f"Le taxon n'a jamais été observé à cette altitude ({altitude_min}-{altitude_max}m)",
+            }
+        )
+    # check de l'altitude pour la période donnée
+    if len(period_result) > 0:
+        peridod_and_altitude_r = [
+            row
+            for row in period_result
+            if row.calculated_altitude_min <= altitude_min
+            and row.calculated_altitude_max >= altitude_max
+        ]
+        if len(peridod_and_altitude_r) > 0:
+            result["valid_altitude"] = True
+            result["valid_phenology"] = True
+            # Construction de la liste des stade de vie potentielle
+            result["life_stage_accepted"] = sorted(
+                {
+                    row.id_nomenclature_life_stage
+                    for row in peridod_and_altitude_r
+                    if row.id_nomenclature_life_stage
+                }
+            )
+        else:
+            result["valid_altitude"] = False
+            result["valid_phenology"] = False
+            if (
+                altitude_max <= properties["altitude_max"]
+                and altitude_min >= properties["altitude_min"]
+            ):
+                result["errors"].append(
+                    {
+                        "type": "period",
+                        "value": f"Le taxon a déjà été observé à cette altitude ({altitude_min}-{altitude_max}m), mais pas à cette periode de l'année",
+                    }
+                )
+
+    # check du stade de vie pour la periode donnée
+    if check_life_stage and "life_stages" in data:
+        if type(data["life_stages"]) is not list:
+            raise BadRequest("life_stages must be a list")
+        for life_stage in data["life_stages"]:
+            life_stage_value = life_stage_labels.get(life_stage, life_stage)
+            r_life_stage = [
+                row for row in period_result if row.id_nomenclature_life_stage == life_stage
+            ]
+            if len(r_life_stage) == 0:
+                result["valid_life_stage"] = False
+                result["valid_phenology"] = False
+                result["errors"].append(
+                    {
+                        "type": "life_stage",
+                        "value": f"Le taxon n'a jamais été observé à cette periode pour le stade de vie {life_stage_value}",
+                    }
+                )
+
+            # check du stade de vie pour la période et l'altitude
+            else:
+                r_life_stage_altitude = [
+                    row
+                    for row in r_life_stage
+                    if row.calculated_altitude_min <= altitude_min
+                    and row.calculated_altitude_max >= altitude_max
+                ]
+                if len(r_life_stage_altitude) == 0:
+                    result["valid_life_stage"] = False
+                    result["valid_altitude"] = False
+                    result["valid_phenology"] = False
+                    result["errors"].append(
+                        {
+                            "type": "life_stage",
+                            "value": f"""
+                                Le taxon n'a jamais été observé à cette periode et à cette altitude ({altitude_min}-{altitude_max}m)
+                                pour le stade de vie {life_stage_value}""",
+                        }
+                    )
+    return result
@@ -134,3 +134,12 @@ class CorTaxonParameters(DB.Model):
     spatial_precision = DB.Column(DB.Integer)
     temporal_precision_days = DB.Column(DB.Integer)
     active_life_stage = DB.Column(DB.Boolean)
+
+
+class TRefreshHistory(DB.Model):
+    __tablename__ = "t_refresh_history"
+    __table_args__ = {"schema": "gn_profiles"}
+    id_refresh = DB.Column(DB.Integer, primary_key=True)
+    refresh_date = DB.Column(DB.DateTime, server_default=sa.func.now())
+    nb_taxa = DB.Column(DB.Integer)
+    full_refresh = DB.Column(DB.Boolean, default=False)
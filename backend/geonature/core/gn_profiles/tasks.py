@@ -1,10 +1,9 @@
-from sqlalchemy.sql import func
 from celery.utils.log import get_task_logger
 from celery.schedules import crontab
 
-from geonature.utils.env import db
 from geonature.utils.config import config
 from geonature.utils.celery import celery_app
+from geonature.core.gn_profiles.utils import refresh_profiles as refresh_changed_profiles
 
 
 logger = get_task_logger(__name__)
@@ -31,6 +30,5 @@ def setup_periodic_tasks(sender, **kwargs):
 @celery_app.task(bind=True)
 def refresh_profiles(self):
     logger.info("Refresh profiles...")
-    db.session.execute(func.gn_profiles.refresh_profiles())
-    db.session.commit()
-    logger.info("Profiles refreshed.")
+    nb_taxa = refresh_changed_profiles()
+    logger.info(f"Profiles of {nb_taxa} taxa refreshed.")
@@ -0,0 +1,65 @@
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import func, select
+
+from geonature.utils.env import db
+from geonature.core.gn_profiles.models import TRefreshHistory
+
+from apptax.taxonomie.models import Taxref
+
+
+REFRESH_CHUNK_SIZE = 1000
+
+
+def pop_stale_cd_refs():
+    """
+    Empty the queue of the taxa of created, updated or deleted observations, filled
+    by triggers on the synthese, and return their cd_ref.
+
+    Only the rows visible to the transaction are deleted: those of transactions
+    not yet committed are kept for the next refresh.
+    """
+    stale_cd_noms = (
+        sa.text("DELETE FROM gn_profiles.t_stale_taxa RETURNING cd_nom")
+        .columns(sa.column("cd_nom", sa.Integer))
+        .cte("stale")
+    )
+    query = (
+        select([Taxref.cd_ref])
+        .where(Taxref.cd_nom.in_(select([stale_cd_noms.c.cd_nom])))
+        .distinct()
+    )
+    return sorted(cd_ref for cd_ref, in db.session.execute(query))
+
+
+def refresh_profiles(full=False, chunk_size=REFRESH_CHUNK_SIZE):
+    """
+    Refresh the profiles of the taxa whose observations changed since the last refresh,
+    or of all taxa if `full` or if the profiles have never been computed.
+
+    Changes of profiles parameters are not tracked: a full refresh is then required.
+    The refresh is committed and recorded in TRefreshHistory.
+
+    :returns: the number of refreshed taxa
+    """
+    last_refresh = db.session.query(func.max(TRefreshHistory.refresh_date)).scalar()
+    # the queue is emptied by a full refresh too
+    cd_refs = pop_stale_cd_refs()
+    full = full or last_refresh is None
+    if full:
+        nb_taxa = db.session.execute(select([func.gn_profiles.refresh_profiles()])).scalar()
+    else:
+        for idx in range(0, len(cd_refs), chunk_size):
+            db.session.execute(
+                select(
+                    [
+                        func.gn_profiles.refresh_profiles(
+                            sa.cast(cd_refs[idx : idx + chunk_size], ARRAY(sa.Integer))
+                        )
+                    ]
+                )
+            )
+        nb_taxa = len(cd_refs)
+    db.session.add(TRefreshHistory(refresh_date=func.now(), nb_taxa=nb_taxa, full_refresh=full))
+    db.session.commit()
+    return nb_taxa
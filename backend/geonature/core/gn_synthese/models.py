@@ -4,7 +4,7 @@ from typing import List
 
 import sqlalchemy as sa
 import datetime
-from sqlalchemy import ForeignKey, Unicode, and_, DateTime
+from sqlalchemy import ForeignKey, Unicode, and_, or_, DateTime
 from sqlalchemy.orm import (
     relationship,
     column_property,
@@ -15,7 +15,7 @@ from sqlalchemy.orm import (
 )
 from sqlalchemy.sql import select, func, exists
 from sqlalchemy.schema import FetchedValue
-from sqlalchemy.dialects.postgresql import UUID, JSONB
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, JSONB
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import to_shape
 
@@ -40,7 +40,11 @@ from pypn_habref_api.models import Habref
 from apptax.taxonomie.models import Taxref
 from ref_geo.models import LAreas
 
-from geonature.core.gn_meta.models import TDatasets, TAcquisitionFramework
+from geonature.core.gn_meta.models import (
+    CorRoleDatasetScope,
+    TDatasets,
+    TAcquisitionFramework,
+)
 from geonature.core.gn_commons.models import (
     THistoryActions,
     TValidations,
@@ -196,15 +200,13 @@ class SyntheseQuery(GeoFeatureCollectionMixin, Query):
         if scope == 0:
             self = self.filter(sa.false())
         elif scope in (1, 2):
-            ors = []
-            datasets = (
-                TDatasets.query.filter_by_readable(user).with_entities(TDatasets.id_dataset).all()
-            )
             self = self.filter(
                 or_(
-                    Synthese.id_digitizer == user.id_role,
+                    Synthese.id_digitiser == user.id_role,
                     Synthese.cor_observers.any(id_role=user.id_role),
-                    Synthese.id_dataset.in_([ds.id_dataset for ds in datasets]),
+                    Synthese.id_dataset.in_(
+                        CorRoleDatasetScope.select_id_datasets(user.id_role, scope)
+                    ),
                 )
             )
         return self
@@ -687,12 +689,147 @@ class SyntheseLogEntry(DB.Model):
     id_synthese = DB.Column(DB.Integer(), primary_key=True)
     last_action = DB.Column(DB.String(length=1))
     meta_last_action_date = DB.Column(DB.DateTime)
+    cd_nom = DB.Column(DB.Integer)
+
+
+@serializable
+class TExportJob(DB.Model):
+    """Asynchronous export of the synthese, processed by a celery task
+    (see geonature.core.gn_synthese.tasks)
+    """
+
+    __tablename__ = "t_export_jobs"
+    __table_args__ = {"schema": "gn_synthese"}
+
+    STATUS_PENDING = "PENDING"
+    STATUS_RUNNING = "RUNNING"
+    STATUS_SUCCESS = "SUCCESS"
+    STATUS_FAILURE = "FAILURE"
+
+    id_export_job = DB.Column(DB.Integer, primary_key=True)
+    id_role = DB.Column(DB.Integer, ForeignKey(User.id_role), nullable=False)
+    export_type = DB.Column(DB.Unicode, nullable=False)
+    export_format = DB.Column(DB.Unicode, nullable=False)
+    params = DB.Column(JSONB)
+    status = DB.Column(DB.Unicode, nullable=False, default=STATUS_PENDING)
+    progress = DB.Column(DB.Integer, nullable=False, default=0)
+    nb_rows = DB.Column(DB.Integer)
+    file_name = DB.Column(DB.Unicode)
+    error = DB.Column(DB.UnicodeText)
+    creation_date = DB.Column(DB.DateTime, default=datetime.datetime.utcnow)
+    end_date = DB.Column(DB.DateTime)
+
+    role = DB.relationship(User)
+
+
+class TStatsTaxa(DB.Model):
+    """
+    Number of observations of the synthese by dataset, source and taxon,
+    maintained by statement-level triggers on gn_synthese.synthese
+    """
+
+    __tablename__ = "t_stats_taxa"
+    __table_args__ = {"schema": "gn_synthese"}
+
+    id_stats_taxa = DB.Column(DB.Integer, primary_key=True)
+    id_dataset = DB.Column(DB.Integer)
+    id_source = DB.Column(DB.Integer)
+    cd_nom = DB.Column(DB.Integer)
+    nb_obs = DB.Column(DB.BigInteger, nullable=False)
+
+
+class TStatsObservers(DB.Model):
+    """
+    Number of observations of the synthese by distinct value of the observers column,
+    maintained by statement-level triggers on gn_synthese.synthese
+    """
+
+    __tablename__ = "t_stats_observers"
+    __table_args__ = {"schema": "gn_synthese"}
+
+    id_stats_observers = DB.Column(DB.Integer, primary_key=True)
+    observers = DB.Column(DB.Unicode, nullable=False)
+    nb_obs = DB.Column(DB.BigInteger, nullable=False)
+
+
+class TDiffusionGeometries(DB.Model):
+    """
+    Geometry of the observations degraded according to their diffusion level, or
+    their sensitivity if they have no diffusion level, maintained by triggers on
+    gn_synthese.synthese.
+
+    Observations diffused precisely have no row, and observations which must not
+    be diffused have a NULL geometry.
+    """
+
+    __tablename__ = "t_diffusion_geometries"
+    __table_args__ = {"schema": "gn_synthese"}
+
+    id_synthese = DB.Column(
+        DB.Integer, ForeignKey("gn_synthese.synthese.id_synthese"), primary_key=True
+    )
+    id_type = DB.Column(DB.Integer, ForeignKey("ref_geo.bib_areas_types.id_type"))
+    the_geom_4326 = DB.Column(Geometry("GEOMETRY", 4326))
+
+
+class CorAreaSyntheseJob(DB.Model):
+    """
+    Deferred update of cor_area_synthese for new areas of ref_geo, split in tiles
+    so it can be run in parallel and resumed
+    (see geonature.core.gn_synthese.tasks)
+    """
+
+    __tablename__ = "t_cor_area_synthese_jobs"
+    __table_args__ = {"schema": "gn_synthese"}
+
+    id_job = DB.Column(DB.Integer, primary_key=True)
+    id_areas = DB.Column(ARRAY(DB.Integer), nullable=False)
+    # side of the tiles, in the unit of the local SRID
+    tile_size = DB.Column(DB.Integer, nullable=False)
+    creation_date = DB.Column(DB.DateTime, server_default=func.now())
+    end_date = DB.Column(DB.DateTime)
+
+    chunks = relationship(
+        "CorAreaSyntheseChunk",
+        order_by="CorAreaSyntheseChunk.id_chunk",
+        cascade="all, delete-orphan",
+        back_populates="job",
+    )
+
+    @property
+    def pending_chunks(self):
+        return [chunk for chunk in self.chunks if not chunk.done]
+
+
+class CorAreaSyntheseChunk(DB.Model):
+    __tablename__ = "t_cor_area_synthese_chunks"
+    __table_args__ = {"schema": "gn_synthese"}
+
+    id_job = DB.Column(
+        DB.Integer, ForeignKey(CorAreaSyntheseJob.id_job, ondelete="CASCADE"), primary_key=True
+    )
+    id_chunk = DB.Column(DB.Integer, primary_key=True)
+    xmin = DB.Column(DB.Float, nullable=False)
+    ymin = DB.Column(DB.Float, nullable=False)
+    xmax = DB.Column(DB.Float, nullable=False)
+    ymax = DB.Column(DB.Float, nullable=False)
+    # NULL until the chunk is processed
+    nb_inserted = DB.Column(DB.Integer)
+    update_date = DB.Column(DB.DateTime)
+    # error of the last processing of the chunk
+    error = DB.Column(DB.UnicodeText)
+
+    job = relationship(CorAreaSyntheseJob, back_populates="chunks")
+
+    @property
+    def done(self):
+        return self.nb_inserted is not None
 
 
 # defined here to avoid circular dependencies
 source_subquery = (
-    select([TSources.id_source, Synthese.id_dataset])
-    .where(TSources.id_source == Synthese.id_source)
+    select([TStatsTaxa.id_source, TStatsTaxa.id_dataset])
+    .where(TStatsTaxa.id_source.isnot(None))
     .distinct()
     .alias()
 )
@@ -704,8 +841,8 @@ TDatasets.sources = db.relationship(
     viewonly=True,
 )
 TDatasets.synthese_records_count = column_property(
-    select([func.count(Synthese.id_synthese)])
-    .where(Synthese.id_dataset == TDatasets.id_dataset)
+    select([sa.cast(func.coalesce(func.sum(TStatsTaxa.nb_obs), 0), sa.BigInteger)])
+    .where(TStatsTaxa.id_dataset == TDatasets.id_dataset)
     .as_scalar()  # deprecated, replace with scalar_subquery()
     .label("synthese_records_count"),
     deferred=True,
@@ -1,9 +1,9 @@
 import json
 import datetime
-import re
-from collections import OrderedDict
 from warnings import warn
 
+import click
+
 from flask import (
     Blueprint,
     request,
@@ -13,30 +13,47 @@ from flask import (
     render_template,
     jsonify,
     g,
+    stream_with_context,
 )
 from werkzeug.exceptions import Forbidden, NotFound, BadRequest, Conflict
 from werkzeug.datastructures import MultiDict
 from sqlalchemy import distinct, func, desc, asc, select, case
 from sqlalchemy.orm import joinedload, lazyload, selectinload
-from geojson import FeatureCollection, Feature
 import sqlalchemy as sa
 from sqlalchemy.orm import load_only, aliased, Load
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
 
-from utils_flask_sqla.generic import serializeQuery, GenericTable
-from utils_flask_sqla.response import to_csv_resp, to_json_resp, json_resp
-from utils_flask_sqla_geo.generic import GenericTableGeo
+from utils_flask_sqla.generic import GenericTable
+from utils_flask_sqla.response import to_csv_resp, json_resp
 
 from geonature.utils import filemanager
 from geonature.utils.env import db, DB
+from geonature.utils.celery import wait_for_chunks
 from geonature.utils.errors import GeonatureApiError
+from geonature.utils.streaming import (
+    generate_geojson,
+    iter_results,
+    to_csv_stream_resp,
+    to_geojson_stream_resp,
+)
+from geonature.utils.pagination import (
+    check_count_mode,
+    count_rows,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+)
 from geonature.utils.utilsgeometrytools import export_as_geo_file
+from geonature.utils.export_store import get_export_store
 
 from geonature.core.gn_meta.models import TDatasets
+from geonature.core.sensitivity.routes import refresh_diffusion_geometries
 from geonature.core.notifications.utils import dispatch_notifications
 
 from geonature.core.gn_synthese.models import (
     BibReportsTypes,
     CorAreaSynthese,
+    CorAreaSyntheseChunk,
     DefaultsNomenclaturesValue,
     Synthese,
     TSources,
@@ -44,10 +61,35 @@ from geonature.core.gn_synthese.models import (
     VColorAreaTaxon,
     TReport,
     SyntheseLogEntry,
+    TExportJob,
+    TStatsObservers,
+    TStatsTaxa,
+    TDiffusionGeometries,
 )
 from geonature.core.gn_synthese.synthese_config import MANDATORY_COLUMNS
 
 from geonature.core.gn_synthese.utils.query_select_sqla import SyntheseQuery
+from geonature.core.gn_synthese.utils.exports import (
+    get_metadata_export,
+    get_observations_export,
+    get_observations_export_key,
+    get_status_export,
+    get_taxons_export,
+)
+from geonature.core.gn_synthese.tasks import (
+    COR_AREA_MODES,
+    attach_areas_chunk,
+    attach_chunk,
+    count_attach_chunks,
+    create_attach_job,
+    get_cor_area_mode,
+    get_exports_dir,
+    get_nb_pending_areas,
+    get_unfinished_attach_job,
+    process_export_job,
+    set_cor_area_mode,
+    set_rollup_triggers,
+)
 
 from geonature.core.gn_permissions import decorators as permissions
 from geonature.core.gn_permissions.decorators import login_required, permissions_required
@@ -57,18 +99,11 @@ from ref_geo.models import LAreas, BibAreasTypes
 
 from apptax.taxonomie.models import (
     Taxref,
-    bdc_statut_cor_text_area,
-    Taxref,
-    TaxrefBdcStatutCorTextValues,
-    TaxrefBdcStatutTaxon,
-    TaxrefBdcStatutText,
-    TaxrefBdcStatutType,
-    TaxrefBdcStatutValues,
     VMTaxrefListForautocomplete,
 )
 
 
-routes = Blueprint("gn_synthese", __name__)
+routes = Blueprint("gn_synthese", __name__, cli_group="synthese")
 
 
 ############################################
@@ -102,6 +137,10 @@ def get_observations_for_web(permissions):
         geojson["properties"] = properties
 
     :qparam str limit: Limit number of synthese returned. Defaults to NB_MAX_OBS_MAP.
+    :qparam str cursor: Get the observations following the page of this ``next_cursor``
+    :qparam str count: Count of all filtered observations: exact, estimate or none (default)
+    :qparam str diffusion_geometries: if "true", serve the geometries degraded according
+        to the diffusion level of the observations, and exclude those not to be diffused
     :qparam str cd_ref_parent: filtre tous les taxons enfants d'un TAXREF cd_ref.
     :qparam str cd_ref: Filter by TAXREF cd_ref attribute
     :qparam str taxonomy_group2_inpn: Filter by TAXREF group2_inpn attribute
@@ -119,9 +158,9 @@ def get_observations_for_web(permissions):
     :qparam str period_end: *tbd*
     :qparam str area*: Generic filter on area
     :qparam str *: Generic filter, given by colname & value
-    :>jsonarr array data: Array of synthese with geojson key, see above
-    :>jsonarr int nb_total: Number of observations
-    :>jsonarr bool nb_obs_limited: Is number of observations capped
+    :>jsonarr array features: Array of synthese with geojson key, see above
+    :>jsonarr str next_cursor: Cursor of the next page, null if this is the last one
+    :>jsonarr int nb_total: Number of observations, if requested
     """
     filters = request.json if request.is_json else {}
     if type(filters) != dict:
@@ -132,6 +171,8 @@ def get_observations_for_web(permissions):
     output_format = request.args.get("format", "ungrouped_geom")
     if output_format not in ["ungrouped_geom", "grouped_geom", "grouped_geom_by_areas"]:
         raise BadRequest(f"Bad format '{output_format}'")
+    count_mode = check_count_mode(request.args.get("count", "none"))
+    diffusion_geometries = request.args.get("diffusion_geometries") == "true"
 
     # Get Column Frontend parameter to return only the needed columns
     param_column_list = {
@@ -172,11 +213,12 @@ def get_observations_for_web(permissions):
 
     observations = func.json_build_object(*columns).label("obs_as_json")
 
+    # Keyset pagination: observations are ordered by this unique key
+    key_columns = [VSyntheseForWebApp.date_min, VSyntheseForWebApp.id_synthese]
     obs_query = (
-        # select([VSyntheseForWebApp.id_synthese, observations])
-        select([observations])
+        select([observations, *key_columns])
         .where(VSyntheseForWebApp.the_geom_4326.isnot(None))
-        .order_by(VSyntheseForWebApp.date_min.desc())
+        .order_by(*[column.desc() for column in key_columns])
         .limit(result_limit)
     )
 
@@ -185,13 +227,22 @@ def get_observations_for_web(permissions):
         VSyntheseForWebApp,
         obs_query,
         filters,
+        diffusion_geometries=diffusion_geometries,
+        semi_joins=True,
     )
     synthese_query_class.filter_query_all_filters(g.current_user, permissions)
     obs_query = synthese_query_class.query
+    if diffusion_geometries:
+        # SQLAlchemy 1.4: replace column by add_columns
+        obs_query = obs_query.column(TDiffusionGeometries.the_geom_4326.label("diffusion_geom"))
+    nb_total = count_rows(obs_query.limit(None), count_mode)
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        obs_query = obs_query.where(keyset_filter(key_columns, decode_cursor(cursor, key_columns)))
 
     if output_format == "grouped_geom_by_areas":
-        # SQLAlchemy 1.4: replace column by add_columns
-        obs_query = obs_query.column(VSyntheseForWebApp.id_synthese).cte("OBS")
+        obs_query = obs_query.cte("OBS")
         agg_areas = (
             select([CorAreaSynthese.id_synthese, LAreas.id_area])
             .select_from(
@@ -208,8 +259,19 @@ def get_observations_for_web(permissions):
             )
             .lateral("agg_areas")
         )
+        geojson = LAreas.geojson_4326
+        if diffusion_geometries:
+            # degraded observations must not be located more precisely
+            geojson = func.coalesce(func.st_asgeojson(obs_query.c.diffusion_geom), geojson)
         obs_query = (
-            select([LAreas.geojson_4326.label("geojson"), obs_query.c.obs_as_json])
+            select(
+                [
+                    geojson.label("geojson"),
+                    obs_query.c.obs_as_json,
+                    obs_query.c.date_min,
+                    obs_query.c.id_synthese,
+                ]
+            )
             .select_from(
                 obs_query.outerjoin(
                     agg_areas, agg_areas.c.id_synthese == obs_query.c.id_synthese
@@ -218,32 +280,191 @@ def get_observations_for_web(permissions):
             .cte("OBSERVATIONS")
         )
     else:
+        geojson = VSyntheseForWebApp.st_asgeojson
+        if diffusion_geometries:
+            geojson = func.st_asgeojson(synthese_query_class.geom_4326)
         # SQLAlchemy 1.4: replace column by add_columns
-        obs_query = obs_query.column(VSyntheseForWebApp.st_asgeojson.label("geojson")).cte(
-            "OBSERVATIONS"
-        )
+        obs_query = obs_query.column(geojson.label("geojson")).cte("OBSERVATIONS")
 
+    # Properties are fetched as json text: geometries and properties encoded by the
+    # database are spliced into the response without being decoded / re-encoded
     if output_format == "ungrouped_geom":
-        query = select([obs_query.c.geojson, obs_query.c.obs_as_json])
+        query = select(
+            [
+                obs_query.c.geojson,
+                sa.cast(obs_query.c.obs_as_json, sa.Text).label("properties"),
+                sa.literal(1).label("nb_obs"),
+                obs_query.c.date_min,
+                obs_query.c.id_synthese,
+            ]
+        )
     else:
         # Group geometries with main query
         grouped_properties = func.json_build_object(
             "observations", func.json_agg(obs_query.c.obs_as_json).label("observations")
         )
-        query = select([obs_query.c.geojson, grouped_properties]).group_by(obs_query.c.geojson)
+        # last key of the group, i.e. its first one in ascending order
+        group_keys = func.array_agg(
+            aggregate_order_by(
+                obs_query.c.id_synthese, obs_query.c.date_min, obs_query.c.id_synthese
+            ),
+            type_=ARRAY(sa.Integer),
+        )
+        query = select(
+            [
+                obs_query.c.geojson,
+                sa.cast(grouped_properties, sa.Text).label("properties"),
+                func.count().label("nb_obs"),
+                func.min(obs_query.c.date_min).label("date_min"),
+                group_keys[1].label("id_synthese"),
+            ]
+        ).group_by(obs_query.c.geojson)
+
+    page = {"nb_obs": 0, "last_key": None}
+
+    def features():
+        for row in iter_results(query):
+            key = (row.date_min, row.id_synthese)
+            if page["last_key"] is None or key < page["last_key"]:
+                page["last_key"] = key
+            page["nb_obs"] += row.nb_obs
+            yield row.geojson, row.properties
+
+    def members():
+        next_cursor = None
+        if page["nb_obs"] >= result_limit and page["last_key"] is not None:
+            next_cursor = encode_cursor(page["last_key"])
+        if count_mode == "none":
+            return {"next_cursor": next_cursor}
+        return {"next_cursor": next_cursor, "nb_total": nb_total}
+
+    return Response(
+        stream_with_context(generate_geojson(features(), members=members)),
+        mimetype="application/json",
+    )
+
+
+# half width of the Web Mercator (EPSG:3857) square covered by the tiles
+WEB_MERCATOR_BOUND = 20037508.342789244
+
+
+def get_tile_bounds(z, x, y):
+    """
+    Bounds (xmin, ymin, xmax, ymax) in Web Mercator of the tile z/x/y,
+    as ST_TileEnvelope which needs PostGIS 3
+    """
+    size = 2 * WEB_MERCATOR_BOUND / 2**z
+    return (
+        -WEB_MERCATOR_BOUND + x * size,
+        WEB_MERCATOR_BOUND - (y + 1) * size,
+        -WEB_MERCATOR_BOUND + (x + 1) * size,
+        WEB_MERCATOR_BOUND - y * size,
+    )
+
+
+@routes.route("/tiles/<int:z>/<int:x>/<int:y>.mvt", methods=["GET", "POST"])
+@permissions_required("R", module_code="SYNTHESE")
+def get_observations_tile(permissions, z, x, y):
+    """Vector tile (Mapbox Vector Tile) of the observations with all filters.
 
-    results = DB.session.execute(query)
+    .. :quickref: Synthese; Get a vector tile of filtered observations
 
-    # Build final GeoJson
-    geojson_features = []
-    for geom_as_geojson, properties in results:
-        geojson_features.append(
-            Feature(
-                geometry=json.loads(geom_as_geojson) if geom_as_geojson else None,
-                properties=properties,
+    The filters are the same as the /for_web route. They are sent as JSON body
+    or, for GET requests, as a JSON encoded ``filters`` query parameter.
+
+    With the ``grouped_geom_by_areas`` format, the tile contains the areas of type
+    AREA_AGGREGATION_TYPE with the number of observations in the ``areas`` layer.
+    Otherwise, it contains at most NB_MAX_OBS_TILE observations (the more recent)
+    in the ``observations`` layer.
+
+    :qparam str format: ``ungrouped_geom`` (default) or ``grouped_geom_by_areas``
+    :qparam str filters: JSON encoded filters (GET requests)
+    """
+    if z > 30 or not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise NotFound("Tile does not exist")
+    if request.is_json:
+        filters = request.json
+    else:
+        try:
+            filters = json.loads(request.args.get("filters", "{}"))
+        except ValueError:
+            raise BadRequest("Bad filters")
+    if type(filters) != dict:
+        raise BadRequest("Bad filters")
+    output_format = request.args.get("format", "ungrouped_geom")
+    if output_format not in ["ungrouped_geom", "grouped_geom_by_areas"]:
+        raise BadRequest(f"Bad format '{output_format}'")
+
+    tile_bounds = func.ST_MakeEnvelope(*get_tile_bounds(z, x, y), 3857)
+    if output_format == "grouped_geom_by_areas":
+        obs_query = select([VSyntheseForWebApp.id_synthese])
+    else:
+        obs_query = (
+            select(
+                [
+                    VSyntheseForWebApp.id_synthese.label("id"),
+                    VSyntheseForWebApp.cd_nom,
+                    func.coalesce(
+                        func.nullif(VSyntheseForWebApp.nom_vern, ""), VSyntheseForWebApp.lb_nom
+                    ).label("nom_vern_or_lb_nom"),
+                    func.to_char(VSyntheseForWebApp.date_min, "YYYY-MM-DD").label("date_min"),
+                    func.ST_AsMVTGeom(
+                        func.ST_Transform(VSyntheseForWebApp.the_geom_4326, 3857), tile_bounds
+                    ).label("geom"),
+                ]
+            )
+            .order_by(VSyntheseForWebApp.date_min.desc())
+            .limit(current_app.config["SYNTHESE"]["NB_MAX_OBS_TILE"])
+        )
+        obs_query = obs_query.where(
+            func.ST_Intersects(
+                VSyntheseForWebApp.the_geom_4326, func.ST_Transform(tile_bounds, 4326)
             )
         )
-    return jsonify(FeatureCollection(geojson_features))
+    synthese_query_class = SyntheseQuery(VSyntheseForWebApp, obs_query, filters, semi_joins=True)
+    synthese_query_class.filter_query_all_filters(g.current_user, permissions)
+    obs_query = synthese_query_class.query
+
+    if output_format == "grouped_geom_by_areas":
+        # all the observations of the areas in the tile are counted,
+        # so an area has the same count in every tile
+        areas_srid = DB.session.execute(func.Find_SRID("ref_geo", "l_areas", "geom")).scalar()
+        obs_query = obs_query.cte("OBS")
+        layer_query = (
+            select(
+                [
+                    LAreas.id_area,
+                    func.count(obs_query.c.id_synthese).label("nb_obs"),
+                    func.ST_AsMVTGeom(func.ST_Transform(LAreas.geom, 3857), tile_bounds).label(
+                        "geom"
+                    ),
+                ]
+            )
+            .select_from(
+                obs_query.join(
+                    CorAreaSynthese, CorAreaSynthese.id_synthese == obs_query.c.id_synthese
+                )
+                .join(LAreas, LAreas.id_area == CorAreaSynthese.id_area)
+                .join(BibAreasTypes, BibAreasTypes.id_type == LAreas.id_type)
+            )
+            .where(
+                BibAreasTypes.type_code == current_app.config["SYNTHESE"]["AREA_AGGREGATION_TYPE"]
+            )
+            .where(func.ST_Intersects(LAreas.geom, func.ST_Transform(tile_bounds, areas_srid)))
+            .group_by(LAreas.id_area)
+        )
+        layer_name = "areas"
+    else:
+        layer_query = obs_query
+        layer_name = "observations"
+
+    layer = layer_query.alias("layer")
+    tile = DB.session.execute(
+        select([func.ST_AsMVT(sa.literal_column("layer"), layer_name, 4096, "geom")]).select_from(
+            layer
+        )
+    ).scalar()
+    return Response(bytes(tile or b""), mimetype="application/vnd.mapbox-vector-tile")
 
 
 @routes.route("/vsynthese/<id_synthese>", methods=["GET"])
@@ -335,64 +556,18 @@ def export_taxon_web(permissions):
     :query str export_format: str<'csv'>
 
     """
-    taxon_view = GenericTable(
-        tableName="v_synthese_taxon_for_export_view",
-        schemaName="gn_synthese",
-        engine=DB.engine,
-    )
-    columns = taxon_view.tableDef.columns
-
-    # Test de conformité de la vue v_synthese_for_export_view
-    try:
-        assert hasattr(taxon_view.tableDef.columns, "cd_ref")
-    except AssertionError as e:
-        return (
-            {
-                "msg": """
-                        View v_synthese_taxon_for_export_view
-                        must have a cd_ref column \n
-                        trace: {}
-                        """.format(
-                    str(e)
-                )
-            },
-            500,
-        )
-
     id_list = request.get_json()
 
-    sub_query = (
-        select(
-            [
-                VSyntheseForWebApp.cd_ref,
-                func.count(distinct(VSyntheseForWebApp.id_synthese)).label("nb_obs"),
-                func.min(VSyntheseForWebApp.date_min).label("date_min"),
-                func.max(VSyntheseForWebApp.date_max).label("date_max"),
-            ]
-        )
-        .where(VSyntheseForWebApp.id_synthese.in_(id_list))
-        .group_by(VSyntheseForWebApp.cd_ref)
-    )
-
-    synthese_query_class = SyntheseQuery(
-        VSyntheseForWebApp,
-        sub_query,
-        {},
-    )
-
-    synthese_query_class.filter_query_all_filters(g.current_user, permissions)
-
-    subq = synthese_query_class.query.alias("subq")
-
-    q = DB.session.query(*columns, subq.c.nb_obs, subq.c.date_min, subq.c.date_max).join(
-        subq, subq.c.cd_ref == columns.cd_ref
-    )
+    try:
+        columns, data = get_taxons_export(g.current_user, permissions, id_list)
+    except GeonatureApiError as e:
+        return {"msg": e.message}, e.status_code
 
     return to_csv_resp(
         datetime.datetime.now().strftime("%Y_%m_%d_%Hh%Mm%S"),
-        data=serializeQuery(q.all(), q.column_descriptions),
+        data=data,
         separator=";",
-        columns=[db_col.key for db_col in columns] + ["nb_obs", "date_min", "date_max"],
+        columns=columns,
     )
 
 
@@ -420,88 +595,53 @@ def export_observations_web(permissions):
 
     # get list of id synthese from POST
     id_list = request.get_json()
+    limit = current_app.config["SYNTHESE"]["NB_MAX_OBS_EXPORT"]
 
-    # Get the SRID for the export
-    srid = DB.session.execute(func.Find_SRID("gn_synthese", "synthese", "the_geom_local")).scalar()
-
-    # Get the CTE for synthese filtered by user permissions
-    synthese_query_class = SyntheseQuery(
-        Synthese,
-        select([Synthese.id_synthese]),
-        {},
-    )
-    synthese_query_class.filter_query_all_filters(g.current_user, permissions)
-    cte_synthese_filtered = synthese_query_class.build_query().cte("cte_synthese_filtered")
-
-    # Get the view for export
-    export_view = GenericTableGeo(
-        tableName="v_synthese_for_export",
-        schemaName="gn_synthese",
-        engine=DB.engine,
-        geometry_field=None,
-        srid=srid,
-    )
-
-    # Get the query for export
-    export_query = (
-        select([export_view.tableDef])
-        .select_from(
-            export_view.tableDef.join(
-                cte_synthese_filtered,
-                cte_synthese_filtered.c.id_synthese == export_view.tableDef.c.id_synthese,
-            )
-        )
-        .where(
-            export_view.tableDef.columns[
-                current_app.config["SYNTHESE"]["EXPORT_ID_SYNTHESE_COL"]
-            ].in_(id_list)
-        )
-    )
-
-    # Get the results for export
-    results = DB.session.execute(
-        export_query.limit(current_app.config["SYNTHESE"]["NB_MAX_OBS_EXPORT"])
+    export_view, export_query, db_cols_for_shape, columns_to_serialize = get_observations_export(
+        g.current_user, permissions, id_list, limit=limit
     )
 
-    db_cols_for_shape = []
-    columns_to_serialize = []
-    # loop over synthese config to get the columns for export
-    for db_col in export_view.db_cols:
-        if db_col.key in current_app.config["SYNTHESE"]["EXPORT_COLUMNS"]:
-            db_cols_for_shape.append(db_col)
-            columns_to_serialize.append(db_col.key)
+    # Get the results for export, fetched by batch with a server-side cursor
+    results = iter_results(export_query)
 
     file_name = datetime.datetime.now().strftime("%Y_%m_%d_%Hh%Mm%S")
     file_name = filemanager.removeDisallowedFilenameChars(file_name)
 
     if export_format == "csv":
-        formated_data = [export_view.as_dict(d, columns=columns_to_serialize) for d in results]
-        return to_csv_resp(file_name, formated_data, separator=";", columns=columns_to_serialize)
+        formated_data = (export_view.as_dict(d, columns=columns_to_serialize) for d in results)
+        return to_csv_stream_resp(
+            file_name, formated_data, separator=";", columns=columns_to_serialize
+        )
     elif export_format == "geojson":
-        features = []
-        for r in results:
-            geometry = json.loads(
-                getattr(r, current_app.config["SYNTHESE"]["EXPORT_GEOJSON_4326_COL"])
-            )
-            feature = Feature(
-                geometry=geometry,
-                properties=export_view.as_dict(r, columns=columns_to_serialize),
-            )
-            features.append(feature)
-        results = FeatureCollection(features)
-        return to_json_resp(results, as_file=True, filename=file_name, indent=4)
+        geojson_col = current_app.config["SYNTHESE"]["EXPORT_GEOJSON_4326_COL"]
+        features = (
+            (getattr(r, geojson_col), export_view.as_dict(r, columns=columns_to_serialize))
+            for r in results
+        )
+        return to_geojson_stream_resp(file_name, features)
     else:
+        # geographic files are costly to build: they are kept and reused for identical exports
+        store = get_export_store()
         try:
-            dir_name, file_name = export_as_geo_file(
+            return export_as_geo_file(
                 export_format=export_format,
                 export_view=export_view,
                 db_cols=db_cols_for_shape,
                 geojson_col=current_app.config["SYNTHESE"]["EXPORT_GEOJSON_LOCAL_COL"],
-                data=results,
+                query=export_query,
                 file_name=file_name,
+                store=store,
+                key=get_observations_export_key(
+                    store,
+                    g.current_user,
+                    permissions,
+                    id_list,
+                    export_format,
+                    export_view,
+                    columns_to_serialize,
+                    limit=limit,
+                ),
             )
-            return send_from_directory(dir_name, file_name, as_attachment=True)
-
         except GeonatureApiError as e:
             message = str(e)
 
@@ -528,58 +668,10 @@ def export_metadata(permissions):
     """
     filters = request.json if request.is_json else {}
 
-    metadata_view = GenericTable(
-        tableName="v_metadata_for_export",
-        schemaName="gn_synthese",
-        engine=DB.engine,
-    )
-
-    # Test de conformité de la vue v_metadata_for_export
     try:
-        assert hasattr(metadata_view.tableDef.columns, "jdd_id")
-    except AssertionError as e:
-        return (
-            {
-                "msg": """
-                        View v_metadata_for_export
-                        must have a jdd_id column \n
-                        trace: {}
-                        """.format(
-                    str(e)
-                )
-            },
-            500,
-        )
-
-    q = select([distinct(VSyntheseForWebApp.id_dataset), metadata_view.tableDef])
-
-    synthese_query_class = SyntheseQuery(
-        VSyntheseForWebApp,
-        q,
-        filters,
-    )
-    synthese_query_class.add_join(
-        metadata_view.tableDef,
-        getattr(
-            metadata_view.tableDef.columns,
-            current_app.config["SYNTHESE"]["EXPORT_METADATA_ID_DATASET_COL"],
-        ),
-        VSyntheseForWebApp.id_dataset,
-    )
-
-    # Filter query with permissions (scope, sensitivity, ...)
-    synthese_query_class.filter_query_all_filters(g.current_user, permissions)
-
-    data = DB.session.execute(synthese_query_class.query)
-
-    # Define the header of the csv file
-    columns = [db_col.key for db_col in metadata_view.tableDef.columns]
-    columns[columns.index("nombre_obs")] = "nombre_total_obs"
-
-    # Retrieve the data to write in the csv file
-    data = [metadata_view.as_dict(d) for d in data]
-    for d in data:
-        d["nombre_total_obs"] = d.pop("nombre_obs")
+        columns, data = get_metadata_export(g.current_user, permissions, filters)
+    except GeonatureApiError as e:
+        return {"msg": e.message}, e.status_code
 
     return to_csv_resp(
         datetime.datetime.now().strftime("%Y_%m_%d_%Hh%Mm%S"),
@@ -604,112 +696,107 @@ def export_status(permissions):
     """
     filters = request.json if request.is_json else {}
 
-    # Initalize the select object
-    q = select(
-        [
-            distinct(VSyntheseForWebApp.cd_nom),
-            Taxref.cd_ref,
-            Taxref.nom_complet,
-            Taxref.nom_vern,
-            TaxrefBdcStatutTaxon.rq_statut,
-            TaxrefBdcStatutType.regroupement_type,
-            TaxrefBdcStatutType.lb_type_statut,
-            TaxrefBdcStatutText.cd_sig,
-            TaxrefBdcStatutText.full_citation,
-            TaxrefBdcStatutText.doc_url,
-            TaxrefBdcStatutValues.code_statut,
-            TaxrefBdcStatutValues.label_statut,
-        ]
+    columns, data = get_status_export(g.current_user, permissions, filters)
+
+    return to_csv_resp(
+        datetime.datetime.now().strftime("%Y_%m_%d_%Hh%Mm%S"),
+        data,
+        separator=";",
+        columns=columns,
     )
 
-    # Initialize SyntheseQuery class
-    synthese_query = SyntheseQuery(VSyntheseForWebApp, q, filters)
 
-    # Filter query with permissions
-    synthese_query.filter_query_all_filters(g.current_user, permissions)
+@routes.route("/export_jobs/<export_type>", methods=["POST"])
+@permissions_required("E", module_code="SYNTHESE")
+def create_export_job(permissions, export_type):
+    """Enqueue an export to be processed by a celery worker
 
-    # Add join
-    synthese_query.add_join(Taxref, Taxref.cd_nom, VSyntheseForWebApp.cd_nom)
-    synthese_query.add_join(
-        CorAreaSynthese,
-        CorAreaSynthese.id_synthese,
-        VSyntheseForWebApp.id_synthese,
-    )
-    synthese_query.add_join(
-        bdc_statut_cor_text_area, bdc_statut_cor_text_area.c.id_area, CorAreaSynthese.id_area
-    )
-    synthese_query.add_join(TaxrefBdcStatutTaxon, TaxrefBdcStatutTaxon.cd_ref, Taxref.cd_ref)
-    synthese_query.add_join(
-        TaxrefBdcStatutCorTextValues,
-        TaxrefBdcStatutCorTextValues.id_value_text,
-        TaxrefBdcStatutTaxon.id_value_text,
-    )
-    synthese_query.add_join_multiple_cond(
-        TaxrefBdcStatutText,
-        [
-            TaxrefBdcStatutText.id_text == TaxrefBdcStatutCorTextValues.id_text,
-            TaxrefBdcStatutText.id_text == bdc_statut_cor_text_area.c.id_text,
-        ],
-    )
-    synthese_query.add_join(
-        TaxrefBdcStatutType,
-        TaxrefBdcStatutType.cd_type_statut,
-        TaxrefBdcStatutText.cd_type_statut,
+    .. :quickref: Synthese;
+
+    The user is notified when the export file is ready,
+    it can then be downloaded with the /export_jobs/<id>/download route.
+
+    POST parameters: the same as the corresponding synchronous export route,
+    i.e. a list of id_synthese for 'observations' and 'taxons' exports,
+    and the filters of the synthese search for 'metadata' and 'statuts' exports.
+
+    :param str export_type: str<'observations', 'taxons', 'metadata', 'statuts'>
+    :query str export_format: str<'csv', 'geojson', 'shapefile', 'gpkg'>,
+        only 'csv' is available for other exports than 'observations'
+    """
+    export_format = request.args.get("export_format", "csv")
+    if export_type == "observations":
+        if export_format not in current_app.config["SYNTHESE"]["EXPORT_FORMAT"]:
+            raise BadRequest("Unsupported format")
+        params = {"id_list": request.get_json()}
+    elif export_type == "taxons":
+        params = {"id_list": request.get_json()}
+    elif export_type in ("metadata", "statuts"):
+        params = {"filters": request.json if request.is_json else {}}
+    else:
+        raise NotFound(f"Unknown export type '{export_type}'")
+    if export_type != "observations" and export_format != "csv":
+        raise BadRequest("Unsupported format")
+    if "id_list" in params and not isinstance(params["id_list"], list):
+        raise BadRequest("A list of id_synthese is expected")
+    if "filters" in params and not isinstance(params["filters"], dict):
+        raise BadRequest("Bad filters")
+
+    job = TExportJob(
+        id_role=g.current_user.id_role,
+        export_type=export_type,
+        export_format=export_format,
+        params=params,
     )
-    synthese_query.add_join(
-        TaxrefBdcStatutValues,
-        TaxrefBdcStatutValues.id_value,
-        TaxrefBdcStatutCorTextValues.id_value,
+    db.session.add(job)
+    db.session.commit()
+    process_export_job.delay(job.id_export_job)
+    return jsonify(job.as_dict(exclude=["params"]))
+
+
+@routes.route("/export_jobs", methods=["GET"])
+@login_required
+def list_export_jobs():
+    """List the export jobs of the current user
+
+    .. :quickref: Synthese;
+    """
+    jobs = (
+        TExportJob.query.filter_by(id_role=g.current_user.id_role)
+        .order_by(TExportJob.creation_date.desc())
+        .all()
     )
+    return jsonify([job.as_dict(exclude=["params"]) for job in jobs])
 
-    # Build query
-    q = synthese_query.build_query()
 
-    # Set enable status texts filter
-    q = q.where(TaxrefBdcStatutText.enable == True)
+def get_user_export_job(id_export_job):
+    job = TExportJob.query.get_or_404(id_export_job)
+    if job.id_role != g.current_user.id_role:
+        raise Forbidden
+    return job
 
-    protection_status = []
-    data = DB.session.execute(q)
-    for d in data:
-        row = OrderedDict(
-            [
-                ("cd_nom", d["cd_nom"]),
-                ("cd_ref", d["cd_ref"]),
-                ("nom_complet", d["nom_complet"]),
-                ("nom_vern", d["nom_vern"]),
-                ("type_regroupement", d["regroupement_type"]),
-                ("type", d["lb_type_statut"]),
-                ("territoire_application", d["cd_sig"]),
-                ("intitule_doc", re.sub("<[^<]+?>", "", d["full_citation"])),
-                ("code_statut", d["code_statut"]),
-                ("intitule_statut", d["label_statut"]),
-                ("remarque", d["rq_statut"]),
-                ("url_doc", d["doc_url"]),
-            ]
-        )
-        protection_status.append(row)
-
-    export_columns = [
-        "nom_complet",
-        "nom_vern",
-        "cd_nom",
-        "cd_ref",
-        "type_regroupement",
-        "type",
-        "territoire_application",
-        "intitule_doc",
-        "code_statut",
-        "intitule_statut",
-        "remarque",
-        "url_doc",
-    ]
 
-    return to_csv_resp(
-        datetime.datetime.now().strftime("%Y_%m_%d_%Hh%Mm%S"),
-        protection_status,
-        separator=";",
-        columns=export_columns,
-    )
+@routes.route("/export_jobs/<int:id_export_job>", methods=["GET"])
+@login_required
+def get_export_job(id_export_job):
+    """Get the status and progress of an export job
+
+    .. :quickref: Synthese;
+    """
+    return jsonify(get_user_export_job(id_export_job).as_dict(exclude=["params"]))
+
+
+@routes.route("/export_jobs/<int:id_export_job>/download", methods=["GET"])
+@login_required
+def download_export_job(id_export_job):
+    """Download the file of a finished export job
+
+    .. :quickref: Synthese;
+    """
+    job = get_user_export_job(id_export_job)
+    if job.status != TExportJob.STATUS_SUCCESS:
+        raise Conflict(f"Export job status is {job.status}")
+    return send_from_directory(get_exports_dir(), job.file_name, as_attachment=True)
 
 
 ######################################
@@ -731,22 +818,21 @@ def general_stats(permissions):
         - nb of datasets
     """
     allowed_datasets = TDatasets.query.filter_by_readable().count()
-    q = select(
-        [
-            func.count(Synthese.id_synthese),
-            func.count(func.distinct(Synthese.cd_nom)),
-            func.count(func.distinct(Synthese.observers)),
-        ]
-    )
-    synthese_query_obj = SyntheseQuery(Synthese, q, {})
-    synthese_query_obj.filter_query_with_cruved(g.current_user, permissions)
-    result = DB.session.execute(synthese_query_obj.query)
-    synthese_counts = result.fetchone()
+    # counts of the whole synthese, read from the statistics tables maintained by triggers
+    nb_data, nb_species = DB.session.execute(
+        select(
+            [
+                sa.cast(func.coalesce(func.sum(TStatsTaxa.nb_obs), 0), sa.BigInteger),
+                func.count(func.distinct(TStatsTaxa.cd_nom)),
+            ]
+        )
+    ).fetchone()
+    nb_observers = DB.session.query(func.count(TStatsObservers.id_stats_observers)).scalar()
 
     data = {
-        "nb_data": synthese_counts[0],
-        "nb_species": synthese_counts[1],
-        "nb_observers": synthese_counts[2],
+        "nb_data": nb_data,
+        "nb_species": nb_species,
+        "nb_observers": nb_observers,
         "nb_dataset": allowed_datasets,
     }
     return data
@@ -925,10 +1011,10 @@ def get_taxa_count():
     """
     params = request.args
 
-    query = DB.session.query(func.count(distinct(Synthese.cd_nom))).select_from(Synthese)
+    query = DB.session.query(func.count(distinct(TStatsTaxa.cd_nom)))
 
     if "id_dataset" in params:
-        query = query.filter(Synthese.id_dataset == params["id_dataset"])
+        query = query.filter(TStatsTaxa.id_dataset == params["id_dataset"])
     return query.one()
 
 
@@ -953,10 +1039,10 @@ def get_observation_count():
     """
     params = request.args
 
-    query = DB.session.query(func.count(Synthese.id_synthese)).select_from(Synthese)
+    query = DB.session.query(sa.cast(func.coalesce(func.sum(TStatsTaxa.nb_obs), 0), sa.BigInteger))
 
     if "id_dataset" in params:
-        query = query.filter(Synthese.id_dataset == params["id_dataset"])
+        query = query.filter(TStatsTaxa.id_dataset == params["id_dataset"])
 
     return query.one()
 
@@ -1041,21 +1127,21 @@ def get_taxa_distribution():
     Taxref.group2_inpn
 
     query = (
-        DB.session.query(func.count(distinct(Synthese.cd_nom)), rank)
-        .select_from(Synthese)
-        .outerjoin(Taxref, Taxref.cd_nom == Synthese.cd_nom)
+        DB.session.query(func.count(distinct(TStatsTaxa.cd_nom)), rank)
+        .select_from(TStatsTaxa)
+        .outerjoin(Taxref, Taxref.cd_nom == TStatsTaxa.cd_nom)
     )
 
     if id_dataset:
-        query = query.filter(Synthese.id_dataset == id_dataset)
+        query = query.filter(TStatsTaxa.id_dataset == id_dataset)
 
     elif id_af:
-        query = query.outerjoin(TDatasets, TDatasets.id_dataset == Synthese.id_dataset).filter(
+        query = query.outerjoin(TDatasets, TDatasets.id_dataset == TStatsTaxa.id_dataset).filter(
             TDatasets.id_acquisition_framework == id_af
         )
     # User can add id_source filter along with id_dataset or id_af
     if id_source is not None:
-        query = query.filter(Synthese.id_source == id_source)
+        query = query.filter(TStatsTaxa.id_source == id_source)
 
     data = query.group_by(rank).all()
     return jsonify([{"count": d[0], "group": d[1]} for d in data])
@@ -1324,3 +1410,131 @@ def list_synthese_log_entries() -> dict:
             "page": page,
         }
     )
+
+
+######################################
+############# COMMANDS ###############
+######################################
+
+
+@routes.cli.command()
+@click.argument("mode", type=click.Choice(COR_AREA_MODES), required=False)
+def cor_area_mode(mode):
+    """
+    Affiche ou change le mode de rattachement des nouvelles zones aux observations.
+
+    En mode « immediate », les zones insérées dans ref_geo.l_areas sont intersectées
+    avec toute la synthèse dans la transaction de leur insertion.
+    En mode « defer », elles sont mises en attente : à utiliser pendant l’import d’un
+    grand nombre de zones, puis lancer la commande attach-areas.
+    """
+    if mode is not None:
+        set_cor_area_mode(mode)
+    click.echo(f"Mode : {get_cor_area_mode()}")
+    nb_pending = get_nb_pending_areas()
+    if nb_pending:
+        click.echo(f"{nb_pending} zones en attente de rattachement (commande attach-areas)")
+
+
+@routes.cli.command()
+@click.argument("state", type=click.Choice(["enable", "disable"]))
+@click.pass_context
+def rollup_triggers(ctx, state):
+    """
+    Active ou désactive les triggers maintenant les tables dérivées de la synthèse.
+
+    Ces triggers (statistiques, statistiques des jeux de données, géométries de diffusion,
+    file des profils) relisent les lignes modifiées par chaque requête sur la synthèse :
+    les désactiver pendant un chargement massif. Leur réactivation recalcule entièrement
+    les tables dérivées.
+    """
+    set_rollup_triggers(state == "enable")
+    if state == "enable":
+        ctx.invoke(refresh_diffusion_geometries)
+        click.echo("Lancer « geonature profiles update » pour recalculer les profils")
+
+
+@routes.cli.command()
+@click.option(
+    "--tile-size",
+    default=10000,
+    show_default=True,
+    help="Côté des tuiles traitées par lot, dans l’unité du SRID local",
+)
+@click.option("--resume", is_flag=True, help="Reprend le dernier rattachement inachevé")
+@click.option(
+    "--celery", "use_celery", is_flag=True, help="Répartit les tuiles entre les workers Celery"
+)
+@click.option(
+    "--timeout",
+    default=3600,
+    show_default=True,
+    help="Avec --celery, abandonne l’attente après ce nombre de secondes sans tuile traitée",
+)
+def attach_areas(tile_size, resume, use_celery, timeout):
+    """
+    Rattache aux observations de la synthèse les zones mises en attente (mode « defer »).
+
+    Les zones sont intersectées avec les observations tuile par tuile, chaque tuile
+    étant validée dans sa propre transaction : s’il est interrompu, le rattachement
+    peut être repris avec --resume, qui traite aussi les tuiles en erreur.
+    """
+    if resume:
+        job = get_unfinished_attach_job()
+        if job is None:
+            click.echo("Aucun rattachement à reprendre")
+            return
+    else:
+        job = create_attach_job(tile_size)
+        if job is None:
+            click.echo("Aucune zone en attente de rattachement")
+            return
+    chunks = job.pending_chunks
+    click.echo(f"{len(job.id_areas)} zones à rattacher, {len(chunks)} tuiles à traiter")
+
+    if use_celery:
+        nb_done = len(job.chunks) - len(chunks)
+        for chunk in chunks:
+            chunk.error = None
+        db.session.commit()
+        for chunk in chunks:
+            attach_areas_chunk.delay(job.id_job, chunk.id_chunk)
+        id_job = job.id_job
+
+        def count_dispatched_chunks():
+            processed, failed = count_attach_chunks(id_job)
+            return processed - nb_done, failed
+
+        try:
+            _, failed = wait_for_chunks(
+                count_dispatched_chunks,
+                len(chunks),
+                label="Rattachement des zones",
+                timeout=timeout,
+            )
+        except TimeoutError:
+            raise click.ClickException(
+                f"Aucune tuile traitée depuis {timeout} secondes, vérifier que les workers "
+                "Celery sont démarrés puis reprendre le rattachement avec --resume"
+            )
+        if failed:
+            errors = CorAreaSyntheseChunk.query.filter(
+                CorAreaSyntheseChunk.id_job == id_job,
+                CorAreaSyntheseChunk.error.isnot(None),
+            )
+            for chunk in errors:
+                click.echo(f"Tuile {chunk.id_chunk} en erreur : {chunk.error}", err=True)
+            raise click.ClickException(
+                f"{failed} tuiles en erreur, reprendre le rattachement avec --resume"
+            )
+    else:
+        with click.progressbar(chunks, label="Rattachement des zones") as bar:
+            for chunk in bar:
+                attach_chunk(chunk)
+
+    count = (
+        db.session.query(func.sum(CorAreaSyntheseChunk.nb_inserted))
+        .filter(CorAreaSyntheseChunk.id_job == job.id_job)
+        .scalar()
+    )
+    click.echo(f"{count or 0} lignes ajoutées dans cor_area_synthese")
@@ -0,0 +1,428 @@
+import datetime
+import uuid
+from pathlib import Path
+
+from flask import current_app, g
+import sqlalchemy as sa
+from sqlalchemy import func, select
+from celery.schedules import crontab
+from celery.utils.log import get_task_logger
+
+from pypnusershub.db.models import User
+
+from geonature.utils.config import config
+from geonature.utils.env import db
+from geonature.utils.celery import celery_app
+from geonature.utils.streaming import (
+    iter_results,
+    generate_csv,
+    generate_geojson,
+)
+from geonature.utils.export_store import get_export_store, link_file
+from geonature.utils.utilsgeometrytools import with_wkb_geometry, write_geo_archive
+from geonature.core.gn_permissions.tools import get_permissions
+from geonature.core.gn_commons.models import TParameters
+from geonature.core.gn_synthese.models import (
+    CorAreaSyntheseChunk,
+    CorAreaSyntheseJob,
+    TExportJob,
+)
+from geonature.core.gn_synthese.utils.exports import (
+    compact_synthese_changes,
+    get_metadata_export,
+    get_observations_export,
+    get_observations_export_key,
+    get_status_export,
+    get_taxons_export,
+)
+from geonature.core.notifications.utils import dispatch_notifications
+
+
+logger = get_task_logger(__name__)
+
+# Number of exported rows between two updates of the job progress
+PROGRESS_STEP = 10000
+
+EXPORT_EXTENSIONS = {"csv": "csv", "geojson": "geojson", "gpkg": "gpkg"}
+
+
+@celery_app.on_after_finalize.connect
+def setup_periodic_tasks(sender, **kwargs):
+    ct = config["EXPORT_CACHE_CLEAN_CRONTAB"]
+    if ct:
+        minute, hour, day_of_month, month_of_year, day_of_week = ct.split(" ")
+        sender.add_periodic_task(
+            crontab(
+                minute=minute,
+                hour=hour,
+                day_of_week=day_of_week,
+                day_of_month=day_of_month,
+                month_of_year=month_of_year,
+            ),
+            clean_export_artifacts.s(),
+            name="clean export artifacts",
+        )
+
+
+def get_exports_dir():
+    exports_dir = Path(current_app.config["MEDIA_FOLDER"]) / "exports"
+    exports_dir.mkdir(parents=True, exist_ok=True)
+    return exports_dir
+
+
+def _update_job(id_export_job, **values):
+    """
+    Update the job in its own transaction, so the progress is visible
+    while the export query is still running in the session transaction.
+    """
+    db.engine.execute(
+        TExportJob.__table__.update()
+        .where(TExportJob.id_export_job == id_export_job)
+        .values(**values)
+    )
+
+
+def _track_progress(job, data, nb_rows):
+    for i, row in enumerate(data, 1):
+        if nb_rows and i % PROGRESS_STEP == 0:
+            _update_job(job.id_export_job, progress=min(99, int(100 * i / nb_rows)))
+        yield row
+
+
+def _write_file(path, chunks):
+    with open(path, "w", encoding="utf-8") as fp:
+        for chunk in chunks:
+            fp.write(chunk)
+
+
+def _export_observations(job, user, permissions, exports_dir, file_name):
+    """
+    Export files are kept in the export artifacts store: the job file is a link
+    to the file of an identical previous export, or to the new file.
+    The number of rows is only known when the file is written.
+    """
+    limit = current_app.config["SYNTHESE"]["NB_MAX_OBS_EXPORT_JOB"]
+    export_view, export_query, db_cols, columns = get_observations_export(
+        user, permissions, job.params["id_list"], limit=limit
+    )
+    ext = EXPORT_EXTENSIONS.get(job.export_format, "zip")
+    store = get_export_store()
+    key = get_observations_export_key(
+        store,
+        user,
+        permissions,
+        job.params["id_list"],
+        job.export_format,
+        export_view,
+        columns,
+        limit=limit,
+    )
+
+    def write(path):
+        job.nb_rows = db.session.execute(
+            select([func.count()]).select_from(export_query.alias())
+        ).scalar()
+        query = export_query
+        if job.export_format not in ("csv", "geojson"):
+            query = with_wkb_geometry(
+                query, export_view, current_app.config["SYNTHESE"]["EXPORT_GEOJSON_LOCAL_COL"]
+            )
+        results = _track_progress(job, iter_results(query), job.nb_rows)
+        if job.export_format == "csv":
+            data = (export_view.as_dict(r, columns=columns) for r in results)
+            _write_file(path, generate_csv(columns, data))
+        elif job.export_format == "geojson":
+            geojson_col = current_app.config["SYNTHESE"]["EXPORT_GEOJSON_4326_COL"]
+            features = (
+                (getattr(r, geojson_col), export_view.as_dict(r, columns=columns)) for r in results
+            )
+            _write_file(path, generate_geojson(features))
+        else:
+            geo_format = "gpkg" if job.export_format == "gpkg" else "shp"
+            write_geo_archive(geo_format, export_view, db_cols, results, path, store.file_name)
+
+    path = store.get(key, ext)
+    if path is None:
+        path = store.put(key, ext, write)
+    else:
+        logger.info(f"Export job {job.id_export_job}: reuse of an identical export")
+    file_name += f".{ext}"
+    link_file(path, exports_dir / file_name)
+    return file_name
+
+
+def _export_csv(job, user, permissions, exports_dir, file_name):
+    if job.export_type == "taxons":
+        columns, data = get_taxons_export(user, permissions, job.params["id_list"])
+    elif job.export_type == "metadata":
+        columns, data = get_metadata_export(user, permissions, job.params["filters"])
+    else:
+        columns, data = get_status_export(user, permissions, job.params["filters"])
+    job.nb_rows = len(data)
+    file_name += ".csv"
+    _write_file(exports_dir / file_name, generate_csv(columns, data))
+    return file_name
+
+
+def run_export_job(job):
+    """
+    Write the export file of the job in MEDIA_FOLDER/exports
+    with the permissions of the user who requested it.
+    """
+    user = User.query.get(job.id_role)
+    # no request context here: initialize what the permissions tools expect
+    g.current_user = user
+    g._permissions_by_user = {}
+    g._permissions = {}
+    permissions = get_permissions("E", id_role=user.id_role, module_code="SYNTHESE")
+    if not permissions:
+        raise PermissionError(f"User {user.id_role} has no permissions to E in SYNTHESE")
+
+    # MEDIA_FOLDER is publicly served: use a not guessable file name
+    file_name = "{}_{}_{}_{}".format(
+        job.export_type,
+        job.id_export_job,
+        datetime.datetime.now().strftime("%Y_%m_%d_%Hh%Mm%S"),
+        uuid.uuid4().hex,
+    )
+    if job.export_type == "observations":
+        return _export_observations(job, user, permissions, get_exports_dir(), file_name)
+    else:
+        return _export_csv(job, user, permissions, get_exports_dir(), file_name)
+
+
+@celery_app.task(bind=True)
+def process_export_job(self, id_export_job):
+    job = TExportJob.query.get(id_export_job)
+    if job is None:
+        logger.warning(f"Export job {id_export_job} not found")
+        return
+    logger.info(f"Process export job {id_export_job}...")
+    job.status = TExportJob.STATUS_RUNNING
+    db.session.commit()
+
+    try:
+        job.file_name = run_export_job(job)
+    except Exception as exc:
+        logger.exception(f"Export job {id_export_job} failed")
+        db.session.rollback()
+        job.status = TExportJob.STATUS_FAILURE
+        job.error = str(exc)
+        job.end_date = datetime.datetime.utcnow()
+        db.session.commit()
+        return
+
+    job.status = TExportJob.STATUS_SUCCESS
+    job.progress = 100
+    job.end_date = datetime.datetime.utcnow()
+    dispatch_notifications(
+        code_categories=["SYNTHESE-EXPORT"],
+        id_roles=[job.id_role],
+        title="Export de la synthèse prêt",
+        url=(
+            current_app.config["API_ENDPOINT"]
+            + f"/synthese/export_jobs/{job.id_export_job}/download"
+        ),
+        context={"export": job},
+    )
+    db.session.commit()
+    logger.info(f"Export job {id_export_job} done.")
+
+
+@celery_app.task(bind=True)
+def clean_export_artifacts(self):
+    logger.info("Cleaning export artifacts...")
+    nb_files = get_export_store().clean()
+    logger.info(f"{nb_files} export artifacts removed.")
+    compact_synthese_changes()
+    db.session.commit()
+
+
+# gn_commons.t_parameters parameter read by the insert trigger on ref_geo.l_areas
+COR_AREA_MODE_PARAMETER = "cor_area_synthese_mode"
+COR_AREA_MODES = ("immediate", "defer")
+
+
+def _get_cor_area_mode_parameter():
+    return TParameters.query.filter_by(
+        parameter_name=COR_AREA_MODE_PARAMETER, id_organism=None
+    ).one()
+
+
+def get_cor_area_mode():
+    """
+    "immediate": new areas are intersected with the synthese when they are inserted
+    "defer": new areas are queued, to be processed by an attach job
+    """
+    return _get_cor_area_mode_parameter().parameter_value
+
+
+def set_cor_area_mode(mode):
+    if mode not in COR_AREA_MODES:
+        raise ValueError(f"Unknown cor_area_synthese mode: {mode}")
+    _get_cor_area_mode_parameter().parameter_value = mode
+    db.session.commit()
+
+
+def set_rollup_triggers(enabled):
+    """
+    Enable or disable the triggers maintaining the tables derived from the synthese
+    (statistics, dataset stats, diffusion geometries, profiles queue), e.g. during a
+    bulk load. When they are enabled again, the statistics and dataset stats are rebuilt
+    and all taxa are queued for the profiles refresh; diffusion geometries must be
+    refreshed by the caller.
+    """
+    db.session.execute(select([func.gn_synthese.set_rollup_triggers(enabled)]))
+    if enabled:
+        db.session.execute(select([func.gn_synthese.refresh_stats()]))
+        db.session.execute(
+            "SELECT gn_meta.refresh_dataset_stats(ARRAY(SELECT id_dataset FROM gn_meta.t_datasets))"
+        )
+        db.session.execute(
+            """
+            INSERT INTO gn_profiles.t_stale_taxa (cd_nom)
+            SELECT DISTINCT cd_nom FROM gn_synthese.synthese WHERE cd_nom IS NOT NULL
+            """
+        )
+    db.session.commit()
+
+
+def get_nb_pending_areas():
+    return db.session.execute(
+        "SELECT count(*) FROM gn_synthese.t_cor_area_synthese_pending"
+    ).scalar()
+
+
+def create_attach_job(tile_size):
+    """
+    Create a job attaching the pending areas to the observations of the synthese,
+    split in square tiles of `tile_size` covering the pending areas.
+
+    :returns: the job, or None if no area is pending
+    """
+    id_areas = sorted(
+        id_area
+        for id_area, in db.session.execute(
+            "DELETE FROM gn_synthese.t_cor_area_synthese_pending RETURNING id_area"
+        )
+    )
+    if not id_areas:
+        db.session.commit()
+        return None
+    tiles = db.session.execute(
+        sa.text(
+            """
+        SELECT gx * :size AS xmin, gy * :size AS ymin
+        FROM
+            (
+                SELECT public.ST_Extent(geom) AS box
+                FROM ref_geo.l_areas
+                WHERE id_area = ANY(:id_areas) AND enable IS true
+            ) extent,
+            generate_series(
+                floor(public.ST_XMin(box) / :size)::integer,
+                floor(public.ST_XMax(box) / :size)::integer
+            ) gx,
+            generate_series(
+                floor(public.ST_YMin(box) / :size)::integer,
+                floor(public.ST_YMax(box) / :size)::integer
+            ) gy
+        WHERE EXISTS (
+            SELECT 1
+            FROM ref_geo.l_areas a
+            WHERE a.id_area = ANY(:id_areas)
+                AND a.enable IS true
+                AND a.geom && public.ST_MakeEnvelope(
+                    gx * :size, gy * :size, (gx + 1) * :size, (gy + 1) * :size, public.ST_SRID(a.geom)
+                )
+        )
+        ORDER BY gy, gx
+        """
+        ),
+        {"size": tile_size, "id_areas": id_areas},
+    )
+    job = CorAreaSyntheseJob(id_areas=id_areas, tile_size=tile_size)
+    job.chunks = [
+        CorAreaSyntheseChunk(
+            id_chunk=id_chunk, xmin=xmin, ymin=ymin, xmax=xmin + tile_size, ymax=ymin + tile_size
+        )
+        for id_chunk, (xmin, ymin) in enumerate(tiles)
+    ]
+    if not job.chunks:
+        job.end_date = func.now()
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def get_unfinished_attach_job():
+    return (
+        CorAreaSyntheseJob.query.filter(CorAreaSyntheseJob.end_date.is_(None))
+        .order_by(CorAreaSyntheseJob.id_job.desc())
+        .first()
+    )
+
+
+def attach_chunk(chunk):
+    """
+    Insert in cor_area_synthese the observations of the tile intersecting the areas
+    of the job, in its own transaction.
+    """
+    tile = func.ST_MakeEnvelope(
+        chunk.xmin,
+        chunk.ymin,
+        chunk.xmax,
+        chunk.ymax,
+        func.Find_SRID("gn_synthese", "synthese", "the_geom_local"),
+    )
+    chunk.nb_inserted = db.session.execute(
+        select([func.gn_synthese.insert_cor_area_synthese(chunk.job.id_areas, tile)])
+    ).scalar()
+    chunk.update_date = datetime.datetime.now()
+    chunk.error = None
+    db.session.commit()
+    # checked after the commit, so that the last finished chunk sees all the others
+    db.session.execute(
+        CorAreaSyntheseJob.__table__.update()
+        .where(CorAreaSyntheseJob.id_job == chunk.id_job)
+        .where(CorAreaSyntheseJob.end_date.is_(None))
+        .where(
+            ~sa.exists()
+            .where(CorAreaSyntheseChunk.id_job == chunk.id_job)
+            .where(CorAreaSyntheseChunk.nb_inserted.is_(None))
+        )
+        .values(end_date=func.now())
+    )
+    db.session.commit()
+    return chunk.nb_inserted
+
+
+@celery_app.task(bind=True)
+def attach_areas_chunk(self, id_job, id_chunk):
+    chunk = CorAreaSyntheseChunk.query.get((id_job, id_chunk))
+    if chunk is None or chunk.done:
+        return
+    logger.info(f"Attach areas to the synthese, job {id_job} tile {id_chunk}...")
+    try:
+        nb_inserted = attach_chunk(chunk)
+    except Exception as exc:
+        logger.exception(f"Attach areas job {id_job} tile {id_chunk} failed")
+        db.session.rollback()
+        chunk.error = str(exc)
+        db.session.commit()
+        return
+    logger.info(f"{nb_inserted} rows inserted in cor_area_synthese.")
+
+
+def count_attach_chunks(id_job):
+    """Numbers of processed and failed tiles of the job"""
+    return (
+        db.session.query(
+            func.count(CorAreaSyntheseChunk.nb_inserted),
+            func.count(CorAreaSyntheseChunk.error).filter(
+                CorAreaSyntheseChunk.nb_inserted.is_(None)
+            ),
+        )
+        .filter(CorAreaSyntheseChunk.id_job == id_job)
+        .one()
+    )
@@ -0,0 +1,368 @@
+"""
+Queries of the synthese exports
+
+They are shared by the export routes and by the asynchronous export jobs
+"""
+import re
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import distinct, func, select
+
+from utils_flask_sqla.generic import serializeQuery, GenericTable
+from utils_flask_sqla_geo.generic import GenericTableGeo
+
+from geonature.utils.env import DB
+from geonature.utils.errors import GeonatureApiError
+from geonature.core.gn_meta.models import CorRoleDatasetScope
+from geonature.core.gn_synthese.models import CorAreaSynthese, Synthese, VSyntheseForWebApp
+from geonature.core.gn_synthese.utils.query_select_sqla import SyntheseQuery
+
+from apptax.taxonomie.models import (
+    Taxref,
+    bdc_statut_cor_text_area,
+    TaxrefBdcStatutCorTextValues,
+    TaxrefBdcStatutTaxon,
+    TaxrefBdcStatutText,
+    TaxrefBdcStatutType,
+    TaxrefBdcStatutValues,
+)
+
+
+def get_observations_export(user, permissions, id_list, limit=None):
+    """
+    Build the query of the observations export (view gn_synthese.v_synthese_for_export)
+
+    Returns
+    -------
+    export_view: GenericTableGeo
+    export_query: select
+    db_cols: list
+        exported columns, used to build geographic files
+    columns: list
+        exported columns names
+    """
+    # Get the SRID for the export
+    srid = DB.session.execute(func.Find_SRID("gn_synthese", "synthese", "the_geom_local")).scalar()
+
+    # Get the CTE for synthese filtered by user permissions
+    synthese_query_class = SyntheseQuery(
+        Synthese,
+        select([Synthese.id_synthese]),
+        {},
+    )
+    synthese_query_class.filter_query_all_filters(user, permissions)
+    cte_synthese_filtered = synthese_query_class.build_query().cte("cte_synthese_filtered")
+
+    # Get the view for export
+    export_view = GenericTableGeo(
+        tableName="v_synthese_for_export",
+        schemaName="gn_synthese",
+        engine=DB.engine,
+        geometry_field=None,
+        srid=srid,
+    )
+
+    # Get the query for export
+    export_query = (
+        select([export_view.tableDef])
+        .select_from(
+            export_view.tableDef.join(
+                cte_synthese_filtered,
+                cte_synthese_filtered.c.id_synthese == export_view.tableDef.c.id_synthese,
+            )
+        )
+        .where(
+            export_view.tableDef.columns[
+                current_app.config["SYNTHESE"]["EXPORT_ID_SYNTHESE_COL"]
+            ].in_(id_list)
+        )
+    )
+    if limit is not None:
+        export_query = export_query.limit(limit)
+
+    db_cols = []
+    columns = []
+    # loop over synthese config to get the columns for export
+    for db_col in export_view.db_cols:
+        if db_col.key in current_app.config["SYNTHESE"]["EXPORT_COLUMNS"]:
+            db_cols.append(db_col)
+            columns.append(db_col.key)
+
+    return export_view, export_query, db_cols, columns
+
+
+def get_synthese_version():
+    """
+    Version of the synthese data, increased by each committed transaction changing
+    the synthese (see gn_synthese.t_synthese_changes)
+    """
+    return DB.session.execute(
+        "SELECT coalesce(sum(weight), 0) FROM gn_synthese.t_synthese_changes"
+    ).scalar()
+
+
+def compact_synthese_changes():
+    """
+    Replace the rows of gn_synthese.t_synthese_changes by a single row of the same
+    total weight: the version is unchanged. Rows of transactions not yet committed
+    are not visible, and are kept.
+    """
+    DB.session.execute(
+        """
+        WITH deleted AS (DELETE FROM gn_synthese.t_synthese_changes RETURNING weight)
+        INSERT INTO gn_synthese.t_synthese_changes (weight)
+        SELECT sum(weight) FROM deleted HAVING count(*) > 0
+        """
+    )
+
+
+def get_observations_export_key(
+    store, user, permissions, id_list, export_format, export_view, columns, limit=None
+):
+    """
+    Key of the observations export in the export artifacts store
+
+    The key covers the parameters of the export (selected observations, format,
+    columns), the permissions of the user, and the version of the synthese data.
+    For limited scopes, it covers the user and the datasets they can read, so only
+    users with unlimited scopes share files.
+    Changes of the data joined by the export view (taxonomy, metadata...) are not
+    tracked: they show up once the files expire (EXPORT_CACHE_MAX_AGE).
+    """
+    scopes = []
+    for perm in permissions:
+        # permissions ignored by SyntheseQuery.filter_query_with_permissions
+        if perm.has_other_filters_than("SCOPE", "SENSITIVITY"):
+            continue
+        scope = [perm.scope_value, bool(perm.sensitivity_filter)]
+        if perm.scope_value in (1, 2):
+            id_datasets = DB.session.execute(
+                CorRoleDatasetScope.select_id_datasets(user.id_role, perm.scope_value)
+            )
+            scope += [user.id_role, sorted(id_dataset for id_dataset, in id_datasets)]
+        scopes.append(scope)
+    return store.key(
+        "observations",
+        export_format,
+        export_view.srid,
+        list(columns),
+        limit,
+        sorted(scopes, key=str),
+        sorted({int(id_synthese) for id_synthese in id_list}),
+        get_synthese_version(),
+    )
+
+
+def get_taxons_export(user, permissions, id_list):
+    """
+    Data of the taxons export (view gn_synthese.v_synthese_taxon_for_export_view)
+
+    Returns a tuple (columns, data)
+    """
+    taxon_view = GenericTable(
+        tableName="v_synthese_taxon_for_export_view",
+        schemaName="gn_synthese",
+        engine=DB.engine,
+    )
+    columns = taxon_view.tableDef.columns
+
+    # Test de conformité de la vue v_synthese_for_export_view
+    if not hasattr(columns, "cd_ref"):
+        raise GeonatureApiError(
+            "View v_synthese_taxon_for_export_view must have a cd_ref column", status_code=500
+        )
+
+    sub_query = (
+        select(
+            [
+                VSyntheseForWebApp.cd_ref,
+                func.count(distinct(VSyntheseForWebApp.id_synthese)).label("nb_obs"),
+                func.min(VSyntheseForWebApp.date_min).label("date_min"),
+                func.max(VSyntheseForWebApp.date_max).label("date_max"),
+            ]
+        )
+        .where(VSyntheseForWebApp.id_synthese.in_(id_list))
+        .group_by(VSyntheseForWebApp.cd_ref)
+    )
+
+    synthese_query_class = SyntheseQuery(
+        VSyntheseForWebApp,
+        sub_query,
+        {},
+    )
+
+    synthese_query_class.filter_query_all_filters(user, permissions)
+
+    subq = synthese_query_class.query.alias("subq")
+
+    q = DB.session.query(*columns, subq.c.nb_obs, subq.c.date_min, subq.c.date_max).join(
+        subq, subq.c.cd_ref == columns.cd_ref
+    )
+
+    return (
+        [db_col.key for db_col in columns] + ["nb_obs", "date_min", "date_max"],
+        serializeQuery(q.all(), q.column_descriptions),
+    )
+
+
+def get_metadata_export(user, permissions, filters):
+    """
+    Data of the metadata export (view gn_synthese.v_metadata_for_export)
+
+    Returns a tuple (columns, data)
+    """
+    metadata_view = GenericTable(
+        tableName="v_metadata_for_export",
+        schemaName="gn_synthese",
+        engine=DB.engine,
+    )
+
+    # Test de conformité de la vue v_metadata_for_export
+    if not hasattr(metadata_view.tableDef.columns, "jdd_id"):
+        raise GeonatureApiError(
+            "View v_metadata_for_export must have a jdd_id column", status_code=500
+        )
+
+    q = select([distinct(VSyntheseForWebApp.id_dataset), metadata_view.tableDef])
+
+    synthese_query_class = SyntheseQuery(
+        VSyntheseForWebApp,
+        q,
+        filters,
+        semi_joins=True,
+    )
+    synthese_query_class.add_join(
+        metadata_view.tableDef,
+        getattr(
+            metadata_view.tableDef.columns,
+            current_app.config["SYNTHESE"]["EXPORT_METADATA_ID_DATASET_COL"],
+        ),
+        VSyntheseForWebApp.id_dataset,
+    )
+
+    # Filter query with permissions (scope, sensitivity, ...)
+    synthese_query_class.filter_query_all_filters(user, permissions)
+
+    data = DB.session.execute(synthese_query_class.query)
+
+    # Define the header of the csv file
+    columns = [db_col.key for db_col in metadata_view.tableDef.columns]
+    columns[columns.index("nombre_obs")] = "nombre_total_obs"
+
+    # Retrieve the data to write in the csv file
+    data = [metadata_view.as_dict(d) for d in data]
+    for d in data:
+        d["nombre_total_obs"] = d.pop("nombre_obs")
+
+    return columns, data
+
+
+STATUS_EXPORT_COLUMNS = [
+    "nom_complet",
+    "nom_vern",
+    "cd_nom",
+    "cd_ref",
+    "type_regroupement",
+    "type",
+    "territoire_application",
+    "intitule_doc",
+    "code_statut",
+    "intitule_statut",
+    "remarque",
+    "url_doc",
+]
+
+
+def get_status_export(user, permissions, filters):
+    """
+    Data of the protection status export
+
+    Returns a tuple (columns, data)
+    """
+    # Initalize the select object
+    q = select(
+        [
+            distinct(VSyntheseForWebApp.cd_nom),
+            Taxref.cd_ref,
+            Taxref.nom_complet,
+            Taxref.nom_vern,
+            TaxrefBdcStatutTaxon.rq_statut,
+            TaxrefBdcStatutType.regroupement_type,
+            TaxrefBdcStatutType.lb_type_statut,
+            TaxrefBdcStatutText.cd_sig,
+            TaxrefBdcStatutText.full_citation,
+            TaxrefBdcStatutText.doc_url,
+            TaxrefBdcStatutValues.code_statut,
+            TaxrefBdcStatutValues.label_statut,
+        ]
+    )
+
+    # Initialize SyntheseQuery class
+    synthese_query = SyntheseQuery(VSyntheseForWebApp, q, filters, semi_joins=True)
+
+    # Filter query with permissions
+    synthese_query.filter_query_all_filters(user, permissions)
+
+    # Add join
+    synthese_query.add_join(Taxref, Taxref.cd_nom, VSyntheseForWebApp.cd_nom)
+    synthese_query.add_join(
+        CorAreaSynthese,
+        CorAreaSynthese.id_synthese,
+        VSyntheseForWebApp.id_synthese,
+    )
+    synthese_query.add_join(
+        bdc_statut_cor_text_area, bdc_statut_cor_text_area.c.id_area, CorAreaSynthese.id_area
+    )
+    synthese_query.add_join(TaxrefBdcStatutTaxon, TaxrefBdcStatutTaxon.cd_ref, Taxref.cd_ref)
+    synthese_query.add_join(
+        TaxrefBdcStatutCorTextValues,
+        TaxrefBdcStatutCorTextValues.id_value_text,
+        TaxrefBdcStatutTaxon.id_value_text,
+    )
+    synthese_query.add_join_multiple_cond(
+        TaxrefBdcStatutText,
+        [
+            TaxrefBdcStatutText.id_text == TaxrefBdcStatutCorTextValues.id_text,
+            TaxrefBdcStatutText.id_text == bdc_statut_cor_text_area.c.id_text,
+        ],
+    )
+    synthese_query.add_join(
+        TaxrefBdcStatutType,
+        TaxrefBdcStatutType.cd_type_statut,
+        TaxrefBdcStatutText.cd_type_statut,
+    )
+    synthese_query.add_join(
+        TaxrefBdcStatutValues,
+        TaxrefBdcStatutValues.id_value,
+        TaxrefBdcStatutCorTextValues.id_value,
+    )
+
+    # Build query
+    q = synthese_query.build_query()
+
+    # Set enable status texts filter
+    q = q.where(TaxrefBdcStatutText.enable == True)
+
+    protection_status = []
+    data = DB.session.execute(q)
+    for d in data:
+        row = OrderedDict(
+            [
+                ("cd_nom", d["cd_nom"]),
+                ("cd_ref", d["cd_ref"]),
+                ("nom_complet", d["nom_complet"]),
+                ("nom_vern", d["nom_vern"]),
+                ("type_regroupement", d["regroupement_type"]),
+                ("type", d["lb_type_statut"]),
+                ("territoire_application", d["cd_sig"]),
+                ("intitule_doc", re.sub("<[^<]+?>", "", d["full_citation"])),
+                ("code_statut", d["code_statut"]),
+                ("intitule_statut", d["label_statut"]),
+                ("remarque", d["rq_statut"]),
+                ("url_doc", d["doc_url"]),
+            ]
+        )
+        protection_status.append(row)
+
+    return STATUS_EXPORT_COLUMNS, protection_status
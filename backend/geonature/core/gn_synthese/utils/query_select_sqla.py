@@ -26,11 +26,13 @@ from geonature.core.gn_synthese.models import (
     CorObserverSynthese,
     CorAreaSynthese,
     BibReportsTypes,
+    TDiffusionGeometries,
     TReport,
     TSources,
 )
 from geonature.core.gn_meta.models import (
     CorDatasetActor,
+    CorRoleDatasetScope,
     TDatasets,
 )
 from geonature.utils.errors import GeonatureApiError
@@ -58,6 +60,11 @@ class SyntheseQuery:
         model: a SQLA model
         _already_joined_table: (private) a list of already joined table. Auto build with 'add_join' method
         query_joins = SQLA Join object
+        diffusion_geometries: serve the geometries degraded according to the
+            diffusion level (see :meth:`filter_diffusion_geometries`)
+        semi_joins: filter on areas with EXISTS semi-joins instead of joining
+            cor_area_synthese once per area filter, which duplicates the observations
+            found in several areas and multiplies the joined rows
     """
 
     def __init__(
@@ -71,8 +78,12 @@ class SyntheseQuery:
         id_digitiser_column="id_digitiser",
         with_generic_table=False,
         query_joins=None,
+        diffusion_geometries=False,
+        semi_joins=False,
     ):
         self.query = query
+        self.diffusion_geometries = diffusion_geometries
+        self.semi_joins = semi_joins
 
         self.filters = filters
         self.first = query_joins is None
@@ -115,7 +126,14 @@ class SyntheseQuery:
         else:
             # check if the table not already joined
             if right_table not in self._already_joined_table:
-                self.query_joins = self.query_joins.join(right_table, left_column == right_column)
+                if join_type == "right":
+                    self.query_joins = self.query_joins.join(
+                        right_table, left_column == right_column
+                    )
+                else:
+                    self.query_joins = self.query_joins.outerjoin(
+                        right_table, left_column == right_column
+                    )
                 # push the joined table in _already_joined_table list
                 self._already_joined_table.append(right_table)
 
@@ -139,7 +157,6 @@ class SyntheseQuery:
             .select_from(CorObserverSynthese)
             .where(CorObserverSynthese.id_role == user.id_role)
         )
-        datasets_by_scope = {}  # to avoid fetching datasets several time for same scope
         permissions_filters = []
         nomenclature_non_sensible = None
         for perm in permissions:
@@ -161,18 +178,12 @@ class SyntheseQuery:
                     self.model.id_nomenclature_sensitivity
                     == nomenclature_non_sensible.id_nomenclature
                 )
-            if perm.scope_value:
-                if perm.scope_value not in datasets_by_scope:
-                    datasets_by_scope[perm.scope_value] = [
-                        d.id_dataset
-                        for d in TDatasets.query.filter_by_scope(perm.scope_value).all()
-                    ]
-                datasets = datasets_by_scope[perm.scope_value]
+            if perm.scope_value in (1, 2):
                 scope_filters = [
                     self.model_id_syn_col.in_(subquery_observers),  # user is observer
                     self.model_id_digitiser_column == user.id_role,  # user id digitizer
                     self.model_id_dataset_column.in_(
-                        datasets
+                        CorRoleDatasetScope.select_id_datasets(user.id_role, perm.scope_value)
                     ),  # user is dataset (or parent af) actor
                 ]
                 perm_filters.append(or_(*scope_filters))
@@ -201,8 +212,11 @@ class SyntheseQuery:
                 self.model_id_digitiser_column == user.id_role,
             ]
 
-            allowed_datasets = [d.id_dataset for d in TDatasets.query.filter_by_scope(scope).all()]
-            ors_filters.append(self.model_id_dataset_column.in_(allowed_datasets))
+            ors_filters.append(
+                self.model_id_dataset_column.in_(
+                    CorRoleDatasetScope.select_id_datasets(user.id_role, scope)
+                )
+            )
 
             self.query = self.query.where(or_(*ors_filters))
 
@@ -343,10 +357,11 @@ class SyntheseQuery:
         if "observers" in self.filters:
             # découpe des éléments saisies par des ","
             observers = self.filters.pop("observers").split(",")
+            # immutable_unaccent matches the trigram index on observers
             self.query = self.query.where(
                 or_(
                     *[
-                        func.unaccent(self.model.observers).ilike(
+                        func.gn_synthese.immutable_unaccent(self.model.observers).ilike(
                             "%" + remove_accents(observer) + "%"
                         )
                         for observer in observers
@@ -365,13 +380,13 @@ class SyntheseQuery:
             )
 
         if "id_organism" in self.filters:
-            datasets = (
-                DB.session.query(CorDatasetActor.id_dataset)
-                .filter(CorDatasetActor.id_organism.in_(self.filters.pop("id_organism")))
-                .all()
+            self.query = self.query.where(
+                self.model.id_dataset.in_(
+                    select([CorDatasetActor.id_dataset]).where(
+                        CorDatasetActor.id_organism.in_(self.filters.pop("id_organism"))
+                    )
+                )
             )
-            formated_datasets = [d[0] for d in datasets]
-            self.query = self.query.where(self.model.id_dataset.in_(formated_datasets))
         if "date_min" in self.filters:
             self.query = self.query.where(self.model.date_min >= self.filters.pop("date_min"))
         if "date_max" in self.filters:
@@ -452,7 +467,13 @@ class SyntheseQuery:
             self.query = self.query.where(self.model.unique_id_sinp == uuid_filter)
         # generic filters
         for colname, value in self.filters.items():
-            if colname.startswith("area"):
+            if colname.startswith("area") and self.semi_joins:
+                self.query = self.query.where(
+                    sa.exists()
+                    .where(CorAreaSynthese.id_synthese == self.model_id_syn_col)
+                    .where(CorAreaSynthese.id_area.in_(value))
+                )
+            elif colname.startswith("area"):
                 cor_area_synthese_alias = aliased(CorAreaSynthese)
                 self.add_join(
                     cor_area_synthese_alias,
@@ -476,6 +497,35 @@ class SyntheseQuery:
                 else:
                     self.query = self.query.where(col.ilike("%{}%".format(value)))
 
+    @property
+    def geom_4326(self):
+        """
+        Geometry column to select: the precomputed diffusion geometry if the
+        ``diffusion_geometries`` option is set, the precise geometry otherwise
+        """
+        if self.diffusion_geometries:
+            return func.coalesce(TDiffusionGeometries.the_geom_4326, self.model.the_geom_4326)
+        return self.model.the_geom_4326
+
+    def filter_diffusion_geometries(self):
+        """
+        Join the precomputed diffusion geometries, and exclude the observations
+        which must not be diffused.
+        Use :attr:`geom_4326` to select the geometry of the observations.
+        """
+        self.add_join(
+            TDiffusionGeometries,
+            TDiffusionGeometries.id_synthese,
+            self.model_id_syn_col,
+            join_type="left",
+        )
+        self.query = self.query.where(
+            or_(
+                TDiffusionGeometries.id_synthese.is_(None),
+                TDiffusionGeometries.the_geom_4326.isnot(None),
+            )
+        )
+
     def apply_all_filters(self, user, permissions):
         if type(permissions) == int:  # scope
             self.filter_query_with_cruved(user, scope=permissions)
@@ -483,6 +533,8 @@ class SyntheseQuery:
             self.filter_query_with_permissions(user, permissions)
         self.filter_taxonomy()
         self.filter_other_filters(user)
+        if self.diffusion_geometries:
+            self.filter_diffusion_geometries()
 
     def build_query(self):
         if self.query_joins is not None:
@@ -34,6 +34,67 @@ def dispatch_notifications(
         dispatch_notification(category, role, title, url, content=content, context=context)
 
 
+def dispatch_notifications_batch(code_categories, notifications):
+    """
+    Dispatch many notifications of the same categories at once.
+
+    `notifications` is an iterable of (id_role, title, url, context) tuples.
+    Categories, roles, rules and templates are fetched once for the whole batch
+    instead of once per notification.
+    """
+    if not current_app.config["NOTIFICATIONS_ENABLED"]:
+        return
+    notifications = list(notifications)
+    if not notifications:
+        return
+
+    categories = list(
+        chain.from_iterable(
+            [
+                NotificationCategory.query.filter(NotificationCategory.code.like(code)).all()
+                for code in code_categories
+            ]
+        )
+    )
+    id_roles = {id_role for id_role, *_ in notifications}
+    roles = {role.id_role: role for role in User.query.filter(User.id_role.in_(id_roles))}
+    templates = {
+        (template.code_category, template.code_method): template.content
+        for template in NotificationTemplate.query.filter(
+            NotificationTemplate.code_category.in_([category.code for category in categories])
+        )
+    }
+    # all rules of the recipients and default rules in one query; a rule of the
+    # role overrides the default rule of the same category and method
+    rules = {}
+    for rule in NotificationRule.query.filter(
+        NotificationRule.code_category.in_([category.code for category in categories]),
+        sa.or_(NotificationRule.id_role.is_(None), NotificationRule.id_role.in_(id_roles)),
+    ).order_by(NotificationRule.id_role.asc().nullsfirst()):
+        recipients = id_roles if rule.id_role is None else [rule.id_role]
+        for id_role in recipients:
+            rules.setdefault((rule.code_category, id_role), {})[rule.code_method] = rule
+
+    for id_role, title, url, context in notifications:
+        role = roles[id_role]
+        for category in categories:
+            notification_title = title or category.label
+            render_context = {"role": role, "title": notification_title, "url": url, **context}
+            for rule in rules.get((category.code, id_role), {}).values():
+                if not rule.subscribed:
+                    continue
+                template = templates.get((category.code, rule.code_method))
+                if not template:
+                    continue
+                notification_content = Template(template).render(render_context)
+                if not notification_content.strip():
+                    continue
+                if rule.code_method == "DB":
+                    send_db_notification(role, notification_title, notification_content, url)
+                elif rule.code_method == "EMAIL":
+                    send_mail_notification(role, notification_title, notification_content)
+
+
 def dispatch_notification(category, role, title=None, url=None, *, content=None, context={}):
     if not title:
         title = category.label
@@ -0,0 +1,307 @@
+"""
+    In-process sensitivity evaluation
+
+    Same algorithm as gn_sensitivity.get_id_nomenclature_sensitivity, but active rules
+    are loaded once and indexed by cd_ref and by area, and observations are evaluated
+    by batches: taxa and intersecting areas are fetched with one query per batch
+    instead of once per observation.
+"""
+import datetime
+from collections import Counter, defaultdict, namedtuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from geonature.utils.env import db
+
+from .utils import load_sensitivity_referential
+
+
+Rule = namedtuple(
+    "Rule",
+    [
+        "id_sensitivity",
+        "id_nomenclature_sensitivity",
+        "cd_nomenclature",
+        "sensitivity_duration",
+        "period_min",  # MMDD
+        "period_max",  # MMDD
+        "areas",  # empty if the rule applies everywhere
+        "criterias",  # empty if the rule applies whatever the criterias
+    ],
+)
+
+
+class SensitivityEngine:
+    """
+    Evaluate the sensitivity of batches of observations against a set of rules.
+
+    Each observation is a mapping with ``date_min``, ``cd_ref``, ``areas`` (id of
+    the intersecting areas among :attr:`area_ids`) and ``criterias`` (id of its
+    biological status and behaviour nomenclatures).
+    """
+
+    def __init__(self, rules, nomenclatures):
+        """
+        :param rules: iterable of (cd_ref, :class:`Rule`)
+        :param nomenclatures: cd_nomenclature of the SENSIBILITE nomenclatures by id
+        """
+        self.rules = defaultdict(list)
+        self.area_ids = set()
+        for cd_ref, rule in rules:
+            self.rules[cd_ref].append(rule)
+            self.area_ids |= rule.areas
+        # cd_ref of the taxa having rules restricted to some areas
+        self.spatial_cd_refs = {
+            cd_ref for cd_ref, rules in self.rules.items() if any(rule.areas for rule in rules)
+        }
+        self.nomenclatures = nomenclatures
+        self.not_sensitive = next(
+            id_nomenclature
+            for id_nomenclature, cd_nomenclature in nomenclatures.items()
+            if cd_nomenclature == "0"
+        )
+
+    @classmethod
+    def from_database(cls):
+        """Load the active rules extrapolated to children taxa"""
+        rules = db.session.execute(
+            """
+            SELECT
+                r.cd_ref,
+                r.id_sensitivity,
+                r.id_nomenclature_sensitivity,
+                n.cd_nomenclature,
+                r.sensitivity_duration,
+                to_char(r.date_min, 'MMDD'),
+                to_char(r.date_max, 'MMDD'),
+                CASE
+                    -- an area without geometry does not restrict the rule
+                    WHEN EXISTS (
+                        SELECT 1
+                        FROM gn_sensitivity.cor_sensitivity_area c
+                        JOIN ref_geo.l_areas a USING (id_area)
+                        WHERE c.id_sensitivity = r.id_sensitivity AND a.geom IS NULL
+                    ) THEN '{}'::int[]
+                    ELSE ARRAY(
+                        SELECT c.id_area
+                        FROM gn_sensitivity.cor_sensitivity_area c
+                        WHERE c.id_sensitivity = r.id_sensitivity
+                    )
+                END,
+                ARRAY(
+                    SELECT c.id_criteria
+                    FROM gn_sensitivity.cor_sensitivity_criteria c
+                    WHERE c.id_sensitivity = r.id_sensitivity
+                )
+            FROM gn_sensitivity.t_sensitivity_rules_cd_ref r
+            JOIN ref_nomenclatures.t_nomenclatures n
+                ON n.id_nomenclature = r.id_nomenclature_sensitivity
+            """
+        )
+        nomenclatures = db.session.execute(
+            """
+            SELECT n.id_nomenclature, n.cd_nomenclature
+            FROM ref_nomenclatures.t_nomenclatures n
+            JOIN ref_nomenclatures.bib_nomenclatures_types t USING (id_type)
+            WHERE t.mnemonique = 'SENSIBILITE'
+            """
+        )
+        return cls(
+            (
+                (
+                    cd_ref,
+                    Rule(
+                        id_sensitivity,
+                        id_nomenclature,
+                        cd_nomenclature,
+                        duration,
+                        period_min,
+                        period_max,
+                        frozenset(areas),
+                        frozenset(criterias),
+                    ),
+                )
+                for (
+                    cd_ref,
+                    id_sensitivity,
+                    id_nomenclature,
+                    cd_nomenclature,
+                    duration,
+                    period_min,
+                    period_max,
+                    areas,
+                    criterias,
+                ) in rules
+            ),
+            dict(nomenclatures.fetchall()),
+        )
+
+    def evaluate_one(self, observation, current_year=None):
+        """id_nomenclature_sensitivity of one observation"""
+        if current_year is None:
+            current_year = datetime.date.today().year
+        date_obs = observation["date_min"]
+        period = date_obs.strftime("%m%d")
+        areas = observation["areas"]
+        criterias = observation["criterias"]
+        sensitivity, cd_nomenclature = self.not_sensitive, None
+        for rule in self.rules.get(observation["cd_ref"], ()):
+            if (
+                (not rule.areas or not rule.areas.isdisjoint(areas))
+                and rule.period_min <= period <= rule.period_max
+                and current_year - rule.sensitivity_duration <= date_obs.year
+                and (not rule.criterias or not rule.criterias.isdisjoint(criterias))
+                and (cd_nomenclature is None or rule.cd_nomenclature > cd_nomenclature)
+            ):
+                sensitivity, cd_nomenclature = (
+                    rule.id_nomenclature_sensitivity,
+                    rule.cd_nomenclature,
+                )
+        return sensitivity
+
+    def evaluate(self, observations):
+        """id_nomenclature_sensitivity of each observation"""
+        current_year = datetime.date.today().year
+        return [self.evaluate_one(obs, current_year=current_year) for obs in observations]
+
+    def evaluate_candidates(self, candidates, srid=4326):
+        """
+        id_nomenclature_sensitivity of observations not yet in the synthese
+
+        :param candidates: list of mappings with ``date_min``, ``cd_nom``, ``geom``
+            (WKT in `srid`) and optionally ``id_nomenclature_bio_status`` and
+            ``id_nomenclature_behaviour``
+        """
+        cd_refs = dict(
+            db.session.execute(
+                sa.text(
+                    "SELECT cd_nom, cd_ref FROM taxonomie.taxref WHERE cd_nom = ANY(:cd_noms)"
+                ),
+                {"cd_noms": list({c["cd_nom"] for c in candidates})},
+            ).fetchall()
+        )
+        geoms = [
+            c["geom"] if cd_refs.get(c["cd_nom"]) in self.spatial_cd_refs else None
+            for c in candidates
+        ]
+        areas = defaultdict(set)
+        if any(geoms):
+            areas.update(
+                (idx - 1, set(id_areas))
+                for idx, id_areas in db.session.execute(
+                    sa.text(
+                        """
+                        SELECT g.idx, array_agg(a.id_area)
+                        FROM unnest(:geoms) WITH ORDINALITY AS g(geom, idx)
+                        JOIN ref_geo.l_areas a
+                            ON a.id_area = ANY(:area_ids)
+                            AND st_intersects(
+                                a.geom,
+                                st_transform(
+                                    st_geomfromtext(g.geom, :srid),
+                                    find_srid('ref_geo', 'l_areas', 'geom')
+                                )
+                            )
+                        GROUP BY g.idx
+                        """
+                    ).bindparams(sa.bindparam("geoms", type_=ARRAY(sa.UnicodeText))),
+                    {"geoms": geoms, "area_ids": list(self.area_ids), "srid": srid},
+                )
+            )
+        return self.evaluate(
+            {
+                "date_min": c["date_min"],
+                "cd_ref": cd_refs.get(c["cd_nom"]),
+                "areas": areas[idx],
+                "criterias": {
+                    c.get("id_nomenclature_bio_status"),
+                    c.get("id_nomenclature_behaviour"),
+                }
+                - {None},
+            }
+            for idx, c in enumerate(candidates)
+        )
+
+    def iter_synthese(self, chunk_size=10000):
+        """
+        Evaluate the observations of the synthese whose sensitivity may depend on
+        the rules: observations of the taxa having rules or currently sensitive.
+
+        Yield (id_synthese, current sensitivity, evaluated sensitivity) by chunks.
+        """
+        query = sa.text(
+            """
+            SELECT
+                s.id_synthese,
+                s.date_min::date AS date_min,
+                t.cd_ref,
+                s.id_nomenclature_bio_status,
+                s.id_nomenclature_behaviour,
+                s.id_nomenclature_sensitivity,
+                CASE WHEN t.cd_ref = ANY(:spatial_cd_refs) THEN ARRAY(
+                    SELECT a.id_area
+                    FROM ref_geo.l_areas a
+                    WHERE a.id_area = ANY(:area_ids)
+                    AND st_intersects(s.the_geom_local, a.geom)
+                ) END AS areas
+            FROM gn_synthese.synthese s
+            JOIN taxonomie.taxref t USING (cd_nom)
+            WHERE s.id_synthese > :last_id
+            AND (
+                t.cd_ref = ANY(:cd_refs)
+                OR s.id_nomenclature_sensitivity IS DISTINCT FROM :not_sensitive
+            )
+            ORDER BY s.id_synthese
+            LIMIT :chunk_size
+            """
+        )
+        params = {
+            "cd_refs": list(self.rules),
+            "spatial_cd_refs": list(self.spatial_cd_refs),
+            "area_ids": list(self.area_ids),
+            "not_sensitive": self.not_sensitive,
+            "chunk_size": chunk_size,
+            "last_id": 0,
+        }
+        while True:
+            rows = db.session.execute(query, params).fetchall()
+            if not rows:
+                return
+            sensitivities = self.evaluate(
+                {
+                    "date_min": row.date_min,
+                    "cd_ref": row.cd_ref,
+                    "areas": row.areas or (),
+                    "criterias": {row.id_nomenclature_bio_status, row.id_nomenclature_behaviour}
+                    - {None},
+                }
+                for row in rows
+            )
+            for row, sensitivity in zip(rows, sensitivities):
+                yield row.id_synthese, row.id_nomenclature_sensitivity, sensitivity
+            params["last_id"] = rows[-1].id_synthese
+
+
+def simulate_referential(source, csvfile, chunk_size=10000, replace=False):
+    """
+    Simulate the loading of a sensitivity referential without writing anything:
+    the referential is loaded in a savepoint, only long enough to load the resulting
+    rules in memory, and the synthese is then evaluated against these rules.
+
+    Return the rules counts given by :func:`load_sensitivity_referential` and the
+    number of observations by change of sensitivity level, as
+    {(old cd_nomenclature, new cd_nomenclature): count}.
+    """
+    transaction = db.session.begin_nested()
+    try:
+        counts = load_sensitivity_referential(source, csvfile, replace=replace)
+        engine = SensitivityEngine.from_database()
+    finally:
+        transaction.rollback()
+    changes = Counter(
+        (engine.nomenclatures.get(old), engine.nomenclatures[new])
+        for _, old, new in engine.iter_synthese(chunk_size=chunk_size)
+        if old != new
+    )
+    return counts, dict(changes)
@@ -1,4 +1,5 @@
-from sqlalchemy import ForeignKey, event
+from sqlalchemy import ForeignKey, event, func
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.ext.associationproxy import association_proxy
 
@@ -79,3 +80,53 @@ class CorSensitivityCriteria(db.Model):
 @event.listens_for(CorSensitivityCriteria, "before_update")
 def before_insert_sensitivity_criteria(mapper, connection, target):
     target.id_nomenclature_type = target.criteria.nomenclature_type.id_type
+
+
+class SensitivityUpdateJob(db.Model):
+    """
+    Recomputation of the synthese sensitivity, split in chunks of id_synthese
+    so it can be run in parallel and resumed
+    """
+
+    __tablename__ = "t_sensitivity_update_jobs"
+    __table_args__ = {"schema": "gn_sensitivity"}
+
+    id_job = db.Column(db.Integer, primary_key=True)
+    # restrict the update to the observations of these taxa, all if NULL
+    cd_refs = db.Column(ARRAY(db.Integer))
+    chunk_size = db.Column(db.Integer, nullable=False)
+    creation_date = db.Column(db.DateTime, server_default=func.now())
+    end_date = db.Column(db.DateTime)
+
+    chunks = relationship(
+        "SensitivityUpdateChunk",
+        order_by="SensitivityUpdateChunk.id_min",
+        cascade="all, delete-orphan",
+        back_populates="job",
+    )
+
+    @property
+    def pending_chunks(self):
+        return [chunk for chunk in self.chunks if not chunk.done]
+
+
+class SensitivityUpdateChunk(db.Model):
+    __tablename__ = "t_sensitivity_update_chunks"
+    __table_args__ = {"schema": "gn_sensitivity"}
+
+    id_job = db.Column(
+        db.Integer, ForeignKey(SensitivityUpdateJob.id_job, ondelete="CASCADE"), primary_key=True
+    )
+    id_min = db.Column(db.Integer, primary_key=True)
+    id_max = db.Column(db.Integer, nullable=False)
+    # NULL until the chunk is processed
+    nb_updated = db.Column(db.Integer)
+    update_date = db.Column(db.DateTime)
+    # error of the last processing of the chunk
+    error = db.Column(db.UnicodeText)
+
+    job = relationship(SensitivityUpdateJob, back_populates="chunks")
+
+    @property
+    def done(self):
+        return self.nb_updated is not None
@@ -4,16 +4,33 @@ from contextlib import ExitStack, nullcontext
 from zipfile import ZipFile
 
 import click
-from flask import Blueprint, current_app
-from sqlalchemy import func
+from flask import Blueprint, current_app, request, jsonify
+from sqlalchemy import func, select
 from sqlalchemy.schema import Table
+from werkzeug.exceptions import BadRequest
 
 from geonature.utils.env import db
+from geonature.utils.celery import wait_for_chunks
+from geonature.core.gn_permissions.decorators import permissions_required
+from geonature.core.gn_synthese.models import Synthese
 
 from utils_flask_sqla.utils import remote_file
 
-from .models import SensitivityRule
-from .utils import remove_sensitivity_referential, insert_sensitivity_referential
+from .engine import simulate_referential
+from .models import SensitivityRule, SensitivityUpdateChunk
+from .tasks import (
+    count_chunks,
+    create_update_job,
+    get_sources_cd_refs,
+    get_unfinished_job,
+    update_chunk,
+    update_sensitivity_chunk,
+)
+from .utils import (
+    remove_sensitivity_referential,
+    load_sensitivity_referential,
+    refresh_sensitivity_rules_cache,
+)
 
 
 routes = Blueprint("sensitivity", __name__)
@@ -83,9 +100,20 @@ def info():
 @click.option("--url", help="Le fichier ou l’archive est à télécharger")
 @click.option("--zipfile", help="Le fichier CSV est contenu dans une archive")
 @click.option("--encoding")
-def add_referential(source_name, csvfile, url, zipfile, encoding):
+@click.option(
+    "--replace",
+    is_flag=True,
+    help="Supprime les règles de cette source absentes du fichier",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Affiche les changements sans modifier la base de données"
+)
+def add_referential(source_name, csvfile, url, zipfile, encoding, replace, dry_run):
     """
     Ajoute les règles pour une source données
+
+    Les règles déjà présentes pour cette source sont conservées. Avec --replace,
+    celles qui ne figurent plus dans le fichier sont supprimées.
     """
     filepath = zipfile or csvfile
     with ExitStack() as stack:
@@ -101,9 +129,99 @@ def add_referential(source_name, csvfile, url, zipfile, encoding):
         else:
             csvfile = stack.enter_context(filepath.open("r", encoding=encoding))
         click.echo(f"Ajout de règles de sensibilité '{source_name}'")
-        count = insert_sensitivity_referential(source_name, csvfile)
-    db.session.commit()
-    click.echo(f"{count} règles ajoutées")
+        counts = load_sensitivity_referential(
+            source_name, csvfile, dry_run=dry_run, replace=replace
+        )
+    if dry_run:
+        db.session.rollback()
+        click.echo(
+            "{added} règles à ajouter, {removed} à supprimer, {unchanged} inchangées".format(
+                **counts
+            )
+        )
+    else:
+        db.session.commit()
+        click.echo(
+            "{added} règles ajoutées, {removed} supprimées, {unchanged} inchangées".format(
+                **counts
+            )
+        )
+    if counts["kept"]:
+        click.echo(
+            "{kept} règles absentes du fichier conservées (--replace pour les supprimer)".format(
+                **counts
+            )
+        )
+
+
+def changes_as_dict(changes):
+    return [
+        {"from": old, "to": new, "count": count}
+        for (old, new), count in sorted(changes.items(), key=lambda c: (c[0][0] or "", c[0][1]))
+    ]
+
+
+@routes.route("/simulate", methods=["POST"])
+@permissions_required("R", module_code="ADMIN")
+def simulate():
+    """
+    Simulate the loading of a sensitivity referential on the synthese,
+    without writing anything.
+
+    .. :quickref: Sensitivity; Simulate a sensitivity referential
+    """
+    if "file" not in request.files or "source" not in request.form:
+        raise BadRequest("A 'file' and a 'source' are required")
+    csvfile = TextIOWrapper(request.files["file"].stream, encoding=request.form.get("encoding"))
+    try:
+        counts, changes = simulate_referential(
+            request.form["source"],
+            csvfile,
+            replace=request.form.get("replace") == "true",
+        )
+    except ValueError as exc:
+        raise BadRequest(str(exc))
+    return jsonify(
+        {
+            "rules": counts,
+            "changes": changes_as_dict(changes),
+            "nb_changed": sum(changes.values()),
+        }
+    )
+
+
+@routes.cli.command("simulate-referential")
+@click.option("--source-name", required=True)
+@click.option("--csvfile", required=True)
+@click.option("--encoding")
+@click.option(
+    "--chunk-size",
+    default=10000,
+    show_default=True,
+    help="Nombre d’observations évaluées par lot",
+)
+@click.option(
+    "--replace",
+    is_flag=True,
+    help="Simule la suppression des règles de cette source absentes du fichier",
+)
+def simulate_referential_cmd(source_name, csvfile, encoding, chunk_size, replace):
+    """
+    Simule l’effet d’un référentiel sur la sensibilité des observations de la synthèse
+
+    Aucune modification n’est enregistrée en base de données.
+    """
+    with open(csvfile, "r", encoding=encoding) as f:
+        counts, changes = simulate_referential(
+            source_name, f, chunk_size=chunk_size, replace=replace
+        )
+    db.session.rollback()
+    click.echo(
+        "{added} règles à ajouter, {removed} à supprimer, {unchanged} inchangées".format(**counts)
+    )
+    click.echo(f"{sum(changes.values())} observations changeraient de niveau de sensibilité :")
+    for change in changes_as_dict(changes):
+        click.echo("\t{from} → {to} : {count}".format(**change))
 
 
 @routes.cli.command()
@@ -119,19 +237,156 @@ def remove_referential(source):
 
 
 @routes.cli.command()
-def refresh_rules_cache():
+@click.option(
+    "--source",
+    "sources",
+    multiple=True,
+    help="Ne recalcule que les règles de cette source",
+)
+def refresh_rules_cache(sources):
     """
-    Rafraichie la vue matérialisée extrapolant les règles aux taxons enfants.
+    Recalcule la table extrapolant les règles aux taxons enfants.
+
+    Cette table est maintenue à jour par des triggers lors des modifications
+    des règles et de TAXREF : ce recalcul n’est utile que si ces triggers ont été
+    désactivés. Les lignes sont remplacées dans une seule transaction, sans
+    bloquer le calcul de la sensibilité des observations insérées en parallèle.
     """
-    db.session.execute("REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref")
+    count = refresh_sensitivity_rules_cache(sources)
     db.session.commit()
+    click.echo(f"{count} règles extrapolées aux taxons enfants")
 
 
 @routes.cli.command()
-def update_synthese():
+@click.option(
+    "--chunk-size",
+    default=100000,
+    show_default=True,
+    help="Nombre d’identifiants de la synthèse traités par lot",
+)
+@click.option(
+    "--source",
+    "sources",
+    multiple=True,
+    help="Ne recalcule que les observations des taxons concernés par les règles de cette source",
+)
+@click.option(
+    "--cd-ref",
+    "cd_refs",
+    multiple=True,
+    type=int,
+    help="Ne recalcule que les observations de ce taxon",
+)
+@click.option("--resume", is_flag=True, help="Reprend le dernier recalcul inachevé")
+@click.option(
+    "--celery", "use_celery", is_flag=True, help="Répartit les lots entre les workers Celery"
+)
+@click.option(
+    "--timeout",
+    default=3600,
+    show_default=True,
+    help="Avec --celery, abandonne l’attente après ce nombre de secondes sans lot traité",
+)
+def update_synthese(chunk_size, sources, cd_refs, resume, use_celery, timeout):
     """
     Recalcule la sensibilité des observations de la synthèse.
+
+    Le recalcul est découpé en lots d’id_synthese validés un par un :
+    s’il est interrompu, il peut être repris avec --resume, qui traite aussi les lots en erreur.
+    Après la suppression d’une source, utiliser --cd-ref ou recalculer toute la synthèse.
     """
-    count = db.session.execute("SELECT gn_synthese.update_sensitivity()").scalar()
-    db.session.commit()
-    click.echo(f"Sensitivity updated for {count} rows")
+    if resume:
+        job = get_unfinished_job()
+        if job is None:
+            click.echo("Aucun recalcul à reprendre")
+            return
+    else:
+        if sources:
+            cd_refs = set(cd_refs) | set(get_sources_cd_refs(sources))
+            if not cd_refs:
+                click.echo("Aucun taxon concerné par ces sources")
+                return
+        job = create_update_job(chunk_size, cd_refs=sorted(cd_refs) if cd_refs else None)
+    chunks = job.pending_chunks
+
+    if use_celery:
+        nb_done = len(job.chunks) - len(chunks)
+        for chunk in chunks:
+            chunk.error = None
+        db.session.commit()
+        for chunk in chunks:
+            update_sensitivity_chunk.delay(job.id_job, chunk.id_min)
+        id_job = job.id_job
+
+        def count_dispatched_chunks():
+            processed, failed = count_chunks(id_job)
+            return processed - nb_done, failed
+
+        try:
+            _, failed = wait_for_chunks(
+                count_dispatched_chunks,
+                len(chunks),
+                label="Recalcul de la sensibilité",
+                timeout=timeout,
+            )
+        except TimeoutError:
+            raise click.ClickException(
+                f"Aucun lot traité depuis {timeout} secondes, vérifier que les workers Celery "
+                "sont démarrés puis reprendre le recalcul avec --resume"
+            )
+        if failed:
+            errors = SensitivityUpdateChunk.query.filter(
+                SensitivityUpdateChunk.id_job == id_job,
+                SensitivityUpdateChunk.error.isnot(None),
+            )
+            for chunk in errors:
+                click.echo(
+                    f"Lot {chunk.id_min}-{chunk.id_max} en erreur : {chunk.error}", err=True
+                )
+            raise click.ClickException(
+                f"{failed} lots en erreur, reprendre le recalcul avec --resume"
+            )
+    else:
+        with click.progressbar(chunks, label="Recalcul de la sensibilité") as bar:
+            for chunk in bar:
+                update_chunk(chunk)
+
+    count = (
+        db.session.query(func.sum(SensitivityUpdateChunk.nb_updated))
+        .filter(SensitivityUpdateChunk.id_job == job.id_job)
+        .scalar()
+    )
+    click.echo(f"Sensitivity updated for {count or 0} rows")
+
+
+@routes.cli.command()
+@click.option(
+    "--chunk-size",
+    default=100000,
+    show_default=True,
+    help="Nombre d’identifiants de la synthèse traités par lot",
+)
+def refresh_diffusion_geometries(chunk_size):
+    """
+    Recalcule les géométries dégradées selon le niveau de diffusion des observations.
+
+    Ces géométries sont maintenues à jour par des triggers sur la synthèse :
+    ce recalcul n’est utile qu’après une modification du référentiel géographique.
+    """
+    id_min, id_max = db.session.query(
+        func.min(Synthese.id_synthese), func.max(Synthese.id_synthese)
+    ).one()
+    if id_min is None:
+        return
+    count = 0
+    with click.progressbar(
+        range(id_min, id_max + 1, chunk_size), label="Calcul des géométries de diffusion"
+    ) as bar:
+        for start in bar:
+            count += db.session.execute(
+                select(
+                    [func.gn_synthese.refresh_diffusion_geometries(start, start + chunk_size - 1)]
+                )
+            ).scalar()
+            db.session.commit()
+    click.echo(f"{count} géométries dégradées")
@@ -0,0 +1,118 @@
+import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import func, select
+from celery.utils.log import get_task_logger
+
+from geonature.utils.env import db
+from geonature.utils.celery import celery_app
+from geonature.core.gn_synthese.models import Synthese
+from geonature.core.sensitivity.models import SensitivityUpdateChunk, SensitivityUpdateJob
+
+
+logger = get_task_logger(__name__)
+
+
+def get_sources_cd_refs(sources):
+    """cd_ref of the taxa (children taxa included) having rules from these sources"""
+    return [
+        cd_ref
+        for (cd_ref,) in db.session.execute(
+            sa.text(
+                """
+            SELECT DISTINCT c.cd_ref
+            FROM gn_sensitivity.t_sensitivity_rules_cd_ref c
+            JOIN gn_sensitivity.t_sensitivity_rules r USING (id_sensitivity)
+            WHERE r.source = ANY(:sources)
+            """
+            ),
+            {"sources": list(sources)},
+        )
+    ]
+
+
+def create_update_job(chunk_size, cd_refs=None):
+    """
+    Split the synthese in ranges of `chunk_size` id_synthese
+    whose sensitivity will be updated independently.
+    """
+    id_min, id_max = db.session.query(
+        func.min(Synthese.id_synthese), func.max(Synthese.id_synthese)
+    ).one()
+    job = SensitivityUpdateJob(chunk_size=chunk_size, cd_refs=cd_refs)
+    if id_min is not None:
+        job.chunks = [
+            SensitivityUpdateChunk(id_min=start, id_max=min(start + chunk_size - 1, id_max))
+            for start in range(id_min, id_max + 1, chunk_size)
+        ]
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def get_unfinished_job():
+    return (
+        SensitivityUpdateJob.query.filter(SensitivityUpdateJob.end_date.is_(None))
+        .order_by(SensitivityUpdateJob.id_job.desc())
+        .first()
+    )
+
+
+def update_chunk(chunk):
+    """
+    Update the sensitivity of the observations of the chunk in its own transaction,
+    so that rows are locked only while their chunk is processed.
+    """
+    chunk.nb_updated = db.session.execute(
+        select(
+            [func.gn_synthese.update_sensitivity(chunk.id_min, chunk.id_max, chunk.job.cd_refs)]
+        )
+    ).scalar()
+    chunk.update_date = datetime.datetime.now()
+    chunk.error = None
+    db.session.commit()
+    # checked after the commit, so that the last finished chunk sees all the others
+    db.session.execute(
+        SensitivityUpdateJob.__table__.update()
+        .where(SensitivityUpdateJob.id_job == chunk.id_job)
+        .where(SensitivityUpdateJob.end_date.is_(None))
+        .where(
+            ~sa.exists()
+            .where(SensitivityUpdateChunk.id_job == chunk.id_job)
+            .where(SensitivityUpdateChunk.nb_updated.is_(None))
+        )
+        .values(end_date=func.now())
+    )
+    db.session.commit()
+    return chunk.nb_updated
+
+
+@celery_app.task(bind=True)
+def update_sensitivity_chunk(self, id_job, id_min):
+    chunk = SensitivityUpdateChunk.query.get((id_job, id_min))
+    if chunk is None or chunk.done:
+        return
+    logger.info(f"Update sensitivity of id_synthese {chunk.id_min} to {chunk.id_max}...")
+    try:
+        nb_updated = update_chunk(chunk)
+    except Exception as exc:
+        logger.exception(f"Update of sensitivity chunk ({id_job}, {id_min}) failed")
+        db.session.rollback()
+        chunk.error = str(exc)
+        db.session.commit()
+        return
+    logger.info(f"Sensitivity updated for {nb_updated} rows.")
+
+
+def count_chunks(id_job):
+    """Numbers of processed and failed chunks of the job"""
+    return (
+        db.session.query(
+            func.count(SensitivityUpdateChunk.nb_updated),
+            func.count(SensitivityUpdateChunk.error).filter(
+                SensitivityUpdateChunk.nb_updated.is_(None)
+            ),
+        )
+        .filter(SensitivityUpdateChunk.id_job == id_job)
+        .one()
+    )
@@ -2,6 +2,7 @@ import csv
 from functools import lru_cache
 
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
 
 from geonature.utils.env import db
 
@@ -10,13 +11,17 @@ from pypnnomenclature.models import (
     BibNomenclaturesTypes as NomenclatureType,
 )
 
-from .models import CorSensitivityCriteria, SensitivityRule
+from .models import SensitivityRule
+
+
+# Statut biologique codes moved to the OCC_COMPORTEMENT nomenclature
+FREEZED_STATUT_BIO_CODES = ["6", "7", "8", "10", "11", "12"]
 
 
 @lru_cache(maxsize=64)
 def get_nomenclature(type_mnemonique, code):
     # Retro-compatibility with freezed nomenclatures
-    if type_mnemonique == "STATUT_BIO" and code in ["6", "7", "8", "10", "11", "12"]:
+    if type_mnemonique == "STATUT_BIO" and code in FREEZED_STATUT_BIO_CODES:
         type_mnemonique = "OCC_COMPORTEMENT"
     return Nomenclature.query.filter(
         Nomenclature.active == True,  # noqa: E712
@@ -25,104 +30,369 @@ def get_nomenclature(type_mnemonique, code):
     ).one()
 
 
-def insert_sensitivity_referential(source, csvfile):
-    statut_biologique_nomenclature_type = NomenclatureType.query.filter_by(
-        mnemonique="STATUT_BIO"
-    ).one()
-    behaviour_nomenclature_type = NomenclatureType.query.filter_by(
-        mnemonique="OCC_COMPORTEMENT"
-    ).one()
-    defaults_nomenclatures = {
-        statut_biologique_nomenclature_type: set(
-            Nomenclature.query.filter(
-                Nomenclature.nomenclature_type == statut_biologique_nomenclature_type,
-                Nomenclature.mnemonique.in_(["Inconnu", "Non renseigné", "Non Déterminé"]),
-            )
-        ),
-        behaviour_nomenclature_type: set(
-            Nomenclature.query.filter(
-                Nomenclature.nomenclature_type == behaviour_nomenclature_type,
-                Nomenclature.mnemonique.in_(["NSP", "1"]),
+# Criterias added with any criteria of the same nomenclature type
+DEFAULT_CRITERIAS = {
+    "STATUT_BIO": ["Inconnu", "Non renseigné", "Non Déterminé"],
+    "OCC_COMPORTEMENT": ["NSP", "1"],
+}
+REFERENTIAL_COLUMNS = [
+    "CD_NOM",
+    "NOM_CITE",
+    "CD_SENSIBILITE",
+    "DUREE",
+    "STATUT_BIOLOGIQUE",
+    "COMPORTEMENT",
+    "AUTRE",
+]
+
+
+def _copy_referential(csvfile):
+    """
+    COPY the CSV file into the tmp_sensitivity_referential staging table,
+    whose columns are the CSV columns (as text) plus a line number.
+    """
+    header = next(csv.reader([csvfile.readline()], delimiter=";"))
+    header = [column.strip().lstrip("\ufeff") for column in header]
+    dep_col = next((column for column in header if column in ["CD_DEP", "CD_DEPT"]), None)
+    missing_columns = set(REFERENTIAL_COLUMNS) - set(header)
+    if dep_col is None or missing_columns:
+        raise ValueError(
+            "Missing columns in referential: {}".format(
+                ", ".join(sorted(missing_columns | ({"CD_DEP"} if dep_col is None else set())))
             )
+        )
+    quote = db.engine.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column) for column in header)
+    db.session.execute(
+        "CREATE TEMPORARY TABLE tmp_sensitivity_referential ("
+        + ", ".join(f"{quote(column)} text" for column in header)
+        + ", line serial) ON COMMIT DROP"
+    )
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY tmp_sensitivity_referential ({columns}) FROM STDIN "
+        "WITH (FORMAT csv, DELIMITER ';')",
+        csvfile,
+    )
+    return quote(dep_col)
+
+
+def load_sensitivity_referential(source, csvfile, dry_run=False, replace=False):
+    """
+    Load the rules of a referential CSV file as the rules of `source`.
+
+    The file is streamed with COPY in a staging table and nomenclatures, departments
+    and criterias are resolved in SQL. Rules of the source which are already loaded
+    are left untouched and new ones are inserted with their criterias and areas.
+    Rules of the source missing from the file are kept, or removed with `replace`.
+    With `dry_run`, the database is left untouched.
+
+    Returns the number of added, removed, unchanged and kept (missing from the file
+    but not removed) rules.
+    """
+    dep_col = _copy_referential(csvfile)
+
+    # criterias of each line: resolved codes and defaults of the same nomenclature type
+    db.session.execute(
+        sa.text(
+            """
+        CREATE TEMPORARY TABLE tmp_sensitivity_criterias ON COMMIT DROP AS
+        WITH requested AS (
+            SELECT
+                line,
+                CASE
+                    WHEN "STATUT_BIOLOGIQUE" = ANY(:freezed_codes) THEN 'OCC_COMPORTEMENT'
+                    ELSE 'STATUT_BIO'
+                END AS type_mnemonique,
+                "STATUT_BIOLOGIQUE" AS code
+            FROM tmp_sensitivity_referential
+            WHERE COALESCE("STATUT_BIOLOGIQUE", '') <> ''
+            UNION ALL
+            SELECT line, 'OCC_COMPORTEMENT', "COMPORTEMENT"
+            FROM tmp_sensitivity_referential
+            WHERE COALESCE("COMPORTEMENT", '') <> ''
+        ), resolved AS (
+            SELECT r.line, r.type_mnemonique, r.code, n.id_type, n.id_nomenclature
+            FROM requested r
+            LEFT JOIN (
+                ref_nomenclatures.t_nomenclatures n
+                JOIN ref_nomenclatures.bib_nomenclatures_types t ON t.id_type = n.id_type
+            ) ON t.mnemonique = r.type_mnemonique AND n.cd_nomenclature = r.code AND n.active
+        )
+        SELECT line, type_mnemonique, code, id_type, id_nomenclature FROM resolved
+        UNION
+        SELECT r.line, t.mnemonique, n.cd_nomenclature, n.id_type, n.id_nomenclature
+        FROM resolved r
+        JOIN ref_nomenclatures.t_nomenclatures n ON n.id_type = r.id_type
+        JOIN ref_nomenclatures.bib_nomenclatures_types t ON t.id_type = n.id_type
+        WHERE
+            (t.mnemonique = 'STATUT_BIO' AND n.mnemonique = ANY(:default_statut_bio))
+            OR (t.mnemonique = 'OCC_COMPORTEMENT' AND n.mnemonique = ANY(:default_behaviour))
+        """
         ),
-    }
+        {
+            "freezed_codes": FREEZED_STATUT_BIO_CODES,
+            "default_statut_bio": DEFAULT_CRITERIAS["STATUT_BIO"],
+            "default_behaviour": DEFAULT_CRITERIAS["OCC_COMPORTEMENT"],
+        },
+    )
+    unknown = db.session.execute(
+        """
+        SELECT DISTINCT type_mnemonique, code
+        FROM tmp_sensitivity_criterias
+        WHERE id_nomenclature IS NULL
+        """
+    ).fetchall()
+    if unknown:
+        raise ValueError(
+            "Unknown nomenclatures: {}".format(", ".join(f"{t} {c}" for t, c in unknown))
+        )
 
-    rules = []
-    criterias = set()
-    reader = csv.DictReader(csvfile, delimiter=";")
-    dep_col = next(
-        fieldname for fieldname in reader.fieldnames if fieldname in ["CD_DEP", "CD_DEPT"]
+    # rules, with a key identifying them among the existing rules of the source
+    db.session.execute(
+        sa.text(
+            f"""
+        CREATE TEMPORARY TABLE tmp_sensitivity_rules ON COMMIT DROP AS
+        SELECT
+            *,
+            NULL::integer AS id_sensitivity,
+            row_number() OVER (PARTITION BY rule_key ORDER BY line) AS key_rank
+        FROM (
+            SELECT
+                *,
+                md5(concat_ws('|',
+                    cd_nom, nom_cite, id_nomenclature_sensitivity,
+                    sensitivity_duration, id_territory, comments, criterias
+                )) AS rule_key
+            FROM (
+                SELECT
+                    r.line,
+                    r."CD_NOM"::integer AS cd_nom,
+                    COALESCE(r."NOM_CITE", '') AS nom_cite,
+                    sensitivity.id_nomenclature AS id_nomenclature_sensitivity,
+                    r."CD_SENSIBILITE" AS cd_sensitivity,
+                    COALESCE(NULLIF(r."DUREE", '')::integer, 10000) AS sensitivity_duration,
+                    CASE r.{dep_col}
+                        WHEN 'D3' THEN '973'
+                        WHEN 'D4' THEN '974'
+                        ELSE COALESCE(r.{dep_col}, '')
+                    END AS id_territory,
+                    COALESCE(r."AUTRE", '') AS comments,
+                    COALESCE(c.criterias, '{{}}') AS criterias
+                FROM tmp_sensitivity_referential r
+                LEFT JOIN (
+                    ref_nomenclatures.t_nomenclatures sensitivity
+                    JOIN ref_nomenclatures.bib_nomenclatures_types t
+                        ON t.id_type = sensitivity.id_type AND t.mnemonique = 'SENSIBILITE'
+                ) ON sensitivity.cd_nomenclature = r."CD_SENSIBILITE" AND sensitivity.active
+                LEFT JOIN (
+                    SELECT line, array_agg(id_nomenclature ORDER BY id_nomenclature) AS criterias
+                    FROM tmp_sensitivity_criterias
+                    GROUP BY line
+                ) c ON c.line = r.line
+            ) AS rules
+        ) AS keyed_rules
+        """
+        )
     )
-    for row in reader:
-        sensi_nomenclature = get_nomenclature("SENSIBILITE", code=row["CD_SENSIBILITE"])
-        if row[dep_col] == "D3":
-            cd_dep = "973"
-        elif row[dep_col] == "D4":
-            cd_dep = "974"
-        else:
-            cd_dep = row[dep_col]
-        if row["DUREE"]:
-            duration = int(row["DUREE"])
-        else:
-            duration = 10000
-        rule = {
-            "cd_nom": int(row["CD_NOM"]),
-            "nom_cite": row["NOM_CITE"],
-            "id_nomenclature_sensitivity": sensi_nomenclature.id_nomenclature,
-            "sensitivity_duration": duration,
-            "sensitivity_territory": "Département",
-            "id_territory": cd_dep,
-            "source": f"{source}",
-            "comments": row["AUTRE"],
-            "active": True,
-        }
-        _criterias = set()
-        if row["STATUT_BIOLOGIQUE"]:
-            criteria = get_nomenclature("STATUT_BIO", code=row["STATUT_BIOLOGIQUE"])
-            _criterias |= {criteria} | defaults_nomenclatures[criteria.nomenclature_type]
-        if row["COMPORTEMENT"]:
-            criteria = get_nomenclature("OCC_COMPORTEMENT", code=row["COMPORTEMENT"])
-            _criterias |= {criteria} | defaults_nomenclatures[criteria.nomenclature_type]
-        for criteria in _criterias:
-            criterias.add((len(rules), criteria))
-        rules.append(rule)
-    results = db.session.execute(
-        sa.insert(SensitivityRule).values(rules).returning(SensitivityRule.id)
+    unknown = db.session.execute(
+        """
+        SELECT DISTINCT cd_sensitivity
+        FROM tmp_sensitivity_rules
+        WHERE id_nomenclature_sensitivity IS NULL
+        """
+    ).fetchall()
+    if unknown:
+        raise ValueError(
+            "Unknown sensitivity codes: {}".format(", ".join(str(c) for c, in unknown))
+        )
+
+    # match rules with the existing rules of the source
+    db.session.execute(
+        sa.text(
+            """
+        CREATE TEMPORARY TABLE tmp_sensitivity_existing_rules ON COMMIT DROP AS
+        SELECT
+            *,
+            row_number() OVER (PARTITION BY rule_key ORDER BY id_sensitivity) AS key_rank
+        FROM (
+            SELECT
+                s.id_sensitivity,
+                md5(concat_ws('|',
+                    s.cd_nom, COALESCE(s.nom_cite, ''), s.id_nomenclature_sensitivity,
+                    s.sensitivity_duration, COALESCE(s.id_territory, ''),
+                    COALESCE(s.comments, ''),
+                    COALESCE(
+                        array_agg(c.id_criteria ORDER BY c.id_criteria)
+                            FILTER (WHERE c.id_criteria IS NOT NULL),
+                        '{}'
+                    )
+                )) AS rule_key
+            FROM gn_sensitivity.t_sensitivity_rules s
+            LEFT JOIN gn_sensitivity.cor_sensitivity_criteria c USING (id_sensitivity)
+            WHERE s.source = :source
+            GROUP BY s.id_sensitivity
+        ) AS existing_rules
+        """
+        ),
+        {"source": source},
     )
-    rules_indexes = [rule_index for rule_index, in results]  # flattening singleton results
     db.session.execute(
-        sa.insert(CorSensitivityCriteria).values(
-            [
-                {
-                    "id_sensitivity": rules_indexes[rule_idx],
-                    "id_type_nomenclature": nomenclature.id_type,
-                    "id_criteria": nomenclature.id_nomenclature,
-                }
-                for rule_idx, nomenclature in criterias
-            ]
-        )
+        """
+        UPDATE tmp_sensitivity_rules r
+        SET id_sensitivity = e.id_sensitivity
+        FROM tmp_sensitivity_existing_rules e
+        WHERE e.rule_key = r.rule_key AND e.key_rank = r.key_rank
+        """
     )
+    unchanged, added = db.session.execute(
+        """
+        SELECT count(id_sensitivity), count(*) - count(id_sensitivity)
+        FROM tmp_sensitivity_rules
+        """
+    ).fetchone()
+    missing = db.session.execute(
+        """
+        SELECT count(*)
+        FROM tmp_sensitivity_existing_rules e
+        WHERE NOT EXISTS (
+            SELECT 1 FROM tmp_sensitivity_rules r WHERE r.id_sensitivity = e.id_sensitivity
+        )
+        """
+    ).scalar()
+    counts = {
+        "added": added,
+        "removed": missing if replace else 0,
+        "unchanged": unchanged,
+        "kept": 0 if replace else missing,
+    }
+    if dry_run:
+        db.session.execute(
+            "DROP TABLE tmp_sensitivity_referential, tmp_sensitivity_criterias, "
+            "tmp_sensitivity_rules, tmp_sensitivity_existing_rules"
+        )
+        return counts
 
-    # Populate cor_sensitivity_area
-    db.session.connection().execute(
+    if replace:
+        # criterias and areas are deleted in cascade
+        db.session.execute(
+            """
+            DELETE FROM gn_sensitivity.t_sensitivity_rules s
+            USING tmp_sensitivity_existing_rules e
+            WHERE
+                s.id_sensitivity = e.id_sensitivity
+                AND NOT EXISTS (
+                    SELECT 1 FROM tmp_sensitivity_rules r
+                    WHERE r.id_sensitivity = e.id_sensitivity
+                )
+            """
+        )
+    # new rules ids are allocated first to insert their criterias and areas
+    db.session.execute(
+        """
+        UPDATE tmp_sensitivity_rules
+        SET
+            id_sensitivity = nextval(
+                pg_get_serial_sequence('gn_sensitivity.t_sensitivity_rules', 'id_sensitivity')
+            ),
+            key_rank = 0
+        WHERE id_sensitivity IS NULL
+        """
+    )
+    db.session.execute(
         sa.text(
             """
-    INSERT INTO gn_sensitivity.cor_sensitivity_area
-        SELECT DISTINCT id_sensitivity, id_area
-        FROM gn_sensitivity.t_sensitivity_rules s
-        JOIN ref_geo.l_areas a
-        ON
-                s.sensitivity_territory = 'Département'
-            AND a.id_type = (SELECT id_type FROM ref_geo.bib_areas_types WHERE type_code ='DEP')
-            AND regexp_replace(s.id_territory, '^([0-9])$', '0\\1') = a.area_code
-        WHERE s.source = :source
-    """
+        INSERT INTO gn_sensitivity.t_sensitivity_rules (
+            id_sensitivity,
+            cd_nom,
+            nom_cite,
+            id_nomenclature_sensitivity,
+            sensitivity_duration,
+            sensitivity_territory,
+            id_territory,
+            source,
+            comments,
+            active
+        )
+        SELECT
+            id_sensitivity,
+            cd_nom,
+            nom_cite,
+            id_nomenclature_sensitivity,
+            sensitivity_duration,
+            'Département',
+            id_territory,
+            :source,
+            comments,
+            true
+        FROM tmp_sensitivity_rules
+        WHERE key_rank = 0
+        """
         ),
-        source=source,
+        {"source": source},
     )
+    db.session.execute(
+        """
+        INSERT INTO gn_sensitivity.cor_sensitivity_criteria (
+            id_sensitivity,
+            id_criteria,
+            id_type_nomenclature
+        )
+        SELECT DISTINCT r.id_sensitivity, c.id_nomenclature, c.id_type
+        FROM tmp_sensitivity_rules r
+        JOIN tmp_sensitivity_criterias c ON c.line = r.line
+        WHERE r.key_rank = 0
+        """
+    )
+    db.session.execute(
+        r"""
+        INSERT INTO gn_sensitivity.cor_sensitivity_area
+            SELECT DISTINCT r.id_sensitivity, a.id_area
+            FROM tmp_sensitivity_rules r
+            JOIN ref_geo.l_areas a
+            ON
+                    a.id_type = (SELECT id_type FROM ref_geo.bib_areas_types WHERE type_code ='DEP')
+                AND regexp_replace(r.id_territory, '^([0-9])$', '0\1') = a.area_code
+            WHERE r.key_rank = 0
+        """
+    )
+    db.session.execute(
+        "DROP TABLE tmp_sensitivity_referential, tmp_sensitivity_criterias, "
+        "tmp_sensitivity_rules, tmp_sensitivity_existing_rules"
+    )
+    return counts
+
 
-    return len(rules)
+def insert_sensitivity_referential(source, csvfile):
+    return load_sensitivity_referential(source, csvfile)["added"]
 
 
 def remove_sensitivity_referential(source):
     return SensitivityRule.query.filter_by(source=source).delete()
+
+
+def refresh_sensitivity_rules_cache(sources=None):
+    """
+    Recompute the rules extrapolated to children taxa, for all rules or only
+    for the rules of the given sources.
+
+    The cache is kept up to date by triggers on rules and TAXREF changes:
+    this is only needed if these triggers were disabled, e.g. during a TAXREF update.
+    """
+    sensitivity_ids = None
+    if sources:
+        sensitivity_ids = [
+            id_sensitivity
+            for (id_sensitivity,) in db.session.query(SensitivityRule.id).filter(
+                SensitivityRule.source.in_(sources)
+            )
+        ]
+    return db.session.execute(
+        sa.select(
+            [
+                sa.func.gn_sensitivity.refresh_rules_cd_ref(
+                    sa.cast(sensitivity_ids, ARRAY(sa.Integer))
+                )
+            ]
+        )
+    ).scalar()
@@ -0,0 +1,130 @@
+"""add gn_synthese.t_export_jobs
+
+Revision ID: 3a9c1f5e7b20
+Revises: d99a7c22cc3c
+Create Date: 2026-10-18 09:12:04.318275
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "3a9c1f5e7b20"
+down_revision = "d99a7c22cc3c"
+branch_labels = None
+depends_on = ("09a637f06b96",)  # Geonature Notifications
+
+CATEGORY_CODE = "SYNTHESE-EXPORT"
+EMAIL_CONTENT = (
+    "<p>Bonjour <i>{{ role.nom_complet }}</i> !</p>"
+    "<p>Votre export des {{ export.export_type }} de la synthèse "
+    "(format {{ export.export_format }}) est prêt.</p>"
+    '<p>Vous pouvez le télécharger <a href="{{ url }}">ici</a></p>'
+    "<p><i>Vous recevez cet email automatiquement via le service de notification de GeoNature.</i></p>"
+)
+DB_CONTENT = (
+    "Votre export des {{ export.export_type }} de la synthèse "
+    "(format {{ export.export_format }}) est prêt"
+)
+
+
+def upgrade():
+    logger.info("Create table gn_synthese.t_export_jobs")
+    op.create_table(
+        "t_export_jobs",
+        sa.Column("id_export_job", sa.Integer, primary_key=True),
+        sa.Column(
+            "id_role",
+            sa.Integer,
+            sa.ForeignKey("utilisateurs.t_roles.id_role", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column("export_type", sa.Unicode, nullable=False),
+        sa.Column("export_format", sa.Unicode, nullable=False),
+        sa.Column("params", JSONB),
+        sa.Column("status", sa.Unicode, nullable=False, server_default="PENDING"),
+        sa.Column("progress", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("nb_rows", sa.Integer),
+        sa.Column("file_name", sa.Unicode),
+        sa.Column("error", sa.UnicodeText),
+        sa.Column("creation_date", sa.DateTime, server_default=sa.func.now()),
+        sa.Column("end_date", sa.DateTime),
+        sa.CheckConstraint(
+            "status IN ('PENDING', 'RUNNING', 'SUCCESS', 'FAILURE')",
+            name="check_t_export_jobs_status",
+        ),
+        schema="gn_synthese",
+    )
+    op.create_index(
+        "i_t_export_jobs_id_role",
+        schema="gn_synthese",
+        table_name="t_export_jobs",
+        columns=["id_role"],
+    )
+
+    logger.info("Create notification category " + CATEGORY_CODE)
+    op.execute(
+        f"""
+        INSERT INTO
+            gn_notifications.bib_notifications_categories (code, label, description)
+        VALUES
+            (
+                '{CATEGORY_CODE}',
+                'Export de la synthèse prêt',
+                'Se déclenche lorsqu''un export de la synthèse que vous avez demandé est prêt à être téléchargé'
+            )
+        """
+    )
+    templates = sa.table(
+        "bib_notifications_templates",
+        sa.column("code_category"),
+        sa.column("code_method"),
+        sa.column("content"),
+        schema="gn_notifications",
+    )
+    op.bulk_insert(
+        templates,
+        [
+            {"code_category": CATEGORY_CODE, "code_method": "EMAIL", "content": EMAIL_CONTENT},
+            {"code_category": CATEGORY_CODE, "code_method": "DB", "content": DB_CONTENT},
+        ],
+    )
+    op.execute(
+        f"""
+        INSERT INTO
+            gn_notifications.t_notifications_rules (code_category, code_method)
+        VALUES
+            ('{CATEGORY_CODE}', 'DB')
+        """
+    )
+
+
+def downgrade():
+    op.execute(
+        f"""
+        DELETE FROM
+            gn_notifications.t_notifications_rules
+        WHERE
+            code_category = '{CATEGORY_CODE}'
+        """
+    )
+    op.execute(
+        f"""
+        DELETE FROM
+            gn_notifications.bib_notifications_templates
+        WHERE
+            code_category = '{CATEGORY_CODE}'
+        """
+    )
+    op.execute(
+        f"""
+        DELETE FROM
+            gn_notifications.bib_notifications_categories
+        WHERE
+            code = '{CATEGORY_CODE}'
+        """
+    )
+    op.drop_table("t_export_jobs", schema="gn_synthese")
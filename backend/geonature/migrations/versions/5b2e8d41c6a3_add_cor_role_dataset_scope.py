@@ -0,0 +1,270 @@
+"""add gn_meta.cor_role_dataset_scope
+
+Revision ID: 5b2e8d41c6a3
+Revises: 3a9c1f5e7b20
+Create Date: 2026-10-18 10:41:27.903114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "5b2e8d41c6a3"
+down_revision = "3a9c1f5e7b20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    logger.info("Create table gn_meta.cor_role_dataset_scope")
+    op.create_table(
+        "cor_role_dataset_scope",
+        sa.Column(
+            "id_role",
+            sa.Integer,
+            sa.ForeignKey("utilisateurs.t_roles.id_role", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column(
+            "id_dataset",
+            sa.Integer,
+            sa.ForeignKey("gn_meta.t_datasets.id_dataset", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("scope", sa.SmallInteger, nullable=False),
+        schema="gn_meta",
+    )
+    op.create_index(
+        "i_cor_role_dataset_scope_id_dataset",
+        schema="gn_meta",
+        table_name="cor_role_dataset_scope",
+        columns=["id_dataset"],
+    )
+
+    # Same rules as TDatasetsQuery.filter_by_scope
+    op.execute(
+        """
+    CREATE VIEW gn_meta.v_role_dataset_scope AS
+    SELECT
+        id_role,
+        id_dataset,
+        min(scope) AS scope
+    FROM (
+        -- dataset digitizer
+        SELECT d.id_digitizer AS id_role, d.id_dataset, 1 AS scope
+        FROM gn_meta.t_datasets d
+        WHERE d.id_digitizer IS NOT NULL
+        UNION ALL
+        -- dataset actor
+        SELECT cda.id_role, d.id_dataset, 1 AS scope
+        FROM gn_meta.t_datasets d
+        JOIN gn_meta.cor_dataset_actor cda ON cda.id_dataset = d.id_dataset
+        WHERE cda.id_role IS NOT NULL
+        UNION ALL
+        -- acquisition framework digitizer
+        SELECT af.id_digitizer AS id_role, d.id_dataset, 1 AS scope
+        FROM gn_meta.t_datasets d
+        JOIN gn_meta.t_acquisition_frameworks af
+            ON af.id_acquisition_framework = d.id_acquisition_framework
+        WHERE af.id_digitizer IS NOT NULL
+        UNION ALL
+        -- acquisition framework actor
+        SELECT cafa.id_role, d.id_dataset, 1 AS scope
+        FROM gn_meta.t_datasets d
+        JOIN gn_meta.cor_acquisition_framework_actor cafa
+            ON cafa.id_acquisition_framework = d.id_acquisition_framework
+        WHERE cafa.id_role IS NOT NULL
+        UNION ALL
+        -- role organism is dataset actor
+        SELECT r.id_role, d.id_dataset, 2 AS scope
+        FROM gn_meta.t_datasets d
+        JOIN gn_meta.cor_dataset_actor cda ON cda.id_dataset = d.id_dataset
+        JOIN utilisateurs.t_roles r ON r.id_organisme = cda.id_organism
+        UNION ALL
+        -- role organism is acquisition framework actor
+        SELECT r.id_role, d.id_dataset, 2 AS scope
+        FROM gn_meta.t_datasets d
+        JOIN gn_meta.cor_acquisition_framework_actor cafa
+            ON cafa.id_acquisition_framework = d.id_acquisition_framework
+        JOIN utilisateurs.t_roles r ON r.id_organisme = cafa.id_organism
+    ) AS role_dataset
+    GROUP BY id_role, id_dataset
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.fct_refresh_cor_role_dataset_scope_by_datasets(dataset_ids integer[])
+     RETURNS void
+     LANGUAGE plpgsql
+    AS $function$
+    BEGIN
+        DELETE FROM gn_meta.cor_role_dataset_scope WHERE id_dataset = ANY(dataset_ids);
+        INSERT INTO gn_meta.cor_role_dataset_scope (id_role, id_dataset, scope)
+            SELECT id_role, id_dataset, scope
+            FROM gn_meta.v_role_dataset_scope
+            WHERE id_dataset = ANY(dataset_ids);
+    END;
+    $function$
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.fct_refresh_cor_role_dataset_scope_by_role(role_id integer)
+     RETURNS void
+     LANGUAGE plpgsql
+    AS $function$
+    BEGIN
+        DELETE FROM gn_meta.cor_role_dataset_scope WHERE id_role = role_id;
+        INSERT INTO gn_meta.cor_role_dataset_scope (id_role, id_dataset, scope)
+            SELECT id_role, id_dataset, scope
+            FROM gn_meta.v_role_dataset_scope
+            WHERE id_role = role_id;
+    END;
+    $function$
+    """
+    )
+
+    logger.info("Create triggers maintaining gn_meta.cor_role_dataset_scope")
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_dataset()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+    BEGIN
+        PERFORM gn_meta.fct_refresh_cor_role_dataset_scope_by_datasets(ARRAY[NEW.id_dataset]);
+        RETURN NULL;
+    END;
+    $function$
+    """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER tri_cor_role_dataset_scope
+    AFTER INSERT OR UPDATE OF id_digitizer, id_acquisition_framework ON gn_meta.t_datasets
+    FOR EACH ROW
+    EXECUTE PROCEDURE gn_meta.fct_trg_cor_role_dataset_scope_dataset();
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_dataset_actor()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM gn_meta.fct_refresh_cor_role_dataset_scope_by_datasets(ARRAY[NEW.id_dataset]);
+        ELSIF TG_OP = 'UPDATE' THEN
+            PERFORM gn_meta.fct_refresh_cor_role_dataset_scope_by_datasets(
+                ARRAY[OLD.id_dataset, NEW.id_dataset]
+            );
+        ELSE
+            PERFORM gn_meta.fct_refresh_cor_role_dataset_scope_by_datasets(ARRAY[OLD.id_dataset]);
+        END IF;
+        RETURN NULL;
+    END;
+    $function$
+    """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER tri_cor_role_dataset_scope
+    AFTER INSERT OR UPDATE OR DELETE ON gn_meta.cor_dataset_actor
+    FOR EACH ROW
+    EXECUTE PROCEDURE gn_meta.fct_trg_cor_role_dataset_scope_dataset_actor();
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_af()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+    DECLARE
+        af_ids integer[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            af_ids := ARRAY[NEW.id_acquisition_framework];
+        ELSIF TG_OP = 'UPDATE' THEN
+            af_ids := ARRAY[OLD.id_acquisition_framework, NEW.id_acquisition_framework];
+        ELSE
+            af_ids := ARRAY[OLD.id_acquisition_framework];
+        END IF;
+        PERFORM gn_meta.fct_refresh_cor_role_dataset_scope_by_datasets(
+            ARRAY(
+                SELECT id_dataset
+                FROM gn_meta.t_datasets
+                WHERE id_acquisition_framework = ANY(af_ids)
+            )
+        );
+        RETURN NULL;
+    END;
+    $function$
+    """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER tri_cor_role_dataset_scope
+    AFTER UPDATE OF id_digitizer ON gn_meta.t_acquisition_frameworks
+    FOR EACH ROW
+    EXECUTE PROCEDURE gn_meta.fct_trg_cor_role_dataset_scope_af();
+    """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER tri_cor_role_dataset_scope
+    AFTER INSERT OR UPDATE OR DELETE ON gn_meta.cor_acquisition_framework_actor
+    FOR EACH ROW
+    EXECUTE PROCEDURE gn_meta.fct_trg_cor_role_dataset_scope_af();
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_role()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+    BEGIN
+        PERFORM gn_meta.fct_refresh_cor_role_dataset_scope_by_role(NEW.id_role);
+        RETURN NULL;
+    END;
+    $function$
+    """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER tri_cor_role_dataset_scope
+    AFTER INSERT OR UPDATE OF id_organisme ON utilisateurs.t_roles
+    FOR EACH ROW
+    EXECUTE PROCEDURE gn_meta.fct_trg_cor_role_dataset_scope_role();
+    """
+    )
+
+    logger.info("Populate gn_meta.cor_role_dataset_scope")
+    op.execute(
+        """
+    INSERT INTO gn_meta.cor_role_dataset_scope (id_role, id_dataset, scope)
+    SELECT id_role, id_dataset, scope FROM gn_meta.v_role_dataset_scope
+    """
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER tri_cor_role_dataset_scope ON utilisateurs.t_roles")
+    op.execute(
+        "DROP TRIGGER tri_cor_role_dataset_scope ON gn_meta.cor_acquisition_framework_actor"
+    )
+    op.execute("DROP TRIGGER tri_cor_role_dataset_scope ON gn_meta.t_acquisition_frameworks")
+    op.execute("DROP TRIGGER tri_cor_role_dataset_scope ON gn_meta.cor_dataset_actor")
+    op.execute("DROP TRIGGER tri_cor_role_dataset_scope ON gn_meta.t_datasets")
+    op.execute("DROP FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_role")
+    op.execute("DROP FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_af")
+    op.execute("DROP FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_dataset_actor")
+    op.execute("DROP FUNCTION gn_meta.fct_trg_cor_role_dataset_scope_dataset")
+    op.execute("DROP FUNCTION gn_meta.fct_refresh_cor_role_dataset_scope_by_role")
+    op.execute("DROP FUNCTION gn_meta.fct_refresh_cor_role_dataset_scope_by_datasets")
+    op.execute("DROP VIEW gn_meta.v_role_dataset_scope")
+    op.drop_table("cor_role_dataset_scope", schema="gn_meta")
@@ -38,6 +38,27 @@ base_url = "https://geonature.fr/data/inpn/sensitivity/"
 filename = "referentiel_donnees_sensibles_v13.csv.xz"
 
 
+def refresh_rules_cd_ref():
+    # t_sensitivity_rules_cd_ref is a table refreshed by gn_sensitivity.refresh_rules_cd_ref()
+    # since core revision a4c8e2f6b931, and a materialized view before
+    op.execute(
+        """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM pg_matviews
+            WHERE schemaname = 'gn_sensitivity' AND matviewname = 't_sensitivity_rules_cd_ref'
+        ) THEN
+            REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref;
+        ELSE
+            PERFORM gn_sensitivity.refresh_rules_cd_ref();
+        END IF;
+    END
+    $$
+    """
+    )
+
+
 @lru_cache(maxsize=32)
 def get_id_from_cd(cd_nomenc):
     return (
@@ -164,7 +185,7 @@ def upgrade():
     """
     )
 
-    op.execute("REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref")
+    refresh_rules_cd_ref()
 
 
 def downgrade():
@@ -190,4 +211,4 @@ def downgrade():
     """
     )
 
-    op.execute("REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref")
+    refresh_rules_cd_ref()
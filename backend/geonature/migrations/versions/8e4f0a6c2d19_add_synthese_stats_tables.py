@@ -0,0 +1,196 @@
+"""add synthese statistics tables
+
+Revision ID: 8e4f0a6c2d19
+Revises: 5b2e8d41c6a3
+Create Date: 2026-10-18 11:52:13.418066
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "8e4f0a6c2d19"
+down_revision = "5b2e8d41c6a3"
+branch_labels = None
+depends_on = None
+
+
+# {delta} is a query returning (id_dataset, id_source, cd_nom, observers, nb) rows
+# where nb is the (signed) number of observations to add to the statistics
+APPLY_DELTA = """
+        INSERT INTO gn_synthese.t_stats_taxa AS s (id_dataset, id_source, cd_nom, nb_obs)
+            SELECT id_dataset, id_source, cd_nom, sum(nb)
+            FROM ({delta}) AS delta
+            GROUP BY id_dataset, id_source, cd_nom
+            HAVING sum(nb) <> 0
+        ON CONFLICT (
+            (COALESCE(id_dataset, -1)), (COALESCE(id_source, -1)), (COALESCE(cd_nom, -1))
+        )
+        DO UPDATE SET nb_obs = s.nb_obs + EXCLUDED.nb_obs;
+
+        INSERT INTO gn_synthese.t_stats_observers AS s (observers, nb_obs)
+            SELECT observers, sum(nb)
+            FROM ({delta}) AS delta
+            WHERE observers IS NOT NULL
+            GROUP BY observers
+            HAVING sum(nb) <> 0
+        ON CONFLICT ((md5(observers)))
+        DO UPDATE SET nb_obs = s.nb_obs + EXCLUDED.nb_obs;
+
+        DELETE FROM gn_synthese.t_stats_taxa WHERE nb_obs <= 0;
+        DELETE FROM gn_synthese.t_stats_observers WHERE nb_obs <= 0;
+"""
+
+NEW_ROWS = "SELECT id_dataset, id_source, cd_nom, observers, 1 AS nb FROM {table}"
+OLD_ROWS = "SELECT id_dataset, id_source, cd_nom, observers, -1 AS nb FROM {table}"
+CHANGED_ROWS = """
+    SELECT n.id_dataset, n.id_source, n.cd_nom, n.observers, 1 AS nb
+    FROM new n JOIN old o ON o.id_synthese = n.id_synthese
+    WHERE (n.id_dataset, n.id_source, n.cd_nom, n.observers)
+        IS DISTINCT FROM (o.id_dataset, o.id_source, o.cd_nom, o.observers)
+    UNION ALL
+    SELECT o.id_dataset, o.id_source, o.cd_nom, o.observers, -1 AS nb
+    FROM new n JOIN old o ON o.id_synthese = n.id_synthese
+    WHERE (n.id_dataset, n.id_source, n.cd_nom, n.observers)
+        IS DISTINCT FROM (o.id_dataset, o.id_source, o.cd_nom, o.observers)
+"""
+
+
+def upgrade():
+    logger.info("Create synthese statistics tables")
+    op.create_table(
+        "t_stats_taxa",
+        sa.Column("id_stats_taxa", sa.Integer, primary_key=True),
+        # no foreign keys: rows follow the synthese through its triggers
+        sa.Column("id_dataset", sa.Integer),
+        sa.Column("id_source", sa.Integer),
+        sa.Column("cd_nom", sa.Integer),
+        sa.Column("nb_obs", sa.BigInteger, nullable=False),
+        schema="gn_synthese",
+    )
+    op.execute(
+        """
+    CREATE UNIQUE INDEX i_unique_t_stats_taxa ON gn_synthese.t_stats_taxa (
+        (COALESCE(id_dataset, -1)), (COALESCE(id_source, -1)), (COALESCE(cd_nom, -1))
+    )
+    """
+    )
+    op.create_index(
+        "i_t_stats_taxa_id_dataset",
+        schema="gn_synthese",
+        table_name="t_stats_taxa",
+        columns=["id_dataset"],
+    )
+    op.create_index(
+        "i_t_stats_taxa_id_source",
+        schema="gn_synthese",
+        table_name="t_stats_taxa",
+        columns=["id_source"],
+    )
+    op.create_table(
+        "t_stats_observers",
+        sa.Column("id_stats_observers", sa.Integer, primary_key=True),
+        sa.Column("observers", sa.Unicode, nullable=False),
+        sa.Column("nb_obs", sa.BigInteger, nullable=False),
+        schema="gn_synthese",
+    )
+    # md5 as observers may be too long to be indexed
+    op.execute(
+        """
+    CREATE UNIQUE INDEX i_unique_t_stats_observers
+    ON gn_synthese.t_stats_observers ((md5(observers)))
+    """
+    )
+
+    # let the triggers find quickly the rows to delete
+    op.execute(
+        """
+    CREATE INDEX i_t_stats_taxa_empty ON gn_synthese.t_stats_taxa (id_stats_taxa)
+    WHERE nb_obs <= 0
+    """
+    )
+    op.execute(
+        """
+    CREATE INDEX i_t_stats_observers_empty ON gn_synthese.t_stats_observers (id_stats_observers)
+    WHERE nb_obs <= 0
+    """
+    )
+
+    logger.info("Populate synthese statistics tables")
+    op.execute(
+        """
+    INSERT INTO gn_synthese.t_stats_taxa (id_dataset, id_source, cd_nom, nb_obs)
+    SELECT id_dataset, id_source, cd_nom, count(*)
+    FROM gn_synthese.synthese
+    GROUP BY id_dataset, id_source, cd_nom
+    """
+    )
+    op.execute(
+        """
+    INSERT INTO gn_synthese.t_stats_observers (observers, nb_obs)
+    SELECT observers, count(*)
+    FROM gn_synthese.synthese
+    WHERE observers IS NOT NULL
+    GROUP BY observers
+    """
+    )
+
+    logger.info("Create triggers maintaining synthese statistics")
+    op.execute(
+        f"""
+    CREATE FUNCTION gn_synthese.fct_tri_stats_on_each_statement()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {APPLY_DELTA.format(delta=NEW_ROWS.format(table="new"))}
+        ELSIF TG_OP = 'DELETE' THEN
+            {APPLY_DELTA.format(delta=OLD_ROWS.format(table="old"))}
+        ELSE
+            {APPLY_DELTA.format(delta=CHANGED_ROWS)}
+        END IF;
+        RETURN NULL;
+    END;
+    $function$
+    """
+    )
+    # transition tables can only be used with one event per trigger
+    op.execute(
+        """
+    CREATE TRIGGER tri_insert_stats
+    AFTER INSERT ON gn_synthese.synthese
+    REFERENCING NEW TABLE AS new
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE gn_synthese.fct_tri_stats_on_each_statement();
+    """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER tri_update_stats
+    AFTER UPDATE ON gn_synthese.synthese
+    REFERENCING OLD TABLE AS old NEW TABLE AS new
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE gn_synthese.fct_tri_stats_on_each_statement();
+    """
+    )
+    op.execute(
+        """
+    CREATE TRIGGER tri_delete_stats
+    AFTER DELETE ON gn_synthese.synthese
+    REFERENCING OLD TABLE AS old
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE gn_synthese.fct_tri_stats_on_each_statement();
+    """
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER tri_delete_stats ON gn_synthese.synthese")
+    op.execute("DROP TRIGGER tri_update_stats ON gn_synthese.synthese")
+    op.execute("DROP TRIGGER tri_insert_stats ON gn_synthese.synthese")
+    op.execute("DROP FUNCTION gn_synthese.fct_tri_stats_on_each_statement")
+    op.drop_table("t_stats_observers", schema="gn_synthese")
+    op.drop_table("t_stats_taxa", schema="gn_synthese")
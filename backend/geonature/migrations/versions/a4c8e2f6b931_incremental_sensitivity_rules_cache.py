@@ -0,0 +1,232 @@
+"""incremental sensitivity rules cache
+
+Revision ID: a4c8e2f6b931
+Revises: e2a9c4d7f318
+Create Date: 2026-10-18 16:21:09.384102
+
+"""
+from alembic import op
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "a4c8e2f6b931"
+down_revision = "e2a9c4d7f318"
+branch_labels = None
+depends_on = None
+
+
+# Rules extrapolated to children taxa, as in the former materialized view
+RULES_CD_REF_QUERY = """
+    WITH RECURSIVE r(cd_ref) AS (
+        SELECT t.cd_ref, r.id_sensitivity, r.cd_nom, r.nom_cite, r.id_nomenclature_sensitivity,
+           r.sensitivity_duration, r.sensitivity_territory, r.id_territory,
+           COALESCE(r.date_min, '1900-01-01'::date) AS date_min,
+           COALESCE(r.date_max, '1900-12-31'::date) AS date_max,
+           r.active, r.comments, r.meta_create_date, r.meta_update_date
+        FROM gn_sensitivity.t_sensitivity_rules r
+        JOIN taxonomie.taxref t ON t.cd_nom = r.cd_nom
+        WHERE r.active = true
+        {where}
+      UNION ALL
+        SELECT t.cd_ref , r.id_sensitivity, t.cd_nom, r.nom_cite, r.id_nomenclature_sensitivity,
+           r.sensitivity_duration, r.sensitivity_territory, r.id_territory, r.date_min,
+           r.date_max, r.active, r.comments, r.meta_create_date, r.meta_update_date
+        FROM taxonomie.taxref t, r
+        WHERE cd_taxsup = r.cd_ref
+    )
+    SELECT r.* FROM r
+"""
+
+
+def upgrade():
+    logger.info("Replace materialized view t_sensitivity_rules_cd_ref with a table")
+    op.execute("DROP MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref")
+    op.execute(
+        "CREATE TABLE gn_sensitivity.t_sensitivity_rules_cd_ref AS "
+        + RULES_CD_REF_QUERY.format(where="")
+    )
+    op.execute(
+        """
+    ALTER TABLE gn_sensitivity.t_sensitivity_rules_cd_ref
+        ADD CONSTRAINT fk_t_sensitivity_rules_cd_ref_id_sensitivity
+        FOREIGN KEY (id_sensitivity)
+        REFERENCES gn_sensitivity.t_sensitivity_rules (id_sensitivity)
+        ON DELETE CASCADE
+    """
+    )
+    op.create_index(
+        "i_t_sensitivity_rules_cd_ref_cd_ref",
+        schema="gn_sensitivity",
+        table_name="t_sensitivity_rules_cd_ref",
+        columns=["cd_ref"],
+    )
+    op.create_index(
+        "i_t_sensitivity_rules_cd_ref_id_sensitivity",
+        schema="gn_sensitivity",
+        table_name="t_sensitivity_rules_cd_ref",
+        columns=["id_sensitivity"],
+    )
+    op.create_index(
+        "i_t_sensitivity_rules_cd_ref_cd_nom",
+        schema="gn_sensitivity",
+        table_name="t_sensitivity_rules_cd_ref",
+        columns=["cd_nom"],
+    )
+
+    # Recompute the cache rows of the given rules, or of all rules if NULL.
+    # Rows are replaced in the caller transaction: concurrent readers, such as
+    # the synthese sensitivity trigger, keep seeing the previous rows until commit.
+    op.execute(
+        """
+    CREATE FUNCTION gn_sensitivity.refresh_rules_cd_ref(sensitivity_ids integer[] DEFAULT NULL)
+     RETURNS integer
+     LANGUAGE plpgsql
+    AS $function$
+            DECLARE
+                affected_rows_count int;
+            BEGIN
+                IF sensitivity_ids IS NULL THEN
+                    DELETE FROM gn_sensitivity.t_sensitivity_rules_cd_ref;
+                ELSIF cardinality(sensitivity_ids) = 0 THEN
+                    RETURN 0;
+                ELSE
+                    DELETE FROM gn_sensitivity.t_sensitivity_rules_cd_ref
+                    WHERE id_sensitivity = ANY(sensitivity_ids);
+                END IF;
+                INSERT INTO gn_sensitivity.t_sensitivity_rules_cd_ref
+                """
+        + RULES_CD_REF_QUERY.format(
+            where="AND (sensitivity_ids IS NULL OR r.id_sensitivity = ANY(sensitivity_ids))"
+        )
+        + """;
+                GET DIAGNOSTICS affected_rows_count = ROW_COUNT;
+                RETURN affected_rows_count;
+            END;
+        $function$
+    ;
+    """
+    )
+
+    logger.info("Maintain t_sensitivity_rules_cd_ref on rules changes")
+    # Deleted rules are removed by the foreign key cascade
+    op.execute(
+        """
+    CREATE FUNCTION gn_sensitivity.fct_tri_refresh_rules_cd_ref()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    PERFORM gn_sensitivity.refresh_rules_cd_ref(
+                        ARRAY(SELECT id_sensitivity FROM new_table)
+                    );
+                ELSE
+                    PERFORM gn_sensitivity.refresh_rules_cd_ref(
+                        ARRAY(
+                            SELECT id_sensitivity FROM new_table
+                            UNION
+                            SELECT id_sensitivity FROM old_table
+                        )
+                    );
+                END IF;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_insert_refresh_rules_cd_ref
+        AFTER INSERT ON gn_sensitivity.t_sensitivity_rules
+        REFERENCING NEW TABLE AS new_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_sensitivity.fct_tri_refresh_rules_cd_ref();
+    CREATE TRIGGER tri_update_refresh_rules_cd_ref
+        AFTER UPDATE ON gn_sensitivity.t_sensitivity_rules
+        REFERENCING NEW TABLE AS new_table OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_sensitivity.fct_tri_refresh_rules_cd_ref();
+    """
+    )
+
+    logger.info("Maintain t_sensitivity_rules_cd_ref on TAXREF hierarchy changes")
+    # Only the rules whose extrapolation may change are recomputed: rules on the
+    # changed taxa and rules covering their former or new parent.
+    op.execute(
+        """
+    CREATE FUNCTION gn_sensitivity.fct_tri_refresh_rules_cd_ref_taxref()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            DECLARE
+                taxa integer[];
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    taxa := ARRAY(
+                        SELECT unnest(ARRAY[cd_nom, cd_ref, cd_taxsup]) FROM new_table
+                    );
+                ELSIF TG_OP = 'DELETE' THEN
+                    taxa := ARRAY(
+                        SELECT unnest(ARRAY[cd_nom, cd_ref, cd_taxsup]) FROM old_table
+                    );
+                ELSE
+                    taxa := ARRAY(
+                        SELECT unnest(ARRAY[n.cd_nom, n.cd_ref, n.cd_taxsup, o.cd_ref, o.cd_taxsup])
+                        FROM new_table n
+                        JOIN old_table o USING (cd_nom)
+                        WHERE (n.cd_ref, n.cd_taxsup) IS DISTINCT FROM (o.cd_ref, o.cd_taxsup)
+                    );
+                END IF;
+                IF cardinality(taxa) > 0 THEN
+                    PERFORM gn_sensitivity.refresh_rules_cd_ref(
+                        ARRAY(
+                            SELECT c.id_sensitivity
+                            FROM gn_sensitivity.t_sensitivity_rules_cd_ref c
+                            WHERE c.cd_ref = ANY(taxa) OR c.cd_nom = ANY(taxa)
+                            UNION
+                            SELECT r.id_sensitivity
+                            FROM gn_sensitivity.t_sensitivity_rules r
+                            WHERE r.cd_nom = ANY(taxa)
+                        )
+                    );
+                END IF;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_insert_refresh_sensitivity_rules_cd_ref
+        AFTER INSERT ON taxonomie.taxref
+        REFERENCING NEW TABLE AS new_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_sensitivity.fct_tri_refresh_rules_cd_ref_taxref();
+    CREATE TRIGGER tri_update_refresh_sensitivity_rules_cd_ref
+        AFTER UPDATE ON taxonomie.taxref
+        REFERENCING NEW TABLE AS new_table OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_sensitivity.fct_tri_refresh_rules_cd_ref_taxref();
+    CREATE TRIGGER tri_delete_refresh_sensitivity_rules_cd_ref
+        AFTER DELETE ON taxonomie.taxref
+        REFERENCING OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_sensitivity.fct_tri_refresh_rules_cd_ref_taxref();
+    """
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+    DROP TRIGGER tri_insert_refresh_sensitivity_rules_cd_ref ON taxonomie.taxref;
+    DROP TRIGGER tri_update_refresh_sensitivity_rules_cd_ref ON taxonomie.taxref;
+    DROP TRIGGER tri_delete_refresh_sensitivity_rules_cd_ref ON taxonomie.taxref;
+    DROP FUNCTION gn_sensitivity.fct_tri_refresh_rules_cd_ref_taxref();
+    DROP TRIGGER tri_insert_refresh_rules_cd_ref ON gn_sensitivity.t_sensitivity_rules;
+    DROP TRIGGER tri_update_refresh_rules_cd_ref ON gn_sensitivity.t_sensitivity_rules;
+    DROP FUNCTION gn_sensitivity.fct_tri_refresh_rules_cd_ref();
+    DROP FUNCTION gn_sensitivity.refresh_rules_cd_ref(integer[]);
+    DROP TABLE gn_sensitivity.t_sensitivity_rules_cd_ref;
+    """
+    )
+    op.execute(
+        "CREATE MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref AS "
+        + RULES_CD_REF_QUERY.format(where="")
+        + " WITH DATA"
+    )
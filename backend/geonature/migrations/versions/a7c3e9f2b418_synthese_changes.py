@@ -0,0 +1,64 @@
+"""data version of the synthese for the exports cache
+
+Revision ID: a7c3e9f2b418
+Revises: d4f6b8a2c157
+Create Date: 2026-10-19 14:08:51.302117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a7c3e9f2b418"
+down_revision = "d4f6b8a2c157"
+branch_labels = None
+depends_on = None
+
+"""
+Chaque requête modifiant la synthèse ajoute une ligne à gn_synthese.t_synthese_changes :
+la somme des poids des lignes est une version des données de la synthèse, qui augmente
+à chaque transaction validée. Elle remplace, dans la clé des fichiers d'export conservés,
+le parcours des observations exportées.
+La table n'est jamais mise à jour, seulement complétée, pour que les écritures
+concurrentes dans la synthèse ne s'attendent pas : elle est compactée périodiquement
+en une ligne de même poids total.
+"""
+
+
+def upgrade():
+    op.create_table(
+        "t_synthese_changes",
+        sa.Column("id_change", sa.Integer, primary_key=True),
+        sa.Column("weight", sa.BigInteger, nullable=False, server_default="1"),
+        sa.Column("change_date", sa.DateTime, server_default=sa.func.now()),
+        schema="gn_synthese",
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.fct_tri_synthese_changes()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                INSERT INTO gn_synthese.t_synthese_changes DEFAULT VALUES;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_synthese_changes
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON gn_synthese.synthese
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_synthese.fct_tri_synthese_changes();
+    """
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+    DROP TRIGGER tri_synthese_changes ON gn_synthese.synthese;
+    DROP FUNCTION gn_synthese.fct_tri_synthese_changes();
+    """
+    )
+    op.drop_table("t_synthese_changes", schema="gn_synthese")
@@ -0,0 +1,198 @@
+"""dataset stats taxa as rows
+
+Revision ID: b2e8f4a6c913
+Revises: a7c3e9f2b418
+Create Date: 2026-10-19 16:41:09.518832
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "b2e8f4a6c913"
+down_revision = "a7c3e9f2b418"
+branch_labels = None
+depends_on = None
+
+
+"""
+- Les taxons des jeux de données sont stockés en lignes dans gn_meta.t_dataset_taxa
+  au lieu du tableau gn_meta.t_dataset_stats.taxa, reconstruit à chaque insertion
+  dans la synthèse.
+- Les statistiques périmées ne sont plus recalculées à la lecture, mais par la commande
+  geonature metadata refresh-stats et par une tâche périodique.
+"""
+
+REFRESH_DATASET_STATS = """
+    CREATE OR REPLACE FUNCTION gn_meta.refresh_dataset_stats(ids integer[])
+     RETURNS integer
+     LANGUAGE plpgsql
+    AS $function$
+            DECLARE
+                affected_rows_count int;
+            BEGIN
+                DELETE FROM gn_meta.t_dataset_stats WHERE id_dataset = ANY(ids);
+                {refresh}
+                GET DIAGNOSTICS affected_rows_count = ROW_COUNT;
+                RETURN affected_rows_count;
+            END;
+        $function$
+    ;
+"""
+
+REFRESH_ROWS = """
+                DELETE FROM gn_meta.t_dataset_taxa WHERE id_dataset = ANY(ids);
+                INSERT INTO gn_meta.t_dataset_taxa (id_dataset, cd_nom)
+                SELECT DISTINCT s.id_dataset, s.cd_nom
+                FROM gn_synthese.synthese s
+                WHERE s.id_dataset = ANY(ids) AND s.cd_nom IS NOT NULL;
+                INSERT INTO gn_meta.t_dataset_stats (id_dataset, nb_observations, bbox)
+                SELECT
+                    s.id_dataset,
+                    count(*),
+                    st_setsrid(st_extent(s.the_geom_4326)::geometry, 4326)
+                FROM gn_synthese.synthese s
+                WHERE s.id_dataset = ANY(ids)
+                GROUP BY s.id_dataset;
+"""
+
+REFRESH_ARRAY = """
+                INSERT INTO gn_meta.t_dataset_stats (id_dataset, nb_observations, taxa, bbox)
+                SELECT
+                    s.id_dataset,
+                    count(*),
+                    ARRAY(
+                        SELECT DISTINCT unnest(
+                            array_agg(s.cd_nom) FILTER (WHERE s.cd_nom IS NOT NULL)
+                        ) AS cd_nom
+                        ORDER BY cd_nom
+                    ),
+                    st_setsrid(st_extent(s.the_geom_4326)::geometry, 4326)
+                FROM gn_synthese.synthese s
+                WHERE s.id_dataset = ANY(ids)
+                GROUP BY s.id_dataset;
+"""
+
+INSERT_DATASET_STATS = """
+    CREATE OR REPLACE FUNCTION gn_meta.fct_tri_insert_dataset_stats()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                {insert}
+                RETURN NULL;
+            END;
+        $function$
+    ;
+"""
+
+INSERT_ROWS = """
+                -- datasets are locked in the same order by concurrent inserts
+                INSERT INTO gn_meta.t_dataset_stats AS st (id_dataset, nb_observations, bbox)
+                SELECT
+                    n.id_dataset,
+                    count(*),
+                    st_setsrid(st_extent(n.the_geom_4326)::geometry, 4326)
+                FROM new_table n
+                GROUP BY n.id_dataset
+                ORDER BY n.id_dataset
+                ON CONFLICT (id_dataset) DO UPDATE SET
+                    nb_observations = st.nb_observations + EXCLUDED.nb_observations,
+                    bbox = CASE
+                        WHEN st.bbox IS NULL THEN EXCLUDED.bbox
+                        WHEN EXCLUDED.bbox IS NULL THEN st.bbox
+                        ELSE st_envelope(st_collect(st.bbox, EXCLUDED.bbox))
+                    END,
+                    meta_update_date = now();
+                INSERT INTO gn_meta.t_dataset_taxa (id_dataset, cd_nom)
+                SELECT DISTINCT n.id_dataset, n.cd_nom
+                FROM new_table n
+                WHERE n.cd_nom IS NOT NULL
+                ON CONFLICT DO NOTHING;
+"""
+
+INSERT_ARRAY = """
+                INSERT INTO gn_meta.t_dataset_stats AS st (id_dataset, nb_observations, taxa, bbox)
+                SELECT
+                    n.id_dataset,
+                    count(*),
+                    ARRAY(
+                        SELECT DISTINCT unnest(
+                            array_agg(n.cd_nom) FILTER (WHERE n.cd_nom IS NOT NULL)
+                        ) AS cd_nom
+                        ORDER BY cd_nom
+                    ),
+                    st_setsrid(st_extent(n.the_geom_4326)::geometry, 4326)
+                FROM new_table n
+                GROUP BY n.id_dataset
+                ON CONFLICT (id_dataset) DO UPDATE SET
+                    nb_observations = st.nb_observations + EXCLUDED.nb_observations,
+                    taxa = ARRAY(
+                        SELECT DISTINCT unnest(st.taxa || EXCLUDED.taxa) AS cd_nom ORDER BY cd_nom
+                    ),
+                    bbox = CASE
+                        WHEN st.bbox IS NULL THEN EXCLUDED.bbox
+                        WHEN EXCLUDED.bbox IS NULL THEN st.bbox
+                        ELSE st_envelope(st_collect(st.bbox, EXCLUDED.bbox))
+                    END,
+                    meta_update_date = now();
+"""
+
+
+def upgrade():
+    logger.info("Create dataset taxa table")
+    op.create_table(
+        "t_dataset_taxa",
+        sa.Column(
+            "id_dataset",
+            sa.Integer,
+            sa.ForeignKey("gn_meta.t_datasets.id_dataset", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("cd_nom", sa.Integer, primary_key=True),
+        schema="gn_meta",
+    )
+    op.execute(
+        """
+    INSERT INTO gn_meta.t_dataset_taxa (id_dataset, cd_nom)
+    SELECT st.id_dataset, unnest(st.taxa)
+    FROM gn_meta.t_dataset_stats st
+    WHERE NOT st.stale
+    """
+    )
+    op.execute(INSERT_DATASET_STATS.format(insert=INSERT_ROWS))
+    op.execute(REFRESH_DATASET_STATS.format(refresh=REFRESH_ROWS))
+    op.drop_column("t_dataset_stats", "taxa", schema="gn_meta")
+
+    logger.info("Compute stale stats")
+    op.execute(
+        """
+    SELECT gn_meta.refresh_dataset_stats(ARRAY(
+        SELECT id_dataset FROM gn_meta.t_dataset_stats WHERE stale
+    ))
+    """
+    )
+
+
+def downgrade():
+    op.add_column(
+        "t_dataset_stats",
+        sa.Column("taxa", ARRAY(sa.Integer), nullable=False, server_default="{}"),
+        schema="gn_meta",
+    )
+    op.execute(
+        """
+    UPDATE gn_meta.t_dataset_stats st
+    SET taxa = ARRAY(
+        SELECT t.cd_nom FROM gn_meta.t_dataset_taxa t
+        WHERE t.id_dataset = st.id_dataset
+        ORDER BY t.cd_nom
+    )
+    """
+    )
+    op.execute(REFRESH_DATASET_STATS.format(refresh=REFRESH_ARRAY))
+    op.execute(INSERT_DATASET_STATS.format(insert=INSERT_ARRAY))
+    op.drop_table("t_dataset_taxa", schema="gn_meta")
@@ -0,0 +1,28 @@
+"""add error to sensitivity update chunks
+
+Revision ID: b5d1f7c3e820
+Revises: f3b8d2c6a914
+Create Date: 2026-10-19 09:41:12.318604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b5d1f7c3e820"
+down_revision = "f3b8d2c6a914"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "t_sensitivity_update_chunks",
+        sa.Column("error", sa.UnicodeText),
+        schema="gn_sensitivity",
+    )
+
+
+def downgrade():
+    op.drop_column("t_sensitivity_update_chunks", "error", schema="gn_sensitivity")
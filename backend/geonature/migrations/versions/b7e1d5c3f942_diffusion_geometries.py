@@ -0,0 +1,208 @@
+"""precomputed diffusion geometries
+
+Revision ID: b7e1d5c3f942
+Revises: a4c8e2f6b931
+Create Date: 2026-10-18 17:05:42.618350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from geoalchemy2 import Geometry
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "b7e1d5c3f942"
+down_revision = "a4c8e2f6b931"
+branch_labels = None
+depends_on = None
+
+
+"""
+- gn_synthese.t_diffusion_geometries contient la géométrie des observations dégradée
+  selon leur niveau de diffusion, ou à défaut leur niveau de sensibilité :
+  commune (1), maille 10 km (2), département (3). Les observations non diffusées (4)
+  ont une géométrie NULL ; les observations diffusées précisément n’ont pas de ligne.
+- La table est maintenue par des triggers sur gn_synthese.synthese.
+"""
+
+
+def upgrade():
+    logger.info("Create diffusion geometries table")
+    op.create_table(
+        "t_diffusion_geometries",
+        sa.Column(
+            "id_synthese",
+            sa.Integer,
+            sa.ForeignKey("gn_synthese.synthese.id_synthese", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column(
+            "id_type",
+            sa.Integer,
+            sa.ForeignKey("ref_geo.bib_areas_types.id_type", ondelete="SET NULL"),
+        ),
+        sa.Column("the_geom_4326", Geometry("GEOMETRY", 4326, spatial_index=False)),
+        schema="gn_synthese",
+    )
+    op.execute(
+        """
+    CREATE INDEX i_t_diffusion_geometries_the_geom_4326
+        ON gn_synthese.t_diffusion_geometries USING gist (the_geom_4326)
+    """
+    )
+
+    # Area type to which the geometry of each observation must be degraded:
+    # NULL for a precise diffusion, '' for no diffusion at all
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.get_diffusion_area_type(
+        id_nomenclature_diffusion_level integer,
+        id_nomenclature_sensitivity integer
+    )
+     RETURNS varchar
+     LANGUAGE sql
+     STABLE
+    AS $function$
+        SELECT
+            CASE COALESCE(
+                ref_nomenclatures.get_cd_nomenclature(id_nomenclature_diffusion_level),
+                ref_nomenclatures.get_cd_nomenclature(id_nomenclature_sensitivity)
+            )
+                WHEN '1' THEN 'COM'
+                WHEN '2' THEN 'M10'
+                WHEN '3' THEN 'DEP'
+                WHEN '4' THEN ''
+            END
+    $function$
+    ;
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.refresh_diffusion_geometries(ids integer[])
+     RETURNS integer
+     LANGUAGE plpgsql
+    AS $function$
+            DECLARE
+                affected_rows_count int;
+            BEGIN
+                DELETE FROM gn_synthese.t_diffusion_geometries WHERE id_synthese = ANY(ids);
+                INSERT INTO gn_synthese.t_diffusion_geometries (id_synthese, id_type, the_geom_4326)
+                SELECT
+                    s.id_synthese,
+                    t.id_type,
+                    -- no area found: the observation is not diffused
+                    (
+                        SELECT st_transform(st_union(a.geom), 4326)
+                        FROM ref_geo.l_areas a
+                        WHERE a.id_type = t.id_type
+                        AND st_intersects(a.geom, s.the_geom_local)
+                    )
+                FROM gn_synthese.synthese s
+                CROSS JOIN LATERAL gn_synthese.get_diffusion_area_type(
+                    s.id_nomenclature_diffusion_level,
+                    s.id_nomenclature_sensitivity
+                ) AS d(type_code)
+                LEFT JOIN ref_geo.bib_areas_types t ON t.type_code = d.type_code
+                WHERE s.id_synthese = ANY(ids)
+                AND d.type_code IS NOT NULL;
+                GET DIAGNOSTICS affected_rows_count = ROW_COUNT;
+                RETURN affected_rows_count;
+            END;
+        $function$
+    ;
+    CREATE FUNCTION gn_synthese.refresh_diffusion_geometries(id_min integer, id_max integer)
+     RETURNS integer
+     LANGUAGE sql
+    AS $function$
+        SELECT gn_synthese.refresh_diffusion_geometries(ARRAY(
+            SELECT id_synthese
+            FROM gn_synthese.synthese
+            WHERE id_synthese BETWEEN id_min AND id_max
+        ))
+    $function$
+    ;
+    """
+    )
+
+    logger.info("Maintain diffusion geometries on synthese changes")
+    # The insert trigger reads the rows from the synthese, as their sensitivity is
+    # computed by the tri_insert_calculate_sensitivity trigger, fired before this one.
+    # Its UPDATE of the sensitivity already refreshes the sensitive observations.
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.fct_tri_refresh_diffusion_geometries()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    -- skip the rows already refreshed by the sensitivity update
+                    PERFORM gn_synthese.refresh_diffusion_geometries(
+                        ARRAY(
+                            SELECT n.id_synthese
+                            FROM new_table n
+                            WHERE NOT EXISTS (
+                                SELECT 1
+                                FROM gn_synthese.t_diffusion_geometries d
+                                WHERE d.id_synthese = n.id_synthese
+                            )
+                        )
+                    );
+                ELSE
+                    PERFORM gn_synthese.refresh_diffusion_geometries(
+                        ARRAY(
+                            SELECT n.id_synthese
+                            FROM new_table n
+                            JOIN old_table o USING (id_synthese)
+                            WHERE n.id_nomenclature_sensitivity IS DISTINCT FROM o.id_nomenclature_sensitivity
+                            OR n.id_nomenclature_diffusion_level IS DISTINCT FROM o.id_nomenclature_diffusion_level
+                            OR n.the_geom_local IS DISTINCT FROM o.the_geom_local
+                        )
+                    );
+                END IF;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_insert_diffusion_geometries
+        AFTER INSERT ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_synthese.fct_tri_refresh_diffusion_geometries();
+    CREATE TRIGGER tri_update_diffusion_geometries
+        AFTER UPDATE ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_synthese.fct_tri_refresh_diffusion_geometries();
+    """
+    )
+
+    logger.info("Compute diffusion geometries of existing observations")
+    op.execute(
+        """
+    SELECT gn_synthese.refresh_diffusion_geometries(ARRAY(
+        SELECT id_synthese
+        FROM gn_synthese.synthese
+        WHERE gn_synthese.get_diffusion_area_type(
+            id_nomenclature_diffusion_level,
+            id_nomenclature_sensitivity
+        ) IS NOT NULL
+    ))
+    """
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+    DROP TRIGGER tri_insert_diffusion_geometries ON gn_synthese.synthese;
+    DROP TRIGGER tri_update_diffusion_geometries ON gn_synthese.synthese;
+    DROP FUNCTION gn_synthese.fct_tri_refresh_diffusion_geometries();
+    DROP FUNCTION gn_synthese.refresh_diffusion_geometries(integer, integer);
+    DROP FUNCTION gn_synthese.refresh_diffusion_geometries(integer[]);
+    DROP FUNCTION gn_synthese.get_diffusion_area_type(integer, integer);
+    """
+    )
+    op.drop_table("t_diffusion_geometries", schema="gn_synthese")
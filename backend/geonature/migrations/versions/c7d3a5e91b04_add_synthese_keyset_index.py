@@ -0,0 +1,30 @@
+"""add index for synthese keyset pagination
+
+Revision ID: c7d3a5e91b04
+Revises: 8e4f0a6c2d19
+Create Date: 2026-10-18 14:06:38.512094
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c7d3a5e91b04"
+down_revision = "8e4f0a6c2d19"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pages are ordered by (date_min, id_synthese) DESC and
+    # started with a (date_min, id_synthese) < (:date_min, :id_synthese) row comparison
+    op.create_index(
+        "i_synthese_date_min_id_synthese",
+        schema="gn_synthese",
+        table_name="synthese",
+        columns=["date_min", "id_synthese"],
+    )
+
+
+def downgrade():
+    op.drop_index("i_synthese_date_min_id_synthese", schema="gn_synthese", table_name="synthese")
@@ -0,0 +1,28 @@
+"""add error to cor_area_synthese chunks
+
+Revision ID: c8e4a2d6f195
+Revises: b5d1f7c3e820
+Create Date: 2026-10-19 10:07:54.902137
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c8e4a2d6f195"
+down_revision = "b5d1f7c3e820"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "t_cor_area_synthese_chunks",
+        sa.Column("error", sa.UnicodeText),
+        schema="gn_synthese",
+    )
+
+
+def downgrade():
+    op.drop_column("t_cor_area_synthese_chunks", "error", schema="gn_synthese")
@@ -0,0 +1,179 @@
+"""dataset statistics rollup
+
+Revision ID: c9d3e7a1f254
+Revises: b7e1d5c3f942
+Create Date: 2026-10-18 18:12:27.504913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from geoalchemy2 import Geometry
+from sqlalchemy.dialects.postgresql import ARRAY
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "c9d3e7a1f254"
+down_revision = "b7e1d5c3f942"
+branch_labels = None
+depends_on = None
+
+
+"""
+- gn_meta.t_dataset_stats contient, pour chaque jeu de données ayant des observations
+  dans la synthèse, le nombre d’observations, les taxons (cd_nom distincts) et
+  l’emprise des observations.
+- Les insertions dans la synthèse sont ajoutées aux statistiques existantes ;
+  les modifications et suppressions marquent les statistiques comme périmées (stale),
+  elles sont alors recalculées à la lecture.
+"""
+
+
+def upgrade():
+    logger.info("Create dataset stats table")
+    op.create_table(
+        "t_dataset_stats",
+        sa.Column(
+            "id_dataset",
+            sa.Integer,
+            sa.ForeignKey("gn_meta.t_datasets.id_dataset", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("nb_observations", sa.BigInteger, nullable=False, server_default="0"),
+        sa.Column("taxa", ARRAY(sa.Integer), nullable=False, server_default="{}"),
+        sa.Column("bbox", Geometry("GEOMETRY", 4326, spatial_index=False)),
+        sa.Column("stale", sa.Boolean, nullable=False, server_default=sa.false()),
+        sa.Column("meta_update_date", sa.DateTime, nullable=False, server_default=sa.func.now()),
+        schema="gn_meta",
+    )
+
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.refresh_dataset_stats(ids integer[])
+     RETURNS integer
+     LANGUAGE plpgsql
+    AS $function$
+            DECLARE
+                affected_rows_count int;
+            BEGIN
+                DELETE FROM gn_meta.t_dataset_stats WHERE id_dataset = ANY(ids);
+                INSERT INTO gn_meta.t_dataset_stats (id_dataset, nb_observations, taxa, bbox)
+                SELECT
+                    s.id_dataset,
+                    count(*),
+                    ARRAY(
+                        SELECT DISTINCT unnest(
+                            array_agg(s.cd_nom) FILTER (WHERE s.cd_nom IS NOT NULL)
+                        ) AS cd_nom
+                        ORDER BY cd_nom
+                    ),
+                    st_setsrid(st_extent(s.the_geom_4326)::geometry, 4326)
+                FROM gn_synthese.synthese s
+                WHERE s.id_dataset = ANY(ids)
+                GROUP BY s.id_dataset;
+                GET DIAGNOSTICS affected_rows_count = ROW_COUNT;
+                RETURN affected_rows_count;
+            END;
+        $function$
+    ;
+    """
+    )
+
+    logger.info("Maintain dataset stats on synthese changes")
+    op.execute(
+        """
+    CREATE FUNCTION gn_meta.fct_tri_insert_dataset_stats()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                INSERT INTO gn_meta.t_dataset_stats AS st (id_dataset, nb_observations, taxa, bbox)
+                SELECT
+                    n.id_dataset,
+                    count(*),
+                    ARRAY(
+                        SELECT DISTINCT unnest(
+                            array_agg(n.cd_nom) FILTER (WHERE n.cd_nom IS NOT NULL)
+                        ) AS cd_nom
+                        ORDER BY cd_nom
+                    ),
+                    st_setsrid(st_extent(n.the_geom_4326)::geometry, 4326)
+                FROM new_table n
+                GROUP BY n.id_dataset
+                ON CONFLICT (id_dataset) DO UPDATE SET
+                    nb_observations = st.nb_observations + EXCLUDED.nb_observations,
+                    taxa = ARRAY(
+                        SELECT DISTINCT unnest(st.taxa || EXCLUDED.taxa) AS cd_nom ORDER BY cd_nom
+                    ),
+                    bbox = CASE
+                        WHEN st.bbox IS NULL THEN EXCLUDED.bbox
+                        WHEN EXCLUDED.bbox IS NULL THEN st.bbox
+                        ELSE st_envelope(st_collect(st.bbox, EXCLUDED.bbox))
+                    END,
+                    meta_update_date = now();
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE FUNCTION gn_meta.fct_tri_stale_dataset_stats()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    UPDATE gn_meta.t_dataset_stats
+                    SET stale = true
+                    WHERE id_dataset IN (SELECT id_dataset FROM old_table)
+                    AND NOT stale;
+                ELSE
+                    -- observations may be moved to a dataset without stats yet
+                    INSERT INTO gn_meta.t_dataset_stats AS st (id_dataset, stale)
+                    SELECT DISTINCT unnest(ARRAY[n.id_dataset, o.id_dataset]), true
+                    FROM new_table n
+                    JOIN old_table o USING (id_synthese)
+                    WHERE n.id_dataset IS DISTINCT FROM o.id_dataset
+                    OR n.cd_nom IS DISTINCT FROM o.cd_nom
+                    OR n.the_geom_4326 IS DISTINCT FROM o.the_geom_4326
+                    ON CONFLICT (id_dataset) DO UPDATE SET stale = true
+                    WHERE NOT st.stale;
+                END IF;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_insert_dataset_stats
+        AFTER INSERT ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_meta.fct_tri_insert_dataset_stats();
+    CREATE TRIGGER tri_update_dataset_stats
+        AFTER UPDATE ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_meta.fct_tri_stale_dataset_stats();
+    CREATE TRIGGER tri_delete_dataset_stats
+        AFTER DELETE ON gn_synthese.synthese
+        REFERENCING OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_meta.fct_tri_stale_dataset_stats();
+    """
+    )
+
+    logger.info("Compute stats of existing datasets")
+    op.execute(
+        "SELECT gn_meta.refresh_dataset_stats(ARRAY(SELECT id_dataset FROM gn_meta.t_datasets))"
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+    DROP TRIGGER tri_insert_dataset_stats ON gn_synthese.synthese;
+    DROP TRIGGER tri_update_dataset_stats ON gn_synthese.synthese;
+    DROP TRIGGER tri_delete_dataset_stats ON gn_synthese.synthese;
+    DROP FUNCTION gn_meta.fct_tri_insert_dataset_stats();
+    DROP FUNCTION gn_meta.fct_tri_stale_dataset_stats();
+    DROP FUNCTION gn_meta.refresh_dataset_stats(integer[]);
+    """
+    )
+    op.drop_table("t_dataset_stats", schema="gn_meta")
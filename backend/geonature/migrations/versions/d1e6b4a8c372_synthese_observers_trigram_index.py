@@ -0,0 +1,46 @@
+"""trigram index on synthese observers
+
+Revision ID: d1e6b4a8c372
+Revises: c9d3e7a1f254
+Create Date: 2026-10-18 18:47:51.092374
+
+"""
+from alembic import op
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "d1e6b4a8c372"
+down_revision = "c9d3e7a1f254"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # unaccent is only stable as it depends on the search_path:
+    # an immutable version with an explicit dictionary is needed to be indexed
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.immutable_unaccent(value text)
+     RETURNS text
+     LANGUAGE sql
+     IMMUTABLE PARALLEL SAFE STRICT
+    AS $function$
+        SELECT public.unaccent('public.unaccent'::regdictionary, value)
+    $function$
+    ;
+    """
+    )
+    logger.info("Create trigram index on synthese observers")
+    op.execute(
+        """
+    CREATE INDEX i_synthese_observers_unaccent_trgm
+        ON gn_synthese.synthese
+        USING gin (gn_synthese.immutable_unaccent(observers) gin_trgm_ops)
+    """
+    )
+
+
+def downgrade():
+    op.execute("DROP INDEX gn_synthese.i_synthese_observers_unaccent_trgm")
+    op.execute("DROP FUNCTION gn_synthese.immutable_unaccent(text)")
@@ -0,0 +1,144 @@
+"""queue taxa of changed observations for profiles refresh
+
+Revision ID: d4f6b8a2c157
+Revises: c8e4a2d6f195
+Create Date: 2026-10-19 10:52:26.771048
+
+"""
+from alembic import op
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "d4f6b8a2c157"
+down_revision = "c8e4a2d6f195"
+branch_labels = None
+depends_on = None
+
+"""
+Les taxons à recalculer étaient retrouvés par la date de modification des observations :
+une observation écrite par une transaction encore en cours pendant un calcul a une date
+antérieure au calcul, mais n'est visible qu'après, et n'était donc jamais prise en compte.
+Les triggers de la synthèse ajoutent désormais le cd_nom de chaque observation créée,
+modifiée ou supprimée à la file gn_profiles.t_stale_taxa, vidée par le calcul dans sa
+transaction. La file n'a pas de contrainte d'unicité sur cd_nom, pour que les écritures
+dans la synthèse n'attendent jamais la fin d'un calcul.
+"""
+
+
+def upgrade():
+    op.execute(
+        """
+    DROP TRIGGER tri_update_stale_taxa ON gn_synthese.synthese;
+    DROP FUNCTION gn_profiles.fct_tri_stale_taxa();
+    ALTER TABLE gn_profiles.t_stale_taxa DROP CONSTRAINT t_stale_taxa_pkey;
+    ALTER TABLE gn_profiles.t_stale_taxa ADD COLUMN id_stale serial PRIMARY KEY;
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_profiles.fct_tri_stale_taxa()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO gn_profiles.t_stale_taxa (cd_nom)
+                    SELECT DISTINCT cd_nom FROM new_table WHERE cd_nom IS NOT NULL;
+                ELSIF TG_OP = 'UPDATE' THEN
+                    INSERT INTO gn_profiles.t_stale_taxa (cd_nom)
+                    SELECT cd_nom FROM new_table WHERE cd_nom IS NOT NULL
+                    UNION
+                    SELECT cd_nom FROM old_table WHERE cd_nom IS NOT NULL;
+                ELSE
+                    INSERT INTO gn_profiles.t_stale_taxa (cd_nom)
+                    SELECT DISTINCT cd_nom FROM old_table WHERE cd_nom IS NOT NULL;
+                END IF;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_insert_stale_taxa
+        AFTER INSERT ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_profiles.fct_tri_stale_taxa();
+    CREATE TRIGGER tri_update_stale_taxa
+        AFTER UPDATE ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_profiles.fct_tri_stale_taxa();
+    CREATE TRIGGER tri_delete_stale_taxa
+        AFTER DELETE ON gn_synthese.synthese
+        REFERENCING OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_profiles.fct_tri_stale_taxa();
+    """
+    )
+
+    logger.info("Queue taxa of the observations changed since the last profiles refresh")
+    op.execute(
+        """
+    WITH last_refresh AS (
+        SELECT max(refresh_date) AS refresh_date FROM gn_profiles.t_refresh_history
+    )
+    INSERT INTO gn_profiles.t_stale_taxa (cd_nom)
+    SELECT s.cd_nom
+    FROM gn_synthese.synthese s, last_refresh r
+    WHERE COALESCE(s.meta_update_date, s.meta_create_date) >= r.refresh_date
+    UNION
+    SELECT l.cd_nom
+    FROM gn_synthese.t_log_synthese l, last_refresh r
+    WHERE l.meta_last_action_date >= r.refresh_date AND l.cd_nom IS NOT NULL
+    """
+    )
+    # only used to find the changed observations
+    op.execute("DROP INDEX gn_synthese.i_synthese_last_action_date")
+
+
+def downgrade():
+    op.execute(
+        """
+    CREATE INDEX i_synthese_last_action_date
+        ON gn_synthese.synthese
+        USING btree (COALESCE(meta_update_date, meta_create_date))
+    """
+    )
+    op.execute(
+        """
+    DROP TRIGGER tri_insert_stale_taxa ON gn_synthese.synthese;
+    DROP TRIGGER tri_update_stale_taxa ON gn_synthese.synthese;
+    DROP TRIGGER tri_delete_stale_taxa ON gn_synthese.synthese;
+    DROP FUNCTION gn_profiles.fct_tri_stale_taxa();
+    DELETE FROM gn_profiles.t_stale_taxa a
+        USING gn_profiles.t_stale_taxa b
+        WHERE a.cd_nom = b.cd_nom AND a.id_stale > b.id_stale;
+    ALTER TABLE gn_profiles.t_stale_taxa DROP COLUMN id_stale;
+    ALTER TABLE gn_profiles.t_stale_taxa ADD PRIMARY KEY (cd_nom);
+    """
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_profiles.fct_tri_stale_taxa()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                INSERT INTO gn_profiles.t_stale_taxa (cd_nom)
+                SELECT DISTINCT o.cd_nom
+                FROM new_table n
+                JOIN old_table o USING (id_synthese)
+                WHERE n.cd_nom IS DISTINCT FROM o.cd_nom
+                AND o.cd_nom IS NOT NULL
+                ON CONFLICT (cd_nom) DO NOTHING;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_update_stale_taxa
+        AFTER UPDATE ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_profiles.fct_tri_stale_taxa();
+    """
+    )
@@ -0,0 +1,117 @@
+"""chunked update of synthese sensitivity
+
+Revision ID: e2a9c4d7f318
+Revises: c7d3a5e91b04
+Create Date: 2026-10-18 15:02:51.207469
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "e2a9c4d7f318"
+down_revision = "c7d3a5e91b04"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    logger.info("Create sensitivity update jobs tables")
+    op.create_table(
+        "t_sensitivity_update_jobs",
+        sa.Column("id_job", sa.Integer, primary_key=True),
+        sa.Column("cd_refs", ARRAY(sa.Integer)),
+        sa.Column("chunk_size", sa.Integer, nullable=False),
+        sa.Column("creation_date", sa.DateTime, server_default=sa.func.now()),
+        sa.Column("end_date", sa.DateTime),
+        schema="gn_sensitivity",
+    )
+    op.create_table(
+        "t_sensitivity_update_chunks",
+        sa.Column(
+            "id_job",
+            sa.Integer,
+            sa.ForeignKey("gn_sensitivity.t_sensitivity_update_jobs.id_job", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("id_min", sa.Integer, primary_key=True),
+        sa.Column("id_max", sa.Integer, nullable=False),
+        sa.Column("nb_updated", sa.Integer),
+        sa.Column("update_date", sa.DateTime),
+        schema="gn_sensitivity",
+    )
+
+    # Same as gn_synthese.update_sensitivity() restricted to a range of id_synthese
+    # and, if cd_refs is given, to the observations of these taxa
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.update_sensitivity(
+        id_min integer,
+        id_max integer,
+        cd_refs integer[] DEFAULT NULL
+    )
+     RETURNS integer
+     LANGUAGE plpgsql
+    AS $function$
+            DECLARE
+                affected_rows_count int;
+            BEGIN
+                WITH cte AS (
+                    SELECT
+                        id_synthese,
+                        id_nomenclature_sensitivity AS old_sensitivity,
+                        gn_sensitivity.get_id_nomenclature_sensitivity(
+                          date_min::date,
+                          taxonomie.find_cdref(cd_nom),
+                          the_geom_local,
+                          jsonb_build_object(
+                            'STATUT_BIO', id_nomenclature_bio_status,
+                            'OCC_COMPORTEMENT', id_nomenclature_behaviour
+                          )
+                        ) AS new_sensitivity
+                    FROM
+                        gn_synthese.synthese
+                    WHERE
+                        id_synthese BETWEEN id_min AND id_max
+                    AND (
+                        CASE
+                            WHEN cd_refs IS NOT NULL THEN
+                                taxonomie.find_cdref(cd_nom) = ANY(cd_refs)
+                            ELSE
+                                id_nomenclature_sensitivity IS NULL
+                            OR
+                                id_nomenclature_sensitivity != ref_nomenclatures.get_id_nomenclature('SENSIBILITE', '0') -- non sensible
+                            OR
+                                taxonomie.find_cdref(cd_nom) IN (SELECT DISTINCT cd_ref FROM gn_sensitivity.t_sensitivity_rules_cd_ref)
+                        END
+                    )
+                )
+                UPDATE
+                    gn_synthese.synthese s
+                SET
+                    id_nomenclature_sensitivity = new_sensitivity
+                FROM
+                    cte
+                WHERE
+                        s.id_synthese = cte.id_synthese
+                    AND (
+                        old_sensitivity IS NULL
+                        OR
+                        old_sensitivity != new_sensitivity
+                    );
+                GET DIAGNOSTICS affected_rows_count = ROW_COUNT;
+                RETURN affected_rows_count;
+            END;
+        $function$
+    ;
+    """
+    )
+
+
+def downgrade():
+    op.execute("DROP FUNCTION gn_synthese.update_sensitivity(integer, integer, integer[])")
+    op.drop_table("t_sensitivity_update_chunks", schema="gn_sensitivity")
+    op.drop_table("t_sensitivity_update_jobs", schema="gn_sensitivity")
@@ -0,0 +1,391 @@
+"""incremental profiles refresh
+
+Revision ID: e5a2c8f1d736
+Revises: d1e6b4a8c372
+Create Date: 2026-10-18 19:21:08.275164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "e5a2c8f1d736"
+down_revision = "d1e6b4a8c372"
+branch_labels = None
+depends_on = None
+
+
+"""
+- Les vues matérialisées gn_profiles.vm_valid_profiles et gn_profiles.vm_cor_taxon_phenology
+  deviennent des tables (même nom, mêmes colonnes), recalculées taxon par taxon par
+  gn_profiles.refresh_profiles(cd_refs) ; sans argument, tous les profils sont recalculés.
+- gn_profiles.t_refresh_history conserve la date de chaque calcul : seuls les taxons dont
+  les observations ont été créées, modifiées (meta_update_date) ou supprimées
+  (gn_synthese.t_log_synthese, qui conserve désormais le cd_nom) depuis le dernier calcul
+  sont recalculés.
+- gn_profiles.t_stale_taxa conserve l’ancien cd_nom des observations dont le taxon a
+  été modifié.
+"""
+
+
+CONSISTANCY_DATA_VIEW = """
+    CREATE VIEW gn_profiles.v_consistancy_data AS
+    SELECT s.id_synthese,
+        s.unique_id_sinp AS id_sinp,
+        t.cd_ref,
+        t.lb_nom AS valid_name,
+        gn_profiles.check_profile_distribution(s.the_geom_local, p.valid_distribution) AS valid_distribution,
+        gn_profiles.check_profile_phenology(
+          t.cd_ref, s.date_min::date, s.date_max::date, s.altitude_min, s.altitude_max, s.id_nomenclature_life_stage, p.active_life_stage
+        ) AS valid_phenology,
+        gn_profiles.check_profile_altitudes(
+            s.altitude_min, s.altitude_max, p.altitude_min, p.altitude_max
+        ) AS valid_altitude,
+        n.label_default AS valid_status
+    FROM gn_synthese.synthese s
+    JOIN taxonomie.taxref t
+        ON s.cd_nom = t.cd_nom
+    JOIN gn_profiles.vm_valid_profiles p
+        ON p.cd_ref = t.cd_ref
+    LEFT JOIN ref_nomenclatures.t_nomenclatures n
+        ON s.id_nomenclature_valid_status = n.id_nomenclature
+    ;
+"""
+
+
+def upgrade():
+    logger.info("Convert profiles materialized views into tables")
+    op.execute("DROP VIEW gn_profiles.v_consistancy_data")
+    op.execute(
+        """
+    CREATE TABLE gn_profiles.t_valid_profiles AS
+        SELECT * FROM gn_profiles.vm_valid_profiles;
+    CREATE TABLE gn_profiles.t_cor_taxon_phenology AS
+        SELECT * FROM gn_profiles.vm_cor_taxon_phenology;
+    DROP MATERIALIZED VIEW gn_profiles.vm_valid_profiles;
+    DROP MATERIALIZED VIEW gn_profiles.vm_cor_taxon_phenology;
+    ALTER TABLE gn_profiles.t_valid_profiles RENAME TO vm_valid_profiles;
+    ALTER TABLE gn_profiles.t_cor_taxon_phenology RENAME TO vm_cor_taxon_phenology;
+    ALTER TABLE gn_profiles.vm_valid_profiles
+        ADD CONSTRAINT pk_vm_valid_profiles PRIMARY KEY (cd_ref);
+    CREATE INDEX index_vm_cor_taxon_phenology_cd_ref
+        ON gn_profiles.vm_cor_taxon_phenology USING btree (cd_ref);
+    CREATE UNIQUE INDEX vm_cor_taxon_phenology_cd_ref_period_id_nomenclature_life_s_idx
+        ON gn_profiles.vm_cor_taxon_phenology
+        USING btree (cd_ref, doy_min, doy_max, id_nomenclature_life_stage);
+    COMMENT ON TABLE gn_profiles.vm_cor_taxon_phenology IS 'Table containing phenological combinations and corresponding valid data for each taxa';
+    """
+    )
+    op.execute(CONSISTANCY_DATA_VIEW)
+
+    op.execute("DROP FUNCTION gn_profiles.refresh_profiles()")
+    op.execute(
+        """
+    CREATE FUNCTION gn_profiles.refresh_profiles(cd_refs integer[] DEFAULT NULL)
+     RETURNS integer
+     LANGUAGE plpgsql
+    AS $function$
+    -- Recalcul des profils des taxons donnés, ou de tous les taxons si cd_refs est NULL
+    -- USAGE : SELECT gn_profiles.refresh_profiles(ARRAY[cd_ref1, cd_ref2])
+    -- Retourne le nombre de profils calculés
+    DECLARE
+        affected_rows_count int;
+    BEGIN
+        DELETE FROM gn_profiles.vm_valid_profiles
+        WHERE cd_refs IS NULL OR cd_ref = ANY(cd_refs);
+        DELETE FROM gn_profiles.vm_cor_taxon_phenology
+        WHERE cd_refs IS NULL OR cd_ref = ANY(cd_refs);
+
+        INSERT INTO gn_profiles.vm_valid_profiles
+        SELECT DISTINCT vsfp.cd_ref,
+            public.st_union(public.st_buffer(vsfp.the_geom_local, (COALESCE(vsfp.spatial_precision, 1))::double precision)) AS valid_distribution,
+            min(vsfp.altitude_min) AS altitude_min,
+            max(vsfp.altitude_max) AS altitude_max,
+            min(vsfp.date_min) AS first_valid_data,
+            max(vsfp.date_max) AS last_valid_data,
+            count(vsfp.*) AS count_valid_data,
+            vsfp.active_life_stage
+        FROM gn_profiles.v_synthese_for_profiles vsfp
+        WHERE cd_refs IS NULL OR vsfp.cd_ref = ANY(cd_refs)
+        GROUP BY vsfp.cd_ref, vsfp.active_life_stage;
+        GET DIAGNOSTICS affected_rows_count = ROW_COUNT;
+
+        INSERT INTO gn_profiles.vm_cor_taxon_phenology
+        WITH exlude_live_stage AS (
+            SELECT ref_nomenclatures.get_id_nomenclature('STADE_VIE', '0') AS id_n_excluded
+            UNION
+            SELECT ref_nomenclatures.get_id_nomenclature('STADE_VIE', '1') AS id_n_excluded
+        ),  params AS (
+            SELECT (value::double PRECISION / 100 ) AS proportion_kept_data
+            FROM gn_profiles.t_parameters parameters
+            WHERE parameters.name = 'proportion_kept_data'
+        ), classified_data AS (
+            SELECT DISTINCT
+                vsfp.cd_ref,
+                unnest(
+                    ARRAY[
+                        floor(date_part('doy', vsfp.date_min) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision,
+                        floor(date_part('doy', vsfp.date_max) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision
+                    ]
+                ) AS doy_min,
+                unnest(
+                    ARRAY[
+                        floor(date_part('doy', vsfp.date_min) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision + vsfp.temporal_precision_days::double precision,
+                        floor(date_part('doy', vsfp.date_max) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision + vsfp.temporal_precision_days::double precision
+                        ]
+                ) AS doy_max,
+                CASE
+                    WHEN vsfp.active_life_stage = true AND NOT vsfp.id_nomenclature_life_stage IN (SELECT id_n_excluded FROM exlude_live_stage)
+                        THEN vsfp.id_nomenclature_life_stage
+                    ELSE NULL::integer
+                END AS id_nomenclature_life_stage,
+                count(vsfp.*) AS count_valid_data,
+                min(vsfp.altitude_min) AS extreme_altitude_min,
+                percentile_disc((SELECT proportion_kept_data FROM params)) WITHIN GROUP (ORDER BY vsfp.altitude_min DESC) AS p_min,
+                max(vsfp.altitude_max) AS extreme_altitude_max,
+                percentile_disc((SELECT proportion_kept_data FROM params)) WITHIN GROUP (ORDER BY vsfp.altitude_max) AS p_max
+            FROM  gn_profiles.v_synthese_for_profiles  vsfp
+            WHERE (cd_refs IS NULL OR vsfp.cd_ref = ANY(cd_refs))
+            AND vsfp.temporal_precision_days IS NOT NULL
+            AND vsfp.spatial_precision IS NOT NULL
+            AND vsfp.active_life_stage IS NOT NULL
+            AND date_part('day', vsfp.date_max - vsfp.date_min) < vsfp.temporal_precision_days::double precision
+            AND vsfp.altitude_min IS NOT NULL AND vsfp.altitude_max IS NOT NULL
+            GROUP BY
+            vsfp.cd_ref,
+            doy_min,
+            doy_max,
+            4  --id_nomenclature_life_stage
+        )
+        SELECT classified_data.cd_ref,
+            classified_data.doy_min,
+            classified_data.doy_max,
+            classified_data.id_nomenclature_life_stage,
+            classified_data.count_valid_data,
+            classified_data.extreme_altitude_min,
+            p_min AS calculated_altitude_min,
+            classified_data.extreme_altitude_max,
+            p_max AS calculated_altitude_max
+        FROM classified_data;
+
+        RETURN affected_rows_count;
+    END;
+    $function$
+    ;
+    """
+    )
+
+    logger.info("Create profiles change feed")
+    op.add_column("t_log_synthese", sa.Column("cd_nom", sa.Integer), schema="gn_synthese")
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION gn_synthese.fct_tri_log_delete_on_synthese() RETURNS TRIGGER AS
+    $BODY$
+    DECLARE
+    BEGIN
+        -- log id/uuid of deleted datas into specific log table
+        IF (TG_OP = 'DELETE') THEN
+            INSERT INTO gn_synthese.t_log_synthese (id_synthese, last_action, meta_last_action_date, cd_nom)
+            SELECT
+                o.id_synthese    AS id_synthese
+                , 'D'                AS last_action
+                , now()              AS meta_last_action_date
+                , o.cd_nom           AS cd_nom
+            from old_table o
+            ON CONFLICT (id_synthese)
+            DO UPDATE SET last_action = 'D', meta_last_action_date = now(), cd_nom = EXCLUDED.cd_nom;
+        END IF;
+        RETURN NULL;
+    END;
+    $BODY$ LANGUAGE plpgsql COST 100
+    ;
+    """
+    )
+    op.execute(
+        """
+    CREATE INDEX i_synthese_last_action_date
+        ON gn_synthese.synthese
+        USING btree (COALESCE(meta_update_date, meta_create_date))
+    """
+    )
+    op.create_table(
+        "t_stale_taxa",
+        sa.Column("cd_nom", sa.Integer, primary_key=True),
+        schema="gn_profiles",
+    )
+    op.execute(
+        """
+    CREATE FUNCTION gn_profiles.fct_tri_stale_taxa()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+            BEGIN
+                INSERT INTO gn_profiles.t_stale_taxa (cd_nom)
+                SELECT DISTINCT o.cd_nom
+                FROM new_table n
+                JOIN old_table o USING (id_synthese)
+                WHERE n.cd_nom IS DISTINCT FROM o.cd_nom
+                AND o.cd_nom IS NOT NULL
+                ON CONFLICT (cd_nom) DO NOTHING;
+                RETURN NULL;
+            END;
+        $function$
+    ;
+    CREATE TRIGGER tri_update_stale_taxa
+        AFTER UPDATE ON gn_synthese.synthese
+        REFERENCING NEW TABLE AS new_table OLD TABLE AS old_table
+        FOR EACH STATEMENT
+        EXECUTE PROCEDURE gn_profiles.fct_tri_stale_taxa();
+    """
+    )
+    op.create_table(
+        "t_refresh_history",
+        sa.Column("id_refresh", sa.Integer, primary_key=True),
+        sa.Column("refresh_date", sa.DateTime, nullable=False, server_default=sa.func.now()),
+        sa.Column("nb_taxa", sa.Integer),
+        sa.Column("full_refresh", sa.Boolean, nullable=False, server_default=sa.false()),
+        schema="gn_profiles",
+    )
+
+    logger.info("Compute profiles")
+    op.execute(
+        """
+    INSERT INTO gn_profiles.t_refresh_history (nb_taxa, full_refresh)
+    SELECT gn_profiles.refresh_profiles(), true
+    """
+    )
+
+
+def downgrade():
+    op.drop_table("t_refresh_history", schema="gn_profiles")
+    op.execute(
+        """
+    DROP TRIGGER tri_update_stale_taxa ON gn_synthese.synthese;
+    DROP FUNCTION gn_profiles.fct_tri_stale_taxa();
+    DROP INDEX gn_synthese.i_synthese_last_action_date;
+    CREATE OR REPLACE FUNCTION gn_synthese.fct_tri_log_delete_on_synthese() RETURNS TRIGGER AS
+    $BODY$
+    DECLARE
+    BEGIN
+        -- log id/uuid of deleted datas into specific log table
+        IF (TG_OP = 'DELETE') THEN
+            INSERT INTO gn_synthese.t_log_synthese
+            SELECT
+                o.id_synthese    AS id_synthese
+                , 'D'                AS last_action
+                , now()              AS meta_last_action_date
+            from old_table o
+            ON CONFLICT (id_synthese)
+            DO UPDATE SET last_action = 'D', meta_last_action_date = now();
+        END IF;
+        RETURN NULL;
+    END;
+    $BODY$ LANGUAGE plpgsql COST 100
+    ;
+    """
+    )
+    op.drop_table("t_stale_taxa", schema="gn_profiles")
+    op.drop_column("t_log_synthese", "cd_nom", schema="gn_synthese")
+
+    op.execute("DROP VIEW gn_profiles.v_consistancy_data")
+    op.execute("DROP FUNCTION gn_profiles.refresh_profiles(integer[])")
+    op.execute(
+        """
+    DROP TABLE gn_profiles.vm_valid_profiles;
+    DROP TABLE gn_profiles.vm_cor_taxon_phenology;
+    CREATE MATERIALIZED VIEW gn_profiles.vm_cor_taxon_phenology
+    AS
+    WITH exlude_live_stage AS (
+        SELECT ref_nomenclatures.get_id_nomenclature('STADE_VIE', '0') AS id_n_excluded
+        UNION
+        SELECT ref_nomenclatures.get_id_nomenclature('STADE_VIE', '1') AS id_n_excluded
+    ),  params AS (
+        SELECT (value::double PRECISION / 100 ) AS proportion_kept_data
+        FROM gn_profiles.t_parameters parameters
+        WHERE parameters.name = 'proportion_kept_data'
+    ), classified_data AS (
+        SELECT DISTINCT
+            vsfp.cd_ref,
+            unnest(
+                ARRAY[
+                    floor(date_part('doy', vsfp.date_min) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision,
+                    floor(date_part('doy', vsfp.date_max) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision
+                ]
+            ) AS doy_min,
+            unnest(
+                ARRAY[
+                    floor(date_part('doy', vsfp.date_min) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision + vsfp.temporal_precision_days::double precision,
+                    floor(date_part('doy', vsfp.date_max) / vsfp.temporal_precision_days::double precision) * vsfp.temporal_precision_days::double precision + vsfp.temporal_precision_days::double precision
+                    ]
+            ) AS doy_max,
+            CASE
+                WHEN vsfp.active_life_stage = true AND NOT vsfp.id_nomenclature_life_stage IN (SELECT id_n_excluded FROM exlude_live_stage)
+                    THEN vsfp.id_nomenclature_life_stage
+                ELSE NULL::integer
+            END AS id_nomenclature_life_stage,
+            count(vsfp.*) AS count_valid_data,
+            min(vsfp.altitude_min) AS extreme_altitude_min,
+            percentile_disc((SELECT proportion_kept_data FROM params)) WITHIN GROUP (ORDER BY vsfp.altitude_min DESC) AS p_min,
+            max(vsfp.altitude_max) AS extreme_altitude_max,
+            percentile_disc((SELECT proportion_kept_data FROM params)) WITHIN GROUP (ORDER BY vsfp.altitude_max) AS p_max
+        FROM  gn_profiles.v_synthese_for_profiles  vsfp
+        WHERE vsfp.temporal_precision_days IS NOT NULL
+        AND vsfp.spatial_precision IS NOT NULL
+        AND vsfp.active_life_stage IS NOT NULL
+        AND date_part('day', vsfp.date_max - vsfp.date_min) < vsfp.temporal_precision_days::double precision
+        AND vsfp.altitude_min IS NOT NULL AND vsfp.altitude_max IS NOT NULL
+        GROUP BY
+        vsfp.cd_ref,
+        doy_min,
+        doy_max,
+        4  --id_nomenclature_life_stage
+    )
+    SELECT classified_data.cd_ref,
+        classified_data.doy_min,
+        classified_data.doy_max,
+        classified_data.id_nomenclature_life_stage,
+        classified_data.count_valid_data,
+        classified_data.extreme_altitude_min,
+        p_min AS calculated_altitude_min,
+        classified_data.extreme_altitude_max,
+        p_max AS calculated_altitude_max
+        FROM classified_data ;
+    COMMENT ON MATERIALIZED VIEW gn_profiles.vm_cor_taxon_phenology IS 'View containing phenological combinations and corresponding valid data for each taxa';
+    CREATE MATERIALIZED VIEW gn_profiles.vm_valid_profiles AS
+     SELECT DISTINCT vsfp.cd_ref,
+        public.st_union(public.st_buffer(vsfp.the_geom_local, (COALESCE(vsfp.spatial_precision, 1))::double precision)) AS valid_distribution,
+        min(vsfp.altitude_min) AS altitude_min,
+        max(vsfp.altitude_max) AS altitude_max,
+        min(vsfp.date_min) AS first_valid_data,
+        max(vsfp.date_max) AS last_valid_data,
+        count(vsfp.*) AS count_valid_data,
+        vsfp.active_life_stage
+       FROM  gn_profiles.v_synthese_for_profiles vsfp
+      GROUP BY vsfp.cd_ref, vsfp.active_life_stage
+      WITH DATA;
+    CREATE UNIQUE INDEX index_vm_valid_profiles_cd_ref
+        ON gn_profiles.vm_valid_profiles USING btree (cd_ref);
+    CREATE INDEX index_vm_cor_taxon_phenology_cd_ref
+        ON gn_profiles.vm_cor_taxon_phenology USING btree (cd_ref);
+    CREATE UNIQUE INDEX vm_cor_taxon_phenology_cd_ref_period_id_nomenclature_life_s_idx
+        ON gn_profiles.vm_cor_taxon_phenology
+        USING btree (cd_ref, doy_min, doy_max, id_nomenclature_life_stage);
+    """
+    )
+    op.execute(CONSISTANCY_DATA_VIEW)
+    op.execute(
+        """
+    CREATE FUNCTION gn_profiles.refresh_profiles() RETURNS void
+        LANGUAGE plpgsql
+        AS $$
+    -- Rafraichissement des vues matérialisées des profils
+    -- USAGE : SELECT gn_profiles.refresh_profiles()
+    BEGIN
+      REFRESH MATERIALIZED VIEW CONCURRENTLY gn_profiles.vm_valid_profiles;
+      REFRESH MATERIALIZED VIEW CONCURRENTLY gn_profiles.vm_cor_taxon_phenology;
+    END
+    $$;
+    """
+    )
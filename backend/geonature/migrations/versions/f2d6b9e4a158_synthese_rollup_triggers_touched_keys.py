@@ -0,0 +1,246 @@
+"""synthese statistics triggers only touch changed keys
+
+Revision ID: f2d6b9e4a158
+Revises: b2e8f4a6c913
+Create Date: 2026-10-20 09:14:37.204815
+
+"""
+from alembic import op
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "f2d6b9e4a158"
+down_revision = "b2e8f4a6c913"
+branch_labels = None
+depends_on = None
+
+
+"""
+- Les triggers des statistiques de la synthèse (gn_synthese.t_stats_taxa et
+  gn_synthese.t_stats_observers) lisent une seule fois les tables de transition,
+  ne mettent à jour que les lignes des clés modifiées, dans le même ordre pour toutes
+  les transactions, et ne suppriment que celles de ces lignes devenues vides.
+- Cinq ensembles de triggers par requête maintiennent des tables dérivées de la synthèse :
+  statistiques (tri_*_stats), géométries de diffusion (tri_*_diffusion_geometries),
+  statistiques des jeux de données (tri_*_dataset_stats), file des profils
+  (tri_*_stale_taxa) et version des données (tri_synthese_changes). Tous sauf le dernier
+  lisent les tables de transition : chaque requête sur la synthèse relit ainsi quatre fois
+  les lignes modifiées, et les mises à jour des lignes agrégées communes sérialisent les
+  imports concurrents. La fonction gn_synthese.set_rollup_triggers(enabled) active ou
+  désactive les quatre premiers pendant un chargement massif ; la commande
+  geonature synthese rollup-triggers enable les réactive et recalcule les tables dérivées.
+"""
+
+# {delta} is a query returning (id_dataset, id_source, cd_nom, observers, nb) rows
+# where nb is the (signed) number of observations to add to the statistics
+APPLY_DELTA = """
+        WITH delta AS (
+            {delta}
+        ),
+        taxa AS (
+            INSERT INTO gn_synthese.t_stats_taxa AS s (id_dataset, id_source, cd_nom, nb_obs)
+                SELECT id_dataset, id_source, cd_nom, sum(nb)
+                FROM delta
+                GROUP BY id_dataset, id_source, cd_nom
+                HAVING sum(nb) <> 0
+                -- rows are locked in the same order by concurrent statements
+                ORDER BY id_dataset, id_source, cd_nom
+            ON CONFLICT (
+                (COALESCE(id_dataset, -1)), (COALESCE(id_source, -1)), (COALESCE(cd_nom, -1))
+            )
+            DO UPDATE SET nb_obs = s.nb_obs + EXCLUDED.nb_obs
+            RETURNING s.id_stats_taxa, s.nb_obs
+        ),
+        observers AS (
+            INSERT INTO gn_synthese.t_stats_observers AS s (observers, nb_obs)
+                SELECT observers, sum(nb)
+                FROM delta
+                WHERE observers IS NOT NULL
+                GROUP BY observers
+                HAVING sum(nb) <> 0
+                ORDER BY md5(observers)
+            ON CONFLICT ((md5(observers)))
+            DO UPDATE SET nb_obs = s.nb_obs + EXCLUDED.nb_obs
+            RETURNING s.id_stats_observers, s.nb_obs
+        )
+        SELECT
+            ARRAY(SELECT id_stats_taxa FROM taxa WHERE nb_obs <= 0),
+            ARRAY(SELECT id_stats_observers FROM observers WHERE nb_obs <= 0)
+        INTO empty_taxa, empty_observers;
+
+        DELETE FROM gn_synthese.t_stats_taxa WHERE id_stats_taxa = ANY(empty_taxa);
+        DELETE FROM gn_synthese.t_stats_observers
+        WHERE id_stats_observers = ANY(empty_observers);
+"""
+
+NEW_ROWS = "SELECT id_dataset, id_source, cd_nom, observers, 1 AS nb FROM new"
+OLD_ROWS = "SELECT id_dataset, id_source, cd_nom, observers, -1 AS nb FROM old"
+# changes of the observers only add and remove the same taxa key, and conversely:
+# their sum is 0 and these keys are left untouched
+CHANGED_ROWS = """
+            SELECT d.*
+            FROM new n
+            JOIN old o ON o.id_synthese = n.id_synthese
+            CROSS JOIN LATERAL (
+                VALUES
+                    (n.id_dataset, n.id_source, n.cd_nom, n.observers, 1),
+                    (o.id_dataset, o.id_source, o.cd_nom, o.observers, -1)
+            ) AS d (id_dataset, id_source, cd_nom, observers, nb)
+            WHERE (n.id_dataset, n.id_source, n.cd_nom, n.observers)
+                IS DISTINCT FROM (o.id_dataset, o.id_source, o.cd_nom, o.observers)
+"""
+
+PREVIOUS_APPLY_DELTA = """
+        INSERT INTO gn_synthese.t_stats_taxa AS s (id_dataset, id_source, cd_nom, nb_obs)
+            SELECT id_dataset, id_source, cd_nom, sum(nb)
+            FROM ({delta}) AS delta
+            GROUP BY id_dataset, id_source, cd_nom
+            HAVING sum(nb) <> 0
+        ON CONFLICT (
+            (COALESCE(id_dataset, -1)), (COALESCE(id_source, -1)), (COALESCE(cd_nom, -1))
+        )
+        DO UPDATE SET nb_obs = s.nb_obs + EXCLUDED.nb_obs;
+
+        INSERT INTO gn_synthese.t_stats_observers AS s (observers, nb_obs)
+            SELECT observers, sum(nb)
+            FROM ({delta}) AS delta
+            WHERE observers IS NOT NULL
+            GROUP BY observers
+            HAVING sum(nb) <> 0
+        ON CONFLICT ((md5(observers)))
+        DO UPDATE SET nb_obs = s.nb_obs + EXCLUDED.nb_obs;
+
+        DELETE FROM gn_synthese.t_stats_taxa WHERE nb_obs <= 0;
+        DELETE FROM gn_synthese.t_stats_observers WHERE nb_obs <= 0;
+"""
+PREVIOUS_CHANGED_ROWS = """
+    SELECT n.id_dataset, n.id_source, n.cd_nom, n.observers, 1 AS nb
+    FROM new n JOIN old o ON o.id_synthese = n.id_synthese
+    WHERE (n.id_dataset, n.id_source, n.cd_nom, n.observers)
+        IS DISTINCT FROM (o.id_dataset, o.id_source, o.cd_nom, o.observers)
+    UNION ALL
+    SELECT o.id_dataset, o.id_source, o.cd_nom, o.observers, -1 AS nb
+    FROM new n JOIN old o ON o.id_synthese = n.id_synthese
+    WHERE (n.id_dataset, n.id_source, n.cd_nom, n.observers)
+        IS DISTINCT FROM (o.id_dataset, o.id_source, o.cd_nom, o.observers)
+"""
+
+ROLLUP_TRIGGERS = [
+    "tri_insert_stats",
+    "tri_update_stats",
+    "tri_delete_stats",
+    "tri_insert_diffusion_geometries",
+    "tri_update_diffusion_geometries",
+    "tri_insert_dataset_stats",
+    "tri_update_dataset_stats",
+    "tri_delete_dataset_stats",
+    "tri_insert_stale_taxa",
+    "tri_update_stale_taxa",
+    "tri_delete_stale_taxa",
+]
+
+
+def upgrade():
+    logger.info("Limit synthese statistics triggers to the changed keys")
+    op.execute(
+        f"""
+    CREATE OR REPLACE FUNCTION gn_synthese.fct_tri_stats_on_each_statement()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+    DECLARE
+        empty_taxa integer[];
+        empty_observers integer[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {APPLY_DELTA.format(delta=NEW_ROWS)}
+        ELSIF TG_OP = 'DELETE' THEN
+            {APPLY_DELTA.format(delta=OLD_ROWS)}
+        ELSE
+            {APPLY_DELTA.format(delta=CHANGED_ROWS)}
+        END IF;
+        RETURN NULL;
+    END;
+    $function$
+    """
+    )
+    # empty rows are now deleted by id
+    op.execute("DROP INDEX gn_synthese.i_t_stats_taxa_empty")
+    op.execute("DROP INDEX gn_synthese.i_t_stats_observers_empty")
+
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.refresh_stats()
+     RETURNS void
+     LANGUAGE sql
+    AS $function$
+        TRUNCATE gn_synthese.t_stats_taxa, gn_synthese.t_stats_observers;
+        INSERT INTO gn_synthese.t_stats_taxa (id_dataset, id_source, cd_nom, nb_obs)
+        SELECT id_dataset, id_source, cd_nom, count(*)
+        FROM gn_synthese.synthese
+        GROUP BY id_dataset, id_source, cd_nom;
+        INSERT INTO gn_synthese.t_stats_observers (observers, nb_obs)
+        SELECT observers, count(*)
+        FROM gn_synthese.synthese
+        WHERE observers IS NOT NULL
+        GROUP BY observers;
+    $function$
+    """
+    )
+    op.execute(
+        f"""
+    CREATE FUNCTION gn_synthese.set_rollup_triggers(enabled boolean)
+     RETURNS void
+     LANGUAGE plpgsql
+    AS $function$
+    DECLARE
+        trigger_name varchar;
+    BEGIN
+        FOREACH trigger_name IN ARRAY ARRAY{ROLLUP_TRIGGERS}::varchar[] LOOP
+            EXECUTE format(
+                'ALTER TABLE gn_synthese.synthese %s TRIGGER %I',
+                CASE WHEN enabled THEN 'ENABLE' ELSE 'DISABLE' END,
+                trigger_name
+            );
+        END LOOP;
+    END;
+    $function$
+    """
+    )
+
+
+def downgrade():
+    op.execute("DROP FUNCTION gn_synthese.set_rollup_triggers")
+    op.execute("DROP FUNCTION gn_synthese.refresh_stats")
+    op.execute(
+        """
+    CREATE INDEX i_t_stats_taxa_empty ON gn_synthese.t_stats_taxa (id_stats_taxa)
+    WHERE nb_obs <= 0
+    """
+    )
+    op.execute(
+        """
+    CREATE INDEX i_t_stats_observers_empty ON gn_synthese.t_stats_observers (id_stats_observers)
+    WHERE nb_obs <= 0
+    """
+    )
+    op.execute(
+        f"""
+    CREATE OR REPLACE FUNCTION gn_synthese.fct_tri_stats_on_each_statement()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            {PREVIOUS_APPLY_DELTA.format(delta=NEW_ROWS)}
+        ELSIF TG_OP = 'DELETE' THEN
+            {PREVIOUS_APPLY_DELTA.format(delta=OLD_ROWS)}
+        ELSE
+            {PREVIOUS_APPLY_DELTA.format(delta=PREVIOUS_CHANGED_ROWS)}
+        END IF;
+        RETURN NULL;
+    END;
+    $function$
+    """
+    )
@@ -0,0 +1,172 @@
+"""deferred cor_area_synthese update on new areas
+
+Revision ID: f3b8d2c6a914
+Revises: e5a2c8f1d736
+Create Date: 2026-10-18 21:12:37.405218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+from utils_flask_sqla.migrations.utils import logger
+
+
+# revision identifiers, used by Alembic.
+revision = "f3b8d2c6a914"
+down_revision = "e5a2c8f1d736"
+branch_labels = None
+depends_on = None
+
+"""
+Le trigger tri_insert_cor_area_synthese intersecte les nouvelles zones de ref_geo.l_areas
+avec toute la synthèse, dans la transaction de l'insertion des zones.
+Lorsque le paramètre cor_area_synthese_mode vaut 'defer', les nouvelles zones sont seulement
+ajoutées à gn_synthese.t_cor_area_synthese_pending : elles sont ensuite rattachées aux
+observations par tuiles, une transaction par tuile (commande geonature synthese attach-areas).
+"""
+
+INSERT_ON_L_AREAS_FUNCTION = """
+    CREATE OR REPLACE FUNCTION gn_synthese.fct_trig_l_areas_insert_cor_area_synthese_on_each_statement()
+     RETURNS trigger
+     LANGUAGE plpgsql
+    AS $function$
+      DECLARE
+      BEGIN
+      {defer}
+      -- Intersection de toutes les observations avec les nouvelles zones et écriture dans cor_area_synthese
+          INSERT INTO gn_synthese.cor_area_synthese (id_area, id_synthese)
+            SELECT
+              new_areas.id_area AS id_area,
+              s.id_synthese as id_synthese
+            FROM NEW as new_areas
+            join gn_synthese.synthese s
+              ON public.ST_INTERSECTS(s.the_geom_local, new_areas.geom)
+            WHERE new_areas.enable IS true
+                AND (
+                        ST_GeometryType(s.the_geom_local) = 'ST_Point'
+                    OR
+                    NOT public.ST_TOUCHES(s.the_geom_local, new_areas.geom)
+                );
+      RETURN NULL;
+      END;
+      $function$
+"""
+
+DEFER = """
+      -- Mode différé : les zones sont mises en attente
+      IF (
+          SELECT parameter_value
+          FROM gn_commons.t_parameters
+          WHERE parameter_name = 'cor_area_synthese_mode' AND id_organism IS NULL
+      ) = 'defer' THEN
+          INSERT INTO gn_synthese.t_cor_area_synthese_pending (id_area)
+            SELECT id_area FROM NEW WHERE enable IS true
+          ON CONFLICT DO NOTHING;
+          RETURN NULL;
+      END IF;
+"""
+
+
+def upgrade():
+    logger.info("Create deferred cor_area_synthese tables")
+    op.create_table(
+        "t_cor_area_synthese_pending",
+        sa.Column(
+            "id_area",
+            sa.Integer,
+            sa.ForeignKey("ref_geo.l_areas.id_area", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("insert_date", sa.DateTime, server_default=sa.func.now()),
+        schema="gn_synthese",
+    )
+    op.create_table(
+        "t_cor_area_synthese_jobs",
+        sa.Column("id_job", sa.Integer, primary_key=True),
+        sa.Column("id_areas", ARRAY(sa.Integer), nullable=False),
+        sa.Column("tile_size", sa.Integer, nullable=False),
+        sa.Column("creation_date", sa.DateTime, server_default=sa.func.now()),
+        sa.Column("end_date", sa.DateTime),
+        schema="gn_synthese",
+    )
+    op.create_table(
+        "t_cor_area_synthese_chunks",
+        sa.Column(
+            "id_job",
+            sa.Integer,
+            sa.ForeignKey("gn_synthese.t_cor_area_synthese_jobs.id_job", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("id_chunk", sa.Integer, primary_key=True),
+        sa.Column("xmin", sa.Float, nullable=False),
+        sa.Column("ymin", sa.Float, nullable=False),
+        sa.Column("xmax", sa.Float, nullable=False),
+        sa.Column("ymax", sa.Float, nullable=False),
+        sa.Column("nb_inserted", sa.Integer),
+        sa.Column("update_date", sa.DateTime),
+        schema="gn_synthese",
+    )
+    op.execute(
+        """
+    INSERT INTO gn_commons.t_parameters (id_organism, parameter_name, parameter_desc, parameter_value)
+    VALUES (
+        NULL,
+        'cor_area_synthese_mode',
+        'Rattachement des nouvelles zones de ref_geo aux observations de la synthèse : immediate (à l''insertion des zones) ou defer (par la commande geonature synthese attach-areas)',
+        'immediate'
+    )
+    """
+    )
+
+    logger.info("Update the insert trigger on ref_geo.l_areas")
+    op.execute(INSERT_ON_L_AREAS_FUNCTION.format(defer=DEFER))
+
+    # Même intersection que le trigger, restreinte aux zones données et aux observations
+    # dont l'emprise intersecte la tuile, pour utiliser l'index GiST de the_geom_local.
+    # Une observation à cheval sur plusieurs tuiles est traitée avec chacune d'elles.
+    op.execute(
+        """
+    CREATE FUNCTION gn_synthese.insert_cor_area_synthese(id_areas integer[], tile geometry)
+     RETURNS integer
+     LANGUAGE plpgsql
+    AS $function$
+      DECLARE
+          affected_rows_count int;
+      BEGIN
+          INSERT INTO gn_synthese.cor_area_synthese (id_area, id_synthese)
+            SELECT
+              a.id_area,
+              s.id_synthese
+            FROM ref_geo.l_areas a
+            JOIN gn_synthese.synthese s
+              ON s.the_geom_local && tile
+              AND public.ST_INTERSECTS(s.the_geom_local, a.geom)
+            WHERE a.id_area = ANY(id_areas)
+                AND a.enable IS true
+                AND a.geom && tile
+                AND (
+                        ST_GeometryType(s.the_geom_local) = 'ST_Point'
+                    OR
+                    NOT public.ST_TOUCHES(s.the_geom_local, a.geom)
+                )
+          ON CONFLICT DO NOTHING;
+          GET DIAGNOSTICS affected_rows_count = ROW_COUNT;
+          RETURN affected_rows_count;
+      END;
+    $function$
+    """
+    )
+
+
+def downgrade():
+    op.execute("DROP FUNCTION gn_synthese.insert_cor_area_synthese(integer[], geometry)")
+    op.execute(INSERT_ON_L_AREAS_FUNCTION.format(defer=""))
+    op.execute(
+        """
+    DELETE FROM gn_commons.t_parameters
+    WHERE parameter_name = 'cor_area_synthese_mode' AND id_organism IS NULL
+    """
+    )
+    op.drop_table("t_cor_area_synthese_chunks", schema="gn_synthese")
+    op.drop_table("t_cor_area_synthese_jobs", schema="gn_synthese")
+    op.drop_table("t_cor_area_synthese_pending", schema="gn_synthese")
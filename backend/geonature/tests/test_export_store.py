@@ -0,0 +1,93 @@
+import os
+import time
+
+import pytest
+
+from geonature.utils.export_store import ExportArtifactStore, link_file
+
+
+def write_bytes(content):
+    def write(path):
+        with open(path, "wb") as fp:
+            fp.write(content)
+
+    return write
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ExportArtifactStore(tmp_path / "artifacts", "secret" * 4)
+
+
+class TestExportArtifactStore:
+    def test_key(self, store):
+        assert store.key("csv", [1, 2]) == store.key("csv", [1, 2])
+        assert store.key("csv", [1, 2]) != store.key("csv", [2, 1])
+        assert store.key("csv", [1, 2]) != ExportArtifactStore("", "other" * 4).key("csv", [1, 2])
+
+    def test_get_put(self, store):
+        key = store.key("gpkg")
+        assert store.get(key, "gpkg") is None
+
+        path = store.put(key, "gpkg", write_bytes(b"data"))
+
+        assert path.read_bytes() == b"data"
+        assert store.get(key, "gpkg") == path
+        assert store.get(key, "zip") is None
+
+    def test_put_failure(self, store):
+        def write(path):
+            write_bytes(b"partial")(path)
+            raise ValueError()
+
+        key = store.key("zip")
+        with pytest.raises(ValueError):
+            store.put(key, "zip", write)
+
+        assert store.get(key, "zip") is None
+        assert list(store.root.iterdir()) == []
+
+    def test_get_touches_file(self, store):
+        path = store.put("a", "csv", write_bytes(b"a"))
+        os.utime(path, (0, 0))
+
+        store.get("a", "csv")
+
+        assert path.stat().st_mtime > 0
+
+    def test_clean_max_age(self, store):
+        now = time.time()
+        old = store.put("old", "csv", write_bytes(b"old"))
+        recent = store.put("recent", "csv", write_bytes(b"recent"))
+        os.utime(old, (now - 100, now - 100))
+        store.max_age = 50
+
+        assert store.clean(now=now) == 1
+
+        assert not old.exists()
+        assert recent.exists()
+
+    def test_clean_max_size(self, store):
+        now = time.time()
+        paths = [store.put(str(i), "csv", write_bytes(b"x" * 10)) for i in range(4)]
+        for i, path in enumerate(paths):
+            os.utime(path, (now - 10 * i, now - 10 * i))
+        store.max_size = 25
+
+        assert store.clean(now=now) == 2
+
+        # least recently used files are removed first
+        assert [path.exists() for path in paths] == [True, True, False, False]
+
+    def test_clean_missing_root(self, store):
+        assert store.clean() == 0
+
+    def test_link_file(self, store, tmp_path):
+        path = store.put("a", "csv", write_bytes(b"a"))
+        dest = tmp_path / "export.csv"
+
+        link_file(path, dest)
+        store.max_age = 0
+        store.clean(now=time.time() + 1)
+
+        assert dest.read_bytes() == b"a"
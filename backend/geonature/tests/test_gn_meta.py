@@ -17,9 +17,11 @@ from ref_geo.models import BibAreasTypes, LAreas
 from geonature.core.gn_commons.models import TModules
 from geonature.core.gn_meta.models import (
     CorDatasetActor,
+    CorRoleDatasetScope,
     TAcquisitionFramework,
     TDatasets,
 )
+from geonature.core.gn_meta.repositories import refresh_stale_dataset_stats
 from geonature.core.gn_meta.routes import get_af_from_id
 from geonature.core.gn_synthese.models import Synthese
 from geonature.utils.env import db
@@ -505,6 +507,56 @@ class TestGNMeta:
         assert response.status_code == 200
         assert data["type"] == "Polygon"
 
+    def test_get_stats(self, users, synthese_data):
+        af = synthese_data["p1_af1"].dataset.acquisition_framework
+        ds = synthese_data["obs1"].dataset
+        set_logged_user_cookie(self.client, users["user"])
+        url = url_for(
+            "gn_meta.get_stats",
+            id_acquisition_framework=[af.id_acquisition_framework],
+            id_dataset=[ds.id_dataset],
+        )
+
+        response = self.client.get(url)
+
+        assert response.status_code == 200
+        assert response.cache_control.private
+        af_stats = response.json["acquisition_frameworks"][str(af.id_acquisition_framework)]
+        af_obs = [s for s in synthese_data.values() if s.dataset.acquisition_framework == af]
+        assert af_stats["nb_dataset"] == len(af.datasets)
+        assert af_stats["nb_observations"] == len(af_obs)
+        assert af_stats["nb_taxons"] == len({s.cd_nom for s in af_obs})
+        assert af_stats["bbox"]["type"] == "Polygon"
+        ds_stats = response.json["datasets"][str(ds.id_dataset)]
+        ds_obs = [s for s in synthese_data.values() if s.dataset == ds]
+        assert ds_stats["nb_observations"] == len(ds_obs)
+        assert ds_stats["nb_taxons"] == len({s.cd_nom for s in ds_obs})
+
+        # unchanged stats are revalidated
+        etag = response.headers["ETag"]
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        # stats of deleted observations are stale until they are recomputed
+        with db.session.begin_nested():
+            db.session.delete(synthese_data["obs1"])
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert refresh_stale_dataset_stats() >= 1
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        ds_stats = response.json["datasets"][str(ds.id_dataset)]
+        ds_obs.remove(synthese_data["obs1"])
+        assert ds_stats["nb_observations"] == len(ds_obs)
+        assert ds_stats["nb_taxons"] == len({s.cd_nom for s in ds_obs})
+
+    def test_get_stats_no_ids(self, users):
+        set_logged_user_cookie(self.client, users["user"])
+
+        response = self.client.get(url_for("gn_meta.get_stats"))
+
+        assert response.status_code == BadRequest.code
+
     def test_datasets_permissions(self, app, datasets, users):
         ds = datasets["own_dataset"]
         with app.test_request_context(headers=logged_user_headers(users["user"])):
@@ -547,6 +599,31 @@ class TestGNMeta:
             )
             assert set(qs.filter_by_scope(3).all()) == set(datasets.values())
 
+    def test_cor_role_dataset_scope(self, app, datasets, users):
+        def readable_datasets(user, scope):
+            q = CorRoleDatasetScope.select_id_datasets(user.id_role, scope)
+            return {r.id_dataset for r in db.session.execute(q)}
+
+        ds_ids = {ds.id_dataset for ds in datasets.values()}
+        for user in (users["user"], users["associate_user"], users["stranger_user"]):
+            with app.test_request_context(headers=logged_user_headers(user)):
+                app.preprocess_request()
+                qs = TDatasets.query.filter(TDatasets.id_dataset.in_(ds_ids))
+                for scope in (1, 2):
+                    assert readable_datasets(user, scope) & ds_ids == {
+                        ds.id_dataset for ds in qs.filter_by_scope(scope).all()
+                    }
+
+        # triggers keep the table up to date when actors change
+        ds = datasets["orphan_dataset"]
+        user = users["stranger_user"]
+        with db.session.begin_nested():
+            ds.cor_dataset_actor.append(CorDatasetActor(role=user))
+        assert ds.id_dataset in readable_datasets(user, 1)
+        with db.session.begin_nested():
+            ds.cor_dataset_actor = []
+        assert ds.id_dataset not in readable_datasets(user, 2)
+
     def test_dataset_is_deletable(self, app, synthese_data, datasets):
         assert (
             datasets["own_dataset"].is_deletable() == False
@@ -917,6 +994,22 @@ class TestGNMeta:
         )
         assert response.status_code == 200
 
+    def test_sensi_report_content(self, users, synthese_data):
+        ds = synthese_data["obs1"].dataset
+        obs = [s for s in synthese_data.values() if s.dataset == ds]
+        set_logged_user_cookie(self.client, users["user"])
+
+        response = self.client.get(
+            url_for("gn_meta.sensi_report"), query_string={"id_dataset": ds.id_dataset}
+        )
+
+        assert response.status_code == 200
+        assert response.is_streamed
+        content = response.get_data(as_text=True)
+        assert f'"Nombre de données total dans le fichier";"{len(obs)}"' in content
+        for s in obs:
+            assert str(s.unique_id_sinp) in content
+
     def test_sensi_report_fail(self, users):
         set_logged_user_cookie(self.client, users["admin_user"])
 
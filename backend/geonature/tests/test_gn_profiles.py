@@ -7,6 +7,7 @@ from flask import url_for
 import sqlalchemy as sa
 from sqlalchemy.sql.expression import func
 from geoalchemy2.elements import WKTElement
+from shapely.geometry import Point
 
 from geonature.utils.env import db
 from geonature.core.gn_meta.models import TDatasets
@@ -16,8 +17,11 @@ from geonature.core.gn_profiles.models import (
     VmValidProfiles,
     TParameters,
     CorTaxonParameters,
+    TRefreshHistory,
     VSyntheseForProfiles,
 )
+from geonature.core.gn_profiles.checks import profiles_cache
+from geonature.core.gn_profiles.utils import refresh_profiles
 from geonature.core.gn_synthese.models import Synthese
 from apptax.taxonomie.models import Taxref
 
@@ -110,8 +114,8 @@ def sample_synthese_records_for_profile(
         db.session.add(taxon_param)
 
     with db.session.begin_nested():
-        db.session.execute("REFRESH MATERIALIZED VIEW gn_profiles.vm_valid_profiles")
-        db.session.execute("REFRESH MATERIALIZED VIEW gn_profiles.vm_cor_taxon_phenology")
+        db.session.execute(func.gn_profiles.refresh_profiles())
+    profiles_cache.clear()
 
     return synthese_record_for_profile
 
@@ -137,8 +141,8 @@ def wrong_sample_synthese_records_for_profile(
         db.session.add(wrong_new_obs)
 
     with db.session.begin_nested():
-        db.session.execute("REFRESH MATERIALIZED VIEW gn_profiles.vm_valid_profiles")
-        db.session.execute("REFRESH MATERIALIZED VIEW gn_profiles.vm_cor_taxon_phenology")
+        db.session.execute(func.gn_profiles.refresh_profiles())
+    profiles_cache.clear()
 
     return wrong_new_obs
 
@@ -222,6 +226,51 @@ class TestGnProfiles:
         assert first_pheno["calculated_altitude_min"] == 1000
         assert first_pheno["calculated_altitude_max"] == 1200
 
+    def test_refresh_profiles(self, source, sample_synthese_records_for_profile):
+        obs = sample_synthese_records_for_profile
+        cd_ref = db.session.query(func.taxonomie.find_cdref(obs.cd_nom)).scalar()
+
+        def count_valid_data():
+            profile = VmValidProfiles.query.filter_by(cd_ref=cd_ref).one_or_none()
+            return profile.count_valid_data if profile else 0
+
+        # new observation
+        with db.session.begin_nested():
+            new_obs = create_synthese_record(
+                source=source,
+                cd_nom=obs.cd_nom,
+                date_min=obs.date_min,
+                date_max=obs.date_max,
+                altitude_min=ALT_MIN,
+                altitude_max=ALT_MAX,
+                id_nomenclature_valid_status=obs.id_nomenclature_valid_status,
+            )
+            db.session.add(new_obs)
+        assert refresh_profiles() >= 1
+        db.session.expire_all()
+        assert count_valid_data() == 2
+        history = TRefreshHistory.query.order_by(TRefreshHistory.id_refresh.desc()).first()
+        assert history.full_refresh is False
+        # queue emptied by the refresh
+        assert db.session.execute("SELECT count(*) FROM gn_profiles.t_stale_taxa").scalar() == 0
+
+        # observation moved to another taxon
+        other_cd_nom = (
+            Taxref.query.filter(Taxref.cd_ref != cd_ref, Taxref.id_rang == "ES").first().cd_nom
+        )
+        with db.session.begin_nested():
+            new_obs.cd_nom = other_cd_nom
+        refresh_profiles()
+        db.session.expire_all()
+        assert count_valid_data() == 1
+
+        # deleted observation
+        with db.session.begin_nested():
+            db.session.delete(obs)
+        refresh_profiles()
+        db.session.expire_all()
+        assert count_valid_data() == 0
+
     def test_get_phenology_none(self):
         invalid_cd_nom = 0
 
@@ -351,6 +400,75 @@ class TestGnProfiles:
             err["value"] for err in response.json["errors"]
         ]
 
+    def test_get_observations_scores(self, sample_synthese_records_for_profile):
+        cd_ref = sample_synthese_records_for_profile.cd_nom
+        observation = {
+            "altitude_min": ALT_MIN,
+            "altitude_max": ALT_MAX,
+            "date_min": DATE_MIN,
+            "date_max": DATE_MAX,
+            "cd_ref": cd_ref,
+            "geom": {"coordinates": [6.12, 44.85], "type": "Point"},
+        }
+        observations = [
+            observation,
+            {**observation, "altitude_min": 500, "altitude_max": 600},
+            {**observation, "cd_ref": 0},
+        ]
+
+        response = self.client.post(
+            url_for("gn_profiles.get_observations_scores"), json=observations
+        )
+
+        assert response.status_code == 200, response.json
+        results = response.json
+        assert len(results) == 3
+        single = self.client.post(url_for("gn_profiles.get_observation_score"), json=observation)
+        assert results[0] == single.json
+        assert results[0]["errors"] == []
+        assert results[1]["valid_altitude"] is False
+        assert "Le taxon n'a jamais été observé à cette altitude (500-600m)" in [
+            err["value"] for err in results[1]["errors"]
+        ]
+        assert results[2]["profil"] is None
+        assert results[2]["errors"][0]["type"] == "profile"
+
+    def test_get_observations_scores_bad_request(self, sample_synthese_records_for_profile):
+        observation = {
+            "altitude_min": ALT_MIN,
+            "altitude_max": ALT_MAX,
+            "date_min": DATE_MIN,
+            "date_max": DATE_MAX,
+            "cd_ref": sample_synthese_records_for_profile.cd_nom,
+        }
+
+        response = self.client.post(
+            url_for("gn_profiles.get_observations_scores"), json=observation
+        )
+        assert response.status_code == 400, response.json
+
+        response = self.client.post(
+            url_for("gn_profiles.get_observations_scores"),
+            json=[observation, {**observation, "date_max": None}],
+        )
+        assert response.status_code == 400, response.json
+        assert response.json["description"] == "Observation 1: Missing date min or date max"
+
+    def test_profiles_cache(self, sample_synthese_records_for_profile):
+        cd_ref = sample_synthese_records_for_profile.cd_nom
+        profile = profiles_cache.get_many([cd_ref, 0])[cd_ref]
+        assert profile.properties["count_valid_data"] == 1
+        assert profile.distribution.contains(Point(6.12, 44.85))
+        assert profiles_cache.get_many([cd_ref]) == {cd_ref: profile}
+        assert profiles_cache.get_many([0]) == {0: None}
+
+        # a new refresh of the profiles clears the cache
+        with db.session.begin_nested():
+            sample_synthese_records_for_profile.altitude_max = ALT_MAX + 100
+        refresh_profiles()
+        profile = profiles_cache.get_many([cd_ref])[cd_ref]
+        assert profile.properties["altitude_max"] == ALT_MAX + 100
+
     @pytest.mark.xfail(reason="Test non implémenté")
     def test_get_observation_score_error_not_observed_alt(self):
         # TODO when routes.py is fixed for this
@@ -1,12 +1,94 @@
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from uuid import uuid4
+
 import pytest
 
-from geonature.core.gn_meta.mtd import sync_af_and_ds_by_user, MTDInstanceApi
+from geonature.core.gn_meta.mtd import (
+    sync_af_and_ds_by_user,
+    add_unexisting_digitizers,
+    bulk_process_af_and_ds,
+    MTDInstanceApi,
+    INPNCAS,
+)
+from geonature.core.gn_meta.mtd.xml_parser import parse_acquisition_framwork_xml
 from pypnusershub.db.models import Organisme as BibOrganismes
-from geonature.core.gn_meta.models import TAcquisitionFramework
+from geonature.core.gn_meta.models import TAcquisitionFramework, TDatasets
+from geonature.core.gn_commons.models import TModules
 from geonature.utils.config import config
 
 from geonature.utils.env import db
 
+AF_NODE = """
+  <mtd:CadreAcquisition>
+    <mtd:identifiantCadre>{uuid}</mtd:identifiantCadre>
+    <mtd:libelle>CA {uuid}</mtd:libelle>
+    <mtd:ReferenceTemporelle>
+      <mtd:dateLancement>2020-01-01</mtd:dateLancement>
+    </mtd:ReferenceTemporelle>
+    <mtd:attributsAdditionnels>
+      <mtd:attributAdditionnel>
+        <mtd:nomAttribut>ID_CREATEUR</mtd:nomAttribut>
+        <mtd:valeurAttribut>1</mtd:valeurAttribut>
+      </mtd:attributAdditionnel>
+    </mtd:attributsAdditionnels>
+  </mtd:CadreAcquisition>
+"""
+AF_LIST_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<mtd:CadresAcquisition xmlns:mtd="http://inpn.mnhn.fr/mtd">{nodes}</mtd:CadresAcquisition>
+"""
+
+
+def af_xml(*af_uuids):
+    return AF_LIST_XML.format(nodes="".join(AF_NODE.format(uuid=uuid) for uuid in af_uuids))
+
+
+@pytest.fixture
+def mtd_server():
+    """
+    Local stand-in for the MTD and CAS web services, failing once with a 503
+    on each URL to check retries
+    """
+    requests = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests[self.path] += 1
+            if requests[self.path] == 1:
+                self.send_response(503)
+                self.end_headers()
+                return
+            url = urlparse(self.path)
+            if url.path.startswith("/cas/rechercheParId/"):
+                user_id = int(url.path.rsplit("/", 1)[-1])
+                content_type, body = "application/json", json.dumps({"id": user_id})
+            elif url.path.endswith("/GetRecordsByInstanceId"):
+                content_type, body = "application/xml", af_xml(*server.af_uuids)
+            else:
+                af_uuid = parse_qs(url.query)["id"][0]
+                content_type, body = "application/xml", af_xml(af_uuid)
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.url = f"http://127.0.0.1:{server.server_port}/"
+    server.requests = requests
+    # AF of the instance export
+    server.af_uuids = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
 
 @pytest.mark.usefixtures("client_class", "temporary_transaction")
 class TestMTD:
@@ -27,3 +109,83 @@ class TestMTD:
             assert db.session.query(
                 BibOrganismes.query.filter_by(uuid_organisme=org_uuid).exists()
             ).scalar()
+
+    def test_get_af_list_by_uuids(self, mtd_server):
+        uuids = [str(uuid4()) for _ in range(5)]
+        mtd_api = MTDInstanceApi(mtd_server.url, None)
+
+        af_list = mtd_api.get_af_list_by_uuids(uuids + uuids[:2])
+
+        # fetched once each, in order, despite the 503
+        assert [af["unique_acquisition_framework_id"] for af in af_list] == uuids
+        assert sorted(mtd_server.requests.values()) == [2] * len(uuids)
+
+    def test_iter_af_list(self, mtd_server):
+        mtd_server.af_uuids = [str(uuid4()) for _ in range(3)]
+        mtd_api = MTDInstanceApi(mtd_server.url, 1)
+
+        af_list = mtd_api.iter_af_list()
+
+        # nothing is requested until the AF are consumed
+        assert not mtd_server.requests
+        assert [af["unique_acquisition_framework_id"] for af in af_list] == mtd_server.af_uuids
+
+    def test_add_unexisting_digitizers(self, mtd_server, monkeypatch, users):
+        monkeypatch.setattr(INPNCAS, "base_url", mtd_server.url + "cas/")
+
+        # already known digitizers are not requested
+        add_unexisting_digitizers([users["user"].id_role, str(users["user"].id_role), None])
+        assert not mtd_server.requests
+
+        assert INPNCAS.get_users([1, 2]) == [{"id": 1}, {"id": 2}]
+        assert sorted(mtd_server.requests.values()) == [2, 2]
+
+    def test_bulk_process_af_and_ds(self, users):
+        af_uuid, ds_uuid, org_uuid = str(uuid4()), str(uuid4()), str(uuid4())
+        id_digitizer = users["user"].id_role
+
+        def sync(ds_name, actors):
+            af = parse_acquisition_framwork_xml(af_xml(af_uuid))
+            af.update(id_digitizer=id_digitizer, actors=actors)
+            ds = {
+                "unique_dataset_id": ds_uuid,
+                "uuid_acquisition_framework": af_uuid,
+                "dataset_name": ds_name,
+                "dataset_shortname": ds_name,
+                "dataset_desc": "",
+                "terrestrial_domain": True,
+                "marine_domain": False,
+                "id_nomenclature_data_type": "1",
+                "id_nomenclature_data_origin": "Pu",
+                "id_digitizer": id_digitizer,
+                "actors": actors,
+            }
+            with db.session.begin_nested():
+                bulk_process_af_and_ds([af], [ds])
+            return TDatasets.query.filter_by(unique_dataset_id=ds_uuid).one()
+
+        actor = {
+            "name": None,
+            "uuid_organism": org_uuid,
+            "organism": "Organisme MTD",
+            "actor_role": "1",
+            "email": None,
+        }
+        ds = sync("JDD", [actor])
+        assert str(ds.acquisition_framework.unique_acquisition_framework_id) == af_uuid
+        assert [str(a.organism.uuid_organisme) for a in ds.cor_dataset_actor] == [org_uuid]
+        assert [str(a.organism.uuid_organisme) for a in ds.acquisition_framework.cor_af_actor] == [
+            org_uuid
+        ]
+        assert set(ds.modules) == set(
+            TModules.query.filter(
+                TModules.module_code.in_(config["MTD"]["JDD_MODULE_CODE_ASSOCIATION"])
+            )
+        )
+
+        # updated in place, actors removed from MTD are removed
+        ds = sync("JDD modifié", [])
+        db.session.refresh(ds)
+        assert ds.dataset_name == "JDD modifié"
+        assert TDatasets.query.filter_by(unique_dataset_id=ds_uuid).count() == 1
+        assert ds.cor_dataset_actor == []
@@ -1,7 +1,9 @@
 from collections import ChainMap
 from itertools import product
+import json
 
 import pytest
+import sqlalchemy as sa
 
 from flask import g
 
@@ -13,6 +15,8 @@ from geonature.core.gn_permissions.models import (
     Permission,
     PermissionAvailable,
 )
+from geonature.core.gn_permissions import tools
+from geonature.core.gn_permissions.cache import LocalCacheBackend, permissions_cache
 from geonature.core.gn_permissions.tools import get_scopes_by_action, has_any_permissions_by_action
 from geonature.utils.env import db
 
@@ -289,3 +293,78 @@ class TestPermissions:
         assert has_any_permissions_by_action(
             id_role=roles["r2"].id_role, module_code=module_a.module_code
         ) == b_cruved("111111")
+
+
+@pytest.fixture()
+def local_permissions_cache(monkeypatch):
+    monkeypatch.setattr(permissions_cache, "backend", LocalCacheBackend(ttl=60))
+
+
+@pytest.fixture()
+def count_permissions_queries(monkeypatch):
+    queries = []
+    _get_user_permissions = tools._get_user_permissions
+
+    def _counting_get_user_permissions(id_role):
+        queries.append(id_role)
+        return _get_user_permissions(id_role)
+
+    monkeypatch.setattr(tools, "_get_user_permissions", _counting_get_user_permissions)
+    return queries
+
+
+def new_request_permissions():
+    # done by load_current_user at the beginning of each request
+    g._permissions_by_user = {}
+    g._permissions = {}
+
+
+@pytest.mark.usefixtures("temporary_transaction", "local_permissions_cache")
+class TestPermissionsCache:
+    def test_cache_shared_across_requests(
+        self, permissions, assert_cruved, roles, module_a, count_permissions_queries
+    ):
+        permissions("r1", "123---", module=module_a)
+
+        new_request_permissions()
+        assert_cruved("r1", "123000", module_a)
+        new_request_permissions()
+        assert_cruved("r1", "123000", module_a)
+        assert count_permissions_queries == [roles["r1"].id_role]
+
+    def test_cache_invalidation(
+        self, permissions, assert_cruved, roles, module_a, count_permissions_queries
+    ):
+        permissions("r1", "1-----", module=module_a)
+        new_request_permissions()
+        assert_cruved("r1", "100000", module_a)
+
+        permissions("r1", "-2----", module=module_a)
+        new_request_permissions()
+        assert_cruved("r1", "120000", module_a)
+        assert len(count_permissions_queries) == 2
+
+    def test_cache_invalidation_group_membership(
+        self, permissions, assert_cruved, roles, groups, module_a
+    ):
+        permissions("g1", "3-----", module=module_a)
+        new_request_permissions()
+        assert_cruved("r1", "000000", module_a)
+
+        with db.session.begin_nested():
+            roles["r1"].groups.append(groups["g1"])
+        new_request_permissions()
+        assert_cruved("r1", "300000", module_a)
+
+    def test_cache_revocation_outside_orm(self, permissions, assert_cruved, roles, module_a):
+        permissions("r1", "1-----", module=module_a)
+        new_request_permissions()
+        assert_cruved("r1", "100000", module_a)
+        assert json.loads(permissions_cache.backend.get(roles["r1"].id_role))
+
+        # e.g. removed from UsersHub: no ORM event clears the cache
+        db.session.execute(
+            sa.delete(Permission.__table__).where(Permission.id_role == roles["r1"].id_role)
+        )
+        new_request_permissions()
+        assert_cruved("r1", "000000", module_a)
@@ -376,6 +376,17 @@ class TestOcchab:
             Station.query.filter_by(id_station=station.id_station).exists()
         ).scalar()
 
+    @pytest.mark.parametrize("export_format", ["gpkg", "shapefile"])
+    def test_export_stations_geofile(self, users, station, export_format):
+        set_logged_user_cookie(self.client, users["user"])
+        response = self.client.post(
+            url_for("occhab.export_all_habitats", export_format=export_format),
+            json={"idsStation": [station.id_station]},
+        )
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.data
+
     def test_get_default_nomenclatures(self, users):
         response = self.client.get(url_for("occhab.get_default_nomenclatures"))
         assert response.status_code == Unauthorized.code
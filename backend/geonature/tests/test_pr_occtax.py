@@ -4,7 +4,7 @@ import pytest
 from datetime import datetime as dt
 
 from flask import url_for, current_app, g
-from werkzeug.exceptions import Unauthorized, Forbidden, NotFound
+from werkzeug.exceptions import BadRequest, Unauthorized, Forbidden, NotFound
 from shapely.geometry import Point
 from geoalchemy2.shape import from_shape
 from sqlalchemy import func
@@ -173,6 +173,29 @@ class TestOcctax:
             int(releve_json["id"]) for releve_json in json_resp["items"]["features"]
         ]
 
+    def test_get_releve_cursor(self, users, releve_occtax):
+        set_logged_user_cookie(self.client, users["user"])
+        url = url_for("pr_occtax.getReleves")
+
+        response = self.client.get(url, query_string={"limit": 1, "count": "none"})
+        assert response.status_code == 200
+        json_resp = response.json
+        assert json_resp["total"] is None
+        assert json_resp["next_cursor"] is not None
+        first_page = [int(releve["id"]) for releve in json_resp["items"]["features"]]
+
+        response = self.client.get(
+            url, query_string={"limit": 1, "cursor": json_resp["next_cursor"]}
+        )
+        assert response.status_code == 200
+        second_page = [int(releve["id"]) for releve in response.json["items"]["features"]]
+        assert not set(first_page) & set(second_page)
+
+        response = self.client.get(
+            url, query_string={"orderby": "dataset", "cursor": json_resp["next_cursor"]}
+        )
+        assert response.status_code == BadRequest.code
+
     def test_post_releve(self, users, releve_data):
         # post with cruved = C = 2
         set_logged_user_cookie(self.client, users["user"])
@@ -1,3 +1,4 @@
+import io
 from datetime import date, datetime, timedelta
 
 import pytest
@@ -6,6 +7,7 @@ import sqlalchemy as sa
 from sqlalchemy.sql.expression import func
 from geoalchemy2.types import Geometry
 from geoalchemy2.elements import WKTElement
+from werkzeug.exceptions import Unauthorized
 
 from geonature.utils.env import db
 from geonature.core.sensitivity.models import (
@@ -13,12 +15,26 @@ from geonature.core.sensitivity.models import (
     cor_sensitivity_area,
     CorSensitivityCriteria,
 )
+from geonature.core.sensitivity.utils import (
+    load_sensitivity_referential,
+    refresh_sensitivity_rules_cache,
+)
+from geonature.core.sensitivity.engine import SensitivityEngine, simulate_referential
+from geonature.core.sensitivity.tasks import (
+    count_chunks,
+    create_update_job,
+    get_sources_cd_refs,
+    get_unfinished_job,
+    update_chunk,
+    update_sensitivity_chunk,
+)
 from geonature.core.gn_synthese.models import Synthese
-from geonature.tests.fixtures import source
+from geonature.tests.fixtures import source, users
 
 from ref_geo.models import LAreas, BibAreasTypes
 from apptax.taxonomie.models import Taxref
 from pypnnomenclature.models import TNomenclatures, BibNomenclaturesTypes
+from pypnusershub.tests.utils import set_logged_user_cookie
 
 
 @pytest.fixture(scope="function")
@@ -100,10 +116,6 @@ class TestSensitivity:
                 sensitivity_duration=100,
             )
             db.session.add(rule)
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
 
         # Check the rule apply correctly
         assert db.session.execute(query).scalar() == diffusion_maille.mnemonique
@@ -112,10 +124,6 @@ class TestSensitivity:
         transaction = db.session.begin_nested()
         with db.session.begin_nested():
             rule.sensitivity_duration = 1
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
         assert db.session.execute(query).scalar() == not_sensitive.mnemonique
         transaction.rollback()  # restore rule duration
 
@@ -123,10 +131,6 @@ class TestSensitivity:
         transaction = db.session.begin_nested()
         with db.session.begin_nested():
             rule.nomenclature_sensitivity = no_diffusion
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
         assert db.session.execute(query).scalar() == no_diffusion.mnemonique
         transaction.rollback()  # restore rule sensitivity
 
@@ -135,10 +139,6 @@ class TestSensitivity:
         with db.session.begin_nested():
             rule.date_min = date(1900, 4, 1)
             rule.date_max = date(1900, 6, 30)
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
         assert db.session.execute(query).scalar() == not_sensitive.mnemonique
         transaction.rollback()
 
@@ -147,10 +147,6 @@ class TestSensitivity:
         with db.session.begin_nested():
             rule.date_min = date(1900, 2, 1)
             rule.date_max = date(1900, 4, 30)
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
         assert db.session.execute(query).scalar() == diffusion_maille.mnemonique
         transaction.rollback()
 
@@ -158,10 +154,6 @@ class TestSensitivity:
         transaction = db.session.begin_nested()
         with db.session.begin_nested():
             rule.active = False
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
         assert db.session.execute(query).scalar() == not_sensitive.mnemonique
         transaction.rollback()
 
@@ -259,10 +251,6 @@ class TestSensitivity:
                 sensitivity_duration=100,
             )
             db.session.add(rule2)
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
         rule1 = rule
 
         # Verify that the more restrictive rule match
@@ -315,10 +303,6 @@ class TestSensitivity:
                 sensitivity_duration=5,
             )
             db.session.add(rule)
-        with db.session.begin_nested():
-            db.session.execute(
-                "REFRESH MATERIALIZED VIEW gn_sensitivity.t_sensitivity_rules_cd_ref"
-            )
 
         date_obs = datetime.now()
         with db.session.begin_nested():
@@ -339,3 +323,298 @@ class TestSensitivity:
             s.date_max = date_obs
         db.session.refresh(s)
         assert s.id_nomenclature_sensitivity == nomenc_not_sensitive.id_nomenclature
+
+    def test_update_synthese_by_chunks(self, app, source):
+        taxon = Taxref.query.first()
+        sensitivity_nomenc_type = BibNomenclaturesTypes.query.filter_by(
+            mnemonique="SENSIBILITE"
+        ).one()
+        nomenc_not_sensitive = TNomenclatures.query.filter_by(
+            id_type=sensitivity_nomenc_type.id_type, mnemonique="0"
+        ).one()
+        nomenc_no_diff = TNomenclatures.query.filter_by(
+            id_type=sensitivity_nomenc_type.id_type, mnemonique="4"
+        ).one()
+        date_obs = datetime.now()
+        with db.session.begin_nested():
+            s = Synthese(
+                source=source,
+                cd_nom=taxon.cd_nom,
+                nom_cite="Sensitive taxon",
+                date_min=date_obs,
+                date_max=date_obs,
+            )
+            db.session.add(s)
+        db.session.refresh(s)
+        assert s.id_nomenclature_sensitivity == nomenc_not_sensitive.id_nomenclature
+
+        # rule added after the observation: the synthese must be updated
+        with db.session.begin_nested():
+            db.session.add(
+                SensitivityRule(
+                    cd_nom=taxon.cd_nom,
+                    nomenclature_sensitivity=nomenc_no_diff,
+                    sensitivity_duration=5,
+                    source="test chunks",
+                )
+            )
+
+        cd_refs = get_sources_cd_refs(["test chunks"])
+        assert taxon.cd_ref in cd_refs
+        job = create_update_job(chunk_size=1000, cd_refs=cd_refs)
+        assert job.chunks[-1].id_min <= s.id_synthese <= job.chunks[-1].id_max
+        assert get_unfinished_job() == job
+
+        # process the last chunk only, as if the job were interrupted
+        assert update_chunk(job.chunks[-1]) >= 1
+        db.session.refresh(s)
+        assert s.id_nomenclature_sensitivity == nomenc_no_diff.id_nomenclature
+        assert len(job.pending_chunks) == len(job.chunks) - 1
+
+        for chunk in job.pending_chunks:
+            update_chunk(chunk)
+        db.session.refresh(job)
+        assert job.end_date is not None
+        assert get_unfinished_job() is None
+
+    def test_update_sensitivity_chunk_failure(self, app, source, monkeypatch):
+        taxon = Taxref.query.first()
+        with db.session.begin_nested():
+            db.session.add(
+                Synthese(
+                    source=source,
+                    cd_nom=taxon.cd_nom,
+                    nom_cite="Taxon",
+                    date_min=datetime.now(),
+                    date_max=datetime.now(),
+                )
+            )
+        job = create_update_job(chunk_size=10**9)
+        (chunk,) = job.chunks
+
+        def fail(chunk):
+            raise ValueError("chunk failure")
+
+        monkeypatch.setattr("geonature.core.sensitivity.tasks.update_chunk", fail)
+        update_sensitivity_chunk(job.id_job, chunk.id_min)
+        assert count_chunks(job.id_job) == (0, 1)
+        db.session.refresh(chunk)
+        assert chunk.error == "chunk failure"
+        assert chunk in job.pending_chunks
+
+        monkeypatch.undo()
+        update_sensitivity_chunk(job.id_job, chunk.id_min)
+        assert count_chunks(job.id_job) == (1, 0)
+        db.session.refresh(chunk)
+        assert chunk.error is None
+
+    def test_load_sensitivity_referential(self, app):
+        taxon = Taxref.query.first()
+        header = (
+            "CD_NOM;NOM_CITE;CD_SENSIBILITE;DUREE;CD_DEP;STATUT_BIOLOGIQUE;COMPORTEMENT;AUTRE\n"
+        )
+        rule1 = f"{taxon.cd_nom};{taxon.lb_nom};2;;38;;;\n"
+        rule2 = f"{taxon.cd_nom};{taxon.lb_nom};3;5;D4;3;;reproduction\n"
+
+        with db.session.begin_nested():
+            counts = load_sensitivity_referential("test", io.StringIO(header + rule1 + rule2))
+        assert counts == {"added": 2, "removed": 0, "unchanged": 0, "kept": 0}
+        rules = SensitivityRule.query.filter_by(source="test").order_by(SensitivityRule.id).all()
+        assert [r.sensitivity_duration for r in rules] == [10000, 5]
+        assert [r.id_territory for r in rules] == ["38", "974"]
+        assert not rules[0].criterias
+        assert "3" in [c.cd_nomenclature for c in rules[1].criterias]
+        id_rule1 = rules[0].id
+
+        rule2 = f"{taxon.cd_nom};{taxon.lb_nom};3;10;D4;3;;reproduction\n"
+        csvfile = io.StringIO(header + rule1 + rule2)
+        with db.session.begin_nested():
+            counts = load_sensitivity_referential("test", csvfile, dry_run=True, replace=True)
+        assert counts == {"added": 1, "removed": 1, "unchanged": 1, "kept": 0}
+        assert SensitivityRule.query.filter_by(source="test", sensitivity_duration=10).count() == 0
+
+        # rules missing from the file are only removed on demand
+        with db.session.begin_nested():
+            counts = load_sensitivity_referential("test", io.StringIO(header + rule1 + rule2))
+        assert counts == {"added": 1, "removed": 0, "unchanged": 1, "kept": 1}
+        db.session.expire_all()
+        rules = SensitivityRule.query.filter_by(source="test").order_by(SensitivityRule.id).all()
+        assert [r.sensitivity_duration for r in rules] == [10000, 5, 10]
+
+        with db.session.begin_nested():
+            counts = load_sensitivity_referential(
+                "test", io.StringIO(header + rule1 + rule2), replace=True
+            )
+        assert counts == {"added": 0, "removed": 1, "unchanged": 2, "kept": 0}
+        db.session.expire_all()
+        rules = SensitivityRule.query.filter_by(source="test").order_by(SensitivityRule.id).all()
+        assert rules[0].id == id_rule1
+        assert [r.sensitivity_duration for r in rules] == [10000, 10]
+
+        csvfile = io.StringIO("CD_NOM;CD_SENSIBILITE\n")
+        with pytest.raises(ValueError):
+            load_sensitivity_referential("test", csvfile)
+
+    def test_load_sensitivity_referential_single_digit_department(self, app):
+        taxon = Taxref.query.first()
+        csvfile = io.StringIO(
+            "CD_NOM;NOM_CITE;CD_SENSIBILITE;DUREE;CD_DEP;STATUT_BIOLOGIQUE;COMPORTEMENT;AUTRE\n"
+            f"{taxon.cd_nom};{taxon.lb_nom};2;;1;;;\n"
+        )
+
+        with db.session.begin_nested():
+            load_sensitivity_referential("test", csvfile)
+
+        rule = SensitivityRule.query.filter_by(source="test").one()
+        assert rule.id_territory == "1"
+        area_codes = [
+            area_code
+            for area_code, in db.session.query(LAreas.area_code)
+            .join(cor_sensitivity_area, cor_sensitivity_area.c.id_area == LAreas.id_area)
+            .filter(cor_sensitivity_area.c.id_sensitivity == rule.id)
+        ]
+        assert area_codes == ["01"]
+
+    def test_sensitivity_rules_cache(self, app):
+        parent = (
+            Taxref.query.filter(
+                sa.exists().where(Taxref.__table__.alias().c.cd_taxsup == Taxref.cd_ref)
+            )
+            .filter(Taxref.cd_nom == Taxref.cd_ref)
+            .first()
+        )
+        child = Taxref.query.filter_by(cd_taxsup=parent.cd_ref).first()
+        nomenc_no_diff = (
+            TNomenclatures.query.join(BibNomenclaturesTypes)
+            .filter(
+                BibNomenclaturesTypes.mnemonique == "SENSIBILITE",
+                TNomenclatures.cd_nomenclature == "4",
+            )
+            .one()
+        )
+
+        def cached_cd_noms(rule):
+            return {
+                cd_nom
+                for (cd_nom,) in db.session.execute(
+                    "SELECT cd_nom FROM gn_sensitivity.t_sensitivity_rules_cd_ref "
+                    "WHERE id_sensitivity = :id",
+                    {"id": rule.id},
+                )
+            }
+
+        # the rule is extrapolated to children taxa as soon as it is inserted
+        with db.session.begin_nested():
+            rule = SensitivityRule(
+                cd_nom=parent.cd_nom,
+                nomenclature_sensitivity=nomenc_no_diff,
+                sensitivity_duration=5,
+                source="test cache",
+            )
+            db.session.add(rule)
+        cd_noms = cached_cd_noms(rule)
+        assert {parent.cd_nom, child.cd_nom} <= cd_noms
+
+        # a full recomputation gives the same rows
+        with db.session.begin_nested():
+            assert refresh_sensitivity_rules_cache(["test cache"]) == len(cd_noms)
+        assert cached_cd_noms(rule) == cd_noms
+
+        with db.session.begin_nested():
+            rule.active = False
+        assert not cached_cd_noms(rule)
+        with db.session.begin_nested():
+            rule.active = True
+        assert cached_cd_noms(rule) == cd_noms
+
+        with db.session.begin_nested():
+            db.session.delete(rule)
+        assert not cached_cd_noms(rule)
+
+    def test_sensitivity_engine(self, app, source):
+        taxon = Taxref.query.first()
+        sensitivity_nomenc_type = BibNomenclaturesTypes.query.filter_by(
+            mnemonique="SENSIBILITE"
+        ).one()
+        nomenc_not_sensitive = TNomenclatures.query.filter_by(
+            id_type=sensitivity_nomenc_type.id_type, mnemonique="0"
+        ).one()
+        nomenc_no_diff = TNomenclatures.query.filter_by(
+            id_type=sensitivity_nomenc_type.id_type, mnemonique="4"
+        ).one()
+        date_obs = datetime.now()
+
+        with db.session.begin_nested():
+            db.session.add(
+                SensitivityRule(
+                    cd_nom=taxon.cd_nom,
+                    nomenclature_sensitivity=nomenc_no_diff,
+                    sensitivity_duration=5,
+                )
+            )
+            s = Synthese(
+                source=source,
+                cd_nom=taxon.cd_nom,
+                nom_cite="Sensitive taxon",
+                date_min=date_obs,
+                date_max=date_obs,
+            )
+            db.session.add(s)
+        db.session.refresh(s)
+        assert s.id_nomenclature_sensitivity == nomenc_no_diff.id_nomenclature
+
+        engine = SensitivityEngine.from_database()
+        # same result as gn_sensitivity.get_id_nomenclature_sensitivity
+        evaluated = {
+            id_synthese: sensitivity
+            for id_synthese, _, sensitivity in engine.iter_synthese(chunk_size=100)
+        }
+        assert evaluated[s.id_synthese] == s.id_nomenclature_sensitivity
+        candidates = [
+            {"date_min": date_obs, "cd_nom": taxon.cd_nom, "geom": "POINT(6.15 44.85)"},
+            {
+                "date_min": date_obs - timedelta(days=365 * 10),
+                "cd_nom": taxon.cd_nom,
+                "geom": "POINT(6.15 44.85)",
+            },
+        ]
+        assert engine.evaluate_candidates(candidates) == [
+            nomenc_no_diff.id_nomenclature,
+            nomenc_not_sensitive.id_nomenclature,
+        ]
+
+    def test_simulate_referential(self, app, source, users):
+        taxon = Taxref.query.first()
+        date_obs = datetime.now()
+        with db.session.begin_nested():
+            db.session.add(
+                Synthese(
+                    source=source,
+                    cd_nom=taxon.cd_nom,
+                    nom_cite="Sensitive taxon",
+                    date_min=date_obs,
+                    date_max=date_obs,
+                )
+            )
+        referential = (
+            "CD_NOM;NOM_CITE;CD_SENSIBILITE;DUREE;CD_DEP;STATUT_BIOLOGIQUE;COMPORTEMENT;AUTRE\n"
+            f"{taxon.cd_nom};{taxon.lb_nom};4;;;;;\n"
+        )
+
+        counts, changes = simulate_referential("test simulate", io.StringIO(referential))
+        assert counts == {"added": 1, "removed": 0, "unchanged": 0, "kept": 0}
+        assert changes[("0", "4")] >= 1
+        assert SensitivityRule.query.filter_by(source="test simulate").count() == 0
+
+        url = url_for("sensitivity.simulate")
+        data = {"source": "test simulate", "file": (io.BytesIO(referential.encode()), "r.csv")}
+        response = self.client.post(url, data=data)
+        assert response.status_code == Unauthorized.code
+
+        set_logged_user_cookie(self.client, users["admin_user"])
+        data = {"source": "test simulate", "file": (io.BytesIO(referential.encode()), "r.csv")}
+        response = self.client.post(url, data=data)
+        assert response.status_code == 200, response.json
+        assert response.json["rules"]["added"] == 1
+        assert response.json["nb_changed"] >= 1
+        assert SensitivityRule.query.filter_by(source="test simulate").count() == 0
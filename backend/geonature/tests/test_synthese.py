@@ -2,9 +2,16 @@ import pytest
 import json
 import datetime
 import itertools
+import io
+import math
+import os
+import time
+import zipfile
 from collections import Counter
 
-from flask import url_for, current_app
+from flask import url_for, current_app, jsonify
+from geojson import Feature, FeatureCollection
+import sqlalchemy as sa
 from sqlalchemy import func
 from werkzeug.exceptions import Forbidden, BadRequest, Unauthorized
 from jsonschema import validate as validate_json
@@ -12,8 +19,36 @@ from geoalchemy2.shape import to_shape, from_shape
 from shapely.geometry import Point
 
 from geonature.utils.env import db
+from geonature.utils.pagination import estimate_count
+from geonature.utils.streaming import generate_geojson
 from geonature.core.gn_meta.models import TDatasets
-from geonature.core.gn_synthese.models import Synthese, TSources, VSyntheseForWebApp
+from geonature.core.gn_synthese.models import (
+    CorAreaSynthese,
+    Synthese,
+    TDiffusionGeometries,
+    TExportJob,
+    TSources,
+    TStatsTaxa,
+    VSyntheseForWebApp,
+)
+from geonature.core.gn_synthese.routes import WEB_MERCATOR_BOUND, get_tile_bounds
+from geonature.core.gn_synthese.tasks import (
+    attach_areas_chunk,
+    attach_chunk,
+    count_attach_chunks,
+    create_attach_job,
+    get_cor_area_mode,
+    get_exports_dir,
+    get_nb_pending_areas,
+    get_unfinished_attach_job,
+    set_cor_area_mode,
+    set_rollup_triggers,
+)
+from geonature.core.gn_synthese.utils.exports import (
+    compact_synthese_changes,
+    get_synthese_version,
+)
+from geonature.core.gn_synthese.utils.query_select_sqla import SyntheseQuery
 
 from pypnusershub.tests.utils import logged_user_headers, set_logged_user_cookie
 from ref_geo.models import BibAreasTypes, LAreas
@@ -142,6 +177,61 @@ synthese_properties = {
 }
 
 
+@pytest.mark.skipif(
+    not os.environ.get("GEONATURE_BENCHMARK"), reason="set GEONATURE_BENCHMARK=1 to run"
+)
+def test_benchmark_observations_for_web_serialization():
+    """
+    Compare the serialization of get_observations_for_web: features decoded and
+    re-encoded by jsonify, or database-encoded JSON spliced into the response
+
+    GEONATURE_BENCHMARK=1 pytest -s tests/test_synthese.py -k benchmark
+    """
+    nb = int(os.environ.get("GEONATURE_BENCHMARK_ROWS", 50000))
+    # rows as fetched from the database: ST_AsGeoJSON output and json properties as text
+    rows = [
+        (
+            json.dumps({"type": "Point", "coordinates": [5.9 + i * 1e-6, 45.5]}),
+            json.dumps(
+                {
+                    "id": i,
+                    "cd_nom": 60612,
+                    "nom_vern_or_lb_nom": "Lynx boréal",
+                    "date_min": "2022-01-01 00:00:00",
+                    "observers": "Administrateur test",
+                    "dataset_name": "Jeu de données",
+                    "url_source": None,
+                    "entity_source_pk_value": str(i),
+                },
+                ensure_ascii=False,
+            ),
+        )
+        for i in range(nb)
+    ]
+
+    def jsonified():
+        features = [
+            Feature(geometry=json.loads(geometry), properties=json.loads(properties))
+            for geometry, properties in rows
+        ]
+        return jsonify(FeatureCollection(features)).get_data(as_text=True)
+
+    def spliced():
+        return "".join(generate_geojson(rows))
+
+    timings = {}
+    outputs = {}
+    for name, fn in (("json.loads + Feature + jsonify", jsonified), ("spliced", spliced)):
+        start = time.perf_counter()
+        outputs[name] = fn()
+        timings[name] = time.perf_counter() - start
+
+    for name, duration in timings.items():
+        print(f"{name}: {duration:.2f}s for {nb} features ({nb / duration:.0f} features/s)")
+    decoded = [json.loads(output) for output in outputs.values()]
+    assert decoded[0]["features"] == decoded[1]["features"]
+
+
 @pytest.mark.usefixtures("client_class", "temporary_transaction")
 class TestSynthese:
     def test_synthese_scope_filtering(self, app, users, synthese_data):
@@ -180,6 +270,7 @@ class TestSynthese:
 
         r = self.client.get(url)
         assert r.status_code == 200
+        assert r.is_streamed
         print(r.json)
         validate_json(instance=r.json, schema=schema)
 
@@ -309,6 +400,95 @@ class TestSynthese:
         r = self.client.get(url, json=filters)
         assert r.status_code == 200
 
+    def test_get_observations_for_web_cursor(self, users, synthese_data):
+        url = url_for("gn_synthese.get_observations_for_web")
+        set_logged_user_cookie(self.client, users["self_user"])
+
+        r = self.client.get(url, query_string={"limit": 2, "count": "exact"})
+        assert r.status_code == 200
+        first_page = [f["properties"]["id"] for f in r.json["features"]]
+        assert len(first_page) == 2
+        assert r.json["nb_total"] >= len(synthese_data)
+        assert r.json["next_cursor"] is not None
+
+        r = self.client.get(url, query_string={"limit": 2, "cursor": r.json["next_cursor"]})
+        assert r.status_code == 200
+        second_page = [f["properties"]["id"] for f in r.json["features"]]
+        assert second_page
+        assert not set(first_page) & set(second_page)
+        assert "nb_total" not in r.json
+
+        r = self.client.get(url, query_string={"cursor": "not a cursor"})
+        assert r.status_code == BadRequest.code
+        r = self.client.get(url, query_string={"count": "approximately"})
+        assert r.status_code == BadRequest.code
+
+    def test_get_observations_for_web_estimate_count(self, users, synthese_data):
+        url = url_for("gn_synthese.get_observations_for_web")
+        set_logged_user_cookie(self.client, users["self_user"])
+        # the geometry of the filter is a parameter processed by its type
+        filters = {
+            "geoIntersection": {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [5.852731, 45.7775],
+                            [5.852731, 44.820481],
+                            [7.029224, 44.820481],
+                            [7.029224, 45.7775],
+                            [5.852731, 45.7775],
+                        ],
+                    ],
+                },
+                "properties": {},
+            },
+        }
+        r = self.client.post(url, json=filters, query_string={"count": "estimate"})
+        assert r.status_code == 200, r.json
+        assert isinstance(r.json["nb_total"], int)
+
+    def test_estimate_count_geometry(self, synthese_data):
+        point = from_shape(Point(5.92, 45.56), srid=4326)
+        query = Synthese.query.filter(func.ST_DWithin(Synthese.the_geom_4326, point, 1))
+        assert estimate_count(query) >= 0
+
+    def test_get_observations_for_web_diffusion_geometries(self, users, synthese_data):
+        url = url_for("gn_synthese.get_observations_for_web")
+        set_logged_user_cookie(self.client, users["self_user"])
+        niv_precis = BibNomenclaturesTypes.query.filter_by(mnemonique="NIV_PRECIS").one()
+        no_diffusion, departement, precise = (
+            TNomenclatures.query.filter_by(id_type=niv_precis.id_type, cd_nomenclature=cd).one()
+            for cd in ("4", "3", "5")
+        )
+        hidden, blurred = synthese_data["obs1"], synthese_data["obs2"]
+        with db.session.begin_nested():
+            hidden.id_nomenclature_diffusion_level = no_diffusion.id_nomenclature
+            blurred.id_nomenclature_diffusion_level = departement.id_nomenclature
+        assert TDiffusionGeometries.query.get(hidden.id_synthese).the_geom_4326 is None
+        assert TDiffusionGeometries.query.get(blurred.id_synthese).the_geom_4326 is not None
+
+        r = self.client.get(url, query_string={"diffusion_geometries": "true"})
+        assert r.status_code == 200
+        features = {f["properties"]["id"]: f for f in r.json["features"]}
+        assert hidden.id_synthese not in features
+        assert features[blurred.id_synthese]["geometry"]["type"] in ("Polygon", "MultiPolygon")
+
+        # precise geometries without the option
+        r = self.client.get(url)
+        features = {f["properties"]["id"]: f for f in r.json["features"]}
+        assert features[hidden.id_synthese]["geometry"]["type"] == "Point"
+        assert features[blurred.id_synthese]["geometry"]["type"] == "Point"
+
+        # the precise diffusion level makes the observation precise again
+        with db.session.begin_nested():
+            blurred.id_nomenclature_diffusion_level = precise.id_nomenclature
+        assert (
+            TDiffusionGeometries.query.filter_by(id_synthese=blurred.id_synthese).one_or_none()
+            is None
+        )
+
     def test_get_observations_for_web_filter_comment(self, users, synthese_data, taxon_attribut):
         set_logged_user_cookie(self.client, users["self_user"])
 
@@ -489,6 +669,54 @@ class TestSynthese:
             set(feature["properties"].keys()) == expected_columns for feature in data["features"]
         )
 
+    def test_get_observations_tile(self, users, synthese_data, unexisted_id):
+        obs = synthese_data["obs1"]
+        point = to_shape(obs.the_geom_4326)
+        z = 12
+        x = int((point.x + 180) / 360 * 2**z)
+        lat = math.radians(point.y)
+        y = int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * 2**z)
+        url = "gn_synthese.get_observations_tile"
+
+        response = self.client.get(url_for(url, z=z, x=x, y=y))
+        assert response.status_code == Unauthorized.code
+
+        set_logged_user_cookie(self.client, users["admin_user"])
+
+        response = self.client.get(url_for(url, z=z, x=x, y=y))
+        assert response.status_code == 200
+        assert response.mimetype == "application/vnd.mapbox-vector-tile"
+        assert len(response.data) > 0
+
+        # filters are applied
+        response = self.client.post(
+            url_for(url, z=z, x=x, y=y),
+            json={"id_dataset": [unexisted_id]},
+        )
+        assert response.status_code == 200
+        assert len(response.data) == 0
+
+        response = self.client.get(
+            url_for(url, z=z, x=x, y=y),
+            query_string={"format": "grouped_geom_by_areas"},
+        )
+        assert response.status_code == 200
+
+        response = self.client.get(
+            url_for(url, z=z, x=x, y=y),
+            query_string={"format": "grouped_geom"},
+        )
+        assert response.status_code == BadRequest.code
+
+        response = self.client.get(url_for(url, z=1, x=2, y=0))
+        assert response.status_code == 404
+
+    def test_get_tile_bounds(self):
+        bound = WEB_MERCATOR_BOUND
+        assert get_tile_bounds(0, 0, 0) == (-bound, -bound, bound, bound)
+        assert get_tile_bounds(1, 1, 0) == (0, 0, bound, bound)
+        assert get_tile_bounds(2, 0, 3) == pytest.approx((-bound, -bound, -bound / 2, -bound / 2))
+
     def test_export(self, users):
         set_logged_user_cookie(self.client, users["self_user"])
 
@@ -515,6 +743,80 @@ class TestSynthese:
         )
         assert response.status_code == 200
 
+    def test_export_geojson_streamed(self, users, synthese_data):
+        set_logged_user_cookie(self.client, users["admin_user"])
+        list_id_synthese = [s.id_synthese for s in synthese_data.values()]
+
+        response = self.client.post(
+            url_for("gn_synthese.export_observations_web"),
+            json=list_id_synthese,
+            query_string={"export_format": "geojson"},
+        )
+
+        assert response.status_code == 200
+        assert response.is_streamed
+        data = json.loads(response.data)
+        assert data["type"] == "FeatureCollection"
+        assert {f["properties"]["id_synthese"] for f in data["features"]} == set(list_id_synthese)
+        assert all(f["geometry"]["type"] == "Point" for f in data["features"])
+
+    def test_export_geo_file_reused(self, users, synthese_data, monkeypatch, tmp_path):
+        monkeypatch.setitem(current_app.config, "MEDIA_FOLDER", str(tmp_path))
+        set_logged_user_cookie(self.client, users["admin_user"])
+        list_id_synthese = [s.id_synthese for s in synthese_data.values()]
+
+        def export():
+            return self.client.post(
+                url_for("gn_synthese.export_observations_web"),
+                json=list_id_synthese,
+                query_string={"export_format": "shapefile"},
+            )
+
+        response = export()
+        assert response.status_code == 200
+        assert response.mimetype == "application/zip"
+        content = response.data
+        artifacts = list((tmp_path / "exports" / "artifacts").iterdir())
+        assert len(artifacts) == 1
+        # the stored file is shared: it must not contain the name of the first request
+        names = zipfile.ZipFile(io.BytesIO(content)).namelist()
+        assert names and all(name.startswith("export.") for name in names)
+
+        def write_geo_archive(*args, **kwargs):
+            raise AssertionError("identical export must reuse the stored file")
+
+        monkeypatch.setattr(
+            "geonature.utils.utilsgeometrytools.write_geo_archive", write_geo_archive
+        )
+        response = export()
+        assert response.status_code == 200
+        assert response.data == content
+
+        # another selection of observations is another export
+        monkeypatch.undo()
+        monkeypatch.setitem(current_app.config, "MEDIA_FOLDER", str(tmp_path))
+        list_id_synthese.pop()
+        assert export().status_code == 200
+        assert len(list((tmp_path / "exports" / "artifacts").iterdir())) == 2
+
+        # changed observations are another export
+        with db.session.begin_nested():
+            synthese_data["obs1"].comment_description = "changed"
+        assert export().status_code == 200
+        assert len(list((tmp_path / "exports" / "artifacts").iterdir())) == 3
+
+    def test_synthese_version(self, synthese_data):
+        version = get_synthese_version()
+        with db.session.begin_nested():
+            synthese_data["obs1"].comment_description = "changed"
+        assert get_synthese_version() > version
+        version = get_synthese_version()
+        compact_synthese_changes()
+        assert get_synthese_version() == version
+        assert (
+            db.session.execute("SELECT count(*) FROM gn_synthese.t_synthese_changes").scalar() == 1
+        )
+
     def test_export_observations(self, users, synthese_data, synthese_sensitive_data, modules):
         data_synthese = synthese_data.values()
         data_synthese_sensitive = synthese_sensitive_data.values()
@@ -999,6 +1301,59 @@ class TestSynthese:
         # TODO: s'assurer qu'on ne récupère pas le dataset "associate_2_dataset_sensitive", car ne contient que des données sensibles, bien que l'utilisateur ait le scope nécessaire par ailleurs (scope 2, et ce dataset lui est associé)
         assert_export_metadata_results(user, dict_expected_datasets)
 
+    def test_export_job(self, users, synthese_data, celery_eager):
+        set_logged_user_cookie(self.client, users["admin_user"])
+        list_id_synthese = [s.id_synthese for s in synthese_data.values()]
+
+        response = self.client.post(
+            url_for("gn_synthese.create_export_job", export_type="unknown"),
+            json=list_id_synthese,
+        )
+        assert response.status_code == 404
+
+        response = self.client.post(
+            url_for("gn_synthese.create_export_job", export_type="taxons"),
+            json=list_id_synthese,
+            query_string={"export_format": "geojson"},
+        )
+        assert response.status_code == BadRequest.code
+
+        response = self.client.post(
+            url_for("gn_synthese.create_export_job", export_type="observations"),
+            json=list_id_synthese,
+            query_string={"export_format": "csv"},
+        )
+        assert response.status_code == 200, response.json
+        id_export_job = response.json["id_export_job"]
+
+        job = TExportJob.query.get(id_export_job)
+        assert job.status == TExportJob.STATUS_SUCCESS, job.error
+        assert job.progress == 100
+        assert job.nb_rows == len(list_id_synthese)
+        assert (get_exports_dir() / job.file_name).exists()
+
+        response = self.client.get(url_for("gn_synthese.list_export_jobs"))
+        assert response.status_code == 200
+        assert id_export_job in [j["id_export_job"] for j in response.json]
+
+        response = self.client.get(
+            url_for("gn_synthese.get_export_job", id_export_job=id_export_job)
+        )
+        assert response.status_code == 200
+        assert response.json["status"] == TExportJob.STATUS_SUCCESS
+
+        response = self.client.get(
+            url_for("gn_synthese.download_export_job", id_export_job=id_export_job)
+        )
+        assert response.status_code == 200
+        assert str(synthese_data["obs1"].id_synthese).encode() in response.data
+
+        set_logged_user_cookie(self.client, users["self_user"])
+        response = self.client.get(
+            url_for("gn_synthese.download_export_job", id_export_job=id_export_job)
+        )
+        assert response.status_code == Forbidden.code
+
     def test_general_stat(self, users):
         set_logged_user_cookie(self.client, users["self_user"])
 
@@ -1006,6 +1361,47 @@ class TestSynthese:
 
         assert response.status_code == 200
 
+    def test_general_stat_from_stats_tables(self, users, synthese_data):
+        set_logged_user_cookie(self.client, users["self_user"])
+
+        response = self.client.get(url_for("gn_synthese.general_stats"))
+
+        assert response.status_code == 200
+        assert response.json["nb_data"] == Synthese.query.count()
+        assert (
+            response.json["nb_species"]
+            == db.session.query(func.count(func.distinct(Synthese.cd_nom))).scalar()
+        )
+        assert (
+            response.json["nb_observers"]
+            == db.session.query(func.count(func.distinct(Synthese.observers))).scalar()
+        )
+
+    def test_stats_tables_follow_synthese(self, users, synthese_data):
+        obs = synthese_data["obs1"]
+        id_dataset = obs.id_dataset
+        url = "gn_synthese.get_observation_count"
+        set_logged_user_cookie(self.client, users["self_user"])
+
+        def count_dataset_obs():
+            response = self.client.get(url_for(url), query_string={"id_dataset": id_dataset})
+            assert response.status_code == 200
+            return response.json
+
+        nb_obs = count_dataset_obs()
+        assert nb_obs == Synthese.query.filter_by(id_dataset=id_dataset).count()
+
+        other_dataset = (
+            TDatasets.query.filter(TDatasets.id_dataset != id_dataset).first().id_dataset
+        )
+        with db.session.begin_nested():
+            obs.id_dataset = other_dataset
+        assert count_dataset_obs() == nb_obs - 1
+
+        with db.session.begin_nested():
+            db.session.delete(obs)
+        assert count_dataset_obs() == nb_obs - 1
+
     def test_get_one_synthese_record(self, app, users, synthese_data):
         response = self.client.get(
             url_for("gn_synthese.get_one_synthese", id_synthese=synthese_data["obs1"].id_synthese)
@@ -1270,3 +1666,186 @@ class TestSynthese:
 
         assert response.status_code == 200
         assert response.json[0]["cd_nom"] == synthese_data["obs1"].cd_nom
+
+
+def explain(query):
+    """Plan of a select, as returned by EXPLAIN (FORMAT JSON)"""
+    compiled = query.compile(dialect=db.engine.dialect)
+    return (
+        db.session.connection()
+        .execute("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params)
+        .scalar()[0]["Plan"]
+    )
+
+
+def iter_plan_nodes(plan):
+    yield plan
+    for subplan in plan.get("Plans", []):
+        yield from iter_plan_nodes(subplan)
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestSyntheseQuery:
+    def get_query(self, filters, **kwargs):
+        query = SyntheseQuery(Synthese, sa.select([Synthese.id_synthese]), filters, **kwargs)
+        query.filter_other_filters(None)
+        return query.build_query()
+
+    def test_area_filters_semi_joins(self, synthese_data):
+        obs = synthese_data["p1_af1"]
+        areas = (
+            db.session.query(LAreas.id_area, BibAreasTypes.type_code)
+            .join(CorAreaSynthese, CorAreaSynthese.id_area == LAreas.id_area)
+            .join(BibAreasTypes, BibAreasTypes.id_type == LAreas.id_type)
+            .filter(CorAreaSynthese.id_synthese == obs.id_synthese)
+            .filter(BibAreasTypes.type_code.in_(["COM", "DEP"]))
+            .all()
+        )
+        filters = {f"area_{type_code}": [id_area] for id_area, type_code in areas}
+        assert len(filters) == 2
+
+        query = self.get_query(dict(filters), semi_joins=True)
+
+        assert "EXISTS" in str(query)
+        assert "JOIN" not in str(query)
+        ids = [id_synthese for (id_synthese,) in db.session.execute(query)]
+        assert len(ids) == len(set(ids))
+        assert set(ids) == {
+            id_synthese for (id_synthese,) in db.session.execute(self.get_query(dict(filters)))
+        }
+        assert obs.id_synthese in ids
+
+    def test_organism_filter_subquery(self, synthese_data, users):
+        id_organism = users["user"].id_organisme
+
+        query = self.get_query({"id_organism": [id_organism]})
+
+        assert "cor_dataset_actor" in str(query)
+        ids = {id_synthese for (id_synthese,) in db.session.execute(query)}
+        assert synthese_data["obs1"].id_synthese in ids
+
+    def test_observers_filter_trigram_index(self, synthese_for_observers):
+        query = self.get_query({"observers": "Camillé"})
+        assert len(db.session.execute(query).fetchall()) == 2
+
+        # the plan for a large synthese, where a sequential scan is not worth it
+        db.session.execute("SET LOCAL enable_seqscan = off")
+        plan = explain(query)
+
+        assert "i_synthese_observers_unaccent_trgm" in {
+            node.get("Index Name") for node in iter_plan_nodes(plan)
+        }
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestCorAreaSyntheseJobs:
+    def create_area(self, obs, code):
+        area_type = BibAreasTypes.query.filter_by(type_code="COM").one()
+        with db.session.begin_nested():
+            area = LAreas(
+                id_type=area_type.id_type,
+                area_name=code,
+                area_code=code,
+                geom=func.ST_Buffer(func.ST_Transform(obs.the_geom_4326, 2154), 10),
+                enable=True,
+            )
+            db.session.add(area)
+        return area
+
+    def is_attached(self, obs, area):
+        return db.session.query(
+            CorAreaSynthese.query.filter_by(
+                id_synthese=obs.id_synthese, id_area=area.id_area
+            ).exists()
+        ).scalar()
+
+    def test_attach_areas(self, synthese_data):
+        obs = synthese_data["obs1"]
+        assert get_cor_area_mode() == "immediate"
+
+        set_cor_area_mode("defer")
+        area = self.create_area(obs, "deferred")
+        assert not self.is_attached(obs, area)
+        assert get_nb_pending_areas() >= 1
+
+        job = create_attach_job(tile_size=1000)
+        assert area.id_area in job.id_areas
+        assert get_nb_pending_areas() == 0
+        # the 20m wide area is covered by 1 to 4 tiles
+        assert 1 <= len(job.chunks) <= 4
+        assert get_unfinished_attach_job() == job
+
+        # process the first tile only, as if the job were interrupted
+        attach_chunk(job.chunks[0])
+        assert len(job.pending_chunks) == len(job.chunks) - 1
+        for chunk in job.pending_chunks:
+            attach_chunk(chunk)
+        assert self.is_attached(obs, area)
+        db.session.refresh(job)
+        assert job.end_date is not None
+        assert get_unfinished_attach_job() is None
+        assert create_attach_job(tile_size=1000) is None
+
+        set_cor_area_mode("immediate")
+        area = self.create_area(obs, "immediate")
+        assert self.is_attached(obs, area)
+        assert get_nb_pending_areas() == 0
+
+    def test_attach_areas_chunk_failure(self, synthese_data, monkeypatch):
+        obs = synthese_data["obs1"]
+        set_cor_area_mode("defer")
+        area = self.create_area(obs, "deferred")
+        job = create_attach_job(tile_size=100000)
+        (chunk,) = job.chunks
+
+        def fail(chunk):
+            raise ValueError("tile failure")
+
+        monkeypatch.setattr("geonature.core.gn_synthese.tasks.attach_chunk", fail)
+        attach_areas_chunk(job.id_job, chunk.id_chunk)
+        assert count_attach_chunks(job.id_job) == (0, 1)
+        db.session.refresh(chunk)
+        assert chunk.error == "tile failure"
+        assert not self.is_attached(obs, area)
+
+        monkeypatch.undo()
+        attach_areas_chunk(job.id_job, chunk.id_chunk)
+        assert count_attach_chunks(job.id_job) == (1, 0)
+        assert self.is_attached(obs, area)
+        set_cor_area_mode("immediate")
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestSyntheseRollups:
+    def nb_obs(self, obs, cd_nom):
+        return (
+            TStatsTaxa.query.filter_by(id_dataset=obs.id_dataset, cd_nom=cd_nom)
+            .with_entities(TStatsTaxa.nb_obs)
+            .scalar()
+        )
+
+    def test_stats_triggers(self, synthese_data):
+        obs = synthese_data["p3_af3"]
+        assert self.nb_obs(obs, 2497) == 1
+
+        with db.session.begin_nested():
+            obs.cd_nom = 212
+        # the empty row of the previous taxon is removed
+        assert self.nb_obs(obs, 2497) is None
+        assert self.nb_obs(obs, 212) == 1
+
+        with db.session.begin_nested():
+            db.session.delete(obs)
+        assert self.nb_obs(obs, 212) is None
+
+    def test_rollup_triggers(self, synthese_data):
+        obs = synthese_data["p3_af3"]
+
+        set_rollup_triggers(False)
+        with db.session.begin_nested():
+            obs.cd_nom = 212
+        assert self.nb_obs(obs, 2497) == 1
+
+        set_rollup_triggers(True)
+        assert self.nb_obs(obs, 2497) is None
+        assert self.nb_obs(obs, 212) == 1
@@ -0,0 +1,159 @@
+import io
+import json
+import os
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import fiona
+import pytest
+import sqlalchemy as sa
+from geoalchemy2.types import Geometry
+from geoalchemy2.shape import from_shape, to_shape
+from shapely.geometry import LineString, MultiPoint, Point, Polygon, mapping
+
+from geonature.utils.errors import GeonatureApiError
+from geonature.utils.streaming import generate_zip
+from geonature.utils.utilsgeometry import FionaGeoWriter, FionaShapeService
+
+Row = namedtuple("Row", ["id", "label", "count", "geom", "geojson"])
+
+DB_COLS = [
+    sa.Column("id", sa.Integer),
+    sa.Column("label", sa.Unicode),
+    sa.Column("count", sa.Integer),
+    sa.Column("geom", Geometry("GEOMETRY", 2154)),
+]
+
+
+class View:
+    """Stand-in for a GenericTable"""
+
+    def as_dict(self, row, columns=None):
+        return {col: getattr(row, col) for col in columns or ("id", "label", "count")}
+
+
+def make_rows(nb):
+    geoms = [
+        Point(700000, 6600000),
+        LineString([(700000, 6600000), (700100, 6600100)]),
+        Polygon([(700000, 6600000), (700100, 6600000), (700100, 6600100)]),
+    ]
+    return [
+        Row(
+            i,
+            f"obs {i}",
+            i % 10,
+            from_shape(geoms[i % 3], srid=2154),
+            None,
+        )
+        for i in range(nb)
+    ]
+
+
+def write(dir_path, rows, export_format="shp", chunk_size=1000):
+    view = View()
+    with FionaGeoWriter(
+        dir_path, "export", DB_COLS, 2154, export_format=export_format, chunk_size=chunk_size
+    ) as writer:
+        writer.write(rows, geometry=lambda row: row.geom, properties=view.as_dict)
+    return writer.files
+
+
+class TestFionaGeoWriter:
+    def test_shapefiles(self, tmp_path):
+        files = write(tmp_path, make_rows(10), chunk_size=4)
+
+        names = {name for _, name in files}
+        for prefix in ("POINT", "POLYLINE", "POLYGON"):
+            assert {f"{prefix}_export.{ext}" for ext in ("shp", "shx", "dbf", "prj")} <= names
+        with fiona.open(str(tmp_path / "POINT_export.shp")) as collection:
+            records = list(collection)
+        assert [r["properties"]["id"] for r in records] == [0, 3, 6, 9]
+        assert records[1]["properties"]["label"] == "obs 3"
+        with fiona.open(str(tmp_path / "POLYGON_export.shp")) as collection:
+            assert len(collection) == 3
+
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(generate_zip(files))))
+        assert set(archive.namelist()) == names
+        assert archive.testzip() is None
+
+    def test_geopackage(self, tmp_path):
+        rows = make_rows(6)
+        (path, name), *others = write(tmp_path, rows, export_format="gpkg")
+
+        assert name == "export.gpkg" and not others
+        with fiona.open(str(path)) as collection:
+            assert sorted(r["properties"]["id"] for r in collection) == list(range(6))
+
+    def test_empty_geopackage(self, tmp_path):
+        ((path, _),) = write(tmp_path, [], export_format="gpkg")
+
+        with fiona.open(str(path)) as collection:
+            assert len(collection) == 0
+
+    def test_multipoint(self, tmp_path):
+        row = Row(1, "obs", 1, from_shape(MultiPoint([(0, 0), (1, 1)]), srid=2154), None)
+
+        files = write(tmp_path, [row])
+
+        assert "MULTIPOINT_export.shp" in {name for _, name in files}
+
+    def test_no_geometry(self, tmp_path):
+        with pytest.raises(GeonatureApiError):
+            write(tmp_path, [Row(1, "obs", 1, None, None)])
+
+    def test_concurrent_writers(self, tmp_path):
+        rows = make_rows(300)
+        dirs = [tmp_path / str(i) for i in range(4)]
+        for dir_path in dirs:
+            dir_path.mkdir()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda d: write(d, rows, chunk_size=50), dirs))
+
+        for dir_path, files in zip(dirs, results):
+            assert all(path.parent == dir_path for path, _ in files)
+            with fiona.open(str(dir_path / "POINT_export.shp")) as collection:
+                assert len(collection) == 100
+
+
+@pytest.mark.skipif(
+    not os.environ.get("GEONATURE_BENCHMARK"), reason="set GEONATURE_BENCHMARK=1 to run"
+)
+def test_benchmark_shapefile_writers(tmp_path):
+    """
+    Compare FionaGeoWriter with FionaShapeService, for the WKB geometries path
+    and the GeoJSON path (the geometries are decoded from ST_AsGeoJSON output)
+
+    GEONATURE_BENCHMARK=1 pytest -s tests/test_utilsgeometry.py -k benchmark
+    """
+    nb = int(os.environ.get("GEONATURE_BENCHMARK_ROWS", 30000))
+    rows = [row._replace(geojson=json.dumps(mapping(to_shape(row.geom)))) for row in make_rows(nb)]
+    view = View()
+    timings = {}
+
+    def legacy(dir_path, geojson_col):
+        FionaShapeService.create_shapes_struct(DB_COLS, 2154, str(dir_path), "export")
+        FionaShapeService.create_features_generic(view, rows, "geom", geojson_col)
+        FionaShapeService.save_and_zip_shapefiles()
+
+    def batched(dir_path):
+        files = write(dir_path, rows)
+        for _ in generate_zip(files):
+            pass
+
+    for name, fn in (
+        ("FionaShapeService (WKB)", lambda d: legacy(d, None)),
+        ("FionaShapeService (GeoJSON)", lambda d: legacy(d, "geojson")),
+        ("FionaGeoWriter", batched),
+    ):
+        dir_path = tmp_path / name.replace(" ", "_")
+        dir_path.mkdir()
+        start = time.perf_counter()
+        fn(dir_path)
+        timings[name] = time.perf_counter() - start
+
+    for name, duration in timings.items():
+        print(f"{name}: {duration:.2f}s for {nb} features ({nb / duration:.0f} features/s)")
@@ -2,9 +2,10 @@ import pytest
 from datetime import datetime, timedelta
 import sqlalchemy as sa
 from flask import url_for
-from werkzeug.exceptions import Unauthorized, BadRequest
+from werkzeug.exceptions import Unauthorized, BadRequest, Forbidden, NotFound
 
 from geonature.core.gn_synthese.models import Synthese
+from geonature.core.gn_commons.models import TValidations
 from geonature.utils.env import db
 from geonature.utils.config import config
 
@@ -30,6 +31,18 @@ class TestValidation:
         assert response.status_code == 200
         assert len(response.json["features"]) >= len(synthese_data)
 
+    def test_get_synthese_data_cursor(self, users, synthese_data):
+        set_logged_user_cookie(self.client, users["self_user"])
+        url = url_for("validation.get_synthese_data")
+        response = self.client.post(url, json={"limit": 1, "count": "exact"})
+        assert response.status_code == 200
+        assert response.json["nb_total"] >= 1
+        first_page = [f["id"] for f in response.json["features"]]
+        assert len(first_page) == 1
+        response = self.client.post(url, json={"limit": 1, "cursor": response.json["next_cursor"]})
+        assert response.status_code == 200
+        assert first_page[0] not in [f["id"] for f in response.json["features"]]
+
     def test_get_status_names(self, users, synthese_data):
         response = self.client.get(url_for("validation.get_statusNames"))
         assert response.status_code == Unauthorized.code
@@ -68,6 +81,94 @@ class TestValidation:
         assert response.status_code == 200
         assert abs(datetime.fromisoformat(response.json) - validation_date) < timedelta(seconds=2)
 
+    def test_add_validation_status_bulk(self, users, synthese_data):
+        set_logged_user_cookie(self.client, users["user"])
+        id_nomenclature_valid_status = TNomenclatures.query.filter(
+            sa.and_(
+                TNomenclatures.cd_nomenclature == "1",
+                TNomenclatures.nomenclature_type.has(mnemonique="STATUT_VALID"),
+            )
+        ).one()
+        observations = [synthese_data["obs1"], synthese_data["obs2"]]
+        data = {
+            "id_synthese": [s.id_synthese for s in observations],
+            "statut": id_nomenclature_valid_status.id_nomenclature,
+            "comment": "bulk",
+        }
+
+        response = self.client.post(url_for("validation.post_bulk_status"), json=data)
+        assert response.status_code == 200
+        assert response.json["nb_validations"] == len(observations)
+        for synthese in observations:
+            validation = (
+                TValidations.query.filter_by(uuid_attached_row=synthese.unique_id_sinp)
+                .order_by(TValidations.validation_date.desc())
+                .first()
+            )
+            assert validation.validation_comment == "bulk"
+            assert (
+                validation.id_nomenclature_valid_status
+                == id_nomenclature_valid_status.id_nomenclature
+            )
+
+        data["id_synthese"] = ["a"]
+        response = self.client.post(url_for("validation.post_bulk_status"), json=data)
+        assert response.status_code == BadRequest.code
+
+        data["id_synthese"] = [
+            observations[0].id_synthese,
+            db.session.query(sa.func.max(Synthese.id_synthese)).scalar() + 1,
+        ]
+        response = self.client.post(url_for("validation.post_bulk_status"), json=data)
+        assert response.status_code == NotFound.code
+
+    @pytest.mark.parametrize(
+        "username,allowed,forbidden",
+        [
+            # scope 1: digitiser of all synthese_data observations
+            ("self_user", "obs1", "p1_af1"),
+            # scope 2: own_dataset belongs to the organism, belong_af_1 does not
+            ("associate_user", "obs1", "p1_af1"),
+        ],
+    )
+    def test_add_validation_status_scope(self, users, synthese_data, username, allowed, forbidden):
+        with db.session.begin_nested():
+            synthese_data["p1_af1"].digitiser = users["stranger_user"]
+            synthese_data["p1_af1"].cor_observers = []
+        set_logged_user_cookie(self.client, users[username])
+        id_nomenclature_valid_status = TNomenclatures.query.filter(
+            sa.and_(
+                TNomenclatures.cd_nomenclature == "1",
+                TNomenclatures.nomenclature_type.has(mnemonique="STATUT_VALID"),
+            )
+        ).one()
+        data = {
+            "statut": id_nomenclature_valid_status.id_nomenclature,
+            "comment": "scope",
+        }
+        allowed = synthese_data[allowed].id_synthese
+        forbidden = synthese_data[forbidden].id_synthese
+
+        response = self.client.post(
+            url_for("validation.post_status", id_synthese=allowed), data=data
+        )
+        assert response.status_code == 200
+        response = self.client.post(
+            url_for("validation.post_status", id_synthese=forbidden), data=data
+        )
+        assert response.status_code == Forbidden.code
+
+        response = self.client.post(
+            url_for("validation.post_bulk_status"), json={**data, "id_synthese": [allowed]}
+        )
+        assert response.status_code == 200
+        assert response.json["nb_validations"] == 1
+        response = self.client.post(
+            url_for("validation.post_bulk_status"),
+            json={**data, "id_synthese": [allowed, forbidden]},
+        )
+        assert response.status_code == Forbidden.code
+
     def test_get_validation_history(self, users, synthese_data):
         set_logged_user_cookie(self.client, users["user"])
         response = self.client.get(url_for("gn_commons.get_hist", uuid_attached_row="invalid"))
@@ -1,4 +1,38 @@
+import time
+
+import click
 from celery import Celery
 
+from geonature.utils.env import db
+
 
 celery_app = Celery("geonature")
+
+
+def wait_for_chunks(count_chunks, nb_chunks, label, timeout=None, interval=1):
+    """
+    Show the progress of chunks dispatched to the celery workers, until they are
+    all processed or one of them failed.
+
+    :param count_chunks: function returning the numbers of (processed, failed) chunks
+    :param nb_chunks: number of dispatched chunks
+    :param timeout: seconds without any processed chunk (no worker running...)
+        before giving up, no limit if None
+    :returns: tuple (number of processed chunks, number of failed chunks)
+    :raises TimeoutError: no chunk processed for `timeout` seconds
+    """
+    done, failed = 0, 0
+    last_progress = time.monotonic()
+    with click.progressbar(length=nb_chunks, label=label) as bar:
+        while done < nb_chunks and not failed:
+            time.sleep(interval)
+            now_done, failed = count_chunks()
+            # end the read transaction, so it is not kept open during the whole processing
+            db.session.rollback()
+            if now_done > done:
+                bar.update(now_done - done)
+                done = now_done
+                last_progress = time.monotonic()
+            elif timeout is not None and time.monotonic() - last_progress > timeout:
+                raise TimeoutError(f"No chunk processed for {timeout} seconds")
+    return done, failed
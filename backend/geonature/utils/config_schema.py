@@ -11,7 +11,7 @@ from marshmallow import (
     ValidationError,
     post_load,
 )
-from marshmallow.validate import OneOf, Regexp, Email, Length
+from marshmallow.validate import OneOf, Regexp, Email, Length, Range
 
 from geonature.core.gn_synthese.synthese_config import (
     DEFAULT_EXPORT_COLUMNS,
@@ -71,6 +71,12 @@ class MTDSchemaConf(Schema):
     JDD_MODULE_CODE_ASSOCIATION = fields.List(fields.String, load_default=["OCCTAX", "OCCHAB"])
     ID_INSTANCE_FILTER = fields.Integer(load_default=None)
     SYNC_LOG_LEVEL = fields.String(load_default="INFO")
+    # Nombre de requêtes simultanées vers les web services MTD et CAS
+    SYNC_MAX_WORKERS = fields.Integer(load_default=8, validate=Range(min=1))
+    # Nombre de tentatives en cas d’erreur de connexion ou d’erreur serveur
+    SYNC_MAX_RETRIES = fields.Integer(load_default=3, validate=Range(min=0))
+    # Délai d’attente d’une réponse, en secondes
+    SYNC_TIMEOUT = fields.Integer(load_default=60)
 
 
 class BddConfig(Schema):
@@ -106,6 +112,16 @@ class CeleryConfig(Schema):
     timezone = fields.String(load_default=None)
 
 
+class PermissionsCacheConfig(Schema):
+    # Durée (en secondes) de mise en cache des permissions d'un rôle, 0 (défaut) pour désactiver
+    # le cache
+    TTL = fields.Integer(load_default=0)
+    # URL d'un serveur Redis (ex : redis://localhost:6379/1) pour partager le cache entre
+    # les processus, sinon le cache est propre à chaque processus et n'est vidé que dans le
+    # processus ayant modifié les permissions
+    REDIS_URL = fields.String(load_default=None)
+
+
 class AccountManagement(Schema):
     # Config for sign-up
     ENABLE_SIGN_UP = fields.Boolean(load_default=False)
@@ -208,6 +224,9 @@ class GnPySchemaConf(Schema):
     MAIL_ON_ERROR = fields.Boolean(load_default=False)
     MAIL_CONFIG = fields.Nested(MailConfig, load_default=MailConfig().load({}))
     CELERY = fields.Nested(CeleryConfig, load_default=CeleryConfig().load({}))
+    PERMISSIONS_CACHE = fields.Nested(
+        PermissionsCacheConfig, load_default=PermissionsCacheConfig().load({})
+    )
     METADATA = fields.Nested(MetadataConfig, load_default=MetadataConfig().load({}))
     ADMIN_APPLICATION_LOGIN = fields.String()
     ACCOUNT_MANAGEMENT = fields.Nested(
@@ -379,6 +398,12 @@ class Synthese(Schema):
     EXPORT_FORMAT = fields.List(fields.String(), load_default=["csv", "geojson", "shapefile"])
     # Nombre max d'observation dans les exports
     NB_MAX_OBS_EXPORT = fields.Integer(load_default=50000)
+    # Nombre max d'observation dans les exports asynchrones (traités par celery)
+    NB_MAX_OBS_EXPORT_JOB = fields.Integer(load_default=500000)
+    # Conservation des fichiers d'export, réutilisés pour les demandes identiques :
+    # durée en secondes depuis la dernière utilisation et taille totale maximale en Mo
+    EXPORT_CACHE_MAX_AGE = fields.Integer(load_default=86400)
+    EXPORT_CACHE_MAX_SIZE = fields.Integer(load_default=1024, allow_none=True)
 
     # --------------------------------------------------------------------
     # SYNTHESE - OBSERVATION DETAILS
@@ -396,6 +421,8 @@ class Synthese(Schema):
 
     # Nombre max d'observation à afficher sur la carte
     NB_MAX_OBS_MAP = fields.Integer(load_default=50000)
+    # Nombre max d'observation par tuile vectorielle (route /synthese/tiles)
+    NB_MAX_OBS_TILE = fields.Integer(load_default=20000)
     # Clusteriser les layers sur la carte
     ENABLE_LEAFLET_CLUSTER = fields.Boolean(load_default=True)
     # Nombre des "dernières observations" affichées à l'arrivée sur la synthese
@@ -559,6 +586,8 @@ class GnGeneralSchemaConf(Schema):
     NOTIFICATIONS_ENABLED = fields.Boolean(load_default=True)
     PROFILES_REFRESH_CRONTAB = fields.String(load_default="0 3 * * *")
     MEDIA_CLEAN_CRONTAB = fields.String(load_default="0 1 * * *")
+    EXPORT_CACHE_CLEAN_CRONTAB = fields.String(load_default="0 * * * *")
+    DATASET_STATS_REFRESH_CRONTAB = fields.String(load_default="*/15 * * * *")
 
     @validates_schema
     def validate_enable_sign_up(self, data, **kwargs):
@@ -0,0 +1,151 @@
+"""
+    Stockage des fichiers d'export déjà générés
+
+    Les fichiers sont rangés sous une clé calculée à partir de ce qui détermine
+    leur contenu (filtres, permissions, format, version des données) : une demande
+    identique réutilise le fichier au lieu de le regénérer.
+    Les fichiers sont supprimés par la tâche périodique de nettoyage
+    (voir :meth:`ExportArtifactStore.clean`).
+"""
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+from flask import current_app
+
+
+TMP_SUFFIX = ".tmp"
+
+
+def link_file(src, dest):
+    """
+    Crée dest comme lien physique vers src, ou comme copie si le lien
+    n'est pas possible (systèmes de fichiers différents)
+    """
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class ExportArtifactStore:
+    """
+    Fichiers d'export indexés par une clé
+
+    :param root: répertoire des fichiers
+    :param secret: secret utilisé pour signer les clés : le répertoire pouvant
+        être servi publiquement, les noms de fichiers ne doivent pas être devinables
+    :param max_age: durée de conservation d'un fichier non utilisé, en secondes
+    :param max_size: taille totale maximale des fichiers, en octets
+    """
+
+    #: nom, sans extension, des fichiers contenus dans les archives : un fichier est
+    #: partagé entre plusieurs demandes, il ne doit pas contenir le nom de l'une d'elles
+    file_name = "export"
+
+    def __init__(self, root, secret, max_age=None, max_size=None):
+        self.root = Path(root)
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def key(self, *parts):
+        """Clé des paramètres donnés, qui doivent être sérialisables en JSON"""
+        message = json.dumps(parts, sort_keys=True, default=str).encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def path(self, key, ext):
+        return self.root / f"{key}.{ext}"
+
+    def get(self, key, ext):
+        """
+        Chemin du fichier de la clé, ou None s'il n'existe pas.
+        La date de modification du fichier est mise à jour : elle sert de date
+        de dernière utilisation lors du nettoyage.
+        """
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, ext, write):
+        """
+        Génère le fichier de la clé
+
+        Le fichier est écrit par ``write(path)`` dans un fichier temporaire,
+        puis renommé : un export concurrent de la même clé ne voit jamais
+        un fichier incomplet.
+
+        :returns: chemin du fichier
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.root / f"{key}.{uuid.uuid4().hex}{TMP_SUFFIX}"
+        try:
+            write(tmp_path)
+            path = self.path(key, ext)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return path
+
+    def clean(self, now=None):
+        """
+        Supprime les fichiers non utilisés depuis plus de max_age secondes,
+        puis les moins récemment utilisés tant que la taille totale dépasse max_size.
+
+        :returns: nombre de fichiers supprimés
+        """
+        if not self.root.is_dir():
+            return 0
+        now = time.time() if now is None else now
+        files = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        files.sort()
+
+        removed, kept = [], []
+        for mtime, size, path in files:
+            if self.max_age is not None and now - mtime > self.max_age:
+                removed.append(path)
+            else:
+                kept.append((mtime, size, path))
+        if self.max_size is not None:
+            total_size = sum(size for _, size, _ in kept)
+            for mtime, size, path in kept:
+                if total_size <= self.max_size:
+                    break
+                # fichiers en cours d'écriture : supprimés seulement quand ils expirent
+                if path.name.endswith(TMP_SUFFIX):
+                    continue
+                removed.append(path)
+                total_size -= size
+
+        for path in removed:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        return len(removed)
+
+
+def get_export_store():
+    """Stockage des exports de GeoNature, dans MEDIA_FOLDER/exports/artifacts"""
+    config = current_app.config
+    max_size = config["SYNTHESE"]["EXPORT_CACHE_MAX_SIZE"]
+    return ExportArtifactStore(
+        Path(config["MEDIA_FOLDER"]) / "exports" / "artifacts",
+        config["SECRET_KEY"],
+        max_age=config["SYNTHESE"]["EXPORT_CACHE_MAX_AGE"],
+        max_size=max_size * 1024 * 1024 if max_size is not None else None,
+    )
@@ -0,0 +1,127 @@
+"""
+    Keyset (seek) pagination helpers
+
+    Instead of skipping `offset` rows, a page starts right after the last row
+    of the previous page, identified by the values of the ordering columns.
+    These values are given to the client as an opaque cursor, so that each page
+    is fetched with the same cost whatever its depth.
+"""
+import base64
+import datetime
+import json
+
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from werkzeug.exceptions import BadRequest
+
+from geonature.utils.env import db
+
+
+COUNT_MODES = ("exact", "estimate", "none")
+
+
+def encode_cursor(key):
+    """Encode the ordering values of the last row of a page"""
+    values = [
+        value.isoformat() if isinstance(value, (datetime.date, datetime.time)) else value
+        for value in key
+    ]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _parse_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, sa.DateTime):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(column.type, sa.Date):
+        return datetime.date.fromisoformat(value)
+    if isinstance(column.type, sa.Integer):
+        return int(value)
+    return value
+
+
+def decode_cursor(cursor, columns):
+    """
+    Decode a cursor given by :func:`encode_cursor` into the values of `columns`
+
+    :raises BadRequest: if the cursor is invalid
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        return tuple(_parse_value(column, value) for column, value in zip(columns, values))
+    except (TypeError, ValueError):
+        raise BadRequest(f"Invalid cursor '{cursor}'")
+
+
+def keyset_filter(columns, key, descending=True):
+    """
+    Condition selecting the rows following `key` when ordering by `columns`.
+
+    Rows must be ordered by all `columns` in the same direction, and the last
+    column must be unique, e.g. ``ORDER BY date_min DESC, id_synthese DESC``.
+    A row comparison is used, so that a multicolumn index can be used by PostgreSQL.
+    """
+    row = sa.tuple_(*columns)
+    key = sa.tuple_(*[sa.literal(value, type_=column.type) for column, value in zip(columns, key)])
+    return row < key if descending else row > key
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN (FORMAT JSON) of a statement
+
+    The statement is compiled and executed as usual, so that its parameters
+    are processed by the bind processors of their types (geometries, enums...).
+    """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def estimate_count(query):
+    """
+    Number of rows of `query` estimated by the PostgreSQL planner.
+
+    Much cheaper than a count(*) on big tables, but may be quite inaccurate
+    with complex filters: use it for display purpose only.
+    """
+    if isinstance(query, Query):
+        query = query.statement
+    plan = db.session.execute(Explain(query)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def count_rows(query, count_mode):
+    """Count the rows of `query` according to `count_mode` (None if "none")"""
+    if count_mode == "estimate":
+        return estimate_count(query)
+    if count_mode == "exact":
+        if isinstance(query, Query):
+            return query.order_by(None).count()
+        return db.session.execute(
+            sa.select([sa.func.count()]).select_from(query.order_by(None).alias())
+        ).scalar()
+    return None
+
+
+def check_count_mode(count_mode):
+    """
+    Check the count mode requested by the client: "exact", "estimate" or "none"
+
+    :raises BadRequest: if the count mode is unknown
+    """
+    if count_mode not in COUNT_MODES:
+        raise BadRequest(f"Bad count mode '{count_mode}', expected one of {COUNT_MODES}")
+    return count_mode
@@ -0,0 +1,165 @@
+"""
+    Helpers to stream query results to the client
+    without loading the whole result set in memory
+"""
+import csv
+import io
+import json
+import zipfile
+from itertools import chain
+
+from flask import Response, stream_with_context
+from werkzeug.datastructures import Headers
+
+from geonature.utils.env import db
+
+
+def iter_results(query, batch_size=1000):
+    """
+    Execute a select with a server-side cursor and yield its rows
+    while fetching them by batch of `batch_size`.
+    """
+    results = db.session.execute(query.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = results.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        results.close()
+
+
+def generate_csv(columns, data, separator=";", chunk_size=64 * 1024):
+    """
+    Generator version of utils_flask_sqla generate_csv_content:
+    yield the CSV content by chunks of about `chunk_size` characters.
+    """
+    fp = io.StringIO()
+    writer = csv.DictWriter(
+        fp, columns, delimiter=separator, quoting=csv.QUOTE_ALL, extrasaction="ignore"
+    )
+    writer.writeheader()
+    for line in data:
+        writer.writerow(line)
+        if fp.tell() >= chunk_size:
+            yield fp.getvalue()
+            fp.seek(0)
+            fp.truncate()
+    yield fp.getvalue()
+
+
+def generate_geojson(features, chunk_size=64 * 1024, members=None):
+    """
+    Yield a GeoJSON FeatureCollection by chunks.
+
+    `features` is an iterable of (geometry, properties) tuples,
+    where geometry is a GeoJSON string (as returned by ST_AsGeoJSON) or None
+    and properties a json serializable dict or an already encoded JSON string.
+    JSON strings are inserted as is to avoid decoding / re-encoding them.
+
+    `members` is an optional callable returning a dict of foreign members
+    (e.g. pagination infos), called once all features have been consumed.
+    """
+    buffer = ['{"type": "FeatureCollection", "features": [']
+    size = 0
+    separator = ""
+    for geometry, properties in features:
+        feature = '{}{{"type": "Feature", "geometry": {}, "properties": {}}}'.format(
+            separator,
+            geometry if geometry else "null",
+            properties
+            if isinstance(properties, str)
+            else json.dumps(properties, ensure_ascii=False),
+        )
+        separator = ", "
+        buffer.append(feature)
+        size += len(feature)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    buffer.append("]")
+    for key, value in (members() if members else {}).items():
+        buffer.append(", {}: {}".format(json.dumps(key), json.dumps(value, ensure_ascii=False)))
+    buffer.append("}")
+    yield "".join(buffer)
+
+
+def to_csv_stream_resp(filename, data, columns, separator=";", header=""):
+    """
+    Streamed equivalent of utils_flask_sqla to_csv_resp
+
+    `header` is an optional text written before the CSV content.
+    """
+    headers = Headers()
+    headers.add("Content-Type", "text/plain")
+    headers.add("Content-Disposition", "attachment", filename="export_%s.csv" % filename)
+    return Response(
+        stream_with_context(chain([header], generate_csv(columns, data, separator))),
+        headers=headers,
+    )
+
+
+def to_geojson_stream_resp(filename, features):
+    """
+    Return a streamed GeoJSON FeatureCollection as a file attachment,
+    see :func:`generate_geojson` for the `features` format.
+    """
+    headers = Headers()
+    headers.add("Content-Disposition", "attachment", filename="export_%s.json" % filename)
+    return Response(
+        stream_with_context(generate_geojson(features)),
+        mimetype="application/json",
+        headers=headers,
+    )
+
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable file object keeping what is written to it until popped"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        return len(b)
+
+    def pop(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def generate_file(path, chunk_size=1024 * 1024):
+    """Yield the content of a file by chunks"""
+    with open(path, "rb") as fp:
+        yield from iter(lambda: fp.read(chunk_size), b"")
+
+
+def generate_zip(files, chunk_size=1024 * 1024):
+    """
+    Yield a zip archive of the given (path, name in the archive) files by chunks,
+    without writing the archive on disk.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_DEFLATED) as zp_file:
+        for path, arcname in files:
+            # the file size is needed to know whether zip64 extensions are required
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with zp_file.open(zinfo, "w") as dst:
+                for chunk in generate_file(path, chunk_size):
+                    dst.write(chunk)
+                    yield stream.pop()
+    yield stream.pop()
+
+
+def to_file_stream_resp(filename, chunks, mimetype="application/octet-stream"):
+    """Return streamed binary chunks as a file attachment"""
+    headers = Headers()
+    headers.add("Content-Disposition", "attachment", filename=filename)
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
@@ -4,15 +4,19 @@
     Car intégré dans flask-sqla-geo
 """
 import datetime
+import json
 import logging
 import zipfile
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from itertools import islice
+from pathlib import Path
 
 import fiona
 
 from fiona.crs import from_epsg
 from geoalchemy2.shape import to_shape
+from shapely import wkb
 from shapely.geometry import *
 
 from geonature.utils.errors import GeonatureApiError
@@ -268,6 +272,141 @@ class FionaShapeService:
         cls.polyline_shape.close()
 
 
+# Shapefiles can only hold one type of geometry:
+# shapefile prefix and fiona geometry type by geometry type
+SHAPEFILE_PARTITIONS = {
+    "Point": ("POINT", "Point"),
+    "MultiPoint": ("MULTIPOINT", "MultiPoint"),
+    "LineString": ("POLYLINE", "LineString"),
+    "MultiLineString": ("POLYLINE", "LineString"),
+    "Polygon": ("POLYGON", "MultiPolygon"),
+    "MultiPolygon": ("POLYGON", "MultiPolygon"),
+}
+
+
+class FionaGeoWriter:
+    """
+    Write features in shapefiles (one by type of geometry) or in a geopackage
+
+    Contrary to FionaShapeService, the files are held by the instance, so that
+    concurrent exports are safe, and features are written by batches with
+    fiona writerecords, from WKB geometries.
+
+    How to use:
+    with FionaGeoWriter(dir_path, file_name, db_cols, srid) as writer:
+        writer.write(rows, geometry=lambda row: row.geom, properties=view.as_dict)
+    writer.files  # [(path, name in the archive)]
+    """
+
+    def __init__(self, dir_path, file_name, db_cols, srid, export_format="shp", chunk_size=1000):
+        """
+        Parameters:
+            dir_path (str): directory path
+            file_name (str): file name, without extension
+            db_cols (list): columns from a SQLA model or table, the geometry columns are ignored
+            srid (int): epsg code
+            export_format (str): shp or gpkg
+            chunk_size (int): number of features written at once
+        """
+        if export_format not in ("shp", "gpkg"):
+            raise GeonatureApiError(f"Unsupported format {export_format}")
+        self.dir_path = Path(dir_path)
+        self.file_name = file_name
+        self.export_format = export_format
+        self.chunk_size = chunk_size
+        self.crs = from_epsg(srid)
+        self.properties = OrderedDict(
+            (db_col.key, FIONA_MAPPING.get(db_col.type.__class__.__name__.lower()))
+            for db_col in db_cols
+            if not db_col.type.__class__.__name__ == "Geometry"
+        )
+        # opened collections by shapefile prefix, or the geopackage layer
+        self.collections = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_collection(self, geom_type):
+        if self.export_format == "gpkg":
+            # geopackage layers can hold any type of geometry
+            prefix, schema_type = None, "Unknown"
+            path, driver = self.dir_path / f"{self.file_name}.gpkg", "GPKG"
+        else:
+            try:
+                prefix, schema_type = SHAPEFILE_PARTITIONS[geom_type]
+            except KeyError:
+                raise GeonatureApiError(f"Cannot create a shapefile record with a {geom_type}")
+            path, driver = self.dir_path / f"{prefix}_{self.file_name}.shp", "ESRI Shapefile"
+        if prefix not in self.collections:
+            self.collections[prefix] = fiona.open(
+                str(path),
+                "w",
+                driver=driver,
+                schema={"geometry": schema_type, "properties": self.properties},
+                crs=self.crs,
+            )
+        return self.collections[prefix]
+
+    def write_records(self, records):
+        """
+        Write a batch of features
+
+        Parameters:
+            records (iterable): (geometry as WKB, properties dict) tuples
+        """
+        batches = defaultdict(list)
+        for geom, properties in records:
+            if geom is None:
+                raise GeonatureApiError("Cannot create a shapefile record whithout a Geometry")
+            geom = wkb.loads(bytes(getattr(geom, "data", geom)))
+            batches[geom.geom_type].append(
+                {
+                    "geometry": mapping(geom),
+                    "properties": {key: properties.get(key) for key in self.properties},
+                }
+            )
+        for geom_type, features in batches.items():
+            self._get_collection(geom_type).writerecords(features)
+
+    def write(self, rows, geometry, properties):
+        """
+        Write all the rows, by batches of `chunk_size`
+
+        Parameters:
+            rows (iterable): rows, ideally fetched from a server-side cursor
+            geometry (callable): return the WKB geometry of a row
+            properties (callable): return the properties of a row as a dict
+        """
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            self.write_records((geometry(row), properties(row)) for row in chunk)
+
+    def close(self):
+        if self.export_format == "gpkg" and not self.collections:
+            # empty export: still create the geopackage
+            self._get_collection(None)
+        for collection in self.collections.values():
+            collection.close()
+
+    @property
+    def files(self):
+        """Written files, as (path, name in the archive) tuples"""
+        if self.export_format == "gpkg":
+            path = self.dir_path / f"{self.file_name}.gpkg"
+            return [(path, path.name)]
+        return [
+            (path, path.name)
+            for prefix in self.collections
+            for path in sorted(self.dir_path.glob(f"{prefix}_{self.file_name}.*"))
+        ]
+
+
 def create_shapes_generic(view, srid, db_cols, data, dir_path, file_name, geom_col, geojson_col):
     log.warning(
         "WARNING: utilsgemetry will soon be removed from GeoNature.\nPlease use utils_flask_sqla_geo instead\n"
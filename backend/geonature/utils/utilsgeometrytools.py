@@ -2,19 +2,91 @@
     Fonctions permettant de manipuler de façon génériques
     les fonctions de flask_sqla_geo
 """
-from pathlib import Path
+import shutil
+import tempfile
 
-from flask import current_app
+from flask import send_file
+from sqlalchemy import func
 
-from geonature.utils import filemanager
+from geonature.utils.streaming import (
+    generate_file,
+    generate_zip,
+    iter_results,
+    to_file_stream_resp,
+)
+from geonature.utils.utilsgeometry import FionaGeoWriter
 
 
-def export_as_geo_file(export_format, export_view, db_cols, geojson_col, data, file_name):
-    """Fonction générant un fixhier export au format shp ou gpkg
+GEOM_WKB_COL = "geom_wkb"
+GPKG_MIMETYPE = "application/geopackage+sqlite3"
+ZIP_MIMETYPE = "application/zip"
+
+
+def with_wkb_geometry(query, export_view, geojson_col=None):
+    """
+    Ajoute à la requête la géométrie de la colonne geojson_col, ou à défaut de la colonne
+    géométrique de la vue, au format WKB sous le nom GEOM_WKB_COL :
+    elle est lue directement par FionaGeoWriter
+    """
+    if geojson_col is None:
+        geom = export_view.tableDef.c[export_view.geometry_field]
+    else:
+        geom = func.ST_GeomFromGeoJSON(export_view.tableDef.c[geojson_col])
+    return query.column(func.ST_AsBinary(geom).label(GEOM_WKB_COL))
+
+
+def write_geo_file(export_format, export_view, db_cols, data, dir_path, file_name):
+    """Écrit les données dans des shapefiles ou un geopackage
+
+    :param export_format: format d'export
+    :type export_format: str() gpkg ou shp
+
+    :param data: Résultats d'une requête complétée par :func:`with_wkb_geometry`
+    :type data: iterable
+
+    :returns: Fichiers écrits, sous la forme de tuples (chemin, nom dans l'archive)
+    """
+    with FionaGeoWriter(
+        dir_path, file_name, db_cols, export_view.srid, export_format=export_format
+    ) as writer:
+        writer.write(
+            data,
+            geometry=lambda row: getattr(row, GEOM_WKB_COL),
+            properties=lambda row: export_view.as_dict(row, columns=writer.properties),
+        )
+    return writer.files
+
+
+def write_geo_archive(export_format, export_view, db_cols, data, path, file_name):
+    """Écrit les données dans un fichier unique : le geopackage, ou les shapefiles zippés
+
+    :param path: chemin du fichier à écrire
+    :param file_name: nom des fichiers dans l'archive zip, sans extension
+    """
+    with tempfile.TemporaryDirectory() as dir_path:
+        files = write_geo_file(export_format, export_view, db_cols, data, dir_path, file_name)
+        if export_format == "gpkg":
+            shutil.move(str(files[0][0]), str(path))
+        else:
+            with open(path, "wb") as fp:
+                for chunk in generate_zip(files):
+                    fp.write(chunk)
+
+
+def export_as_geo_file(
+    export_format, export_view, db_cols, geojson_col, query, file_name, store=None, key=None
+):
+    """Fonction générant un fichier export au format shp ou gpkg
 
     .. :quickref: Utils;
 
-    Fonction générant un fixhier export au format shp ou gpkg
+    Fonction générant un fichier export au format shp ou gpkg, renvoyé en streaming :
+    les shapefiles sont zippés à la volée.
+    Les fichiers sont écrits dans un répertoire temporaire propre à l'export,
+    supprimé une fois la réponse envoyée.
+    Si un stockage et une clé sont fournis, le fichier est conservé dans le stockage
+    et renvoyé directement pour les demandes suivantes de même clé : file_name n'est
+    alors que le nom du fichier téléchargé.
 
 
     :param export_format: format d'export
@@ -26,35 +98,68 @@ def export_as_geo_file(export_format, export_view, db_cols, geojson_col, data, f
     :param db_cols: Liste des colonnes
     :type db_cols: list
 
-    :param geojson_col: Nom de la colonne contenant le geojson
+    :param geojson_col: Nom de la colonne contenant le geojson, ou None pour utiliser
+        la colonne géométrique de la vue
     :type geojson_col: str
 
-    :param data: Résulats
-    :type data: list
+    :param query: Requête des données à exporter
+    :type query: select
 
-    :param file_name: Résulats
+    :param file_name: Nom du fichier, sans extension
     :type file_name: str
 
-    :returns: Répertoire où sont stockées les données et nom du fichier avec son extension
+    :param store: Stockage des fichiers d'export
+    :type store: ExportArtifactStore
+
+    :param key: Clé de l'export dans le stockage
+    :type key: str
+
+    :returns: Réponse flask
     """
-    if export_format == "gpkg":
-        geo_format = "gpkg"
-        dir_path = Path(current_app.config["MEDIA_FOLDER"]) / "geopackages"
-        dwn_extension = "gpkg"
-    elif export_format == "shapefile":
-        geo_format = "shp"
-        dir_path = Path(current_app.config["MEDIA_FOLDER"]) / "shapefiles"
-        dwn_extension = "zip"
-    dir_path.mkdir(parents=True, exist_ok=True)
-    dir_path = str(dir_path)
-
-    filemanager.delete_recursively(dir_path, excluded_files=[".gitkeep"])
-    export_view.as_geofile(
-        export_format=geo_format,
-        db_cols=db_cols,
-        geojson_col=geojson_col,
-        data=data,
-        dir_path=dir_path,
-        file_name=file_name,
-    )
-    return dir_path, file_name + "." + dwn_extension
+    geo_format = "gpkg" if export_format == "gpkg" else "shp"
+    if store is not None:
+        ext, mimetype = ("gpkg", GPKG_MIMETYPE) if geo_format == "gpkg" else ("zip", ZIP_MIMETYPE)
+        path = store.get(key, ext)
+        if path is None:
+            path = store.put(
+                key,
+                ext,
+                lambda path: write_geo_archive(
+                    geo_format,
+                    export_view,
+                    db_cols,
+                    iter_results(with_wkb_geometry(query, export_view, geojson_col)),
+                    path,
+                    store.file_name,
+                ),
+            )
+        return send_file(
+            path, mimetype=mimetype, as_attachment=True, download_name=f"{file_name}.{ext}"
+        )
+
+    dir_path = tempfile.mkdtemp()
+    try:
+        files = write_geo_file(
+            geo_format,
+            export_view,
+            db_cols,
+            iter_results(with_wkb_geometry(query, export_view, geojson_col)),
+            dir_path,
+            file_name,
+        )
+    except Exception:
+        shutil.rmtree(dir_path, ignore_errors=True)
+        raise
+
+    def generate():
+        try:
+            if geo_format == "gpkg":
+                yield from generate_file(files[0][0])
+            else:
+                yield from generate_zip(files)
+        finally:
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+    if geo_format == "gpkg":
+        return to_file_stream_resp(file_name + ".gpkg", generate(), GPKG_MIMETYPE)
+    return to_file_stream_resp(file_name + ".zip", generate(), ZIP_MIMETYPE)
@@ -7,7 +7,6 @@ from flask import (
     Blueprint,
     current_app,
     session,
-    send_from_directory,
     request,
     render_template,
     jsonify,
@@ -248,15 +247,14 @@ def export_all_habitats(
             FeatureCollection(features), as_file=True, filename=file_name, indent=4
         )
     else:
-        dir_name, file_name = export_as_geo_file(
+        return export_as_geo_file(
             export_format=export_format,
             export_view=export_view,
             db_cols=db_cols_for_shape,
             geojson_col=None,
-            data=results,
+            query=results.statement,
             file_name=file_name,
         )
-        return send_from_directory(dir_name, file_name, as_attachment=True)
 
 
 @blueprint.route("/defaultNomenclatures", methods=["GET"])
@@ -8,20 +8,27 @@ from werkzeug.exceptions import Forbidden
 import sqlalchemy as sa
 from sqlalchemy.orm import aliased, contains_eager, selectinload
 from marshmallow import ValidationError
+from geojson import FeatureCollection
 
 from pypnnomenclature.models import TNomenclatures, BibNomenclaturesTypes
 
 from geonature.utils.env import DB, db
+from geonature.utils.pagination import (
+    check_count_mode,
+    count_rows,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+)
 from geonature.core.gn_synthese.models import Synthese, TReport
 from geonature.core.gn_profiles.models import VConsistancyData
 from geonature.core.gn_synthese.utils.query_select_sqla import SyntheseQuery
 from geonature.core.gn_permissions import decorators as permissions
 from geonature.core.gn_commons.schemas import TValidationSchema
-from geonature.core.gn_commons.models.base import TValidations
 
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, NotFound
 from geonature.core.gn_commons.models import TValidations
-from geonature.core.notifications.utils import dispatch_notifications
+from geonature.core.notifications.utils import dispatch_notifications_batch
 
 
 blueprint = Blueprint("validation", __name__)
@@ -39,10 +46,17 @@ def get_synthese_data(scope):
 
     Parameters:
     ------------
+    limit: int
+        maximum number of observations returned
+    cursor: str
+        get the observations following the page of this ``next_cursor``
+    count: str
+        count of all filtered observations: exact, estimate or none (default)
 
     Returns
     -------
     FeatureCollection
+        with ``next_cursor`` (null if last page) and, if requested, ``nb_total`` members
     """
 
     enable_profile = current_app.config["FRONTEND"]["ENABLE_PROFILES"]
@@ -77,6 +91,8 @@ def get_synthese_data(scope):
     filters = (request.json if request.is_json else None) or {}
 
     result_limit = filters.pop("limit", blueprint.config["NB_MAX_OBS_MAP"])
+    cursor = filters.pop("cursor", None)
+    count_mode = check_count_mode(filters.pop("count", "none"))
     lateral_join = {}
     """
     1) We start creating the query with SQLAlchemy ORM.
@@ -133,7 +149,11 @@ def get_synthese_data(scope):
     for alias in lateral_join.keys():
         query = query.outerjoin(alias, sa.true())
 
-    query = query.filter(Synthese.the_geom_4326.isnot(None)).order_by(Synthese.date_min.desc())
+    # Keyset pagination: observations are ordered by this unique key
+    key_columns = [Synthese.date_min, Synthese.id_synthese]
+    query = query.filter(Synthese.the_geom_4326.isnot(None)).order_by(
+        *[column.desc() for column in key_columns]
+    )
 
     # filter with profile
     if enable_profile:
@@ -160,11 +180,13 @@ def get_synthese_data(scope):
     # Step 2: give SyntheseQuery the Core selectable from ORM query
     assert len(query.selectable.froms) == 1
 
-    query = (
-        SyntheseQuery(Synthese, query.selectable, filters, query_joins=query.selectable.froms[0])
-        .filter_query_all_filters(g.current_user, scope)
-        .limit(result_limit)
-    )
+    query = SyntheseQuery(
+        Synthese, query.selectable, filters, query_joins=query.selectable.froms[0]
+    ).filter_query_all_filters(g.current_user, scope)
+    nb_total = count_rows(query, count_mode)
+    if cursor:
+        query = query.where(keyset_filter(key_columns, decode_cursor(cursor, key_columns)))
+    query = query.limit(result_limit)
 
     # Step 3: Construct Synthese model from query result
     syntheseModelQuery = Synthese.query.options(
@@ -187,10 +209,17 @@ def get_synthese_data(scope):
             selectinload(Synthese.reports).joinedload(TReport.report_type)
         )
 
-    query = syntheseModelQuery.from_statement(query)
+    syntheses = syntheseModelQuery.from_statement(query).all()
 
     # The raise option ensure that we have correctly retrived relationships data at step 3
-    return jsonify(query.as_geofeaturecollection(fields=fields))
+    feature_collection = FeatureCollection([s.as_geofeature(fields=fields) for s in syntheses])
+    feature_collection["next_cursor"] = None
+    if len(syntheses) >= result_limit:
+        last = syntheses[-1]
+        feature_collection["next_cursor"] = encode_cursor((last.date_min, last.id_synthese))
+    if count_mode != "none":
+        feature_collection["nb_total"] = nb_total
+    return jsonify(feature_collection)
 
 
 @blueprint.route("/statusNames", methods=["GET"])
@@ -212,10 +241,7 @@ def get_statusNames():
     )
 
 
-@blueprint.route("/<id_synthese>", methods=["POST"])
-@permissions.check_cruved_scope("C", get_scope=True, module_code="VALIDATION")
-def post_status(scope, id_synthese):
-    data = dict(request.get_json())
+def get_validation_params(data):
     try:
         id_validation_status = data["statut"]
     except KeyError:
@@ -225,52 +251,124 @@ def post_status(scope, id_synthese):
         validation_comment = data["comment"]
     except KeyError:
         raise BadRequest("Missing 'comment'")
+    return validation_status, validation_comment
 
-    id_synthese = id_synthese.split(",")
 
-    for id in id_synthese:
-        # t_validations.id_validation:
+def insert_validations(scope, id_synthese, validation_status, validation_comment):
+    """
+    Validate the observations `id_synthese` at once: permissions are checked
+    with one query, validations inserted with a single INSERT ... SELECT
+    and notifications dispatched by batch. The caller commits.
+    """
+    id_synthese = set(id_synthese)
+    allowed = Synthese.query.filter_by_scope(scope).with_entities(Synthese.id_synthese)
+    observations = (
+        db.session.query(
+            Synthese.id_synthese,
+            Synthese.id_synthese.in_(allowed).label("allowed"),
+        )
+        .filter(Synthese.id_synthese.in_(id_synthese))
+        .all()
+    )
+    if len(observations) != len(id_synthese):
+        raise NotFound(
+            "Observations not found: {}".format(
+                sorted(id_synthese - {obs.id_synthese for obs in observations})
+            )
+        )
+    if not all(obs.allowed for obs in observations):
+        raise Forbidden
 
-        # t_validations.uuid_attached_row:
-        synthese = Synthese.query.get_or_404(int(id))
+    # values shared by all validations are checked once
+    try:
+        validation = TValidationSchema().load(
+            {
+                "id_nomenclature_valid_status": validation_status.id_nomenclature,
+                "id_validator": g.current_user.id_role,
+                "validation_comment": validation_comment,
+                "validation_date": str(datetime.datetime.now()),
+                "validation_auto": False,
+            },
+            instance=TValidations(),
+            session=DB.session,
+        )
+    except ValidationError as error:
+        raise BadRequest(error.messages)
 
-        if not synthese.has_instance_permission(scope):
-            raise Forbidden
+    columns = [
+        "uuid_attached_row",
+        "id_nomenclature_valid_status",
+        "id_validator",
+        "validation_comment",
+        "validation_date",
+        "validation_auto",
+    ]
+    values = sa.select(
+        [Synthese.unique_id_sinp]
+        + [
+            sa.literal(getattr(validation, column), type_=TValidations.__table__.c[column].type)
+            for column in columns[1:]
+        ]
+    ).where(Synthese.id_synthese.in_(id_synthese))
+    validations = db.session.execute(
+        TValidations.__table__.insert()
+        .from_select(columns, values)
+        .returning(*TValidations.__table__.c)
+    ).fetchall()
+
+    # Send elements to notification system
+    validations_by_uuid = {v.uuid_attached_row: v for v in validations}
+    notify_validation_state_changes(
+        (
+            (synthese, validations_by_uuid[synthese.unique_id_sinp])
+            for synthese in Synthese.query.filter(
+                Synthese.id_synthese.in_(id_synthese), Synthese.id_digitiser.isnot(None)
+            )
+        ),
+        validation_status,
+    )
+    return validations
 
-        uuid = synthese.unique_id_sinp
 
-        # t_validations.id_validator:
-        id_validator = g.current_user.id_role
+@blueprint.route("/<id_synthese>", methods=["POST"])
+@permissions.check_cruved_scope("C", get_scope=True, module_code="VALIDATION")
+def post_status(scope, id_synthese):
+    validation_status, validation_comment = get_validation_params(dict(request.get_json()))
+    try:
+        id_synthese = [int(id) for id in id_synthese.split(",")]
+    except ValueError:
+        raise BadRequest("Invalid id_synthese")
 
-        # t_validations.validation_date
-        val_date = datetime.datetime.now()
+    insert_validations(scope, id_synthese, validation_status, validation_comment)
+    DB.session.commit()
 
-        # t_validations.validation_auto
-        val_auto = False
-        val_dict = {
-            "uuid_attached_row": uuid,
-            "id_nomenclature_valid_status": id_validation_status,
-            "id_validator": id_validator,
-            "validation_comment": validation_comment,
-            "validation_date": str(val_date),
-            "validation_auto": val_auto,
-        }
-        # insert values in t_validations
-        validationSchema = TValidationSchema()
-        try:
-            validation = validationSchema.load(
-                val_dict, instance=TValidations(), session=DB.session
-            )
-        except ValidationError as error:
-            raise BadRequest(error.messages)
-        DB.session.add(validation)
+    return jsonify(validation_status.as_dict())
 
-        # Send element to notification system
-        notify_validation_state_change(synthese, validation, validation_status)
 
-        DB.session.commit()
+@blueprint.route("/bulk", methods=["POST"])
+@permissions.check_cruved_scope("C", get_scope=True, module_code="VALIDATION")
+def post_bulk_status(scope):
+    """
+    Set the validation status of many observations in one transaction
 
-    return jsonify(validation_status.as_dict())
+    .. :quickref: Validation;
+
+    JSON body: ``{"id_synthese": [1, 2, ...], "statut": <id_nomenclature>, "comment": "..."}``
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise BadRequest("Missing JSON body")
+    validation_status, validation_comment = get_validation_params(data)
+    id_synthese = data.get("id_synthese")
+    if not isinstance(id_synthese, list) or not all(type(id) == int for id in id_synthese):
+        raise BadRequest("'id_synthese' must be a list of integers")
+    if not id_synthese:
+        raise BadRequest("No observation selected")
+
+    validations = insert_validations(scope, id_synthese, validation_status, validation_comment)
+    DB.session.commit()
+
+    return jsonify({**validation_status.as_dict(), "nb_validations": len(validations)})
 
 
 @blueprint.route("/date/<uuid:uuid>", methods=["GET"])
@@ -289,22 +387,24 @@ def get_validation_date(scope, uuid):
         return "", 204
 
 
-# Send notification
-def notify_validation_state_change(synthese, validation, status):
-    if not synthese.id_digitiser:
-        return
-    dispatch_notifications(
-        code_categories=["VALIDATION-STATUS-CHANGED%"],
-        id_roles=[synthese.id_digitiser],
-        title="Changement de statut de validation",
-        url=(
-            current_app.config["URL_APPLICATION"]
-            + "/#/synthese/occurrence/"
-            + str(synthese.id_synthese),
+# Send notifications
+def notify_validation_state_changes(validated_observations, status):
+    """`validated_observations` is an iterable of (synthese, validation) tuples"""
+    dispatch_notifications_batch(
+        ["VALIDATION-STATUS-CHANGED%"],
+        (
+            (
+                synthese.id_digitiser,
+                "Changement de statut de validation",
+                current_app.config["URL_APPLICATION"]
+                + "/#/synthese/occurrence/"
+                + str(synthese.id_synthese),
+                {
+                    "synthese": synthese,
+                    "validation": validation,
+                    "status": status,
+                },
+            )
+            for synthese, validation in validated_observations
         ),
-        context={
-            "synthese": synthese,
-            "validation": validation,
-            "status": status,
-        },
     )
@@ -6,7 +6,6 @@ from flask import (
     request,
     current_app,
     session,
-    send_from_directory,
     render_template,
     jsonify,
     g,
@@ -40,6 +39,13 @@ from .repositories import (
 from .schemas import OccurrenceSchema, ReleveCruvedSchema, ReleveSchema
 from .utils import as_dict_with_add_cols
 from geonature.utils.errors import GeonatureApiError
+from geonature.utils.pagination import (
+    check_count_mode,
+    count_rows,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+)
 from geonature.utils.utilsgeometrytools import export_as_geo_file
 
 from geonature.core.users.models import UserRigth
@@ -77,6 +83,9 @@ def getReleves(scope):
 
     .. :quickref: Occtax;
 
+    Pagination is done with the ``offset`` page number or, when ordered by
+    date_max, with the ``cursor`` returned as ``next_cursor`` by the previous page.
+    The ``count`` parameter (exact, estimate or none) sets how ``total`` is computed.
     """
 
     releve_repository = ReleveRepository(TRelevesOccurrence)
@@ -86,6 +95,8 @@ def getReleves(scope):
 
     limit = int(parameters.get("limit", 100))
     page = int(parameters.get("offset", 0))
+    cursor = parameters.get("cursor")
+    count_mode = check_count_mode(parameters.get("count", "exact"))
     orderby = {
         "orderby": (parameters.get("orderby", "date_max")).lower(),
         "order": (parameters.get("order", "desc")).lower()
@@ -97,11 +108,29 @@ def getReleves(scope):
     q = get_query_occtax_filters(parameters, TRelevesOccurrence, q)
     query_without_limit = q
     # Order by
-    q = get_query_occtax_order(orderby, TRelevesOccurrence, q)
+    if orderby["orderby"] == "date_max":
+        # Keyset pagination: releves are ordered by this unique key
+        key_columns = [TRelevesOccurrence.date_max, TRelevesOccurrence.id_releve_occtax]
+        descending = orderby["order"] == "desc"
+        q = q.order_by(*[column.desc() if descending else column for column in key_columns])
+        if cursor:
+            q = q.filter(
+                keyset_filter(key_columns, decode_cursor(cursor, key_columns), descending)
+            )
+            page = 0
+    elif cursor:
+        raise BadRequest("Cursor pagination is only available when ordering by date_max")
+    else:
+        key_columns = None
+        q = get_query_occtax_order(orderby, TRelevesOccurrence, q)
     data = q.limit(limit).offset(page * limit).all()
 
     # Pour obtenir le nombre de résultat de la requete sans le LIMIT
-    nb_results_without_limit = query_without_limit.count()
+    nb_results_without_limit = count_rows(query_without_limit, count_mode)
+
+    next_cursor = None
+    if key_columns and len(data) >= limit:
+        next_cursor = encode_cursor((data[-1].date_max, data[-1].id_releve_occtax))
 
     featureCollection = []
     for n in data:
@@ -124,6 +153,7 @@ def getReleves(scope):
         "total_filtered": len(data),
         "page": page,
         "limit": limit,
+        "next_cursor": next_cursor,
         "items": FeatureCollection(featureCollection),
     }
 
@@ -594,7 +624,6 @@ def export(scope):
 
     if current_app.config["OCCTAX"]["ADD_MEDIA_IN_EXPORT"]:
         q, columns = releve_repository.add_media_in_export(q, columns)
-    data = q.all()
 
     file_name = datetime.datetime.now().strftime("%Y_%m_%d_%Hh%Mm%S")
     file_name = filemanager.removeDisallowedFilenameChars(file_name)
@@ -620,6 +649,7 @@ def export(scope):
             columns.remove(export_col_name_additional_data)
         columns = columns + additional_col_names
         columns.append(export_col_name_additional_data)
+        data = q.all()
         if additional_col_names:
             serialize_result = [
                 as_dict_with_add_cols(
@@ -631,6 +661,7 @@ def export(scope):
             serialize_result = [export_view.as_dict(row) for row in data]
         return to_csv_resp(file_name, serialize_result, columns, ";")
     elif export_format == "geojson":
+        data = q.all()
         if additional_col_names:
             features = []
             for row in data:
@@ -652,14 +683,11 @@ def export(scope):
         )
     else:
         db_cols = [db_col for db_col in export_view.db_cols if db_col.key in export_columns]
-        dir_name, file_name = export_as_geo_file(
+        return export_as_geo_file(
             export_format=export_format,
             export_view=export_view,
             db_cols=db_cols,
             geojson_col=None,
-            data=data,
+            query=q.statement,
             file_name=file_name,
         )
-        db_cols = [db_col for db_col in export_view.db_cols if db_col.key in export_columns]
-
-        return send_from_directory(dir_name, file_name, as_attachment=True)
@@ -0,0 +1,32 @@
+"""add index for releves keyset pagination
+
+Revision ID: b5e2c7f1a9d3
+Revises: e170d1902137
+Create Date: 2026-10-18 14:09:12.740316
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "b5e2c7f1a9d3"
+down_revision = "e170d1902137"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "i_t_releves_occtax_date_max_id_releve_occtax",
+        schema="pr_occtax",
+        table_name="t_releves_occtax",
+        columns=["date_max", "id_releve_occtax"],
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "i_t_releves_occtax_date_max_id_releve_occtax",
+        schema="pr_occtax",
+        table_name="t_releves_occtax",
+    )
@@ -387,6 +387,22 @@ export class DataFormService {
     });
   }
 
+  /**
+   * Stats of many acquisition frameworks and datasets in one call
+   * @param params: {id_acquisition_framework: [], id_dataset: []}
+   */
+  getMetadataStats(params: { id_acquisition_framework?: number[]; id_dataset?: number[] }) {
+    let queryString: HttpParams = new HttpParams();
+    for (const key of Object.keys(params)) {
+      for (const id of params[key]) {
+        queryString = queryString.append(key, id);
+      }
+    }
+    return this._http.get<any>(`${this.config.API_ENDPOINT}/meta/stats`, {
+      params: queryString,
+    });
+  }
+
   /**
    * @param id_af: id of acquisition_framework
    */
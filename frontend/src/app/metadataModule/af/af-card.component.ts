@@ -84,7 +84,6 @@ export class AfCardComponent implements OnInit {
         this.getAf();
         this.getTaxaDistribution();
         this.getStats();
-        this.getBbox();
       }
     });
   }
@@ -119,11 +118,11 @@ export class AfCardComponent implements OnInit {
   }
 
   getStats() {
-    this._dfs.getAcquisitionFrameworkStats(this.id_af).subscribe((res) => (this.stats = res));
-  }
-
-  getBbox() {
-    this._dfs.getAcquisitionFrameworkBbox(this.id_af).subscribe((res) => (this.bbox = res));
+    this._dfs.getMetadataStats({ id_acquisition_framework: [this.id_af] }).subscribe((res) => {
+      const { bbox, ...stats } = res.acquisition_frameworks[this.id_af];
+      this.stats = stats;
+      this.bbox = bbox;
+    });
   }
 
   getTaxaDistribution() {